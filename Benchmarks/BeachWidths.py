@@ -0,0 +1,298 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Benchmark and parity check for Transects.GetBeachWidth (waterline
+intersections found through a spatial index by Transects.TransectIntersects,
+tidally corrected for all intersections at once by Transects.TidalCorrection,
+and matched to the nearest-dated veg edge with a merge) against the loops it
+replaced, on seeded synthetic transects, waterlines and veg edge
+intersections. Some waterlines stop short of the transects at either end,
+some cross a transect twice, two images share a date, some transects have
+no veg edges and some waterlines are over 5 months from any veg edge on a
+transect, or exactly between two. The script checks field by field that:
+    - the waterline dates, distances, intersection points, tidally corrected
+      distances, water elevations and tide zones on each transect match
+    - the beach widths on each transect match, including NaN where no veg
+      edge is close enough in time
+and reports the time of each.
+
+The old loops raised when a water elevation fell outside the tidal range of
+the tide file (the tide zone list came up short); these now get no tide zone
+(None), so the synthetic water elevations are kept inside the range.
+
+Run from anywhere with:
+    python Benchmarks/BeachWidths.py
+"""
+
+import os
+import io
+import sys
+import time
+import shutil
+import tempfile
+import contextlib
+import warnings
+warnings.filterwarnings("ignore")
+from datetime import datetime, timedelta
+import numpy as np
+import pandas as pd
+import geopandas as gpd
+from shapely.geometry import LineString
+
+RepoDir = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, RepoDir)
+from Toolshed import Transects, Toolbox
+
+#%% Settings
+
+sitename = 'StAndrews'
+NoTransects = 200
+NoImages = 100
+Spacing = 10 # metres between transects
+AvBeachSlope = 0.1
+EPSG = 32630
+Seed = 0
+
+
+#%% Reference implementation (every transect-waterline pair intersected, values regrouped and matched one at a time)
+
+def OldNearDate(target,items):
+    nearestDate = min(items, key=lambda x: abs(x - target))
+
+    # # if difference is longer than 5 months, no match exists
+    if abs((target - nearestDate).days) > 153:
+        return False
+    else:
+        return nearestDate
+
+
+def OldTidalCorrection(settings, output, IntersectDF, AvBeachSlope):
+    dates_sat = []
+    for i in range(len(output['dates'])):
+        dates_sat_str = output['dates'][i] +' '+output['times'][i]
+        dates_sat.append(datetime.strptime(dates_sat_str, '%Y-%m-%d %H:%M:%S.%f'))
+
+    tide_sat = Toolbox.GetWaterElevs(settings,dates_sat)
+    tides_sat = np.array(tide_sat)
+
+    # elevation at which you would like the shoreline time-series to be
+    RefElev = 1.0
+    BeachSlope = AvBeachSlope
+
+    CorrIntDistances = []
+    TidalStages = []
+
+    dates_sat_d = []
+    for dt in dates_sat:
+        dates_sat_d.append(dt.date())
+
+    for D, Dist in enumerate(IntersectDF['wldists']):
+        DateIndex = dates_sat_d.index(datetime.strptime(IntersectDF['wldates'][D], '%Y-%m-%d').date())
+        # calculate and apply cross-shore correction
+        TidalElev = tides_sat[DateIndex] - RefElev
+        Correction = TidalElev / BeachSlope
+        # correction is minus because transect dists are defined land to seaward
+        CorrIntDistances.append(Dist - Correction)
+        TidalStages.append(TidalElev)
+
+    return CorrIntDistances, TidalStages
+
+
+def OldBeachWidth(TransectGDF, TransectDict, WaterlineGDF, settings, output, AvBeachSlope):
+    # initialise where each intersection between lines and transects will be saved
+    ColumnData = []
+    Geoms = []
+    # for each row/feature in transect
+    for ID, TrGeom in zip(TransectGDF['TransectID'], TransectGDF.geometry):
+        # Extend transect line out to sea and inland
+        TrGeom = Toolbox.ExtendLine(TrGeom, 300)
+        # for each row/feature shoreline
+        for dates, SGeom in zip(WaterlineGDF['dates'], WaterlineGDF.geometry):
+            # calculate intersections between each transect and shoreline
+            Intersects = TrGeom.intersection(SGeom)
+            ColumnData.append((ID,dates))
+            Geoms.append(Intersects)
+
+    # create GDF from appended lists of intersections
+    AllIntersects = gpd.GeoDataFrame(ColumnData,geometry=Geoms,columns=['TransectID', 'wldates'])
+    # remove any rows with no intersections
+    AllIntersects = AllIntersects[~AllIntersects.is_empty].reset_index().drop('index',axis=1)
+    # duplicate geom column to save point intersections
+    AllIntersects['wlinterpnt'] = AllIntersects['geometry']
+    # take only first point on any transects which intersected a single shoreline more than once
+    for inter in range(len(AllIntersects)):
+        if AllIntersects['wlinterpnt'][inter].geom_type == 'MultiPoint':
+            AllIntersects.loc[inter, 'wlinterpnt'] = list(AllIntersects['wlinterpnt'][inter].geoms)[0]
+    AllIntersects = AllIntersects.drop('geometry',axis=1)
+    # attribute join on transect ID to get transect geometry back
+    AllIntersects = AllIntersects.merge(TransectGDF[['TransectID','geometry']], on='TransectID')
+
+    # initialise distances of intersections
+    distances = []
+    # for each intersection
+    for i in range(len(AllIntersects)):
+        # calculate distance of intersection along transect
+        distances.append(np.sqrt(
+            (AllIntersects['wlinterpnt'][i].x - AllIntersects['geometry'][i].coords[0][0])**2 +
+            (AllIntersects['wlinterpnt'][i].y - AllIntersects['geometry'][i].coords[0][1])**2 ))
+    AllIntersects['wldists'] = distances
+
+    # Tidal correction to get corrected distances along transects
+    CorrectedDists, TidalStages = OldTidalCorrection(settings, output, AllIntersects, AvBeachSlope)
+    AllIntersects['wlcorrdist'] = CorrectedDists
+    AllIntersects['waterelev'] = TidalStages
+
+    # Field representing beach zone dependent on tidal height range split into 3 (upper, middle or lower)
+    TideSteps = Transects.BeachTideLoc(settings)
+    ShoreLevels = []
+    for i in range(len(AllIntersects)):
+        if AllIntersects['waterelev'][i] > TideSteps[0] and AllIntersects['waterelev'][i] < TideSteps[1]:
+            ShoreLevels.append('lower')
+        elif AllIntersects['waterelev'][i] > TideSteps[1] and AllIntersects['waterelev'][i] < TideSteps[2]:
+            ShoreLevels.append('middle')
+        elif AllIntersects['waterelev'][i] > TideSteps[2] and AllIntersects['waterelev'][i] < TideSteps[3]:
+            ShoreLevels.append('upper')
+    AllIntersects['tidezone'] = ShoreLevels
+
+    #initialise lists used for storing each transect's intersection values
+    dates, distances, corrdists, welev, tzone, interpnt = ([] for i in range(6)) # per-transect lists of values
+
+    Key = [dates, distances, corrdists, welev, tzone, interpnt]
+    KeyName = ['wldates','wldists', 'wlcorrdist','waterelev','tidezone','wlinterpnt']
+
+    # for each column name
+    for i in range(len(Key)):
+        # for each transect
+        for Tr in range(len(TransectGDF['TransectID'])):
+            # refresh per-transect list
+            TrKey = []
+            # for each matching intersection on a single transect
+            for j in range(len(AllIntersects.loc[AllIntersects['TransectID']==Tr])):
+                # append each intersection value to a list for each transect
+                # iloc used so index doesn't restart at 0 each loop
+                TrKey.append(AllIntersects[KeyName[i]].loc[AllIntersects['TransectID']==Tr].iloc[j])
+            Key[i].append(TrKey)
+
+        TransectDict[KeyName[i]] = Key[i]
+
+    # Create beach width attribute
+    TransectDict['beachwidth'] = TransectDict['TransectID'].copy()
+    # for each transect
+    for Tr in range(len(TransectGDF['TransectID'])):
+        # dates into transect-specific list
+        WLDateList = [datetime.strptime(date, '%Y-%m-%d') for date in TransectDict['wldates'][Tr]]
+        VLDateList = [datetime.strptime(date, '%Y-%m-%d') for date in TransectDict['dates'][Tr]]
+        # find index of closest waterline date to each vegline date
+        VLSLDists = []
+        for D, WLDate in enumerate(WLDateList):
+            # index of matching nearest date
+            if VLDateList != []:
+                DateLoc = OldNearDate(WLDate,VLDateList)
+                if DateLoc == False:
+                    VLSLDists.append(np.nan)
+                    continue
+                else:
+                    DateIndex = VLDateList.index(DateLoc)
+            else:
+                continue
+            # use date index to identify matching distance along transect
+            # and calculate distance between two intersections (veg - water means +ve is veg measured seaward towards water)
+            VLSLDists.append(TransectDict['wlcorrdist'][Tr][D] - TransectDict['distances'][Tr][DateIndex])
+
+        TransectDict['beachwidth'][Tr] = VLSLDists
+
+    return TransectDict
+
+
+#%% Inputs
+
+rng = np.random.default_rng(Seed)
+WorkDir = tempfile.mkdtemp()
+os.makedirs(os.path.join(WorkDir, 'tides'))
+X0, Y0 = 500000.0, 6250000.0
+Length = NoTransects*Spacing
+
+# hourly tides over the image dates (sat times, interpolated, keep water elevations in the tidal range)
+TideDates = [datetime(2018, 12, 31) + timedelta(hours=h) for h in range(24*(3*365 + 2))]
+Tides = 2.5*np.sin(2*np.pi*np.arange(len(TideDates))/12.42) + 0.5*np.sin(2*np.pi*np.arange(len(TideDates))/(24*14.8))
+pd.DataFrame({'date':TideDates, 'tide':Tides}).to_csv(os.path.join(WorkDir, 'tides', sitename + '_tides.csv'), index=False)
+settings = {'inputs':{'sitename':sitename, 'filepath':WorkDir}}
+
+Candidates = sorted(datetime(2019, 1, 1, 11) + timedelta(days=int(d), minutes=int(m))
+                    for d, m in zip(rng.choice(3*365, 4*NoImages, replace=False), rng.integers(0, 60, 4*NoImages)))
+with contextlib.redirect_stdout(io.StringIO()):
+    CandTides = np.array(Toolbox.GetWaterElevs(settings, Candidates))
+InRange = (CandTides - 1.0 > Tides.min() + 0.1) & (CandTides - 1.0 < Tides.max() - 0.1)
+ImDates = [Candidates[i] for i in np.sort(rng.choice(np.nonzero(InRange)[0], NoImages, replace=False))]
+# second image on the same date as another, later in the day
+ImDates.append(ImDates[NoImages//2] + timedelta(minutes=30))
+ImDates.sort()
+output = {'dates':[d.strftime('%Y-%m-%d') for d in ImDates], 'times':[d.strftime('%H:%M:%S.%f') for d in ImDates]}
+
+# transects running north to south
+TransectGDF = gpd.GeoDataFrame({'TransectID':np.arange(NoTransects)},
+                               geometry=[LineString([(X0 + Tr*Spacing, Y0), (X0 + Tr*Spacing, Y0 - 400)]) for Tr in range(NoTransects)],
+                               crs='EPSG:%d' % EPSG)
+# wavy waterlines along the coast, some stopping short, some doubling back across a transect
+Lines = []
+for i in range(len(ImDates)):
+    x = np.linspace(X0 - 50 + rng.uniform(0, Length/4)*(rng.random() < 0.2), X0 + Length + 50, 500)
+    y = Y0 - 250 + 20*np.sin((x - X0)/150 + rng.uniform(0, 2*np.pi)) + rng.normal(0, 0.5, len(x))
+    if rng.random() < 0.2:
+        k = int(rng.integers(50, 450))
+        x[k], x[k + 1] = x[k + 1] + 4, x[k] - 4 # zig-zag
+    Lines.append(LineString(np.c_[x, y]))
+WaterlineGDF = gpd.GeoDataFrame({'dates':output['dates']}, geometry=Lines, crs='EPSG:%d' % EPSG)
+
+# veg edge intersections every 20 days (so some waterlines lie exactly between two), with a gap of a year
+VegDates = [datetime(2019, 1, 3) + timedelta(days=20*i) for i in range(55)]
+VegDates = [d for d in VegDates if not datetime(2020, 3, 1) < d < datetime(2021, 3, 1)]
+TransectDict = {'TransectID':list(range(NoTransects)), 'dates':[], 'distances':[]}
+for Tr in range(NoTransects):
+    Keep = [] if Tr % 25 == 0 else sorted(rng.choice(len(VegDates), int(rng.integers(10, len(VegDates))), replace=False))
+    TransectDict['dates'].append([VegDates[i].strftime('%Y-%m-%d') for i in Keep])
+    TransectDict['distances'].append(list(rng.uniform(100, 200, len(Keep))))
+
+
+#%% Run both and compare
+
+Passed = True
+Start = time.perf_counter()
+with contextlib.redirect_stdout(io.StringIO()):
+    Old = OldBeachWidth(TransectGDF, dict((key, list(val)) for key, val in TransectDict.items()),
+                        WaterlineGDF, settings, output, AvBeachSlope)
+OldTime = time.perf_counter() - Start
+Start = time.perf_counter()
+with contextlib.redirect_stdout(io.StringIO()):
+    New = Transects.GetBeachWidth(WorkDir, TransectGDF, dict((key, list(val)) for key, val in TransectDict.items()),
+                                  WaterlineGDF, settings, output, AvBeachSlope)
+NewTime = time.perf_counter() - Start
+
+for key in ['wldates', 'tidezone', 'wlinterpnt', 'wldists', 'wlcorrdist', 'waterelev', 'beachwidth']:
+    if key in ['wldates', 'tidezone']:
+        Same = New[key] == Old[key]
+    elif key == 'wlinterpnt':
+        Same = all(len(n) == len(o) and all(p.equals(q) for p, q in zip(n, o)) for n, o in zip(New[key], Old[key]))
+    else:
+        Same = all(len(n) == len(o) and np.allclose(n, o, rtol=0, atol=1e-9, equal_nan=True)
+                   for n, o in zip(New[key], Old[key]))
+    Passed &= Same
+    Values = [val for vals in New[key] for val in vals]
+    Extra = ''
+    if key == 'beachwidth':
+        Extra = ', %d NaN' % np.sum(np.isnan(Values))
+    print('%s: %d values%s: %s' % (key, len(Values), Extra, 'match' if Same else 'MISMATCH'))
+
+# waterlines exactly between two veg edge dates on a transect
+Ties = 0
+for Tr in range(NoTransects):
+    VLDates = np.array(TransectDict['dates'][Tr], dtype='datetime64[D]')
+    for WLDate in np.array(New['wldates'][Tr], dtype='datetime64[D]') if len(VLDates) else []:
+        Gaps = np.abs(VLDates - WLDate)
+        Ties += np.sum(Gaps == Gaps.min()) > 1
+print('%d transects x %d waterlines (%d waterlines exactly between two veg edges): %.1f s before, %.2f s now (%.0fx)' %
+      (NoTransects, len(ImDates), Ties, OldTime, NewTime, OldTime/NewTime))
+
+shutil.rmtree(WorkDir)
+print('PASS' if Passed else 'FAIL')
+sys.exit(0 if Passed else 1)
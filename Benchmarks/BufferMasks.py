@@ -0,0 +1,165 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Benchmark and parity check for the cached reference-line buffer masks
+(VegetationLine.create_shoreline_buffer and BufferShoreline, through
+Toolbox.BufferMaskGet) against the per-image dilation and rasterisation they
+replaced, on a synthetic run where most images share one grid. The script
+checks:
+    - masks match the old ones exactly, on every grid
+    - with settings['buffer_cache'] on, a new session reads the masks back
+      from disk and they still match
+    - threads computing the same mask at once all write it to the disk cache
+      without errors, leaving one readable .npy and no temp files
+
+Run from anywhere with:
+    python Benchmarks/BufferMasks.py
+"""
+
+import os
+import sys
+import time
+import shutil
+import tempfile
+import threading
+import warnings
+warnings.filterwarnings("ignore")
+from concurrent.futures import ThreadPoolExecutor
+import numpy as np
+from skimage import morphology
+from rasterio import features
+
+RepoDir = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, RepoDir)
+from Toolshed import VegetationLine, Toolbox
+
+#%% Settings
+
+sitename = 'StAndrews'
+NoImages = 500
+ImShape = (600, 800)
+NoThreads = 8
+Rounds = 20 # masks written at once by all threads in the disk cache check
+
+
+#%% Reference implementation (buffer made again for every image)
+
+def OldShorelineBuffer(im_shape, georef, pixel_size, settings):
+    ref_sl = settings['reference_shoreline'][:,:-1]
+    ref_sl_pix = Toolbox.convert_world2pix(ref_sl, georef)
+    ref_sl_pix_rounded = np.round(ref_sl_pix).astype(int)
+    idx_row = np.logical_and(ref_sl_pix_rounded[:,0] > 0, ref_sl_pix_rounded[:,0] < im_shape[1])
+    idx_col = np.logical_and(ref_sl_pix_rounded[:,1] > 0, ref_sl_pix_rounded[:,1] < im_shape[0])
+    idx_inside = np.logical_and(idx_row, idx_col)
+    ref_sl_pix_rounded = ref_sl_pix_rounded[idx_inside,:]
+    im_binary = np.zeros(im_shape)
+    for j in range(len(ref_sl_pix_rounded)):
+        im_binary[ref_sl_pix_rounded[j,1], ref_sl_pix_rounded[j,0]] = 1
+    im_binary = im_binary.astype(bool)
+    max_dist_ref_pixels = np.ceil(settings['max_dist_ref']/pixel_size)
+    se = morphology.disk(max_dist_ref_pixels)
+    return morphology.binary_dilation(im_binary, se)
+
+
+def OldBufferShoreline(settings, refline, georef, cloud_mask):
+    refGS = Toolbox.ArrtoGS(refline, georef)
+    buffDist = settings['max_dist_ref']/georef[1]
+    refLSBuffer = refGS.buffer(buffDist)
+    refShapes = ((geom,value) for geom, value in zip(refLSBuffer.geometry, np.ones(len(refLSBuffer))))
+    return features.rasterize(refShapes, out_shape=cloud_mask.shape) > 0
+
+
+#%% Inputs
+
+# one grid for most images, with a shifted grid every tenth image
+Grids = [[500000.0, 10.0, 0, 6250000.0, 0, -10.0], [499990.0, 10.0, 0, 6250010.0, 0, -10.0],
+         [499980.0, 10.0, 0, 6250000.0, 0, -10.0]]
+ImageGrids = [Grids[(i//10) % 3] if i % 10 == 0 else Grids[0] for i in range(NoImages)]
+t = np.linspace(0, 1, 1500)
+refline = np.c_[500500 + 7000*t, 6249500 - 4000*t - 800*np.sin(8*t), np.zeros_like(t)]
+cloud_mask = np.zeros(ImShape, bool)
+
+WorkDir = tempfile.mkdtemp()
+os.makedirs(os.path.join(WorkDir, sitename))
+def Settings(cache):
+    return {'reference_shoreline':refline, 'max_dist_ref':150, 'buffer_cache':cache,
+            'inputs':{'filepath':WorkDir, 'sitename':sitename}}
+
+Functions = {'create_shoreline_buffer':
+                 (lambda georef, settings: OldShorelineBuffer(ImShape, georef, 10, settings),
+                  lambda georef, settings: VegetationLine.create_shoreline_buffer(ImShape, georef, 32630, 10,
+                                                                                  settings, 32630)),
+             'BufferShoreline':
+                 (lambda georef, settings: OldBufferShoreline(settings, refline, georef, cloud_mask),
+                  lambda georef, settings: VegetationLine.BufferShoreline(settings, refline, georef, cloud_mask))}
+
+
+#%% Run both and compare
+
+Passed = True
+for name, (OldFn, NewFn) in Functions.items():
+    Toolbox.BUFFER_MASKS = Toolbox.BufferMasks()
+    Start = time.perf_counter()
+    OldMasks = {tuple(georef): OldFn(georef, Settings(False)) for georef in ImageGrids}
+    OldTime = time.perf_counter() - Start
+    for georef in Grids: # the old version has no cache, so any repeat costs the same
+        OldMasks[tuple(georef)] = OldFn(georef, Settings(False))
+    Start = time.perf_counter()
+    NewMasks = [NewFn(georef, Settings(False)) for georef in ImageGrids]
+    NewTime = time.perf_counter() - Start
+    Same = all(np.array_equal(OldMasks[tuple(georef)], mask) for georef, mask in zip(ImageGrids, NewMasks))
+    Passed &= Same
+    print('%s: %d images, %.2f ms per image before, %.2f ms cached (%.0fx): %s' %
+          (name, NoImages, OldTime/NoImages*1000, NewTime/NoImages*1000, OldTime/NewTime,
+           'match' if Same else 'MISMATCH'))
+
+    # write to the disk cache, then read back in a new session (files not written again)
+    MaskDir = os.path.join(WorkDir, sitename, 'buffer_masks')
+    shutil.rmtree(MaskDir, ignore_errors=True)
+    Toolbox.BUFFER_MASKS = Toolbox.BufferMasks()
+    for georef in Grids:
+        NewFn(georef, Settings(True))
+    Written = {f: os.stat(os.path.join(MaskDir, f)).st_mtime_ns for f in os.listdir(MaskDir)}
+    Toolbox.BUFFER_MASKS = Toolbox.BufferMasks()
+    Start = time.perf_counter()
+    Same = all(np.array_equal(OldMasks[tuple(georef)], NewFn(georef, Settings(True))) for georef in Grids)
+    DiskTime = (time.perf_counter() - Start) / len(Grids)
+    Reread = {f: os.stat(os.path.join(MaskDir, f)).st_mtime_ns for f in os.listdir(MaskDir)}
+    Same &= len(Written) == len(Grids) and Reread == Written
+    Passed &= Same
+    print('  new session with buffer_cache: %.2f ms per grid read from disk: %s' %
+          (DiskTime*1000, 'match' if Same else 'MISMATCH'))
+
+# every thread misses the in-memory cache and writes the same key at once
+CacheDir = os.path.join(WorkDir, 'concurrent')
+Errors = []
+for r in range(Rounds):
+    Toolbox.BUFFER_MASKS = Toolbox.BufferMasks()
+    Barrier = threading.Barrier(NoThreads)
+    mask = np.random.default_rng(r).random(ImShape) > 0.5
+    def compute():
+        Barrier.wait()
+        return mask.copy()
+    def Get(i):
+        try:
+            return Toolbox.BUFFER_MASKS.Get(('round', r), compute, CacheDir)
+        except Exception as e:
+            Errors.append(repr(e))
+    with ThreadPoolExecutor(NoThreads) as Pool:
+        Results = list(Pool.map(Get, range(NoThreads)))
+    Toolbox.BUFFER_MASKS = Toolbox.BufferMasks()
+    Stored = Toolbox.BUFFER_MASKS.Get(('round', r), lambda: None, CacheDir)
+    if not (Stored is not None and np.array_equal(Stored, mask) and
+            all(Result is not None and np.array_equal(Result, mask) for Result in Results)):
+        Errors.append('round %d: wrong mask' % r)
+Files = os.listdir(CacheDir)
+Same = Errors == [] and len(Files) == Rounds and all(f.endswith('.npy') for f in Files)
+Passed &= Same
+print('disk cache, %d threads writing the same mask, %d rounds: %d errors, %d files: %s' %
+      (NoThreads, Rounds, len(Errors), len(Files), 'ok' if Same else 'MISMATCH'))
+for Error in Errors[:5]:
+    print('  ' + Error)
+
+shutil.rmtree(WorkDir)
+print('PASS' if Passed else 'FAIL')
+sys.exit(0 if Passed else 1)
@@ -0,0 +1,137 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Benchmark and parity check for the server-side cloud cover filter in
+Download.check_images_available, against the client-side
+remove_cloudy_images it replaced, with the Earth Engine API replaced by
+Toolshed.EEEmulator over seeded synthetic Landsat 8 (Tier 1 and 2) and
+Sentinel-2 collections. Each image carries the full band list and 100 extra
+properties, like a real EE feature, and a share of them are over 95% cloud.
+Three paths are compared:
+    - previous: full lists fetched one collection at a time, then very
+      cloudy images removed on the client
+    - server filter: full lists of the clear images only (return_images=True)
+    - counts only: the number of clear images in one request
+      (return_images=False)
+The script checks the images (and counts) are the same on every path, and
+reports the requests, bytes and time of each.
+
+Run from anywhere with:
+    python Benchmarks/CloudFilter.py
+"""
+
+import os
+import io
+import sys
+import time
+import json
+import shutil
+import tempfile
+import contextlib
+import warnings
+warnings.filterwarnings("ignore")
+from datetime import datetime, timedelta, timezone
+import numpy as np
+import rasterio
+from rasterio.transform import from_origin
+from rasterio.warp import transform
+
+RepoDir = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, RepoDir)
+from Toolshed import Download, EEEmulator
+
+#%% Settings
+
+NoImages = 400 # per collection
+CloudyShare = 0.15 # share of images over 95% cloud cover
+ExtraProperties = 100
+Latency = 0.05 # seconds per request
+Seed = 0
+Bands = {'L8':['B1','B2','B3','B4','B5','B6','B7','B8','B9','B10','B11','BQA'],
+         'S2':['B1','B2','B3','B4','B5','B6','B7','B8','B8A','B9','B10','B11','B12','QA10','QA20','QA60']}
+Collections = {('T1','L8'):'LANDSAT/LC08/C01/T1_TOA',
+               ('T2','L8'):'LANDSAT/LC08/C01/T2_TOA',
+               ('T1','S2'):'COPERNICUS/S2'}
+
+
+#%% Reference implementation (full lists, one collection at a time, filtered on the client)
+
+def OldImagesAvailable(inputs):
+    ee = Emulator.ee
+    point = ee.Geometry.Point(inputs['polygon'][0][0])
+    im_dict = {'T1':dict([]), 'T2':dict([])}
+    for (tier, satname), collection in Collections.items():
+        region = point if tier == 'T1' else ee.Geometry.Polygon(inputs['polygon'])
+        col = ee.ImageCollection(collection).filterBounds(region).filterDate(inputs['dates'][0], inputs['dates'][-1])
+        im_list = col.getInfo().get('features')
+        im_dict[tier][satname] = Download.remove_cloudy_images(im_list, satname)
+    return im_dict['T1'], im_dict['T2']
+
+
+#%% Inputs
+
+WorkDir = tempfile.mkdtemp()
+Root = os.path.join(WorkDir, 'ee')
+rng = np.random.default_rng(Seed)
+for (tier, satname), collection in Collections.items():
+    folder = os.path.join(Root, *collection.split('/'))
+    os.makedirs(folder)
+    for i in range(NoImages):
+        date = datetime(2019, 1, 1, 11, tzinfo=timezone.utc) + timedelta(days=int(rng.integers(0, 730)), minutes=i)
+        name = '%s_%s_%03d' % (satname, date.strftime('%Y%m%d'), i)
+        with rasterio.open(os.path.join(folder, name + '.tif'), 'w', driver='GTiff', width=10, height=10,
+                           count=len(Bands[satname]), dtype='uint16', crs='EPSG:32630',
+                           transform=from_origin(500000, 6250000, 300, 300)) as dst:
+            dst.write(np.zeros((len(Bands[satname]), 10, 10), 'uint16'))
+        cloud = float(rng.uniform(95, 100) if rng.random() < CloudyShare else rng.uniform(0, 95))
+        props = dict(('PROPERTY_%03d' % k, float(rng.random())) for k in range(ExtraProperties))
+        props.update({'system:time_start':int(date.timestamp()*1000), Download.CLOUD_PROPERTIES[satname]:cloud})
+        with open(os.path.join(folder, name + '.json'), 'w') as f:
+            json.dump({'bands':Bands[satname], 'properties':props}, f)
+
+xs, ys = [500500, 502500, 502500, 500500, 500500], [6249500, 6249500, 6247500, 6247500, 6249500]
+polygon = [[list(xy) for xy in zip(*transform('EPSG:32630', 'EPSG:4326', xs, ys))]]
+inputs = {'polygon':polygon, 'dates':['2019-01-01', '2021-01-01'], 'sat_list':['L8', 'S2'],
+          'daterange':'yes'}
+
+def Run(fn):
+    Emulator.Reset()
+    Start = time.perf_counter()
+    with contextlib.redirect_stdout(io.StringIO()):
+        T1, T2 = fn()
+    RunTime = time.perf_counter() - Start
+    Stats = Emulator.Stats()
+    return T1, T2, RunTime, Stats['calls'].get('getInfo', 0), Stats['bytes'].get('getInfo', 0)
+
+def IDs(T1, T2):
+    return dict(((tier, satname), sorted(im['id'] for im in ims)) for tier, d in [('T1', T1), ('T2', T2)]
+                for satname, ims in d.items())
+
+
+#%% Run all three and compare
+
+Passed = True
+Emulator = EEEmulator.Emulator(Root, latency=Latency, seed=Seed).Install()
+
+OldT1, OldT2, OldTime, OldCalls, OldBytes = Run(lambda: OldImagesAvailable(inputs))
+Expected = IDs(OldT1, OldT2)
+print('previous, filtered on the client: %d requests, %.0f kB, %.2f s' % (OldCalls, OldBytes/1e3, OldTime))
+
+T1, T2, RunTime, Calls, NBytes = Run(lambda: Download.check_images_available(inputs))
+Same = IDs(T1, T2) == Expected
+Passed &= Same
+print('server filter: %d requests, %.0f kB (%.0f%% less), %.2f s: %s' %
+      (Calls, NBytes/1e3, 100*(1 - NBytes/OldBytes), RunTime, 'match' if Same else 'MISMATCH'))
+
+T1, T2, RunTime, Calls, NBytes = Run(lambda: Download.check_images_available(inputs, return_images=False))
+Same = dict([((tier, satname), n) for tier, d in [('T1', T1), ('T2', T2)] for satname, n in d.items()]) == \
+       dict((key, len(ids)) for key, ids in Expected.items())
+Passed &= Same
+print('counts only: %d request, %.2f kB, %.2f s: %s' % (Calls, NBytes/1e3, RunTime, 'match' if Same else 'MISMATCH'))
+print('%d of %d images kept (%s)' % (sum(len(ids) for ids in Expected.values()), NoImages*len(Collections),
+                                     ', '.join('%s %s: %d' % (key + (len(ids),)) for key, ids in Expected.items())))
+
+Emulator.Uninstall()
+shutil.rmtree(WorkDir)
+print('PASS' if Passed else 'FAIL')
+sys.exit(0 if Passed else 1)
@@ -0,0 +1,140 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Benchmark and parity check for Image_Processing.decode_cloud_QA (integer QA
+bands looked up in the 16-bit table from cloud_QA_LUT) and
+create_cloud_mask, against the np.isin test on each satellite's cloud values
+they replaced, on seeded synthetic QA bands for L5, L7, L8, L9 and S2: clear,
+water, shadow and snow values with cloud banks, cirrus and speckle, at the
+sizes the QA bands come in. The script checks:
+    - the cloud flags match for each satellite and QA dtype (uint16 as
+      downloaded, int16 and int32 with out-of-range values, float32 and float64
+      with NaN, as when QA is stacked with reflectance bands)
+    - create_cloud_mask matches, with and without cloud_mask_issue
+    - the table for each satellite is built once and reused, and an unknown
+      satellite raises
+and reports the time of each. L9 had no cloud values before (its masks
+raised), so it is checked against the L8 values it now shares.
+
+Run from anywhere with:
+    python Benchmarks/CloudQA.py
+"""
+
+import os
+import sys
+import time
+import warnings
+warnings.filterwarnings("ignore")
+import numpy as np
+import skimage.morphology as morphology
+from scipy import ndimage
+
+RepoDir = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, RepoDir)
+from Toolshed import Image_Processing
+
+#%% Settings
+
+Shapes = {'L5':(1000, 1000), 'L7':(1000, 1000), 'L8':(1000, 1000), 'L9':(1000, 1000), 'S2':(500, 500)}
+Repeats = 10 # calls timed per case
+Seed = 0
+
+
+#%% Reference implementation (np.isin on the cloud values of each satellite)
+
+def OldCloudMask(im_QA, satname, cloud_mask_issue):
+    # convert QA bits (the bits allocated to cloud cover vary depending on the satellite mission)
+    if satname == 'L8' or satname == 'L9': # L9 raised before, checked against the L8 values
+        cloud_values = [2800, 2804, 2808, 2812, 6896, 6900, 6904, 6908]
+    elif satname == 'L7' or satname == 'L5' or satname == 'L4':
+        cloud_values = [752, 756, 760, 764]
+    elif satname == 'S2':
+        cloud_values = [1024, 2048] # 1024 = dense cloud, 2048 = cirrus clouds
+
+    # find which pixels have bits corresponding to cloud values
+    cloud_mask = np.isin(im_QA, cloud_values)
+
+    # remove cloud pixels that form very thin features. These are beach or swash pixels that are
+    # erroneously identified as clouds by the CFMASK algorithm applied to the images by the USGS.
+    # (return values used, as newer scikit-image has no in_place argument)
+    if sum(sum(cloud_mask)) > 0 and sum(sum(~cloud_mask)) > 0:
+        cloud_mask = morphology.remove_small_objects(cloud_mask, min_size=10, connectivity=1)
+
+        if cloud_mask_issue:
+            elem = morphology.square(3) # use a square of width 3 pixels
+            cloud_mask = morphology.binary_opening(cloud_mask,elem) # perform image opening
+            # remove objects with less than 25 connected pixels
+            cloud_mask = morphology.remove_small_objects(cloud_mask, min_size=25, connectivity=1)
+
+    return cloud_mask
+
+
+#%% Inputs
+
+rng = np.random.default_rng(Seed)
+# non-cloud QA values of each mission (clear, water, shadow, snow...) and its cloud values
+OtherValues = {'L5':[672, 676, 680, 684, 928, 932, 936, 940, 1696, 1700, 1704, 1708, 1],
+               'L8':[2720, 2724, 2728, 2732, 2976, 2980, 2984, 2988, 3744, 3748, 3752, 3756, 6816, 6820, 7072, 7076, 1],
+               'S2':[0]}
+OtherValues['L7'] = OtherValues['L5']
+OtherValues['L9'] = OtherValues['L8']
+CloudValues = dict((sat, Image_Processing.CLOUD_QA_VALUES[sat]) for sat in Shapes)
+
+def SyntheticQA(satname, shape):
+    # smooth cloud banks, plus speckle (thin features, removed from the mask)
+    Field = ndimage.gaussian_filter(rng.normal(0, 1, shape), 20)
+    Cloud = Field > np.quantile(Field, 0.7)
+    Cloud |= rng.random(shape) < 0.01
+    im_QA = rng.choice(OtherValues[satname], shape)
+    im_QA[Cloud] = rng.choice(CloudValues[satname], Cloud.sum())
+    return im_QA.astype(np.uint16)
+
+def AsDtype(im_QA, dtype):
+    im = im_QA.astype(dtype)
+    Odd = rng.random(im.shape) < 0.001
+    if dtype in ['int16', 'int32']:
+        # values a QA band should never hold (negative, or beyond 16 bits)
+        im[Odd] = -im[Odd] if dtype == 'int16' else im[Odd] + 2**16
+    else:
+        im[Odd] = np.nan # masked pixels
+    return im
+
+
+#%% Run both and compare
+
+Passed = True
+for satname, shape in Shapes.items():
+    im_QA = SyntheticQA(satname, shape)
+    for dtype in ['uint16', 'int16', 'int32', 'float32', 'float64']:
+        im = im_QA if dtype == 'uint16' else AsDtype(im_QA, dtype)
+        Old = np.isin(im, CloudValues['L8' if satname == 'L9' else satname])
+        New = Image_Processing.decode_cloud_QA(im, satname)
+        Start = time.perf_counter()
+        for i in range(Repeats):
+            np.isin(im, CloudValues[satname])
+        OldTime = (time.perf_counter() - Start)/Repeats
+        Start = time.perf_counter()
+        for i in range(Repeats):
+            Image_Processing.decode_cloud_QA(im, satname)
+        NewTime = (time.perf_counter() - Start)/Repeats
+        Same = New.dtype == bool and New.shape == Old.shape and np.array_equal(New, Old)
+        Passed &= Same
+        print('%s, %s %dx%d, %.1f%% cloud: %.1f ms before, %.1f ms now: %s' %
+              (satname, dtype, shape[0], shape[1], 100*Old.mean(), 1e3*OldTime, 1e3*NewTime, 'match' if Same else 'MISMATCH'))
+    for cloud_mask_issue in [False, True]:
+        Same = np.array_equal(Image_Processing.create_cloud_mask(im_QA, satname, cloud_mask_issue),
+                              OldCloudMask(im_QA, satname, cloud_mask_issue))
+        Passed &= Same
+        print('  create_cloud_mask, cloud_mask_issue=%s: %s' % (cloud_mask_issue, 'match' if Same else 'MISMATCH'))
+
+Same = all(Image_Processing.cloud_QA_LUT(satname) is Image_Processing.cloud_QA_LUT(satname) for satname in Shapes)
+try:
+    Image_Processing.decode_cloud_QA(SyntheticQA('S2', (10, 10)), 'L3')
+    Same = False
+except ValueError:
+    pass
+Passed &= Same
+print('tables built once per satellite, unknown satellite raises: %s' % ('ok' if Same else 'MISMATCH'))
+
+print('PASS' if Passed else 'FAIL')
+sys.exit(0 if Passed else 1)
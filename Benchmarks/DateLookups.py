@@ -0,0 +1,284 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Benchmark and parity check for Toolbox.DateIndex (a sorted index answering
+batches of date queries with binary searches) and the lookups built on it
+(get_closest_datapoint, NearDate, NearestDates and GetWaterElevs), against
+the list scans they replaced, on seeded synthetic dates: 100k unsorted
+dates with repeats, queried with random dates, dates falling exactly on or
+exactly between indexed dates, and dates before or after all of them. The
+script checks:
+    - get_closest_datapoint gives the same values, and raises where the
+      time-series does not cover the dates
+    - NearDate gives the same date (or False beyond 153 days), except on ties:
+      the old scan took whichever of the two dates came first in the list, it
+      now always takes the earlier one (the tie queries are counted, and the
+      earlier date must be returned)
+    - NearestDates gives the same dates and positions in the metadata, with
+      ties now going to the earlier image as in NearDate
+    - GetWaterElevs gives the same water levels, including images taken on
+      the hour, and raises where the tide data do not cover the images
+and reports the time of 1M nearest and following date queries against 100k
+dates (the old scans are timed on a sample of queries and scaled up).
+
+Run from anywhere with:
+    python Benchmarks/DateLookups.py
+"""
+
+import os
+import io
+import sys
+import time
+import shutil
+import tempfile
+import contextlib
+import warnings
+warnings.filterwarnings("ignore")
+from datetime import datetime, timedelta
+import numpy as np
+import pandas as pd
+
+RepoDir = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, RepoDir)
+from Toolshed import Toolbox
+
+#%% Settings
+
+sitename = 'StAndrews'
+NoDates = 100000
+NoQueries = 1000000
+NoSample = 300 # queries run through the old scans
+NoImages = 200 # sat images for GetWaterElevs
+Seed = 0
+
+
+#%% Reference implementation (full list scanned for each query)
+
+def OldClosestDatapoint(dates, dates_ts, values_ts):
+    # check if the time-series cover the dates
+    if dates[0] < dates_ts[0] or dates[-1] > dates_ts[-1]:
+        raise Exception('Time-series do not cover the range of your input dates')
+
+    # get closest point to each date (no interpolation)
+    temp = []
+    def find(item, lst):
+        start = 0
+        start = lst.index(item, start)
+        return start
+    for i,date in enumerate(dates):
+        temp.append(values_ts[find(min(item for item in dates_ts if item > date), dates_ts)])
+    values = np.array(temp)
+
+    return values
+
+
+def OldNearDate(target,items):
+    nearestDate = min(items, key=lambda x: abs(x - target))
+
+    # # if difference is longer than 5 months, no match exists
+    if abs((target - nearestDate).days) > 153:
+        return False
+    else:
+        return nearestDate
+
+
+def OldNearestDates(surveys,metadata,sat_list):
+    veridates = sorted(list(surveys.Date.unique()))
+
+    nearestdates = dict.fromkeys(sat_list)
+    nearestIDs = dict.fromkeys(sat_list)
+
+    for sat in sat_list:
+        satdates=[]
+        nearestdate = []
+        nearestID = []
+        for veridate in veridates:
+            veridate = datetime.strptime(veridate,'%Y-%m-%d')
+            for satdate in metadata[sat]['dates']:
+                satdates.append(datetime.strptime(satdate,'%Y-%m-%d'))
+
+            if OldNearDate(veridate,satdates) == False:
+                pass
+            else:
+                nearestdate.append(datetime.strftime(OldNearDate(veridate,satdates),'%Y-%m-%d'))
+                nearestID.append(metadata[sat]['dates'].index(datetime.strftime(OldNearDate(veridate,satdates),'%Y-%m-%d')))
+
+        nearestdates[sat] = nearestdate
+        nearestIDs[sat] = nearestID
+
+    return nearestdates, nearestIDs
+
+
+def OldWaterElevs(settings, dates_sat):
+    # load tidal data
+    tidefilepath = os.path.join(settings['inputs']['filepath'],'tides',settings['inputs']['sitename']+'_tides.csv')
+    tide_data = pd.read_csv(tidefilepath, parse_dates=['date'])
+    dates_ts = [_.to_pydatetime() for _ in tide_data['date']]
+    tides_ts = np.array(tide_data['tide'])
+
+    tides_sat = []
+    def find(item, lst):
+        start = 0
+        start = lst.index(item, start)
+        return start
+
+    # Interpolate tide using number of minutes through the hour the satellite image was captured
+    for i,date in enumerate(dates_sat):
+        # find preceding and following hourly tide levels and times
+        time_1 = dates_ts[find(min(item for item in dates_ts if item > date-timedelta(hours=1)), dates_ts)]
+        tide_1 = tides_ts[find(min(item for item in dates_ts if item > date-timedelta(hours=1)), dates_ts)]
+        time_2 = dates_ts[find(min(item for item in dates_ts if item > date), dates_ts)]
+        tide_2 = tides_ts[find(min(item for item in dates_ts if item > date), dates_ts)]
+
+        # Find time difference of actual satellite timestamp (next hour minus sat timestamp)
+        timediff = time_2 - date
+        # Get proportion of time through the hour (e.g. 59mins past = 0.01)
+        timeprop = timediff / timedelta(hours=1)
+
+        # Get difference between the two tidal stages
+        tidediff = (tide_2 - tide_1) / 2
+        tide_sat = tide_2 - (tidediff * timeprop)
+
+        tides_sat.append(tide_sat)
+
+    return tides_sat
+
+
+#%% Inputs
+
+rng = np.random.default_rng(Seed)
+Start0 = datetime(2000, 1, 1)
+Span = 20*365*24*60 # minutes
+# unsorted dates, with some repeated
+Minutes = rng.integers(0, Span, NoDates)
+Minutes[rng.choice(NoDates, NoDates//20, replace=False)] = Minutes[rng.choice(NoDates, NoDates//20)]
+Dates = [Start0 + timedelta(minutes=int(m)) for m in Minutes]
+Values = rng.normal(0, 1, NoDates)
+
+def Queries(n):
+    # random dates, plus dates exactly on and exactly between indexed dates
+    Q = [Start0 + timedelta(minutes=float(m)) for m in rng.uniform(0, Span, n - 2*(n//10))]
+    Q += [Dates[i] for i in rng.choice(NoDates, n//10)]
+    SortedMins = np.unique(Minutes)
+    Gaps = np.nonzero(np.diff(SortedMins) % 2 == 0)[0]
+    Q += [Start0 + timedelta(minutes=int(SortedMins[i] + SortedMins[i + 1])//2) for i in rng.choice(Gaps, n//10)]
+    return Q
+
+Sample = sorted(Queries(NoSample))
+
+
+#%% Run both and compare
+
+Passed = True
+
+# get_closest_datapoint (first date after each), on a time-series in order
+TimeSeries = sorted(Dates)
+Covered = [d for d in Sample if TimeSeries[0] <= d < TimeSeries[-1]]
+Start = time.perf_counter()
+Old = OldClosestDatapoint(Covered, TimeSeries, Values)
+AfterOldTime = (time.perf_counter() - Start)/len(Covered)
+New = Toolbox.get_closest_datapoint(Covered, TimeSeries, Values)
+Same = np.array_equal(Old, New)
+Raised = []
+for fn in [OldClosestDatapoint, Toolbox.get_closest_datapoint]:
+    try:
+        fn([TimeSeries[0] - timedelta(days=1), TimeSeries[-1] + timedelta(days=1)], TimeSeries, Values)
+        Raised.append(False)
+    except Exception:
+        Raised.append(True)
+Same &= Raised == [True, True]
+Passed &= Same
+print('get_closest_datapoint, %d dates: %s' % (len(Covered), 'match' if Same else 'MISMATCH'))
+
+# NearDate, with queries beyond 153 days from any date too
+Far = [min(Dates) - timedelta(days=153, hours=12), min(Dates) - timedelta(days=154), max(Dates) + timedelta(days=200)]
+Start = time.perf_counter()
+Old = [OldNearDate(d, Dates) for d in Sample]
+NearTime = (time.perf_counter() - Start)/len(Sample)
+Old += [OldNearDate(d, Dates) for d in Far]
+New = [Toolbox.NearDate(d, Dates) for d in Sample + Far]
+DateSet = set(Dates)
+Ties, OldLater = 0, 0
+Same = True
+for d, o, n in zip(Sample + Far, Old, New):
+    Gap = abs(d - n) if n is not False else None
+    Tie = Gap is not None and (d - Gap) in DateSet and (d + Gap) in DateSet and Gap > timedelta(0)
+    if Tie:
+        Ties += 1
+        OldLater += o > n
+        Same &= n == d - Gap
+    else:
+        Same &= o == n
+Passed &= Same
+print('NearDate, %d dates (%d exactly between two, %d of which the old scan matched to the later): %s' %
+      (len(Sample + Far), Ties, OldLater, 'match' if Same else 'MISMATCH'))
+
+# NearestDates, validation dates against image dates per satellite
+Days = sorted(set(d.strftime('%Y-%m-%d') for d in Dates[:3000]))
+metadata = dict((sat, {'dates':list(rng.permutation(Days[k::3]))}) for k, sat in enumerate(['L5', 'L8', 'S2']))
+surveys = pd.DataFrame({'Date':[(Start0 + timedelta(days=int(d))).strftime('%Y-%m-%d') for d in rng.integers(-400, 20*365 + 400, 60)]})
+with contextlib.redirect_stdout(io.StringIO()):
+    Old = OldNearestDates(surveys, metadata, list(metadata))
+    New = Toolbox.NearestDates(surveys, metadata, list(metadata))
+# as with NearDate, ties (a validation date exactly between two image dates) now go to the earlier image
+VeriDates = set(datetime.strptime(d, '%Y-%m-%d') for d in surveys.Date)
+Ties, OldLater = 0, 0
+Same = [len(Old[0][sat]) for sat in metadata] == [len(New[0][sat]) for sat in metadata]
+for sat in metadata:
+    for o, n, oID, nID in zip(Old[0][sat], New[0][sat], Old[1][sat], New[1][sat]):
+        o, n = datetime.strptime(o, '%Y-%m-%d'), datetime.strptime(n, '%Y-%m-%d')
+        Mid = n + (o - n)/2
+        if Mid in VeriDates and abs(Mid - n) > timedelta(0) and (Mid - abs(Mid - n)).strftime('%Y-%m-%d') in metadata[sat]['dates'] \
+                and (Mid + abs(Mid - n)).strftime('%Y-%m-%d') in metadata[sat]['dates']:
+            Ties += 1
+            OldLater += o > n
+            Same &= n <= o and metadata[sat]['dates'].index(n.strftime('%Y-%m-%d')) == nID
+        else:
+            Same &= (o, oID) == (n, nID)
+Passed &= Same
+print('NearestDates, %d validation dates x %d image dates (%d exactly between two, %d of which the old scan matched to the later): %s' %
+      (len(surveys), sum(len(m['dates']) for m in metadata.values()), Ties, OldLater, 'match' if Same else 'MISMATCH'))
+
+# GetWaterElevs, hourly tides over the images (some on the hour)
+WorkDir = tempfile.mkdtemp()
+os.makedirs(os.path.join(WorkDir, 'tides'))
+TideDates = [Start0 + timedelta(hours=h) for h in range(NoDates)]
+pd.DataFrame({'date':TideDates, 'tide':2*np.sin(np.arange(NoDates)/2)}).to_csv(
+    os.path.join(WorkDir, 'tides', sitename + '_tides.csv'), index=False)
+settings = {'inputs':{'sitename':sitename, 'filepath':WorkDir}}
+SatDates = sorted([Start0 + timedelta(hours=2, minutes=float(m)) for m in rng.uniform(0, (NoDates - 3)*60, NoImages - 20)] +
+                  [TideDates[i] for i in rng.integers(2, NoDates - 2, 20)])
+Start = time.perf_counter()
+Old = OldWaterElevs(settings, SatDates)
+OldTime = time.perf_counter() - Start
+Start = time.perf_counter()
+New = Toolbox.GetWaterElevs(settings, SatDates)
+NewTime = time.perf_counter() - Start
+Same = np.allclose(Old, New, rtol=0, atol=1e-12)
+Raised = []
+for fn in [OldWaterElevs, Toolbox.GetWaterElevs]:
+    try:
+        fn(settings, [TideDates[-1] + timedelta(minutes=30)])
+        Raised.append(False)
+    except Exception:
+        Raised.append(True)
+Same &= Raised == [True, True]
+Passed &= Same
+print('GetWaterElevs, %d images against %d hourly tides: %.1f s before, %.3f s now: %s' %
+      (len(SatDates), NoDates, OldTime, NewTime, 'match' if Same else 'MISMATCH'))
+shutil.rmtree(WorkDir)
+
+# timing at full size
+Targets = Queries(NoQueries)
+Start = time.perf_counter()
+Index = Toolbox.DateIndex(Dates)
+Nearest = Index.Nearest(Targets, Tolerance=timedelta(days=153))
+NearestTime = time.perf_counter() - Start
+Start = time.perf_counter()
+After = Index.After(Targets, Inclusive=False)
+AfterTime = time.perf_counter() - Start
+print('%d queries against %d dates: nearest %.2f s (about %.1f h before), following %.2f s (about %.1f h before)' %
+      (NoQueries, NoDates, NearestTime, NearTime*NoQueries/3600, AfterTime, AfterOldTime*NoQueries/3600))
+
+print('PASS' if Passed else 'FAIL')
+sys.exit(0 if Passed else 1)
@@ -0,0 +1,222 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Benchmark and fault test for Download.download_image/download_tif, with the
+Earth Engine API replaced by Toolshed.EEEmulator over seeded synthetic
+Sentinel-2 tiles and the download URLs served by a local HTTP server. The
+server waits before answering, fails a share of requests (HTTP 500) and
+stalls on others (sends half the zip, then nothing). The script checks:
+    - every image downloaded concurrently under faults is identical to the
+      same image downloaded one at a time without faults, with no temporary
+      files left behind
+    - a stalled download is abandoned after the timeout, instead of hanging
+    - a zip GDAL cannot read raises (so the download is retried) and leaves
+      no .tif behind
+    - a download that keeps failing stops after the set number of attempts
+and reports the throughput for 1, 4 and 8 downloads at a time.
+
+Run from anywhere with:
+    python Benchmarks/Downloads.py
+"""
+
+import os
+import io
+import sys
+import time
+import json
+import shutil
+import random
+import zipfile
+import tempfile
+import threading
+import warnings
+warnings.filterwarnings("ignore")
+from urllib.parse import quote, unquote
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timedelta, timezone
+import numpy as np
+import rasterio
+from rasterio.transform import from_origin
+from rasterio.warp import transform
+
+RepoDir = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, RepoDir)
+from Toolshed import Download, EEEmulator
+
+#%% Settings
+
+NoImages = 16
+Workers = [1, 4, 8]
+Latency = 0.1 # seconds before the server answers
+FailRate = 0.05 # share of requests answered with HTTP 500
+StallRate = 0.05 # share of requests that stall half way
+Timeout = 1 # seconds before a stalled download is abandoned
+Retries = 8 # all band groups of an image are retried together
+Backoff = 0.1
+Seed = 0
+
+
+#%% Inputs
+
+WorkDir = tempfile.mkdtemp()
+Root = os.path.join(WorkDir, 'ee')
+Collection = 'COPERNICUS/S2_HARMONIZED'
+S2Bands = ['B1','B2','B3','B4','B5','B6','B7','B8','B8A','B9','B10','B11','B12','QA10','QA20','QA60']
+rng = np.random.default_rng(Seed)
+os.makedirs(os.path.join(Root, *Collection.split('/')))
+ImageIDs = []
+for i in range(NoImages):
+    date = datetime(2020, 1, 1, 11, 21, tzinfo=timezone.utc) + timedelta(days=5*i)
+    name = date.strftime('%Y%m%dT%H%M%S') + '_' + date.strftime('%Y%m%dT%H%M%S') + '_T30VVH'
+    path = os.path.join(Root, *Collection.split('/'), name)
+    with rasterio.open(path + '.tif', 'w', driver='GTiff', width=300, height=300, count=len(S2Bands),
+                       dtype='uint16', crs='EPSG:32630', transform=from_origin(500000, 6250000, 10, 10)) as dst:
+        dst.write((rng.random((len(S2Bands), 300, 300))*3000).astype('uint16'))
+    with open(path + '.json', 'w') as f:
+        json.dump({'bands':S2Bands, 'properties':{'system:time_start':int(date.timestamp()*1000)}}, f)
+    ImageIDs.append(Collection + '/' + name)
+
+# site polygon (lon/lat) inside the tiles
+xs, ys = [500500, 502500, 502500, 500500, 500500], [6249500, 6249500, 6247500, 6247500, 6249500]
+polygon = [[list(xy) for xy in zip(*transform('EPSG:32630', 'EPSG:4326', xs, ys))]]
+
+
+#%% Local download server
+
+class Server(BaseHTTPRequestHandler):
+    """
+    Serves the emulator's zip files, with a wait, failures and stalls.
+    """
+    lock = threading.Lock()
+    random = random.Random(Seed)
+    faults = True
+    mode = None # force 'fail', 'stall' or 'corrupt' on every request
+    counts = {'requests':0, 'failed':0, 'stalled':0}
+
+    def log_message(self, *args):
+        pass
+
+    def do_GET(self):
+        with self.lock:
+            draw = self.random.random()
+            self.counts['requests'] += 1
+        mode = self.mode
+        if mode is None and self.faults:
+            mode = 'fail' if draw < FailRate else 'stall' if draw < FailRate + StallRate else None
+        time.sleep(Latency)
+        if mode == 'fail':
+            with self.lock:
+                self.counts['failed'] += 1
+            self.send_error(500)
+            return
+        with open(unquote(self.path.split('docid=')[1]), 'rb') as f:
+            data = f.read()
+        if mode == 'corrupt':
+            # same file names, but not GeoTIFFs
+            buffer = io.BytesIO()
+            with zipfile.ZipFile(io.BytesIO(data)) as src, zipfile.ZipFile(buffer, 'w') as dst:
+                for fn in src.namelist():
+                    dst.writestr(fn, b'not a tif' * 100)
+            data = buffer.getvalue()
+        self.send_response(200)
+        self.send_header('Content-Length', str(len(data)))
+        self.end_headers()
+        if mode == 'stall':
+            with self.lock:
+                self.counts['stalled'] += 1
+            self.wfile.write(data[:len(data)//2])
+            self.wfile.flush()
+            time.sleep(Timeout*3)
+            return
+        self.wfile.write(data)
+
+
+Httpd = ThreadingHTTPServer(('127.0.0.1', 0), Server)
+Httpd.daemon_threads = True
+threading.Thread(target=Httpd.serve_forever, daemon=True).start()
+
+Emulator = EEEmulator.Emulator(Root, seed=Seed).Install()
+Emulator.ee.data.makeDownloadUrl = lambda downloadId: ('http://127.0.0.1:%d/download?docid=%s' %
+                                                       (Httpd.server_port, quote(downloadId['docid'])))
+Images = [Emulator.ee.Image(imageID) for imageID in ImageIDs]
+Bands = Images[0].getInfo()['bands']
+BandGroups = {'10m':[Bands[1], Bands[2], Bands[3], Bands[7]], '20m':[Bands[11]], '60m':[Bands[15]]}
+
+def Downloads(folder, i):
+    # one .tif per band group, as in retrieve_images for S2
+    return [(bands, folder, '%s_S2_%s.tif' % (ImageIDs[i].split('/')[-1], key)) for key, bands in BandGroups.items()]
+
+def DownloadAll(folder, workers):
+    os.makedirs(folder)
+    Start = time.perf_counter()
+    with ThreadPoolExecutor(workers) as Pool:
+        Futures = [Pool.submit(Download.download_image, Images[i], polygon, Downloads(folder, i),
+                               Retries, Backoff, Timeout) for i in range(NoImages)]
+        for Future in Futures:
+            Future.result()
+    return time.perf_counter() - Start
+
+def Read(path):
+    with rasterio.open(path) as src:
+        return src.read(), src.transform, src.crs
+
+
+#%% Run and check
+
+Passed = True
+
+# reference: one at a time, no faults
+Server.faults = False
+RefDir = os.path.join(WorkDir, 'reference')
+RefTime = DownloadAll(RefDir, 1)
+Reference = dict((fn, Read(os.path.join(RefDir, fn))) for fn in os.listdir(RefDir))
+print('reference, one at a time without faults: %d files in %.1f s' % (len(Reference), RefTime))
+
+Server.faults = True
+for workers in Workers:
+    OutDir = os.path.join(WorkDir, 'workers%d' % workers)
+    Server.counts.update(requests=0, failed=0, stalled=0)
+    RunTime = DownloadAll(OutDir, workers)
+    Files = sorted(os.listdir(OutDir))
+    Same = (Files == sorted(Reference) and
+            all(np.array_equal(Read(os.path.join(OutDir, fn))[0], Reference[fn][0]) and
+                Read(os.path.join(OutDir, fn))[1:] == Reference[fn][1:] for fn in Files))
+    Passed &= Same
+    MBytes = sum(os.path.getsize(os.path.join(OutDir, fn)) for fn in Files) / 1e6
+    print('%d at a time: %.1f s, %.1f images/s, %.1f MB/s (%d requests, %d failed, %d stalled): %s' %
+          (workers, RunTime, NoImages/RunTime, MBytes/RunTime, Server.counts['requests'],
+           Server.counts['failed'], Server.counts['stalled'], 'match' if Same else 'MISMATCH'))
+
+FaultDir = os.path.join(WorkDir, 'faults')
+os.makedirs(FaultDir)
+for mode in ['stall', 'corrupt', 'fail']:
+    Server.mode = mode
+    Server.counts.update(requests=0)
+    Start = time.perf_counter()
+    try:
+        if mode == 'fail':
+            Download.download_image(Images[0], polygon, Downloads(FaultDir, 0)[:1], 3, Backoff, Timeout)
+        else:
+            Download.download_tif(Images[0], polygon, BandGroups['10m'], FaultDir, 'fault.tif', Timeout)
+        Error = None
+    except Exception as e:
+        Error = e
+    Elapsed = time.perf_counter() - Start
+    if mode == 'stall':
+        Same = Error is not None and Elapsed < Timeout + Latency + 1
+        print('stalled download: %s after %.1f s: %s' % (type(Error).__name__, Elapsed, 'ok' if Same else 'MISMATCH'))
+    elif mode == 'corrupt':
+        Same = Error is not None and os.listdir(FaultDir) == []
+        print('unreadable bands: %s, files left %s: %s' % (Error, os.listdir(FaultDir), 'ok' if Same else 'MISMATCH'))
+    else:
+        Same = Error is not None and Server.counts['requests'] == 3
+        print('failing download: gave up after %d requests: %s' % (Server.counts['requests'], 'ok' if Same else 'MISMATCH'))
+    Passed &= Same
+Server.mode = None
+
+Emulator.Uninstall()
+Httpd.shutdown()
+shutil.rmtree(WorkDir)
+print('PASS' if Passed else 'FAIL')
+sys.exit(0 if Passed else 1)
@@ -0,0 +1,188 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Fault test and benchmark for Download.check_images_available and
+Toolbox.GetInfoRetry, with the Earth Engine API replaced by
+Toolshed.EEEmulator over seeded synthetic Landsat 8 (Tier 1 and 2) and
+Sentinel-2 collections. The emulator adds latency to every request and fails
+a share of them. Backoff waits are recorded rather than slept. The script
+checks:
+    - the images (and counts, with return_images=False) found under
+      failures are the ones expected from the local collections
+    - every getInfo request either succeeds or is retried, and no query is
+      tried more than the set number of times
+    - a request that keeps failing stops after the set number of attempts,
+      with capped waits in between
+    - an error that won't go away (missing asset) is raised straight away
+    - a request that hangs is abandoned after the timeout
+and times the concurrent queries against one query at a time.
+
+Run from anywhere with:
+    python Benchmarks/EERetries.py
+"""
+
+import os
+import io
+import sys
+import time
+import json
+import types
+import shutil
+import tempfile
+import contextlib
+import warnings
+warnings.filterwarnings("ignore")
+from datetime import datetime, timedelta, timezone
+import numpy as np
+import rasterio
+from rasterio.transform import from_origin
+from rasterio.warp import transform
+
+RepoDir = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, RepoDir)
+from Toolshed import Download, Toolbox, EEEmulator
+
+#%% Settings
+
+NoImages = 60 # per collection
+Latency = (0.05, 0.2) # seconds per request
+FailureRate = 0.3
+Seed = 0
+Collections = {('T1','L8'):('LANDSAT/LC08/C01/T1_TOA', 'CLOUD_COVER'),
+               ('T2','L8'):('LANDSAT/LC08/C01/T2_TOA', 'CLOUD_COVER'),
+               ('T1','S2'):('COPERNICUS/S2', 'CLOUDY_PIXEL_PERCENTAGE')}
+
+
+#%% Inputs
+
+WorkDir = tempfile.mkdtemp()
+Root = os.path.join(WorkDir, 'ee')
+rng = np.random.default_rng(Seed)
+Expected = {}
+for (tier, satname), (collection, cloudkey) in Collections.items():
+    folder = os.path.join(Root, *collection.split('/'))
+    os.makedirs(folder)
+    Expected[(tier, satname)] = []
+    for i in range(NoImages):
+        date = datetime(2019, 1, 1, 11, tzinfo=timezone.utc) + timedelta(days=int(rng.integers(0, 730)), minutes=i)
+        name = '%s_%s_%03d' % (satname, date.strftime('%Y%m%d'), i)
+        with rasterio.open(os.path.join(folder, name + '.tif'), 'w', driver='GTiff', width=10, height=10,
+                           count=1, dtype='uint8', crs='EPSG:32630',
+                           transform=from_origin(500000, 6250000, 300, 300)) as dst:
+            dst.write(np.zeros((1, 10, 10), 'uint8'))
+        cloud = float(rng.uniform(0, 100))
+        with open(os.path.join(folder, name + '.json'), 'w') as f:
+            json.dump({'properties':{'system:time_start':int(date.timestamp()*1000), cloudkey:cloud}}, f)
+        if date < datetime(2020, 6, 1, tzinfo=timezone.utc) and cloud <= 95:
+            Expected[(tier, satname)].append(collection + '/' + name)
+
+xs, ys = [500500, 502500, 502500, 500500, 500500], [6249500, 6249500, 6247500, 6247500, 6249500]
+polygon = [[list(xy) for xy in zip(*transform('EPSG:32630', 'EPSG:4326', xs, ys))]]
+inputs = {'polygon':polygon, 'dates':['2019-01-01', '2020-06-01'], 'sat_list':['L8', 'S2'],
+          'daterange':'yes'}
+
+# backoff waits are recorded instead of slept
+Waits = []
+Toolbox.time = types.SimpleNamespace(sleep=Waits.append, time=time.time, perf_counter=time.perf_counter)
+
+
+class Missing:
+    # getInfo() on an asset that does not exist, as raised by the server
+    calls = 0
+    def getInfo(self):
+        Missing.calls += 1
+        raise EEException("ImageCollection.load: ImageCollection asset 'LANDSAT/LC08/C03/T1' not found.")
+
+
+#%% Run and check
+
+Passed = True
+Emulator = EEEmulator.Emulator(Root, latency=Latency, failure_rate=FailureRate, seed=Seed).Install()
+EEException = Emulator.ee.EEException
+
+for return_images in [True, False]:
+    Emulator.Reset()
+    del Waits[:]
+    Start = time.perf_counter()
+    with contextlib.redirect_stdout(io.StringIO()):
+        T1, T2 = Download.check_images_available(inputs, return_images)
+    RunTime = time.perf_counter() - Start
+    Found = {}
+    for (tier, satname) in Collections:
+        result = (T1 if tier == 'T1' else T2)[satname]
+        Found[(tier, satname)] = sorted(im['id'] for im in result) if return_images else result
+    if return_images:
+        Same = Found == dict((key, sorted(ids)) for key, ids in Expected.items())
+    else:
+        Same = Found == dict((key, len(ids)) for key, ids in Expected.items())
+    Stats = Emulator.Stats()
+    Calls, Failures = Stats['calls']['getInfo'], Stats['failures'].get('getInfo', 0)
+    Queries = len(Collections) if return_images else 1
+    # every failure was retried once, and no query used up its 6 attempts
+    Bounded = Calls == Queries + Failures and len(Waits) == Failures and max(Waits + [0]) <= 32
+    Passed &= Same and Bounded
+    print('return_images=%s: %.2f s, %d getInfo requests, %d failed and retried: %s, %s' %
+          (return_images, RunTime, Calls, Failures, 'match' if Same else 'MISMATCH',
+           'bounded' if Bounded else 'UNBOUNDED'))
+
+# one query at a time, without failures, as before
+Emulator.failure_rate = 0
+Emulator.Reset()
+with contextlib.redirect_stdout(io.StringIO()):
+    Start = time.perf_counter()
+    Download.check_images_available(inputs)
+    ConcurrentTime = time.perf_counter() - Start
+    point = Emulator.ee.Geometry.Point(polygon[0][0])
+    Start = time.perf_counter()
+    for (tier, satname), (collection, cloudkey) in Collections.items():
+        Emulator.ee.ImageCollection(collection).filterBounds(point).filterDate(*inputs['dates'])\
+            .filter(Emulator.ee.Filter.lte(cloudkey, 95)).getInfo()
+    SerialTime = time.perf_counter() - Start
+print('%d queries without failures: one at a time %.2f s, concurrent %.2f s' %
+      (len(Collections), SerialTime, ConcurrentTime))
+
+# a request that always fails
+Emulator.failure_rate = 1
+Emulator.Reset()
+del Waits[:]
+try:
+    Toolbox.GetInfoRetry(Emulator.ee.ImageCollection('COPERNICUS/S2').size())
+    Error = None
+except EEException as e:
+    Error = e
+Calls = Emulator.Stats()['calls']['getInfo']
+Same = Error is not None and Calls == 6 and Waits == [1, 2, 4, 8, 16]
+Passed &= Same
+print('always failing: gave up after %d requests, waits %s s: %s' % (Calls, Waits, 'ok' if Same else 'MISMATCH'))
+
+# an error that is not worth retrying
+del Waits[:]
+try:
+    Toolbox.GetInfoRetry(Missing())
+    Error = None
+except EEException as e:
+    Error = e
+Same = Error is not None and Missing.calls == 1 and Waits == []
+Passed &= Same
+print('missing asset: raised after %d request, no waits: %s' % (Missing.calls, 'ok' if Same else 'MISMATCH'))
+
+# a request that hangs
+Emulator.failure_rate = 0
+Emulator.latency = 3
+Emulator.Reset()
+del Waits[:]
+Start = time.perf_counter()
+try:
+    Toolbox.GetInfoRetry(Emulator.ee.ImageCollection('COPERNICUS/S2').size(), retries=2, timeout=0.5)
+    Error = None
+except TimeoutError as e:
+    Error = e
+Elapsed = time.perf_counter() - Start
+Same = Error is not None and Emulator.Stats()['calls']['getInfo'] == 2 and Elapsed < 2
+Passed &= Same
+print('hanging request: %s after 2 attempts in %.1f s: %s' % (type(Error).__name__, Elapsed, 'ok' if Same else 'MISMATCH'))
+
+Emulator.Uninstall()
+shutil.rmtree(WorkDir)
+print('PASS' if Passed else 'FAIL')
+sys.exit(0 if Passed else 1)
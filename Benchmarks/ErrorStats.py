@@ -0,0 +1,156 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Benchmark and parity check for Toolbox.QuantifyErrors against the per-date,
+per-transect list loops it replaced, on a seeded synthetic validation
+dictionary (with missing dates, nan distances and transects with no
+validation intersections). Also checks that QuantifyErrorsSites, streaming
+over the same transects split into two sites, gives the same totals.
+
+Run from anywhere with:
+    python Benchmarks/ErrorStats.py
+"""
+
+import os
+import io
+import sys
+import time
+import shutil
+import tempfile
+import contextlib
+import warnings
+warnings.filterwarnings("ignore")
+import numpy as np
+import pandas as pd
+
+RepoDir = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, RepoDir)
+from Toolshed import Toolbox
+
+#%% Settings
+
+sitename = 'StAndrews'
+NoTransects = 2000
+NoDates = 150
+Seed = 0
+
+
+#%% Reference implementation (lists of differences per sat date)
+
+def OldQuantifyErrors(SatGDF, DatesCol, ValidDict, TransectIDs):
+    errordata = []
+    errordates = []
+    for Sdate in SatGDF[DatesCol].unique():
+        valsatdist = []
+        for Tr in range(TransectIDs[0],TransectIDs[1]):
+            if Sdate in ValidDict['dates'][Tr]:
+                DateIndex = (ValidDict['dates'][Tr].index(Sdate))
+                if ValidDict['valsatdist'][Tr] != []:
+                    valsatdist.append(ValidDict['valsatdist'][Tr][DateIndex])
+        if valsatdist != []:
+            errordata.append(valsatdist)
+            errordates.append(Sdate)
+    errordatesrt, errorsrt = [list(d) for d in zip(*sorted(zip(errordates, errordata), key=lambda x: x[0]))]
+    df = pd.DataFrame(errorsrt).transpose()
+    df.columns = errordatesrt
+
+    errordict = {'Date':[],'Count':[],'MAE':[],'RMSE':[],'CountSub10m':[],'CountSub15m':[]}
+    totald = []
+    for date in df.columns:
+        d = df[date]
+        totald.extend(d)
+        if d.count() != 0:
+            errordict['Date'].append(date)
+            errordict['Count'].append(d.count())
+            errordict['MAE'].append(np.mean(abs(d)))
+            errordict['RMSE'].append(np.sqrt(np.mean(d**2)))
+            errordict['CountSub10m'].append(d.between(-10,10).sum())
+            errordict['CountSub15m'].append(d.between(-15,15).sum())
+    totald = np.array(totald)
+    totald = totald[~np.isnan(totald)]
+    errordict['Date'].append('Total')
+    errordict['Count'].append(len(totald))
+    errordict['MAE'].append(np.mean(abs(totald)))
+    errordict['RMSE'].append(np.sqrt(np.mean(totald**2)))
+    errordict['CountSub10m'].append(np.logical_and(totald>=-10,totald<=10).sum())
+    errordict['CountSub15m'].append(np.logical_and(totald>=-15,totald<=15).sum())
+
+    return pd.DataFrame(errordict)
+
+
+#%% Inputs
+
+rng = np.random.default_rng(Seed)
+SatDates = sorted(set(str(Date)[:10] for Date in
+                      pd.Timestamp('2015-01-01') + pd.to_timedelta(rng.integers(0, 3000, NoDates), unit='D')))
+ValidDict = {'dates':[], 'distances':[], 'valsatdist':[], 'satname':[]}
+for Tr in range(NoTransects):
+    TrDates = [Date for Date in SatDates if rng.random() > 0.3]
+    Dists = list(rng.normal(0, 12, len(TrDates)))
+    if TrDates and rng.random() < 0.3:
+        Dists[0] = np.nan
+    ValidDict['dates'].append(TrDates)
+    ValidDict['distances'].append(list(rng.uniform(50, 150, len(TrDates))))
+    ValidDict['valsatdist'].append(Dists if Tr % 11 else [])
+    ValidDict['satname'].append(list(rng.choice(['L5','L8','S2'], len(TrDates))))
+# only dates in the sat lines are used
+SatGDF = pd.DataFrame({'dates':SatDates[:-5]})
+TransectIDs = [5, NoTransects-5]
+
+WorkDir = tempfile.mkdtemp()
+os.makedirs(os.path.join(WorkDir, 'Data', sitename))
+os.chdir(WorkDir)
+
+print('%i transects, %i sat dates' % (NoTransects, len(SatDates)))
+
+
+#%% Run both and compare
+
+Start = time.perf_counter()
+OldDF = OldQuantifyErrors(SatGDF, 'dates', ValidDict, TransectIDs)
+OldTime = time.perf_counter() - Start
+
+Start = time.perf_counter()
+with contextlib.redirect_stdout(io.StringIO()):
+    NewDF = Toolbox.QuantifyErrors(sitename, SatGDF, 'dates', ValidDict, TransectIDs,
+                                   Breakdowns=['satname','season','cluster'],
+                                   Clusters=np.arange(NoTransects)//100)
+NewTime = time.perf_counter() - Start
+
+Passed = list(OldDF['Date']) == list(NewDF['Date'])
+print('Dates: %s' % ('match' if Passed else 'MISMATCH'))
+for Col in ['Count','MAE','RMSE','CountSub10m','CountSub15m']:
+    Same = Passed and np.allclose(OldDF[Col].astype(float), NewDF[Col].astype(float))
+    Passed &= Same
+    print('%s: %s' % (Col, 'match' if Same else 'MISMATCH'))
+
+# bias and R squared were not calculated before; check total against numpy
+d = np.array([ValidDict['valsatdist'][Tr][ValidDict['dates'][Tr].index(Date)]
+              for Date in SatGDF['dates'] for Tr in range(*TransectIDs)
+              if Date in ValidDict['dates'][Tr] and ValidDict['valsatdist'][Tr] != []])
+y = np.array([ValidDict['distances'][Tr][ValidDict['dates'][Tr].index(Date)]
+              for Date in SatGDF['dates'] for Tr in range(*TransectIDs)
+              if Date in ValidDict['dates'][Tr] and ValidDict['valsatdist'][Tr] != []]) - d
+y, d = y[~np.isnan(d)], d[~np.isnan(d)]
+Total = NewDF[NewDF['Date'] == 'Total'].iloc[0]
+Same = (np.isclose(Total['Bias'], np.mean(d)) and
+        np.isclose(Total['R2'], 1 - np.sum(d**2)/np.sum((y - np.mean(y))**2)))
+Passed &= Same
+print('Bias, R2: %s' % ('match' if Same else 'MISMATCH'))
+
+# one pass over two halves as separate sites
+Mid = NoTransects // 2
+SitesDF = Toolbox.QuantifyErrorsSites(((SatGDF, 'dates', ValidDict, [TransectIDs[0], Mid]),
+                                       (SatGDF, 'dates', ValidDict, [Mid, TransectIDs[1]])))
+Same = (list(SitesDF['dates']) == list(NewDF['Date']) and
+        np.allclose(SitesDF[['Count','MAE','RMSE','Bias','R2']].astype(float),
+                    NewDF[['Count','MAE','RMSE','Bias','R2']].astype(float)))
+Passed &= Same
+print('QuantifyErrorsSites: %s' % ('match' if Same else 'MISMATCH'))
+
+print('QuantifyErrors: lists %.2f s, grouped %.2f s incl. 3 breakdowns (%.1fx)' % (OldTime, NewTime, OldTime/NewTime))
+
+os.chdir(RepoDir)
+shutil.rmtree(WorkDir)
+print('PASS' if Passed else 'FAIL')
+sys.exit(0 if Passed else 1)
@@ -0,0 +1,167 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Benchmark and check of Toolbox.ScanLocalHeaders (image headers read in
+parallel and kept in an SQLite index keyed by path, modification time and
+size) as used by Toolbox.LocalImageMetadata, against the loop opening every
+image in turn it replaced, on 5000 small seeded synthetic GeoTIFFs. The
+script checks:
+    - LocalImageMetadata gives the same filenames, georef, epsg and dates as
+      the old loop, on a first scan and on a rescan from the index
+    - a rescan opens no images
+    - an image rewritten with a new transform (same size, new mtime), one
+      rewritten with a new size and its old mtime put back, and one only
+      touched are each read again, with the new headers returned and stored;
+      new images are read and added; nothing else is opened
+and reports the time of each scan.
+
+Run from anywhere with:
+    python Benchmarks/LocalHeaders.py
+"""
+
+import os
+import io
+import sys
+import time
+import shutil
+import sqlite3
+import tempfile
+import contextlib
+import warnings
+warnings.filterwarnings("ignore")
+from datetime import datetime, timedelta
+import numpy as np
+import rasterio
+from rasterio.transform import from_origin
+
+RepoDir = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, RepoDir)
+from Toolshed import Toolbox
+
+#%% Settings
+
+sitename = 'StAndrews'
+NoImages = 5000
+Seed = 0
+
+
+#%% Reference implementation (every image opened in turn)
+
+def OldLocalImageMetadata(inputs, Sat):
+    metadata = dict([])
+
+    for i in range(len(inputs['sat_list'])):
+        metadata[inputs['sat_list'][i]] = {'filenames':[], 'acc_georef':[], 'epsg':[], 'dates':[]}
+
+    for i in range(1):
+        for j in range(len(Sat[i])):
+
+            imdata = rasterio.open(Sat[i][j])
+
+            metadata[inputs['sat_list'][i]]['filenames'].append(Sat[i][j])
+
+            metadata[inputs['sat_list'][i]]['acc_georef'].append(list(imdata.transform)[0:6])
+
+            metadata[inputs['sat_list'][i]]['epsg'].append(str(imdata.crs).lstrip('EPSG:'))
+
+            date = datetime.strptime(os.path.basename(Sat[i][j])[0:8],'%Y%m%d') #relies on date being YYYYMMDD first in filename
+            metadata[inputs['sat_list'][i]]['dates'].append(str(date.strftime('%Y-%m-%d')))
+
+    return metadata
+
+
+#%% Inputs
+
+rng = np.random.default_rng(Seed)
+WorkDir = tempfile.mkdtemp()
+ImDir = os.path.join(WorkDir, sitename, 'local_images', 'PSScene4Band')
+os.makedirs(ImDir)
+EPSGs = [32630, 32631, 27700]
+
+def WriteImage(fn, x0, y0, res, epsg, size=8):
+    with rasterio.open(fn, 'w', driver='GTiff', width=size, height=size, count=4, dtype='uint16',
+                       crs='EPSG:%d' % epsg, transform=from_origin(x0, y0, res, res)) as dst:
+        dst.write(rng.integers(0, 10000, (4, size, size)).astype('uint16'))
+
+Sat = [[]]
+for i in range(NoImages):
+    date = datetime(2016, 1, 1) + timedelta(days=int(i//3))
+    fn = os.path.join(ImDir, '%s_%06d_%d_3B_AnalyticMS.tif' % (date.strftime('%Y%m%d'), i, i % 3))
+    WriteImage(fn, 500000 + float(rng.uniform(-50, 50)), 6250000 + float(rng.uniform(-50, 50)), 3.0, EPSGs[i % 3])
+    Sat[0].append(fn)
+inputs = {'sitename':sitename, 'filepath':WorkDir, 'sat_list':['PSScene4Band']}
+MetaFile = os.path.join(WorkDir, sitename, sitename + '_metadata.pkl')
+IndexFile = os.path.join(WorkDir, sitename, sitename + '_localheaders.sqlite')
+
+# count the images opened by the scan
+Opened = []
+ReadLocalHeader = Toolbox.ReadLocalHeader
+def CountedReadLocalHeader(impath):
+    Opened.append(impath)
+    return ReadLocalHeader(impath)
+Toolbox.ReadLocalHeader = CountedReadLocalHeader
+
+def Run(Sat):
+    # metadata pickle removed so the headers are scanned each time
+    if os.path.exists(MetaFile):
+        os.remove(MetaFile)
+    del Opened[:]
+    Start = time.perf_counter()
+    with contextlib.redirect_stdout(io.StringIO()):
+        metadata = Toolbox.LocalImageMetadata(inputs, Sat)
+    return metadata, time.perf_counter() - Start, sorted(Opened)
+
+def Indexed(impath):
+    con = sqlite3.connect(IndexFile)
+    row = con.execute("SELECT mtime, size, transform, crs FROM headers WHERE path = ?", (impath,)).fetchone()
+    con.close()
+    return row
+
+
+#%% Run both and compare
+
+Passed = True
+
+Start = time.perf_counter()
+Old = OldLocalImageMetadata(inputs, Sat)
+OldTime = time.perf_counter() - Start
+
+New, NewTime, NewOpened = Run(Sat)
+Same = New == Old and NewOpened == sorted(Sat[0])
+Passed &= Same
+print('first scan, %d images: %.2f s one at a time, %.2f s now: %s' % (NoImages, OldTime, NewTime, 'match' if Same else 'MISMATCH'))
+
+Again, AgainTime, AgainOpened = Run(Sat)
+Same = Again == Old and AgainOpened == []
+Passed &= Same
+print('rescan from the index: %.2f s (%.0fx), %d images opened: %s' %
+      (AgainTime, OldTime/AgainTime, len(AgainOpened), 'match' if Same else 'MISMATCH'))
+
+# change a few images on disk, and add some
+Moved, Resized, Touched = Sat[0][10], Sat[0][20], Sat[0][30]
+WriteImage(Moved, 400000, 6150000, 3.0, 32630) # same size, new mtime
+Stat = os.stat(Resized)
+WriteImage(Resized, 400000, 6150000, 5.0, 32631, size=16) # new size, old mtime put back
+os.utime(Resized, ns=(Stat.st_atime_ns, Stat.st_mtime_ns))
+os.utime(Touched, ns=(os.stat(Touched).st_atime_ns, os.stat(Touched).st_mtime_ns + 10**9))
+Added = []
+for i in range(3):
+    fn = os.path.join(ImDir, '20300101_%06d_0_3B_AnalyticMS.tif' % i)
+    WriteImage(fn, 510000, 6260000, 3.0, 32630)
+    Added.append(fn)
+Sat2 = [Sat[0] + Added]
+Expected = OldLocalImageMetadata(inputs, Sat2)
+Updated, UpdateTime, UpdateOpened = Run(Sat2)
+Same = Updated == Expected and UpdateOpened == sorted([Moved, Resized, Touched] + Added)
+Same &= Expected != Old # the changes are seen
+for impath in [Moved, Resized, Touched] + Added:
+    Stat, Row = os.stat(impath), Indexed(impath)
+    Same &= Row is not None and (Row[0], Row[1]) == (Stat.st_mtime, Stat.st_size)
+Passed &= Same
+print('rescan after 1 image moved (same size), 1 resized (same mtime), 1 touched and %d added: %.2f s, %s opened: %s' %
+      (len(Added), UpdateTime, len(UpdateOpened), 'match' if Same else 'MISMATCH'))
+
+Toolbox.ReadLocalHeader = ReadLocalHeader
+shutil.rmtree(WorkDir)
+print('PASS' if Passed else 'FAIL')
+sys.exit(0 if Passed else 1)
@@ -0,0 +1,184 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Benchmark and parity check for Toolbox.metadata_collection (one batched,
+server-side reduced request for all satellites) against the per-collection
+getInfo() loop it replaced, with the Earth Engine API replaced by
+Toolshed.EEEmulator over seeded synthetic Landsat 8 and Sentinel-2
+collections. The script checks:
+    - filenames, georef accuracy, epsg and dates match the old loop, and
+      cloud cover matches the image properties
+    - all satellites are fetched with a single getInfo request
+    - with inputs['update_metadata'], a cached run over a shorter date range
+      picks up the images of the longer range (and an image published late
+      on the last cached date), ending up with the same images as a fresh run
+    - an update with nothing new adds nothing
+and reports the requests, bytes and time of each.
+
+Run from anywhere with:
+    python Benchmarks/Metadata.py
+"""
+
+import os
+import io
+import sys
+import time
+import json
+import shutil
+import pickle
+import tempfile
+import contextlib
+import warnings
+warnings.filterwarnings("ignore")
+from datetime import datetime, timedelta, timezone
+import numpy as np
+import rasterio
+from rasterio.transform import from_origin
+from rasterio.warp import transform
+
+RepoDir = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, RepoDir)
+from Toolshed import Toolbox, EEEmulator
+
+#%% Settings
+
+sitename = 'StAndrews'
+NoImages = 150 # per collection
+Latency = 0.05 # seconds per request
+Seed = 0
+Bands = {'L8':['B1','B2','B3','B4','B5','B6','B7','B8','B9','B10','B11','BQA'],
+         'S2':['B1','B2','B3','B4','B5','B6','B7','B8','B8A','B9','B10','B11','B12','QA10','QA20','QA60']}
+Collections = {'L8':'LANDSAT/LC08/C01/T1_TOA', 'S2':'COPERNICUS/S2'}
+
+
+#%% Reference implementation (every image's full description fetched, one collection at a time)
+
+def OldMetadata(sat_list, Sat):
+    metadata = dict([])
+    for i in range(len(sat_list)):
+        metadata[sat_list[i]] = {'filenames':[], 'acc_georef':[], 'epsg':[], 'dates':[]}
+    for i in range(len(Sat)):
+        Features = Sat[i].getInfo().get('features')
+        for j in range(len(Features)):
+            Feature = Features[j]
+            if sat_list[i] != 'S2':
+                metadata[sat_list[i]]['filenames'].append(Feature['id'])
+                metadata[sat_list[i]]['acc_georef'].append(Feature['properties']['GEOMETRIC_RMSE_MODEL'])
+                metadata[sat_list[i]]['epsg'].append(int(Feature['bands'][0]['crs'].lstrip('EPSG:')))
+                metadata[sat_list[i]]['dates'].append(Feature['properties']['DATE_ACQUIRED'])
+            else:
+                metadata[sat_list[i]]['filenames'].append(Feature['id'])
+                metadata[sat_list[i]]['acc_georef'].append(Feature['bands'][1]['crs_transform'])
+                metadata[sat_list[i]]['epsg'].append(int(Feature['bands'][1]['crs'].lstrip('EPSG:')))
+                d = datetime.strptime(Feature['properties']['DATATAKE_IDENTIFIER'][5:13],'%Y%m%d')
+                metadata[sat_list[i]]['dates'].append(str(d.strftime('%Y-%m-%d')))
+    return metadata
+
+
+#%% Inputs
+
+WorkDir = tempfile.mkdtemp()
+Root = os.path.join(WorkDir, 'ee')
+rng = np.random.default_rng(Seed)
+Clouds = {}
+
+def AddImage(satname, date):
+    folder = os.path.join(Root, *Collections[satname].split('/'))
+    os.makedirs(folder, exist_ok=True)
+    day = date.strftime('%Y%m%d')
+    name = ('LC08_204020_%s_%s' if satname == 'L8' else '%s_%s_T30VVH') % (day, date.strftime('%H%M%S'))
+    with rasterio.open(os.path.join(folder, name + '.tif'), 'w', driver='GTiff', width=10, height=10,
+                       count=len(Bands[satname]), dtype='uint16', crs='EPSG:32630',
+                       transform=from_origin(500000, 6250000, 300, 300)) as dst:
+        dst.write(np.zeros((len(Bands[satname]), 10, 10), 'uint16'))
+    cloud = float(rng.uniform(0, 80))
+    props = {'system:time_start':int(date.timestamp()*1000)}
+    if satname == 'L8':
+        props.update(DATE_ACQUIRED=date.strftime('%Y-%m-%d'), CLOUD_COVER=cloud,
+                     GEOMETRIC_RMSE_MODEL=float(rng.uniform(4, 10)))
+    else:
+        props.update(DATATAKE_IDENTIFIER='GS2A_%sT112121_000_N02.08' % day, CLOUDY_PIXEL_PERCENTAGE=cloud)
+    with open(os.path.join(folder, name + '.json'), 'w') as f:
+        json.dump({'bands':Bands[satname], 'properties':props}, f)
+    Clouds[Collections[satname] + '/' + name] = cloud
+
+for satname, start in [('L8', datetime(2019, 1, 1, 11, 5, tzinfo=timezone.utc)),
+                       ('S2', datetime(2019, 1, 2, 11, 21, tzinfo=timezone.utc))]:
+    for i in range(NoImages):
+        AddImage(satname, start + timedelta(days=5*i))
+
+xs, ys = [500500, 502500, 502500, 500500, 500500], [6249500, 6249500, 6247500, 6247500, 6249500]
+polygon = [[list(xy) for xy in zip(*transform('EPSG:32630', 'EPSG:4326', xs, ys))]]
+os.makedirs(os.path.join(WorkDir, sitename))
+def Inputs(enddate, update=False):
+    return {'polygon':polygon, 'dates':['2019-01-01', enddate], 'sat_list':['L8', 'S2'],
+            'sitename':sitename, 'filepath':WorkDir, 'cloud_thresh':0.9, 'update_metadata':update}
+MetaFile = os.path.join(WorkDir, sitename, sitename + '_metadata.pkl')
+
+def Rows(metadata):
+    # one sortable row per image, whatever order the images were added in
+    return dict((satname, sorted((fn, json.dumps(acc), epsg, date) for fn, acc, epsg, date in
+                                 zip(meta['filenames'], meta['acc_georef'], meta['epsg'], meta['dates'])))
+                for satname, meta in metadata.items())
+
+def Run(inputs, fresh):
+    if fresh and os.path.exists(MetaFile):
+        os.remove(MetaFile)
+    Emulator.Reset()
+    Start = time.perf_counter()
+    with contextlib.redirect_stdout(io.StringIO()):
+        metadata = Toolbox.metadata_collection(inputs, Toolbox.image_retrieval(inputs))
+    RunTime = time.perf_counter() - Start
+    Stats = Emulator.Stats()
+    return metadata, RunTime, Stats['calls'].get('getInfo', 0), Stats['bytes'].get('getInfo', 0)
+
+
+#%% Run both and compare
+
+Passed = True
+Emulator = EEEmulator.Emulator(Root, latency=Latency, seed=Seed).Install()
+
+inputs = Inputs('2021-01-01')
+Emulator.Reset()
+Start = time.perf_counter()
+Old = OldMetadata(inputs['sat_list'], Toolbox.image_retrieval(inputs))
+OldTime = time.perf_counter() - Start
+OldStats = Emulator.Stats()
+New, NewTime, NewCalls, NewBytes = Run(inputs, True)
+Same = (Rows(New) == Rows(Old) and
+        all(np.allclose(meta['cloud_cover'], [Clouds[fn] for fn in meta['filenames']]) for meta in New.values()))
+Passed &= Same
+print('full run, %d images: %d requests, %.0f kB, %.2f s before; %d request, %.0f kB, %.2f s batched: %s' %
+      (sum(len(meta['filenames']) for meta in New.values()), OldStats['calls']['getInfo'],
+       OldStats['bytes']['getInfo']/1e3, OldTime, NewCalls, NewBytes/1e3, NewTime, 'match' if Same else 'MISMATCH'))
+Same = NewCalls == 1
+Passed &= Same
+print('  one getInfo request for %d satellites: %s' % (len(inputs['sat_list']), 'ok' if Same else 'MISMATCH'))
+
+# cache the first year, then update to the full range; meanwhile an S2 image is
+# published on the last cached date, later in the day than the one cached
+First, FirstTime, FirstCalls, FirstBytes = Run(Inputs('2020-01-01'), True)
+LastDate = datetime.strptime(max(First['S2']['dates']), '%Y-%m-%d').replace(hour=11, minute=50, tzinfo=timezone.utc)
+AddImage('S2', LastDate)
+Fresh = Run(inputs, True)[0]
+with open(MetaFile, 'wb') as f:
+    pickle.dump(First, f)
+Updated, UpdateTime, UpdateCalls, UpdateBytes = Run(Inputs('2021-01-01', True), False)
+Same = Rows(Updated) == Rows(Fresh) and UpdateCalls == 1
+Late = Collections['S2'] + '/%s_%s_T30VVH' % (LastDate.strftime('%Y%m%d'), LastDate.strftime('%H%M%S'))
+Same &= Late in Updated['S2']['filenames']
+Passed &= Same
+print('update from %d to %d images (with 1 published late): %d request, %.0f kB, %.2f s: %s' %
+      (sum(len(meta['filenames']) for meta in First.values()), sum(len(meta['filenames']) for meta in Updated.values()),
+       UpdateCalls, UpdateBytes/1e3, UpdateTime, 'match' if Same else 'MISMATCH'))
+
+Again, AgainTime, AgainCalls, AgainBytes = Run(Inputs('2021-01-01', True), False)
+Same = Again == Updated
+Passed &= Same
+print('update with nothing new: %d request, %.1f kB, nothing added: %s' %
+      (AgainCalls, AgainBytes/1e3, 'ok' if Same else 'MISMATCH'))
+
+Emulator.Uninstall()
+shutil.rmtree(WorkDir)
+print('PASS' if Passed else 'FAIL')
+sys.exit(0 if Passed else 1)
@@ -0,0 +1,111 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Benchmark and parity check for Image_Processing.pansharpen against the
+sklearn PCA and full histogram matching it replaced, on seeded synthetic
+Landsat-like scenes (30m multispectral resampled to 15m, with a 15m pan band
+and a cloud).
+
+The sign of the 1st PC is arbitrary in both versions, so the reference PC is
+oriented the same way (band loadings summing positive) before comparing.
+Every scene must also keep positive contrast: each pansharpened band has to
+correlate positively with the pan band, whichever way the eigensolver
+returns the PC.
+
+Run from anywhere with:
+    python Benchmarks/Pansharpen.py
+"""
+
+import os
+import sys
+import time
+import warnings
+warnings.filterwarnings("ignore")
+import numpy as np
+import sklearn.decomposition as decomposition
+import skimage.transform as transform
+
+RepoDir = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, RepoDir)
+from Toolshed import Image_Processing
+
+#%% Settings
+
+NoScenes = 6
+SceneSize = 1000
+Tolerance = 0.01 # 99.9th percentile difference as fraction of each band's range
+Seed = 0
+
+
+#%% Reference implementation (sklearn PCA on all non-cloud pixels)
+
+def OldPansharpen(im_ms, im_pan, cloud_mask):
+    vec = im_ms.reshape(im_ms.shape[0] * im_ms.shape[1], im_ms.shape[2])
+    vec_mask = cloud_mask.reshape(im_ms.shape[0] * im_ms.shape[1])
+    vec = vec[~vec_mask, :]
+    pca = decomposition.PCA()
+    vec_pcs = pca.fit_transform(vec)
+    # same orientation of 1st PC as the new version
+    if pca.components_[0].sum() < 0:
+        pca.components_[0] = -pca.components_[0]
+        vec_pcs[:,0] = -vec_pcs[:,0]
+    vec_pan = im_pan.reshape(im_pan.shape[0] * im_pan.shape[1])
+    vec_pan = vec_pan[~vec_mask]
+    vec_pcs[:,0] = Image_Processing.hist_match(vec_pan, vec_pcs[:,0])
+    vec_ms_ps = pca.inverse_transform(vec_pcs)
+    vec_ms_ps_full = np.ones((len(vec_mask), im_ms.shape[2])) * np.nan
+    vec_ms_ps_full[~vec_mask,:] = vec_ms_ps
+    return vec_ms_ps_full.reshape(im_ms.shape[0], im_ms.shape[1], im_ms.shape[2])
+
+
+#%% Inputs
+
+def SyntheticScene(rng, n):
+    y, x = np.mgrid[0:n, 0:n] / n
+    a, b, c = rng.uniform(3, 12, 3)
+    # land/sea pattern, with a few very dark or very bright pixels (e.g.
+    # shadow or glint) which decided the sign of the PC before
+    base = 0.5*(np.sin(a*x + b*y) > 0) + 0.3*np.cos(c*y) + rng.normal(0, 0.03, (n, n))
+    outliers = rng.integers(0, n, (2, 20))
+    base[outliers[0], outliers[1]] += rng.choice([-3, 3])
+    pan = (base*8000 + 10000 + rng.normal(0, 200, (n, n))).clip(0).astype(np.uint16).astype(float)
+    ms = np.stack([base*k + 0.1*j + rng.normal(0, 0.02, (n, n))
+                   for j, k in enumerate(rng.uniform(0.5, 1.0, 4))], -1)
+    ms = transform.resize(ms[::2,::2], (n, n), order=1, preserve_range=True, mode='constant')
+    cloud_mask = np.zeros((n, n), bool)
+    cloud_mask[:n//10, :n//4] = True
+    return ms, pan, cloud_mask
+
+
+rng = np.random.default_rng(Seed)
+Scenes = [SyntheticScene(rng, SceneSize) for i in range(NoScenes)]
+
+
+#%% Run both and compare
+
+Passed = True
+OldTime, NewTime = 0, 0
+for i, (im_ms, im_pan, cloud_mask) in enumerate(Scenes):
+    Start = time.perf_counter()
+    OldPS = OldPansharpen(im_ms, im_pan, cloud_mask)
+    OldTime += time.perf_counter() - Start
+    Start = time.perf_counter()
+    NewPS = Image_Processing.pansharpen(im_ms, im_pan, cloud_mask)
+    NewTime += time.perf_counter() - Start
+
+    clear = ~cloud_mask
+    Ranges = np.ptp(OldPS[clear], axis=0)
+    Diffs = np.abs(OldPS[clear] - NewPS[clear]) / Ranges
+    # only the most extreme (outlier) pixels fall beyond the quantile table, so
+    # the tail is checked by percentile rather than max
+    Diff, MaxDiff = np.percentile(Diffs, 99.9), np.max(Diffs)
+    Corr = min(np.corrcoef(NewPS[:,:,k][clear], im_pan[clear])[0,1] for k in range(im_ms.shape[2]))
+    Same = Diff < Tolerance and Corr > 0 and np.isnan(NewPS[cloud_mask]).all()
+    Passed &= Same
+    print('scene %d: diff %.2f%% of range (99.9th pc), %.1f%% (max), min band-pan correlation %.3f: %s' %
+          (i, Diff*100, MaxDiff*100, Corr, 'ok' if Same else 'MISMATCH'))
+
+print('pansharpen: sklearn %.2f s, subsampled %.2f s per %dx%d scene (%.1fx)' %
+      (OldTime/NoScenes, NewTime/NoScenes, SceneSize, SceneSize, OldTime/NewTime))
+print('PASS' if Passed else 'FAIL')
+sys.exit(0 if Passed else 1)
@@ -0,0 +1,285 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Benchmark and check of Toolbox.PlanetDownload (all assets activated up
+front, activation polled with backoff, downloads run concurrently and
+resumed through Toolbox.PlanetFetchAsset, progress kept in a manifest)
+against a local mock of the Planet Data API (item assets, activation and
+downloads) served over HTTP, with slow responses and failures:
+    - some assets already active, the others activating after 1-4 polls
+    - 503 and 429 responses once (retried), and a missing item (404)
+    - downloads cut off part way (resumed with a Range request on the next
+      run), one from a server ignoring the Range header (downloaded again in
+      full), one failing with 500s for a whole run, and one partial file
+      already complete (416 on the Range request)
+The script checks:
+    - every other asset is downloaded in the first run, byte for byte, and the
+      manifest records each one as done (with its path and size) and the
+      failed ones as active
+    - activation polling backs off (5 s doubling, not a request per image
+      every 10 s), and the retries back off
+    - the second run downloads only the rest of each cut off file, and ends
+      with every asset but the missing one done
+    - a third run makes no requests for the assets already done
+and reports the time of a clean download of the same assets with 1 and 4
+workers. Sleeps in Toolbox are recorded and shortened, so the polling and
+retry waits do not slow the run down.
+
+Run from anywhere with:
+    python Benchmarks/PlanetDownloads.py
+"""
+
+import os
+import io
+import sys
+import json
+import time
+import types
+import shutil
+import hashlib
+import tempfile
+import threading
+import contextlib
+import warnings
+warnings.filterwarnings("ignore")
+from collections import Counter
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+import numpy as np
+import requests
+
+RepoDir = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, RepoDir)
+from Toolshed import Toolbox
+
+#%% Settings
+
+sitename = 'StAndrews'
+NoImages = 20
+ImageSize = 2*2**20 # bytes
+Latency = 0.05 # seconds per request
+DownloadLatency = 0.3 # seconds before each download starts
+Seed = 0
+
+
+#%% Stubs (mock Planet Data API)
+
+rng = np.random.default_rng(Seed)
+IDs = ['20200101_1100%02d_1_0f15' % i for i in range(NoImages)]
+Files = dict((ID, rng.bytes(ImageSize)) for ID in IDs)
+Already = IDs[:5] # active before the first run
+Polls = dict((ID, int(rng.integers(1, 5))) for ID in IDs[5:]) # status polls before active
+Modes = {IDs[5]:'503 once', IDs[6]:'429 once', IDs[7]:'missing',
+         IDs[8]:'cut off', IDs[9]:'cut off', IDs[10]:'cut off, range ignored', IDs[11]:'500s for a run'}
+
+
+class MockPlanet(BaseHTTPRequestHandler):
+    State = dict([])
+    Log = []
+    Sent = Counter()
+    Lock = threading.Lock()
+
+    def log_message(self, *args):
+        pass
+
+    def Reply(self, code, body=b'', headers={}):
+        self.send_response(code)
+        for key, val in headers.items():
+            self.send_header(key, val)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def Asset(self, ID):
+        state = MockPlanet.State[ID]
+        asset = {'status':'active' if state['polls'] <= 0 else ('activating' if state['activated'] else 'inactive'),
+                 '_links':{'_self':Base + '/assets/%s/analytic' % ID, 'activate':Base + '/assets/%s/analytic/activate' % ID}}
+        if asset['status'] == 'active':
+            asset['location'] = Base + '/download/%s' % ID
+        return asset
+
+    def Once(self, ID, kind):
+        # fail the first request of this kind for this item
+        with MockPlanet.Lock:
+            if Modes.get(ID) == kind and not MockPlanet.State[ID].get(kind):
+                MockPlanet.State[ID][kind] = True
+                return True
+        return False
+
+    def do_GET(self):
+        path = self.path.split('/')
+        ID = path[-2] if path[-1] in ['assets', 'analytic'] else path[-3] if path[-1] == 'activate' else path[-1]
+        kind = 'download' if path[1] == 'download' else 'activate' if path[-1] == 'activate' else \
+               'status' if path[-1] == 'analytic' else 'item'
+        with MockPlanet.Lock:
+            MockPlanet.Log.append((kind, ID, self.headers.get('Range')))
+        time.sleep(DownloadLatency if kind == 'download' else Latency)
+        if Modes.get(ID) == 'missing' or ID not in MockPlanet.State:
+            return self.Reply(404, b'{"message": "not found"}')
+        if kind == 'item':
+            if self.Once(ID, '503 once'):
+                return self.Reply(503)
+            return self.Reply(200, json.dumps({'analytic':self.Asset(ID)}).encode())
+        if kind == 'activate':
+            MockPlanet.State[ID]['activated'] = True
+            return self.Reply(202)
+        if kind == 'status':
+            if self.Once(ID, '429 once'):
+                return self.Reply(429)
+            with MockPlanet.Lock:
+                if MockPlanet.State[ID]['activated']:
+                    MockPlanet.State[ID]['polls'] -= 1
+            return self.Reply(200, json.dumps(self.Asset(ID)).encode())
+        # download, with range requests
+        data = Files[ID]
+        if Modes.get(ID) == '500s for a run' and MockPlanet.State[ID].get('failing', True):
+            return self.Reply(500)
+        start = 0
+        if self.headers.get('Range') and Modes.get(ID) != 'cut off, range ignored':
+            start = int(self.headers['Range'].split('=')[1].rstrip('-'))
+            if start >= len(data):
+                return self.Reply(416, headers={'Content-Range':'bytes */%d' % len(data)})
+        self.send_response(206 if start > 0 else 200)
+        if start > 0:
+            self.send_header('Content-Range', 'bytes %d-%d/%d' % (start, len(data) - 1, len(data)))
+        self.send_header('Content-Length', str(len(data) - start))
+        self.end_headers()
+        end = len(data)
+        if Modes.get(ID, '').startswith('cut off') and not MockPlanet.State[ID].get('cut'):
+            MockPlanet.State[ID]['cut'] = True
+            end = start + int((len(data) - start)*rng.uniform(0.3, 0.7))
+        for i in range(start, end, 2**16):
+            self.wfile.write(data[i:min(i + 2**16, end)])
+            with MockPlanet.Lock:
+                MockPlanet.Sent[ID] += min(i + 2**16, end) - i
+        # connection closes after the response (HTTP/1.0), so a cut off body is left short
+
+
+class RequestsProxy:
+    # requests, with calls to api.planet.com sent to the mock server
+    def __getattr__(self, name):
+        return getattr(requests, name)
+
+    def request(self, method, url, **kwargs):
+        return requests.request(method, url.replace('https://api.planet.com/data/v1', Base), **kwargs)
+
+Sleeps = []
+def Sleep(seconds):
+    # recorded with the function waiting (PlanetDownload polling, PlanetRequest retrying)
+    Sleeps.append((sys._getframe(1).f_code.co_name, seconds))
+    time.sleep(seconds/1000)
+
+Server = ThreadingHTTPServer(('127.0.0.1', 0), MockPlanet)
+Server.daemon_threads = True
+threading.Thread(target=Server.serve_forever, daemon=True).start()
+Base = 'http://127.0.0.1:%d' % Server.server_address[1]
+os.environ['PL_API_KEY'] = 'benchmark'
+Toolbox.requests = RequestsProxy()
+Toolbox.time = types.SimpleNamespace(sleep=Sleep, time=time.time, perf_counter=time.perf_counter)
+
+
+#%% Inputs
+
+WorkDir = tempfile.mkdtemp()
+ImDir = os.path.join(WorkDir, sitename, 'local_images', 'PlanetScope')
+ManifestPath = os.path.join(ImDir, 'planet_manifest.json')
+
+def Reset():
+    MockPlanet.State = dict((ID, {'polls':0 if ID in Already else Polls[ID], 'activated':ID in Already}) for ID in IDs)
+    shutil.rmtree(os.path.join(WorkDir, sitename), ignore_errors=True)
+
+def Run(n_workers=4):
+    del MockPlanet.Log[:]
+    MockPlanet.Sent.clear()
+    del Sleeps[:]
+    Start = time.perf_counter()
+    with contextlib.redirect_stdout(io.StringIO()):
+        Toolbox.PlanetDownload([IDs], filepath=WorkDir, sitename=sitename, n_workers=n_workers)
+    return time.perf_counter() - Start
+
+def Manifest():
+    with open(ManifestPath) as f:
+        return json.load(f)
+
+def Intact(ID):
+    impath = os.path.join(ImDir, ID + '.tif')
+    if not os.path.exists(impath):
+        return False
+    with open(impath, 'rb') as f:
+        return hashlib.md5(f.read()).digest() == hashlib.md5(Files[ID]).digest()
+
+
+#%% Run and check
+
+Passed = True
+Reset()
+
+# first run: everything but the failures downloads
+RunTime = Run()
+Failed = [ID for ID in IDs if Modes.get(ID, '').startswith('cut off') or Modes.get(ID) == '500s for a run']
+Missing = [ID for ID in IDs if Modes.get(ID) == 'missing']
+Done = [ID for ID in IDs if ID not in Failed + Missing]
+manifest = Manifest()
+Same = all(Intact(ID) and manifest[ID]['status'] == 'done' and manifest[ID]['size'] == ImageSize and
+           manifest[ID]['path'] == os.path.join(ImDir, ID + '.tif') for ID in Done)
+Same &= all(manifest[ID]['status'] == 'active' and not Intact(ID) for ID in Failed)
+Same &= all(ID not in manifest for ID in Missing)
+Passed &= Same
+print('first run, %d assets: %.1f s, %d downloaded, %d left active (cut off or failing), %d missing: %s' %
+      (len(IDs), RunTime, len(Done), len(Failed), len(Missing), 'ok' if Same else 'MISMATCH'))
+
+Requests = Counter(kind for kind, ID, _ in MockPlanet.Log)
+PollWaits = [s for caller, s in Sleeps if caller == 'PlanetDownload']
+Same = PollWaits == [min(5*2**k, 120) for k in range(len(PollWaits))] and len(PollWaits) == max(Polls.values())
+Same &= Requests['status'] <= sum(Polls.values()) + len(Polls) + 1 # each activating asset polled until active (plus one 429)
+RetryWaits = [s for caller, s in Sleeps if caller == 'PlanetRequest']
+Same &= sorted(RetryWaits) == [2, 2, 2, 4, 8, 16] # 503 and 429 once, and 500s for all 5 attempts
+Passed &= Same
+print('  %d polling rounds, waits %s s, %d status requests; retries waited %s s: %s' %
+      (len(PollWaits), PollWaits, Requests['status'], sorted(RetryWaits), 'ok' if Same else 'MISMATCH'))
+
+# second run: the download that failed now works, one partial file is complete but was never moved
+MockPlanet.State[IDs[11]]['failing'] = False
+Complete = Done[-1]
+os.replace(os.path.join(ImDir, Complete + '.tif'), os.path.join(ImDir, Complete + '.tif.part'))
+manifest[Complete]['status'] = 'active'
+with open(ManifestPath, 'w') as f:
+    json.dump(manifest, f)
+Parts = dict((ID, os.path.getsize(os.path.join(ImDir, ID + '.tif.part'))) for ID in Failed
+             if os.path.exists(os.path.join(ImDir, ID + '.tif.part')))
+RunTime = Run()
+manifest = Manifest()
+Same = all(Intact(ID) and manifest[ID]['status'] == 'done' for ID in IDs if ID not in Missing)
+Resumed = [ID for ID in Failed if Modes[ID] == 'cut off']
+Same &= all(MockPlanet.Sent[ID] == ImageSize - Parts[ID] for ID in Resumed) # only the rest sent
+Same &= MockPlanet.Sent[IDs[10]] == ImageSize # range ignored, sent again in full
+Same &= MockPlanet.Sent[Complete] == 0 and ('download', Complete, 'bytes=%d-' % ImageSize) in MockPlanet.Log
+Same &= not any(kind == 'item' and ID in Done and ID != Complete for kind, ID, _ in MockPlanet.Log)
+Passed &= Same
+print('second run: %.1f s, %d resumed (%.0f%% of their bytes sent again), 1 sent again in full (range ignored), '
+      '1 complete partial file moved without a download, all %d found downloaded: %s' %
+      (RunTime, len(Resumed), 100*sum(MockPlanet.Sent[ID] for ID in Resumed)/(len(Resumed)*ImageSize),
+       len(IDs) - len(Missing), 'ok' if Same else 'MISMATCH'))
+
+# third run: nothing left to do
+RunTime = Run()
+Same = all(ID in Missing for kind, ID, _ in MockPlanet.Log) and Manifest() == manifest
+Passed &= Same
+print('third run: %.2f s, %d requests (for the missing item only), manifest unchanged: %s' %
+      (RunTime, len(MockPlanet.Log), 'ok' if Same else 'MISMATCH'))
+
+# clean downloads of the same assets, one at a time and concurrently
+Modes.clear()
+Times = dict([])
+for n_workers in [1, 4]:
+    Reset()
+    MockPlanet.State = dict((ID, {'polls':0, 'activated':True}) for ID in IDs)
+    Times[n_workers] = Run(n_workers)
+    Same = all(Intact(ID) for ID in IDs)
+    Passed &= Same
+print('clean download of %d x %.0f MB assets (%.1f s to first byte each): %.1f s with 1 worker, %.1f s with 4 (%.1fx)' %
+      (len(IDs), ImageSize/2**20, DownloadLatency, Times[1], Times[4], Times[1]/Times[4]))
+
+Server.shutdown()
+shutil.rmtree(WorkDir)
+print('PASS' if Passed else 'FAIL')
+sys.exit(0 if Passed else 1)
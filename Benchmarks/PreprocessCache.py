@@ -0,0 +1,199 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Benchmark and round trip check of Image_Processing.preprocess_single_cached
+(preprocess_single() outputs kept in a store of compressed NPZ arrays and
+JSON sidecars, loaded by load_preprocessed() on reruns) against calling
+preprocess_single for every image, as each run did before. Local
+PlanetScope images go through the real preprocess_single, on seeded
+synthetic GeoTIFFs with cloud masks; Earth Engine images (L8 and S2) are
+replaced by a stub returning seeded outputs of the same form after a delay
+standing in for the download, including images skipped as too cloudy and
+empty S2 images (which come back with 6 outputs, not 7). The script checks:
+    - with settings['preprocess_cache'] off (the default) the outputs are
+      those of preprocess_single and nothing is stored
+    - the first cached run and a rerun from the store give outputs identical
+      to preprocess_single: the same number of outputs, of the same types,
+      arrays with the same dtypes, shapes and values, georef with the same
+      values and int or float types, and the same skipped image markers
+    - a rerun preprocesses no images
+    - changing a preprocessing setting, or changing a local image on disk,
+      preprocesses the affected images again, and an unreadable entry is
+      preprocessed again rather than raising
+and reports the time of each run.
+
+Run from anywhere with:
+    python Benchmarks/PreprocessCache.py
+"""
+
+import os
+import io
+import sys
+import time
+import copy
+import shutil
+import tempfile
+import contextlib
+import warnings
+warnings.filterwarnings("ignore")
+from datetime import datetime, timedelta
+import numpy as np
+import rasterio
+from rasterio.transform import from_origin
+
+RepoDir = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, RepoDir)
+from Toolshed import Image_Processing
+
+#%% Settings
+
+sitename = 'StAndrews'
+NoLocal = 30 # PlanetScope images
+NoEE = {'L8':20, 'S2':15} # Earth Engine images
+LocalShape = (600, 600)
+DownloadDelay = 0.3 # seconds per Earth Engine image
+Seed = 0
+
+
+#%% Stubs (Earth Engine images)
+
+Preprocessed = []
+preprocess_single = Image_Processing.preprocess_single
+
+def StubPreprocess(fn, filenames, satname, settings, polygon, dates, savetifs, writer=None):
+    Preprocessed.append((satname, filenames[fn]))
+    if satname == 'PSScene4Band':
+        return preprocess_single(fn, filenames, satname, settings, polygon, dates, savetifs, writer)
+    time.sleep(DownloadDelay)
+    i = int(filenames[fn].split('_')[-1])
+    rng = np.random.default_rng(i)
+    if i % 7 == 3: # too cloudy
+        return None, None, None, None, None, None, None
+    if satname == 'S2' and i % 5 == 1: # only zeros
+        return [], [], np.ones((300, 300)).astype('bool'), [], [], []
+    # ints from the rounded origin and from the ee transform, floats elsewhere
+    scale = 15.0 if satname == 'L8' else 10
+    georef = [round(500000 + rng.uniform(-20, 20)), scale/2 if satname == 'L8' else scale, 0,
+              round(6250000 + rng.uniform(-20, 20)), 0, -scale/2 if satname == 'L8' else -scale]
+    shape = (400, 400) if satname == 'L8' else (300, 300)
+    im_ms = rng.uniform(0, 0.4, shape + (5,))
+    im_ms[rng.random(shape) < 0.01] = np.nan
+    im_QA = rng.choice([2720, 2724, 2800, 6896] if satname == 'L8' else [0, 1024, 2048], shape).astype('uint16')
+    im_nodata = np.isnan(im_ms).any(axis=2)
+    cloud_mask = np.isin(im_QA, [2800, 6896, 1024, 2048]) | im_nodata
+    im_extra = rng.uniform(0, 0.4, shape) if satname == 'L8' else rng.uniform(0, 0.4, (shape[0]//2, shape[1]//2))
+    acqtime = (datetime(2020, 1, 1) + timedelta(seconds=int(rng.integers(0, 86400)))).strftime('%H:%M:%S.%f')
+    return im_ms, georef, cloud_mask, im_extra, im_QA, im_nodata, acqtime
+
+Image_Processing.preprocess_single = StubPreprocess
+
+
+#%% Inputs
+
+rng = np.random.default_rng(Seed)
+WorkDir = tempfile.mkdtemp()
+ImDir = os.path.join(WorkDir, sitename, 'local_images', 'PSScene4Band')
+os.makedirs(os.path.join(ImDir, 'cloudmasks'))
+
+def WriteImage(fn, count, dtype, high):
+    with rasterio.open(fn, 'w', driver='GTiff', width=LocalShape[1], height=LocalShape[0], count=count, dtype=dtype,
+                       crs='EPSG:32630', transform=from_origin(500000, 6250000, 3, 3)) as dst:
+        dst.write(rng.integers(0, high, (count,) + LocalShape).astype(dtype))
+
+Images = dict((satname, []) for satname in ['PSScene4Band'] + list(NoEE))
+for i in range(NoLocal):
+    date = datetime(2020, 1, 1) + timedelta(days=i)
+    fn = os.path.join(ImDir, '%s_%06d_%d_3B_AnalyticMS.tif' % (date.strftime('%Y%m%d'), 100000 + i, i % 3))
+    WriteImage(fn, 4, 'uint16', 10000)
+    # UDM2 cloud mask (band 6) for the same date
+    WriteImage(os.path.join(ImDir, 'cloudmasks', '%s_%06d_udm2.tif' % (date.strftime('%Y%m%d'), 100000 + i)), 8, 'uint8', 2)
+    Images['PSScene4Band'].append(fn)
+for satname, n in NoEE.items():
+    Images[satname] = ['COPERNICUS/%s/IMAGE_%d' % (satname, i) if satname == 'S2' else 'LANDSAT/LC08/C02/T1_TOA/LC08_%d' % i
+                       for i in range(n)]
+
+polygon = [[[500000.0, 6250000.0], [501800.0, 6250000.0], [501800.0, 6248200.0],
+            [500000.0, 6248200.0], [500000.0, 6250000.0]]]
+settings = {'cloud_mask_issue':False, 'cloud_thresh':0.5, 'ref_epsg':32630,
+            'inputs':{'sitename':sitename, 'filepath':WorkDir}}
+Store = os.path.join(WorkDir, sitename, 'preprocessed')
+
+def Run(function, settings):
+    del Preprocessed[:]
+    outputs = dict((satname, []) for satname in Images)
+    Start = time.perf_counter()
+    with contextlib.redirect_stdout(io.StringIO()):
+        for satname, filenames in Images.items():
+            for fn in range(len(filenames)):
+                outputs[satname].append(function(fn, filenames, satname, settings, polygon, [], savetifs=False))
+    return outputs, time.perf_counter() - Start, list(Preprocessed)
+
+def Identical(a, b):
+    # same outputs, of the same types, down to the dtypes and int or float georef values
+    if type(a) is not type(b):
+        return False
+    if isinstance(a, np.ndarray):
+        return a.dtype == b.dtype and a.shape == b.shape and np.array_equal(a, b, equal_nan=a.dtype.kind == 'f')
+    if isinstance(a, (list, tuple)):
+        return len(a) == len(b) and all(Identical(x, y) for x, y in zip(a, b))
+    return a == b
+
+def AllIdentical(Ref, New):
+    return all(Identical(Ref[satname][i], New[satname][i]) for satname in Images for i in range(len(Images[satname])))
+
+
+#%% Run both and compare
+
+Passed = True
+NoImages = sum(len(filenames) for filenames in Images.values())
+
+Ref, RefTime, RefPreprocessed = Run(Image_Processing.preprocess_single, settings)
+Skipped = sum(out[0] is None for outs in Ref.values() for out in outs)
+Empty = sum(len(out) == 6 for outs in Ref.values() for out in outs)
+print('%d images (%d local, %s from Earth Engine), %d skipped as cloudy, %d empty S2' %
+      (NoImages, NoLocal, ', '.join('%d %s' % (n, satname) for satname, n in NoEE.items()), Skipped, Empty))
+print('preprocess_single for every image: %.1f s' % RefTime)
+
+Off, OffTime, OffPreprocessed = Run(Image_Processing.preprocess_single_cached, settings)
+Same = AllIdentical(Ref, Off) and len(OffPreprocessed) == NoImages and not os.path.exists(Store)
+Passed &= Same
+print('cache off: %.1f s, nothing stored: %s' % (OffTime, 'match' if Same else 'MISMATCH'))
+
+settings['preprocess_cache'] = True
+First, FirstTime, FirstPreprocessed = Run(Image_Processing.preprocess_single_cached, settings)
+Same = AllIdentical(Ref, First) and len(FirstPreprocessed) == NoImages
+Passed &= Same
+print('first cached run: %.1f s (stored as it went): %s' % (FirstTime, 'match' if Same else 'MISMATCH'))
+
+Again, AgainTime, AgainPreprocessed = Run(Image_Processing.preprocess_single_cached, settings)
+Same = AllIdentical(Ref, Again) and AgainPreprocessed == []
+Passed &= Same
+Size = sum(os.path.getsize(os.path.join(d, f)) for d, _, files in os.walk(Store) for f in files)
+print('rerun from the store: %.1f s (%.0fx), %d images preprocessed, %.0f MB stored: %s' %
+      (AgainTime, RefTime/AgainTime, len(AgainPreprocessed), Size/2**20, 'match' if Same else 'MISMATCH'))
+for satname in Images:
+    Same = all(Identical(Ref[satname][i], Again[satname][i]) for i in range(len(Images[satname])))
+    print('  %s: %d images, outputs identical: %s' % (satname, len(Images[satname]), 'ok' if Same else 'MISMATCH'))
+
+# a new cloud threshold preprocesses everything again, into new entries
+Changed = copy.deepcopy(settings)
+Changed['cloud_thresh'] = 0.4
+_, ChangedTime, ChangedPreprocessed = Run(Image_Processing.preprocess_single_cached, Changed)
+Same = len(ChangedPreprocessed) == NoImages
+# a local image rewritten in place, and an entry left unreadable
+Rewritten = Images['PSScene4Band'][3]
+WriteImage(Rewritten, 4, 'uint16', 10000)
+BrokenImage = Images['L8'][[out[0] is None for out in Ref['L8']].index(False)]
+with open(Image_Processing.preprocess_cache_path(BrokenImage, 'L8', settings, polygon) + '.npz', 'wb') as f:
+    f.write(b'not an npz')
+Ref['PSScene4Band'][3] = preprocess_single(3, Images['PSScene4Band'], 'PSScene4Band', settings, polygon, [], False)
+After, AfterTime, AfterPreprocessed = Run(Image_Processing.preprocess_single_cached, settings)
+Same &= AllIdentical(Ref, After) and sorted(AfterPreprocessed) == sorted([('PSScene4Band', Rewritten), ('L8', BrokenImage)])
+Passed &= Same
+print('new cloud threshold: %d images preprocessed again; 1 local image rewritten and 1 entry unreadable: %s preprocessed '
+      'again, outputs identical: %s' % (len(ChangedPreprocessed), len(AfterPreprocessed), 'ok' if Same else 'MISMATCH'))
+
+Image_Processing.preprocess_single = preprocess_single
+shutil.rmtree(WorkDir)
+print('PASS' if Passed else 'FAIL')
+sys.exit(0 if Passed else 1)
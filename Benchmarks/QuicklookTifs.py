@@ -0,0 +1,178 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Benchmark and check of the quicklook GeoTIFFs (RGB, NDVI and classified
+images) written by VegetationLine.extract_veglines in each
+settings['quicklook_tifs'] mode, on a synthetic 200-image run. Image
+loading, classification and contouring are replaced by local stubs (the
+quicklooks are still made and written by Image_Processing), so only the
+writing is measured. The script checks:
+    - every image's quicklooks are written and readable, with the same
+      pixels and georeferencing as when written straight away ('save'), or
+      every 4th pixel with 4x the pixel size ('downsample')
+    - nothing is written with 'skip'
+    - when an image fails part way through a run with the background writer,
+      the error is raised and the quicklooks already queued are all written
+      in full, with no writer threads left behind
+and reports the runtime of each mode.
+
+Run from anywhere with:
+    python Benchmarks/QuicklookTifs.py
+"""
+
+import os
+import io
+import sys
+import time
+import shutil
+import tempfile
+import threading
+import contextlib
+import warnings
+warnings.filterwarnings("ignore")
+from datetime import datetime, timedelta
+import numpy as np
+import pandas as pd
+import rasterio
+import matplotlib
+matplotlib.use('Agg')
+
+RepoDir = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, RepoDir)
+from Toolshed import VegetationLine, Image_Processing
+
+#%% Settings
+
+sitename = 'StAndrews'
+satname = 'S2'
+NoImages = 200
+ImShape = (150, 200)
+Factor = 4 # settings['quicklook_factor'] for 'downsample'
+FailAt = 150 # image that fails in the error check
+Seed = 0
+
+
+#%% Stubs
+
+rng = np.random.default_rng(Seed)
+Scenes = []
+for k in range(20):
+    cols = np.arange(ImShape[1])[np.newaxis,:].repeat(ImShape[0], 0)
+    land = cols > ImShape[1]*rng.uniform(0.3, 0.7)
+    im_ms = np.stack([0.05 + 0.3*land*(b == 3) + rng.normal(0, 0.02, ImShape) for b in range(5)], -1).clip(0.01)
+    cloud_mask = np.zeros(ImShape, bool)
+    cloud_mask[:10, :10] = True
+    Scenes.append((im_ms, cloud_mask))
+georef = [350000.0, 10.0, 0, 720000.0, 0, -10.0]
+
+def StubPreprocess(fn, filenames, satname, settings, polygon, dates, savetifs, writer=None):
+    if 'fail_image' in settings.keys() and settings['fail_image'] == fn:
+        raise Exception('could not read image %d' % fn)
+    im_ms, cloud_mask = Scenes[fn % len(Scenes)]
+    if savetifs:
+        Image_Processing.save_RGB_NDVI(im_ms, cloud_mask, georef, filenames[fn], settings, writer)
+    return im_ms, georef, cloud_mask, [], None, np.zeros(ImShape, bool), '11:21:%02d.000000' % (fn % 60)
+
+def StubClassify(im_ms, im_extra, cloud_mask, min_beach_area, clf):
+    im_veg = im_ms[:,:,3] > 0.2
+    im_labels = np.stack([im_veg, ~im_veg], -1)
+    return im_veg.astype(np.uint8), im_labels
+
+Image_Processing.preprocess_single = StubPreprocess
+VegetationLine.classify_image_NN = StubClassify
+VegetationLine.classify_image_NN_shore = StubClassify
+VegetationLine.BufferShoreline = lambda settings, refline, georef, cloud_mask: np.ones(cloud_mask.shape, bool)
+VegetationLine.FindShoreContours_WP = lambda im_ndvi, im_labels, cloud_mask, im_ref_buffer: ([], 0.2)
+VegetationLine.FindShoreContours_Water = lambda im_ndwi, im_labels, cloud_mask, im_ref_buffer: ([], 0.0)
+VegetationLine.ProcessShoreline = lambda contours, cloud_mask, georef, image_epsg, settings: (np.zeros((0,2)),)*3
+VegetationLine.joblib = type('joblib', (), {'load':staticmethod(lambda path: None)})
+
+
+#%% Inputs
+
+WorkDir = tempfile.mkdtemp()
+os.makedirs(os.path.join(WorkDir, sitename))
+os.makedirs(os.path.join(WorkDir, 'tides'))
+Dates = [datetime(2020, 1, 1) + timedelta(days=5*i) for i in range(NoImages)]
+TideDates = [datetime(2019, 12, 31) + timedelta(hours=h) for h in range(24*(5*NoImages + 2))]
+pd.DataFrame({'date':TideDates, 'tide':0.0}).to_csv(os.path.join(WorkDir, 'tides', sitename + '_tides.csv'), index=False)
+filenames = ['COPERNICUS/S2_HARMONIZED/%s_%s_T30VVH' % ((date.strftime('%Y%m%dT112100'),)*2) for date in Dates]
+metadata = {satname:{'filenames':filenames, 'dates':[date.strftime('%Y-%m-%d') for date in Dates],
+                     'epsg':[32630]*NoImages, 'acc_georef':[10.0]*NoImages}}
+JpgDir = os.path.join(WorkDir, sitename, 'jpg_files')
+
+def Settings(mode, **kwargs):
+    settings = {'inputs':{'sitename':sitename, 'filepath':WorkDir, 'sat_list':[satname]},
+                'cloud_thresh':0.5, 'cloud_mask_issue':False, 'output_epsg':32630,
+                'buffer_size':250, 'min_beach_area':200, 'wetdry':True,
+                'adjust_detection':False, 'check_detection':False, 'save_figure':False,
+                'reference_shoreline':np.zeros((3,3)), 'quicklook_tifs':mode, 'quicklook_factor':Factor}
+    settings.update(kwargs)
+    return settings
+
+def Run(mode, **kwargs):
+    shutil.rmtree(JpgDir, ignore_errors=True)
+    Start = time.perf_counter()
+    with contextlib.redirect_stdout(io.StringIO()):
+        VegetationLine.extract_veglines(metadata, Settings(mode, **kwargs), None, None, 'model.pkl')
+    return time.perf_counter() - Start
+
+def Quicklooks(images):
+    # every RGB, NDVI and classified image, read back from disk
+    files = dict([])
+    for fn in images:
+        for imtype in ['RGB', 'NDVI', 'CLASS']:
+            path = os.path.join(JpgDir, '%s_%s.tif' % (filenames[fn].rsplit('/',1)[1], imtype))
+            with rasterio.open(path) as src:
+                files[(fn, imtype)] = (src.read(), src.transform)
+    return files
+
+
+#%% Run and check
+
+Passed = True
+Times = dict([])
+Times['save'] = Run('save')
+Reference = Quicklooks(range(NoImages))
+print('save: %d images, %.2f s, %d GeoTIFFs written' % (NoImages, Times['save'], len(Reference)))
+
+for mode in ['defer', 'downsample']:
+    Times[mode] = Run(mode)
+    Files = Quicklooks(range(NoImages))
+    if mode == 'defer':
+        Same = all(np.array_equal(Files[key][0], Reference[key][0], equal_nan=True) and
+                   Files[key][1] == Reference[key][1] for key in Reference)
+    else:
+        Same = all(np.array_equal(Files[key][0], Reference[key][0][:,::Factor,::Factor], equal_nan=True) and
+                   Files[key][1] == Reference[key][1] * rasterio.Affine.scale(Factor) for key in Reference)
+    Passed &= Same
+    print('%s: %d images, %.2f s (%.1fx), %d GeoTIFFs intact: %s' %
+          (mode, NoImages, Times[mode], Times['save']/Times[mode], len(Files), 'match' if Same else 'MISMATCH'))
+
+Times['skip'] = Run('skip')
+Written = [f for f in os.listdir(JpgDir) if f.endswith(('RGB.tif', 'NDVI.tif', 'CLASS.tif'))]
+Same = Written == []
+Passed &= Same
+print('skip: %d images, %.2f s, %d quicklooks written: %s' % (NoImages, Times['skip'], len(Written), 'ok' if Same else 'MISMATCH'))
+
+# an image fails part way through, with quicklooks still queued on the writer
+Threads = threading.active_count()
+try:
+    Run('defer', fail_image=FailAt)
+    Error = None
+except Exception as e:
+    Error = e
+Left = threading.active_count() - Threads
+try:
+    Files = Quicklooks(range(FailAt))
+    Same = all(np.array_equal(Files[key][0], Reference[key][0], equal_nan=True) for key in Files)
+except Exception:
+    Same = False
+Same &= Error is not None and Left == 0
+Passed &= Same
+print('image %d fails with defer: %s raised, quicklooks of the %d images before it intact, %d writer threads left: %s' %
+      (FailAt, 'error' if Error is not None else 'nothing', FailAt, Left, 'ok' if Same else 'MISMATCH'))
+
+shutil.rmtree(WorkDir)
+print('PASS' if Passed else 'FAIL')
+sys.exit(0 if Passed else 1)
@@ -0,0 +1,115 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Benchmark and parity check for the Pillow .jpg quicklooks written by
+Image_Processing.create_jpg, against the matplotlib figure they replaced
+(renderer='matplotlib'), on seeded synthetic scenes with a cloud and a
+shoreline overlay. The script checks:
+    - the 8-bit stretch of quicklook_RGB is within 1 grey level of
+      rescale_image_intensity, which the matplotlib figure shows
+    - both renderers write a readable RGB .jpg
+    - save_jpg writes one .jpg per image when several images share a date
+      (image loading is replaced by a local stub)
+
+Run from anywhere with:
+    python Benchmarks/Quicklooks.py
+"""
+
+import os
+import sys
+import time
+import shutil
+import tempfile
+import warnings
+warnings.filterwarnings("ignore")
+import numpy as np
+import matplotlib
+matplotlib.use('Agg')
+from PIL import Image
+
+RepoDir = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, RepoDir)
+from Toolshed import Image_Processing
+
+#%% Settings
+
+sitename = 'StAndrews'
+satname = 'S2'
+ImShape = (400, 500)
+NoScenes = 1000
+MplScenes = 50 # matplotlib figure is slow, so only timed up to here
+SameDay = 3 # images acquired on one date in the save_jpg check
+Seed = 0
+
+
+#%% Inputs
+
+def SyntheticScene(rng, shape):
+    # land/sea pattern in the visible bands, with a cloud in one corner
+    rows, cols = np.mgrid[0:shape[0], 0:shape[1]]
+    land = cols > shape[1]*rng.uniform(0.3, 0.7) + 20*np.sin(rows/30)
+    im_ms = np.stack([0.05 + 0.2*land*rng.uniform(0.5, 1) + rng.normal(0, 0.02, shape)
+                      for b in range(5)], -1).clip(0)
+    cloud_mask = (rows - shape[0]*0.2)**2 + (cols - shape[1]*0.8)**2 < (shape[0]*0.15)**2
+    return im_ms, cloud_mask
+
+
+rng = np.random.default_rng(Seed)
+Scenes = [SyntheticScene(rng, ImShape) for i in range(20)]
+georef = [350000.0, 10.0, 0, 720000.0, 0, -10.0]
+shoreline = np.c_[georef[0] + np.linspace(1500, 3500, 400), georef[3] - np.linspace(0, 4000, 400)]
+
+WorkDir = tempfile.mkdtemp()
+
+
+#%% Run both and compare
+
+Passed = True
+MaxDiff = 0
+for im_ms, cloud_mask in Scenes:
+    im_8bit = Image_Processing.quicklook_RGB(im_ms[:,:,[2,1,0]], cloud_mask, 99.9)
+    im_adj = Image_Processing.rescale_image_intensity(im_ms[:,:,[2,1,0]], cloud_mask, 99.9)
+    clear = ~cloud_mask
+    MaxDiff = max(MaxDiff, np.abs(im_8bit[clear].astype(int) - np.round(im_adj[clear]*255)).max())
+Same = MaxDiff <= 1
+Passed &= Same
+print('stretch on %d scenes: max diff %d grey levels: %s' % (len(Scenes), MaxDiff, 'match' if Same else 'MISMATCH'))
+
+Times = {}
+for renderer, n in [('matplotlib', MplScenes), ('pillow', NoScenes)]:
+    OutDir = os.path.join(WorkDir, renderer)
+    os.makedirs(OutDir)
+    Start = time.perf_counter()
+    for i in range(n):
+        im_ms, cloud_mask = Scenes[i % len(Scenes)]
+        Image_Processing.create_jpg(im_ms, cloud_mask, '2020-01-01', satname, OutDir, [shoreline], georef,
+                                    renderer=renderer, imagename='%04d' % i)
+    Times[renderer] = (time.perf_counter() - Start) / n
+    Written = sorted(os.listdir(OutDir))
+    with Image.open(os.path.join(OutDir, Written[0])) as im:
+        Same = len(Written) == n and im.mode == 'RGB'
+    Passed &= Same
+    print('%s: %d scenes, %.1f ms per scene, %d .jpg written: %s' %
+          (renderer, n, Times[renderer]*1000, len(Written), 'ok' if Same else 'MISMATCH'))
+print('pillow quicklooks %.0fx faster than matplotlib' % (Times['matplotlib']/Times['pillow']))
+
+# same-day images through save_jpg, with the background writer
+def StubPreprocess(fn, filenames, satname, settings, polygon, dates, savetifs=True):
+    im_ms, cloud_mask = Scenes[fn % len(Scenes)]
+    return im_ms, georef, cloud_mask, None, None, np.zeros(cloud_mask.shape, bool)
+
+Image_Processing.preprocess_single = StubPreprocess
+filenames = ['COPERNICUS/S2_HARMONIZED/20200101T1130%02d_20200101T1130%02d_T30VVH' % (i, i)
+             for i in range(SameDay)] + ['20200102T113021_20200102T113021_T30VVH.tif']
+metadata = {satname:{'filenames':filenames, 'dates':['2020-01-01']*SameDay + ['2020-01-02']}}
+settings = {'inputs':{'sitename':sitename, 'filepath':WorkDir}, 'cloud_thresh':0.5}
+Image_Processing.save_jpg(metadata, settings, None, None)
+Written = os.listdir(os.path.join(WorkDir, sitename, 'jpg_files', 'preprocessed'))
+Same = len(Written) == len(filenames)
+Passed &= Same
+print('save_jpg, %d images (%d on one date): %d .jpg written: %s' %
+      (len(filenames), SameDay, len(Written), 'ok' if Same else 'MISMATCH'))
+
+shutil.rmtree(WorkDir)
+print('PASS' if Passed else 'FAIL')
+sys.exit(0 if Passed else 1)
@@ -0,0 +1,114 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Benchmark and parity check for Download.filter_S2_collection against the
+pairwise timestamp comparison it replaced, on seeded synthetic Sentinel-2
+feature dicts (groups of 1-5 acquisitions a few days apart, spread across
+two UTM zones, in time order and shuffled). The same images must be kept, in
+the same order.
+
+Run from anywhere with:
+    python Benchmarks/S2Duplicates.py
+"""
+
+import os
+import sys
+import time
+import random
+import warnings
+warnings.filterwarnings("ignore")
+from datetime import datetime, timezone
+import numpy as np
+
+RepoDir = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, RepoDir)
+from Toolshed import Download
+
+#%% Settings
+
+ParitySeeds = 30
+ParitySize = 400
+BenchSizes = [1000, 2000, 100000]
+OldMaxSize = 2000 # pairwise version is quadratic, so only timed up to here
+
+
+#%% Reference implementation (every timestamp compared with every other)
+
+def OldFilterS2(im_list):
+    timestamps = [datetime.fromtimestamp(_['properties']['system:time_start']/1000,
+                                         tz=timezone.utc) for _ in im_list]
+    utm_zones = np.array([int(_['bands'][0]['crs'][5:]) for _ in im_list])
+    if len(np.unique(utm_zones)) == 1:
+        return im_list
+    utm_zone_selected = np.max(np.unique(utm_zones))
+    idx_all = np.arange(0,len(im_list),1)
+    idx_covered = np.ones(len(im_list)).astype(bool)
+    idx_delete = []
+    i = 0
+    while 1:
+        same_time = np.abs([(timestamps[i]-_).total_seconds() for _ in timestamps]) < 60*60*24
+        idx_same_time = np.where(same_time)[0]
+        same_utm = utm_zones == utm_zone_selected
+        idx_temp = np.where([same_time[j] == True and same_utm[j] == False for j in idx_all])[0]
+        idx_keep = idx_same_time[[_ not in idx_temp for _ in idx_same_time]]
+        if len(idx_keep) > 2:
+            idx_temp = np.append(idx_temp,idx_keep[-(len(idx_keep)-2):])
+        for j in idx_temp:
+            idx_delete.append(j)
+        idx_covered[idx_same_time] = False
+        if np.any(idx_covered):
+            i = np.where(idx_covered)[0][0]
+        else:
+            break
+    return [x for k,x in enumerate(im_list) if k not in idx_delete]
+
+
+#%% Inputs
+
+def SyntheticCollection(n, seed, shuffle=False):
+    r = random.Random(seed)
+    im_list = []
+    t = 1.5e12
+    while len(im_list) < n:
+        # next pass 2-10 days later, give or take an hour
+        t += r.choice([5,5,3,2,10])*86400000 + r.randint(-3600000,3600000)
+        for j in range(r.choice([1,2,2,3,4,5])):
+            im_list.append({'id':len(im_list),
+                            'properties':{'system:time_start':int(t + r.randint(0,120000))},
+                            'bands':[{'crs':'EPSG:%d' % r.choice([32630,32630,32631])}]})
+    im_list = im_list[:n]
+    if shuffle:
+        r.shuffle(im_list)
+    return im_list
+
+
+#%% Run both and compare
+
+Passed = True
+for seed in range(ParitySeeds):
+    for shuffle in [False, True]:
+        im_list = SyntheticCollection(ParitySize, seed, shuffle)
+        Same = ([_['id'] for _ in OldFilterS2(im_list)] ==
+                [_['id'] for _ in Download.filter_S2_collection(im_list)])
+        Passed &= Same
+print('selection on %d collections of %d images: %s' %
+      (ParitySeeds*2, ParitySize, 'match' if Passed else 'MISMATCH'))
+
+for n in BenchSizes:
+    im_list = SyntheticCollection(n, 1)
+    Start = time.perf_counter()
+    NewList = Download.filter_S2_collection(im_list)
+    NewTime = time.perf_counter() - Start
+    if n <= OldMaxSize:
+        Start = time.perf_counter()
+        OldList = OldFilterS2(im_list)
+        OldTime = time.perf_counter() - Start
+        Same = OldList == NewList
+        Passed &= Same
+        print('%d images (%d kept): pairwise %.2f s, sorted %.3f s (%.0fx) %s' %
+              (n, len(NewList), OldTime, NewTime, OldTime/NewTime, 'match' if Same else 'MISMATCH'))
+    else:
+        print('%d images (%d kept): sorted %.3f s' % (n, len(NewList), NewTime))
+
+print('PASS' if Passed else 'FAIL')
+sys.exit(0 if Passed else 1)
@@ -0,0 +1,208 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Benchmark and parity check for the helpers of
+Download.merge_overlapping_images (group_duplicates,
+find_containing_polygon, pair_simultaneous_images and merge_vrt) against the
+loops and the gdal_merge run they replaced, on a seeded synthetic Sentinel-2
+archive: thousands of passes over a site on a UTM boundary, each seen by 1-3
+tiles from both zones acquired seconds apart, some of them delivered more
+than once with the same timestamp. The script checks:
+    - duplicate timestamps are grouped the same way
+    - the footprint kept among duplicates (the one containing all the
+      others, if any) is the same
+    - the images paired for merging are the same, including which later
+      image each one is paired with
+    - merge_vrt writes the same pixels, pixel size and extent as
+      gdal_merge -n 0 on overlapping tiles with nodata gaps, including when
+      the first tile has coarser pixels than the second (both use the first
+      file's pixel size)
+and reports the time of each.
+
+Run from anywhere with:
+    python Benchmarks/S2Overlaps.py
+"""
+
+import os
+import sys
+import time
+import shutil
+import tempfile
+import warnings
+warnings.filterwarnings("ignore")
+from datetime import datetime, timedelta, timezone
+import numpy as np
+import rasterio
+from rasterio.transform import from_origin
+from shapely.geometry import box
+
+RepoDir = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, RepoDir)
+from Toolshed import Download, gdal_merge
+
+#%% Settings
+
+sitename = 'StAndrews'
+NoPasses = 1500
+DuplicateShare = 0.2 # share of tiles delivered 2-3 times with the same timestamp
+TimeDelta = 5*60 # seconds, as in merge_overlapping_images
+TileSize = 2000 # pixels, for the merge timing
+Seed = 0
+
+
+#%% Reference implementation (nested scans and pairwise loops)
+
+def OldDuplicates(lst):
+    "return duplicates and indices"
+    def duplicates(lst, item):
+            return [i for i, x in enumerate(lst) if x == item]
+    return dict((x, duplicates(lst, x)) for x in set(lst) if lst.count(x) > 1)
+
+
+def OldContaining(polygons):
+    contain_bools_list = []
+    for i,poly1 in enumerate(polygons):
+        contain_bools = []
+        for k,poly2 in enumerate(polygons):
+            if k == i:
+                contain_bools.append(True)
+            else:
+                contain_bools.append(poly1.contains(poly2))
+        contain_bools_list.append(contain_bools)
+    contain_all = [np.all(_) for _ in contain_bools_list]
+    if np.any(contain_all):
+        return np.where(contain_all)[0][0]
+    return None
+
+
+def OldPairs(metadata_dates, time_delta):
+    dates = metadata_dates.copy()
+    pairs = []
+    for i,date in enumerate(metadata_dates):
+        # dummy value so it does not match it again
+        dates[i] = datetime(1,1,1,tzinfo=timezone.utc) + timedelta(days=i+1)
+        # calculate time difference
+        time_diff = np.array([np.abs((date - _).total_seconds()) for _ in dates])
+        # find the matching times and add to pairs list
+        boolvec = time_diff <= time_delta
+        if np.sum(boolvec) == 0:
+            continue
+        else:
+            idx_dup = np.where(boolvec)[0][0]
+            pairs.append([i,idx_dup])
+    return pairs
+
+
+#%% Inputs
+
+rng = np.random.default_rng(Seed)
+# site footprint in each tile's own UTM coordinates (easting offset per zone): full in
+# some tiles, cut by the left or right tile edge in others
+Tiles = {'T30VVH':0, 'T30VVJ':0, 'T31VCC':5e5}
+filenames, dates, footprints = [], [], []
+for p in range(NoPasses):
+    start = datetime(2016, 1, 1, 11, 21, tzinfo=timezone.utc) + timedelta(days=2.5*p, seconds=int(rng.integers(0, 60)))
+    names = rng.choice(list(Tiles), int(rng.integers(1, 4)), replace=False)
+    for k, tile in enumerate(names):
+        date = start + timedelta(seconds=int(4*k))
+        x0 = Tiles[tile]
+        copies = int(rng.choice([2, 3], p=[0.8, 0.2])) if rng.random() < DuplicateShare else 1
+        for c in range(copies):
+            cut = 2000 if rng.random() < 0.4 else float(rng.uniform(500, 1900))
+            left = x0 if rng.random() < 0.5 else x0 + 2000 - cut
+            filenames.append('%s_S2_%s_10m%s.tif' % (date.strftime('%Y-%m-%d-%H-%M-%S'), sitename, '_dup'*c))
+            dates.append(date)
+            footprints.append(box(left, 6e6, left + cut, 6e6 + 2000))
+print('synthetic archive: %d passes, %d images' % (NoPasses, len(filenames)))
+
+
+#%% Run both and compare
+
+Passed = True
+
+timestamps = [_.split('_')[0] for _ in filenames]
+Start = time.perf_counter()
+Old = OldDuplicates(timestamps)
+OldTime = time.perf_counter() - Start
+Start = time.perf_counter()
+New = Download.group_duplicates(timestamps)
+NewTime = time.perf_counter() - Start
+Same = New == Old
+Passed &= Same
+print('group_duplicates, %d groups: %.3f s before, %.4f s now: %s' %
+      (len(New), OldTime, NewTime, 'match' if Same else 'MISMATCH'))
+
+Groups = [[footprints[i] for i in idx] for idx in New.values()]
+Start = time.perf_counter()
+Old = [OldContaining(polygons) for polygons in Groups]
+OldTime = time.perf_counter() - Start
+Start = time.perf_counter()
+New = [Download.find_containing_polygon(polygons) for polygons in Groups]
+NewTime = time.perf_counter() - Start
+Same = New == Old
+Passed &= Same
+print('find_containing_polygon, %d groups (%d with one containing the others): %.3f s before, %.3f s now: %s' %
+      (len(Groups), sum(_ is not None for _ in New), OldTime, NewTime, 'match' if Same else 'MISMATCH'))
+
+Start = time.perf_counter()
+Old = OldPairs(dates, TimeDelta)
+OldTime = time.perf_counter() - Start
+Start = time.perf_counter()
+New = Download.pair_simultaneous_images(dates, TimeDelta)
+NewTime = time.perf_counter() - Start
+Same = New == Old
+Passed &= Same
+print('pair_simultaneous_images, %d images, %d pairs: %.2f s before, %.3f s now: %s' %
+      (len(dates), len(New), OldTime, NewTime, 'match' if Same else 'MISMATCH'))
+
+
+#%% Merge overlapping tiles, against gdal_merge
+
+WorkDir = tempfile.mkdtemp()
+
+def WriteTile(fn, x0, y0, res, shape, gap):
+    # 3 bands with nodata (0) where the tile was masked, as in merge_overlapping_images
+    im = rng.integers(1, 10000, (3,) + shape).astype('uint16')
+    im[:, gap] = 0
+    with rasterio.open(fn, 'w', driver='GTiff', width=shape[1], height=shape[0], count=3, dtype='uint16',
+                       crs='EPSG:32630', transform=from_origin(x0, y0, res, res)) as dst:
+        dst.write(im)
+    return fn
+
+def Read(fn):
+    with rasterio.open(fn) as src:
+        return src.read(), src.transform, src.dtypes
+
+n = 300
+Cases = {'same pixel size': [WriteTile(os.path.join(WorkDir, 'a10.tif'), 500000, 6250000, 10, (n, n),
+                                       (slice(None), slice(2*n//3, None))),
+                             WriteTile(os.path.join(WorkDir, 'b10.tif'), 501000, 6249500, 10, (n, n),
+                                       (slice(n//2, None), slice(None)))],
+         'first tile coarser': [WriteTile(os.path.join(WorkDir, 'a20.tif'), 500000, 6250000, 20, (n//2, n//2),
+                                          (slice(None), slice(n//3, None))),
+                                WriteTile(os.path.join(WorkDir, 'b10_2.tif'), 501000, 6249500, 10, (n, n),
+                                          (slice(n//2, None), slice(None)))],
+         'timing': [WriteTile(os.path.join(WorkDir, 'a_big.tif'), 500000, 6250000, 10, (TileSize, TileSize),
+                              (slice(None), slice(2*TileSize//3, None))),
+                    WriteTile(os.path.join(WorkDir, 'b_big.tif'), 505000, 6245000, 10, (TileSize, TileSize),
+                              (slice(TileSize//2, None), slice(None)))]}
+for case, fn_in in Cases.items():
+    fn_old, fn_new = os.path.join(WorkDir, 'gdal_merge.tif'), os.path.join(WorkDir, 'merge_vrt.tif')
+    Start = time.perf_counter()
+    gdal_merge.main(['', '-q', '-o', fn_old, '-n', '0'] + fn_in)
+    OldTime = time.perf_counter() - Start
+    Start = time.perf_counter()
+    Download.merge_vrt(fn_in, fn_new, nodata=0)
+    NewTime = time.perf_counter() - Start
+    (OldIm, OldGeo, OldTypes), (NewIm, NewGeo, NewTypes) = Read(fn_old), Read(fn_new)
+    Same = OldIm.shape == NewIm.shape and OldGeo == NewGeo and OldTypes == NewTypes
+    Same = Same and np.array_equal(OldIm, NewIm)
+    Passed &= Same
+    print('merge_vrt, %s, %s pixels: %.2f s with gdal_merge, %.2f s now: %s' %
+          (case, 'x'.join(str(_) for _ in NewIm.shape[1:]), OldTime, NewTime, 'match' if Same else 'MISMATCH'))
+    os.remove(fn_old)
+    os.remove(fn_new)
+
+shutil.rmtree(WorkDir)
+print('PASS' if Passed else 'FAIL')
+sys.exit(0 if Passed else 1)
@@ -0,0 +1,168 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Benchmark and parity check for Toolbox.output_to_gdf and
+Toolbox.transects_to_gdf (geometries for all shorelines or transects
+created together by Toolbox.CoordsToGeoms, then one GeoDataFrame built)
+against the loops appending one single-row GeoDataFrame at a time they
+replaced, on 20k seeded synthetic shorelines (some empty) and transects.
+The script checks:
+    - the frames have the same columns in the same order, the same dtypes,
+      the same index (the shoreline positions, skipping empty ones) and the
+      same geometries and values, for 'lines' and 'points'
+    - output_to_gdf leaves output['shorelines'] as it was (the old loop
+      swapped the coordinates of each shoreline in place in 'lines' mode)
+and reports the time of each. DataFrame.append, which the old loops used,
+is gone from pandas 2, so the reference appends with pd.concat (what append
+did underneath).
+
+Run from anywhere with:
+    python Benchmarks/ShorelineGDFs.py
+"""
+
+import os
+import sys
+import copy
+import time
+import warnings
+warnings.filterwarnings("ignore")
+from datetime import datetime
+import numpy as np
+import pandas as pd
+import geopandas as gpd
+from geopandas.testing import assert_geodataframe_equal
+from shapely import geometry
+
+RepoDir = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, RepoDir)
+from Toolshed import Toolbox
+
+#%% Settings
+
+NoShorelines = 20000
+NoTransects = 20000
+EmptyShare = 0.1 # share of images with no shoreline mapped
+Seed = 0
+
+
+#%% Reference implementation (single-row GeoDataFrames appended one at a time)
+
+def OldOutputToGDF(output, geomtype):
+    # loop through the mapped shorelines
+    counter = 0
+    for i in range(len(output['shorelines'])):
+        # skip if there shoreline is empty
+        if len(output['shorelines'][i]) == 0:
+            continue
+        else:
+            # save the geometry depending on the linestyle
+            if geomtype == 'lines':
+                for j in range (len(output['shorelines'][i])):
+                    abbba = []
+                    abbba.append(output['shorelines'][i][j][1])
+                    abbba.append(output['shorelines'][i][j][0])
+                    output['shorelines'][i][j] = abbba
+                geom = geometry.LineString(output['shorelines'][i])
+            elif geomtype == 'points':
+                coords = output['shorelines'][i]
+                geom = geometry.MultiPoint([(coords[_,1], coords[_,0]) for _ in range(coords.shape[0])])
+            else:
+                raise Exception('geomtype %s is not an option, choose between lines or points'%geomtype)
+            # save into geodataframe with attributes
+            gdf = gpd.GeoDataFrame(geometry=gpd.GeoSeries(geom))
+            gdf.index = [i]
+            gdf.loc[i,'date'] = datetime.strftime(datetime.strptime(output['dates'][0],'%Y-%m-%d'),'%Y-%m-%d %H:%M:%S')
+            gdf.loc[i,'satname'] = output['satname'][i]
+            gdf.loc[i,'cloud_cover'] = output['cloud_cover'][i]
+            # store into geodataframe
+            if counter == 0:
+                gdf_all = gdf
+            else:
+                gdf_all = pd.concat([gdf_all, gdf]) # gdf_all.append(gdf)
+            counter = counter + 1
+
+    return gdf_all
+
+
+def OldTransectsToGDF(transects):
+    # loop through the mapped shorelines
+    for i,key in enumerate(list(transects.keys())):
+        # save the geometry + attributes
+        geom = geometry.LineString(transects[key])
+        gdf = gpd.GeoDataFrame(geometry=gpd.GeoSeries(geom))
+        gdf.index = [i]
+        gdf.loc[i,'name'] = key
+        # store into geodataframe
+        if i == 0:
+            gdf_all = gdf
+        else:
+            gdf_all = pd.concat([gdf_all, gdf]) # gdf_all.append(gdf)
+
+    return gdf_all
+
+
+#%% Inputs
+
+rng = np.random.default_rng(Seed)
+shorelines = []
+for i in range(NoShorelines):
+    if rng.random() < EmptyShare:
+        shorelines.append(np.zeros((0, 2)))
+        continue
+    n = int(rng.integers(2, 300))
+    # (row, col) order, as mapped
+    x = np.sort(rng.uniform(500000, 505000, n))
+    y = 6250000 + 50*np.sin(x/300) + rng.normal(0, 2, n)
+    shorelines.append(np.c_[y, x])
+output = {'shorelines':shorelines,
+          'dates':['2019-03-%02d' % (1 + i % 28) for i in range(NoShorelines)],
+          'satname':list(rng.choice(['L5', 'L7', 'L8', 'S2'], NoShorelines)),
+          'cloud_cover':list(rng.uniform(0, 0.5, NoShorelines))}
+transects = dict(('NA%d' % i, np.array([[500000 + i, 6250300], [500000 + i + 20, 6249700]], dtype=float))
+                 for i in range(NoTransects))
+
+
+#%% Run both and compare
+
+Passed = True
+
+def Compare(Old, New):
+    try:
+        assert_geodataframe_equal(New, Old, check_dtype=True, check_less_precise=False)
+        return list(New.columns) == list(Old.columns)
+    except AssertionError as e:
+        print('  ' + str(e).replace('\n', '\n  '))
+        return False
+
+for geomtype in ['lines', 'points']:
+    Before = copy.deepcopy(output)
+    OldInput = copy.deepcopy(output)
+    Start = time.perf_counter()
+    Old = OldOutputToGDF(OldInput, geomtype)
+    OldTime = time.perf_counter() - Start
+    Start = time.perf_counter()
+    New = Toolbox.output_to_gdf(output, geomtype)
+    NewTime = time.perf_counter() - Start
+    Same = Compare(Old, New)
+    Untouched = all(np.array_equal(a, b) for a, b in zip(output['shorelines'], Before['shorelines']))
+    Swapped = not all(np.array_equal(a, b) for a, b in zip(OldInput['shorelines'], Before['shorelines']))
+    Passed &= Same and Untouched
+    print('output_to_gdf, %s, %d shorelines (%d empty): %.1f s before, %.2f s now (%.0fx): %s' %
+          (geomtype, NoShorelines, NoShorelines - len(New), OldTime, NewTime, OldTime/NewTime, 'match' if Same else 'MISMATCH'))
+    print('  columns %s, dtypes %s' % (list(New.columns), [str(d) for d in New.dtypes]))
+    print('  output left as it was%s: %s' % (' (swapped in place before)' if Swapped else '', 'ok' if Untouched else 'MISMATCH'))
+
+Start = time.perf_counter()
+Old = OldTransectsToGDF(transects)
+OldTime = time.perf_counter() - Start
+Start = time.perf_counter()
+New = Toolbox.transects_to_gdf(transects)
+NewTime = time.perf_counter() - Start
+Same = Compare(Old, New)
+Passed &= Same
+print('transects_to_gdf, %d transects: %.1f s before, %.2f s now (%.0fx): %s' %
+      (NoTransects, OldTime, NewTime, OldTime/NewTime, 'match' if Same else 'MISMATCH'))
+print('  columns %s, dtypes %s' % (list(New.columns), [str(d) for d in New.dtypes]))
+
+print('PASS' if Passed else 'FAIL')
+sys.exit(0 if Passed else 1)
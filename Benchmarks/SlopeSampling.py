@@ -0,0 +1,192 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Benchmark and parity check for Transects.SlopeIntersect (sample points for
+all transects built at once and read from one window of the slope raster by
+Transects.SampleRasterWindow) against the per-transect loop of
+interpolated points and src.sample() calls it replaced, on a seeded
+synthetic slope raster and 5000 transects with 300 dates of veg edge
+intersections each. Some transects run off the ends of the raster, some
+cross nodata, some have no intersections and some no TZ width. The script
+checks:
+    - SampleRasterWindow gives the same values as src.sample() at scattered
+      points, including points outside the raster (nodata, or 0 when the
+      raster has no nodata value set), for rasters with and without nodata
+    - max and mean slope on every transect match the old loop, on rasters
+      with and without nodata (transects with no TZ width, on which the old
+      loop raised, are NaN)
+and reports the time of each.
+
+Run from anywhere with:
+    python Benchmarks/SlopeSampling.py
+"""
+
+import os
+import io
+import sys
+import time
+import shutil
+import tempfile
+import contextlib
+import warnings
+warnings.filterwarnings("ignore")
+import numpy as np
+import geopandas as gpd
+import rasterio as rio
+from rasterio.transform import from_origin
+from shapely.geometry import LineString, Point
+
+RepoDir = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, RepoDir)
+from Toolshed import Transects
+
+#%% Settings
+
+NoTransects = 5000
+NoDates = 300
+PixelSize = 2
+Spacing = 2 # metres between transects
+Angle = 10 # degrees off north-south
+OffEnds = 100 # transects past each end of the raster
+NoWidth = 50 # transects with no TZ width
+NoInters = 50 # transects with no intersections
+EPSG = 32630
+Seed = 0
+
+
+#%% Reference implementation (points interpolated along each transect and sampled one transect at a time)
+
+def OldSlopes(TransectInterGDF, DTMfile):
+    # DTM should be in same CRS as Transects
+    src = rio.open(DTMfile)
+
+    MaxSlope = []
+    MeanSlope = []
+
+    for Tr in range(len(TransectInterGDF)):
+        # Only want 20 m either side of veg intersect
+        InterPnts = TransectInterGDF['interpnt'].iloc[Tr]
+        # If there are no line intersections on that transect (or no TZ width, on which this raised)
+        if InterPnts == [] or np.isnan(TransectInterGDF['TZwidthMn'].iloc[Tr]):
+            MaxSlope.append(np.nan)
+            MeanSlope.append(np.nan)
+        else:
+            # Take average vegline intersection point of each transect to swath points along
+            InterPnt = Point(np.mean([Pnt.x for Pnt in InterPnts]), np.mean([Pnt.y for Pnt in InterPnts]))
+
+            # Extend Tr in either direction along transect from intersection point
+            intx, Trx, inty, Try = InterPnt.coords.xy[0][0], TransectInterGDF.iloc[Tr].geometry.coords.xy[0][0], InterPnt.coords.xy[1][0],TransectInterGDF.iloc[Tr].geometry.coords.xy[1][0]
+            # Distance decided by cross-shore width of TZ plus extra 5m buffer
+            dist = round(TransectInterGDF['TZwidthMn'].iloc[Tr]) + 5
+            # calculate vector
+            v = (Trx-intx, Try-inty)
+            v_ = np.sqrt((Trx-intx)**2 + (Try-inty)**2)
+            # calculate normalised vector
+            vnorm = v / v_
+            # use norm vector to extend
+            x_1, y_1 = (intx, inty) - (dist*vnorm)
+            x_2, y_2 = (intx, inty) + (dist*vnorm)
+
+            # New linestring from extended points
+            NewTr = gpd.GeoDataFrame(index=[0], crs=TransectInterGDF.crs, geometry=[LineString([(x_1,y_1),(x_2,y_2)])])
+            NewTrGeom = NewTr.geometry
+            # Generate regularly spaced points along each transect
+            distance_delta = 1
+            distances = np.arange(0, float(NewTrGeom.length.iloc[0]), distance_delta)
+            points = [NewTrGeom.interpolate(distance) for distance in distances]
+            points = [(float(point.x.iloc[0]), float(point.y.iloc[0])) for point in points]
+
+            # Extract slope values at each point along Tr
+            MaxSlopeTr = np.max([val[0] for val in src.sample(points)])
+            MeanSlopeTr = np.mean([val[0] for val in src.sample(points)])
+            if MaxSlopeTr == -9999: # nodata value
+                MaxSlopeTr = np.nan
+                MeanSlopeTr = np.nan
+            MaxSlope.append(MaxSlopeTr)
+            MeanSlope.append(MeanSlopeTr)
+    src.close()
+    return np.array(MaxSlope, dtype=float), np.array(MeanSlope, dtype=float)
+
+
+#%% Inputs
+
+rng = np.random.default_rng(Seed)
+WorkDir = tempfile.mkdtemp()
+X0, Y0 = 500000.0, 6250000.0
+Width = (NoTransects - 2*OffEnds)*Spacing
+Shape = (200, int(Width/PixelSize))
+transform = from_origin(X0, Y0, PixelSize, PixelSize)
+
+# smooth slopes (degrees) with a few nodata gaps
+Cols = np.arange(Shape[1])[None,:]
+Rows = np.arange(Shape[0])[:,None]
+Slope = (15 + 10*np.sin(Cols/150) + 8*np.cos(Rows/20) + rng.normal(0, 2, Shape)).astype('float32')
+Gaps = np.zeros(Shape, bool)
+for c in rng.integers(0, Shape[1] - 100, 20):
+    Gaps[:, c:c + int(rng.integers(20, 100))] = True
+
+def WriteSlope(fn, nodata):
+    with rio.open(fn, 'w', driver='GTiff', width=Shape[1], height=Shape[0], count=1, dtype='float32',
+                  crs='EPSG:%d' % EPSG, transform=transform, nodata=nodata) as dst:
+        dst.write(np.where(Gaps, -9999, Slope)[None] if nodata is not None else Slope[None])
+    return fn
+
+Rasters = {'nodata -9999':WriteSlope(os.path.join(WorkDir, 'slope_nodata.tif'), -9999),
+           'no nodata set':WriteSlope(os.path.join(WorkDir, 'slope.tif'), None)}
+
+# transects from land (north) to sea, some starting past either end of the raster
+TrUnitVec = np.array([np.sin(np.radians(Angle)), -np.cos(np.radians(Angle))])
+TrStarts = np.c_[X0 + (np.arange(NoTransects) - OffEnds)*Spacing, np.full(NoTransects, Y0 - 20)]
+Geoms = [LineString([tuple(S), tuple(S + 360*TrUnitVec)]) for S in TrStarts]
+# veg edge intersections along each transect, one per date
+EdgeDists = 180 + 40*np.sin(np.arange(NoTransects)/300)
+InterPnts = [[Point(S + d*TrUnitVec) for d in e + rng.normal(0, 8, NoDates)] for S, e in zip(TrStarts, EdgeDists)]
+for Tr in rng.choice(NoTransects, NoInters, replace=False):
+    InterPnts[Tr] = []
+TZwidthMn = rng.uniform(5, 40, NoTransects)
+TZwidthMn[rng.choice(NoTransects, NoWidth, replace=False)] = np.nan
+TransectInterGDF = gpd.GeoDataFrame({'TransectID':np.arange(NoTransects), 'interpnt':InterPnts, 'TZwidthMn':TZwidthMn},
+                                    geometry=Geoms, crs='EPSG:%d' % EPSG)
+settings = {'inputs':{'sitename':'StAndrews'}}
+
+
+#%% Run both and compare
+
+Passed = True
+
+# point sampling, inside and outside the raster
+X = X0 + rng.uniform(-200, Width + 200, 20000)
+Y = Y0 - rng.uniform(-100, Shape[0]*PixelSize + 100, 20000)
+for case, fn in Rasters.items():
+    with rio.open(fn) as src:
+        Start = time.perf_counter()
+        Old = np.array([val[0] for val in src.sample(zip(X, Y))])
+        OldTime = time.perf_counter() - Start
+        Start = time.perf_counter()
+        New = Transects.SampleRasterWindow(src, X, Y)
+        NewTime = time.perf_counter() - Start
+        Outside = (X < X0) | (X >= X0 + Width) | (Y > Y0) | (Y <= Y0 - Shape[0]*PixelSize)
+    Same = np.array_equal(Old, New)
+    Passed &= Same
+    print('SampleRasterWindow, %s, %d points (%d outside): %.2f s with src.sample(), %.3f s now: %s' %
+          (case, len(X), Outside.sum(), OldTime, NewTime, 'match' if Same else 'MISMATCH'))
+
+for case, fn in Rasters.items():
+    Start = time.perf_counter()
+    OldMax, OldMean = OldSlopes(TransectInterGDF, fn)
+    OldTime = time.perf_counter() - Start
+    Start = time.perf_counter()
+    with contextlib.redirect_stdout(io.StringIO()):
+        New = Transects.SlopeIntersect(settings, None, TransectInterGDF.copy(), None, WorkDir, fn)
+    NewTime = time.perf_counter() - Start
+    # mean of float32 samples before, float64 now
+    Same = (np.array_equal(OldMax, New['SlopeMax'].values, equal_nan=True) and
+            np.allclose(OldMean, New['SlopeMean'].values, rtol=1e-5, equal_nan=True))
+    Passed &= Same
+    print('SlopeIntersect, %s, %d transects x %d dates (%d NaN): %.1f s before, %.1f s now (%.0fx, with the shapefile): %s' %
+          (case, NoTransects, NoDates, np.isnan(New['SlopeMax']).sum(), OldTime, NewTime, OldTime/NewTime,
+           'match' if Same else 'MISMATCH'))
+
+shutil.rmtree(WorkDir)
+print('PASS' if Passed else 'FAIL')
+sys.exit(0 if Passed else 1)
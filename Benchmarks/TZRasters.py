@@ -0,0 +1,147 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Benchmark and parity check for Image_Processing.save_TZone against the
+per-pixel loop it replaced, on seeded synthetic images. The single-image
+GeoTIFFs must be pixel-identical (nan where the old raster was nan), and each
+band of the batch mode stacks (TZStack) must match its single-image raster.
+
+Run from anywhere with:
+    python Benchmarks/TZRasters.py
+"""
+
+import os
+import sys
+import time
+import shutil
+import tempfile
+import tracemalloc
+import warnings
+warnings.filterwarnings("ignore")
+import numpy as np
+import rasterio
+
+RepoDir = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, RepoDir)
+from Toolshed import Image_Processing, Toolbox
+
+#%% Settings
+
+sitename = 'StAndrews'
+ImShape = (300, 420)
+NoImages = 12
+Seed = 0
+
+
+#%% Reference implementation (loop over every pixel)
+
+def OldTZone(im_ms, im_labels, cloud_mask, georef, savename, epsg):
+    transform = rasterio.transform.from_origin(georef[0], georef[3], georef[1], georef[1])
+    im_ndvi = Toolbox.nd_index(im_ms[:,:,3], im_ms[:,:,2], cloud_mask)
+    int_veg = im_ndvi[im_labels[:,:,0]]
+    int_nonveg = im_ndvi[im_labels[:,:,1]]
+    im_TZ = im_ndvi.copy()
+    TZbuffer = Toolbox.TZValues(int_veg, int_nonveg)
+    for i in range(len(im_ndvi[:,0])):
+        for j in range(len(im_ndvi[0,:])):
+            if im_ndvi[i,j] > TZbuffer[0] and im_ndvi[i,j] < TZbuffer[1]:
+                im_TZ[i,j] = 1.0
+            else:
+                im_TZ[i,j] = np.nan
+    with rasterio.open(savename, 'w', driver='GTiff', height=im_TZ.shape[0], width=im_TZ.shape[1],
+                       count=1, dtype=im_TZ.dtype, crs='EPSG:'+str(epsg), transform=transform) as tif:
+        tif.write(im_TZ,1)
+
+
+#%% Inputs
+
+def SyntheticImage(rng, shape):
+    # smooth vegetated area inland, bare sand and water seaward, plus noise and a cloud
+    rows, cols = np.mgrid[0:shape[0], 0:shape[1]]
+    veg = 1/(1 + np.exp((cols - shape[1]*rng.uniform(0.4, 0.6))/15))
+    im_ms = np.zeros(shape + (5,))
+    im_ms[:,:,2] = 0.08 + 0.1*(1 - veg) + rng.normal(0, 0.01, shape) # red
+    im_ms[:,:,3] = 0.1 + 0.35*veg + rng.normal(0, 0.02, shape) # nir
+    cloud_mask = (rows - shape[0]*0.2)**2 + (cols - shape[1]*0.8)**2 < (shape[0]*0.1)**2
+    im_ms[cloud_mask] = np.nan
+    im_ndvi = Toolbox.nd_index(im_ms[:,:,3], im_ms[:,:,2], cloud_mask)
+    im_labels = np.stack([im_ndvi > 0.4, (im_ndvi < 0.15) & (im_ndvi > -1)], axis=2)
+    return im_ms, im_labels, cloud_mask
+
+
+def ReadBand(path, band=1):
+    with rasterio.open(path) as src:
+        return src.read(band), src.transform, src.descriptions
+
+
+WorkDir = tempfile.mkdtemp()
+JpgDir = os.path.join(WorkDir, sitename, 'jpg_files')
+os.makedirs(JpgDir)
+OldDir = os.path.join(WorkDir, 'old')
+os.makedirs(OldDir)
+settings = {'inputs':{'filepath':WorkDir, 'sitename':sitename}, 'output_epsg':27700}
+
+rng = np.random.default_rng(Seed)
+Images = []
+for i in range(NoImages):
+    im_ms, im_labels, cloud_mask = SyntheticImage(rng, ImShape)
+    # every third image on a shifted grid, to give two stacks
+    georef = [350000.0 + 10*(i % 3 == 0), 10.0, 0, 720000.0, 0, -10.0]
+    Images.append((im_ms, im_labels, cloud_mask, georef, '/x/%s_S2_%02d.tif' % (sitename, i)))
+
+
+#%% Run both and compare
+
+Passed = True
+Start = time.perf_counter()
+for im_ms, im_labels, cloud_mask, georef, filenames in Images:
+    tifname = os.path.basename(filenames)[:-4]
+    OldTZone(im_ms, im_labels, cloud_mask, georef, os.path.join(OldDir, tifname+'_TZ.tif'), 27700)
+OldTime = time.perf_counter() - Start
+
+Start = time.perf_counter()
+for im_ms, im_labels, cloud_mask, georef, filenames in Images:
+    Image_Processing.save_TZone(im_ms, im_labels, cloud_mask, georef, filenames, settings)
+NewTime = time.perf_counter() - Start
+
+Singles = {}
+for _, _, _, _, filenames in Images:
+    tifname = os.path.basename(filenames)[:-4]
+    OldTZ, OldTransform, _ = ReadBand(os.path.join(OldDir, tifname+'_TZ.tif'))
+    NewTZ, NewTransform, _ = ReadBand(os.path.join(JpgDir, tifname+'_TZ.tif'))
+    Singles[tifname] = NewTZ
+    Same = (OldTZ.dtype == NewTZ.dtype and OldTransform == NewTransform and
+            np.array_equal(OldTZ, NewTZ, equal_nan=True))
+    Passed &= Same
+print('single TZ rasters: %s' % ('pixel-identical' if Passed else 'MISMATCH'))
+print('save_TZone: pixel loop %.3f s, masks %.3f s per image (%.0fx)' %
+      (OldTime/NoImages, NewTime/NoImages, OldTime/NewTime))
+
+# batch mode, which also clears the single rasters of the same images
+tracemalloc.start()
+Stack = Image_Processing.TZStack('S2', settings)
+for im_ms, im_labels, cloud_mask, georef, filenames in Images:
+    Image_Processing.save_TZone(im_ms, im_labels, cloud_mask, georef, filenames, settings, Stack)
+Stack.Close()
+_, Peak = tracemalloc.get_traced_memory()
+tracemalloc.stop()
+
+StackPaths = sorted(os.path.join(JpgDir, f) for f in os.listdir(JpgDir) if '_TZstack' in f)
+Bands = {}
+for StackPath in StackPaths:
+    with rasterio.open(StackPath) as src:
+        for b, tifname in enumerate(src.descriptions):
+            Bands[tifname] = src.read(b+1)
+Same = (sorted(Bands) == sorted(Singles) and
+        all(np.array_equal(Bands[f], Singles[f].astype(np.float32), equal_nan=True) for f in Singles))
+Passed &= Same
+print('TZ stacks (%d files, %d bands): %s' % (len(StackPaths), len(Bands), 'match' if Same else 'MISMATCH'))
+Leftover = [f for f in os.listdir(JpgDir) if f.endswith('_TZ.tif') or '_parts_' in f]
+Passed &= Leftover == []
+print('stale single TZ rasters and part files removed: %s' % (Leftover == []))
+print('peak traced memory writing stacks: %.1f MB (one band is %.1f MB)' %
+      (Peak/1e6, np.prod(ImShape)*8/1e6))
+
+shutil.rmtree(WorkDir)
+print('PASS' if Passed else 'FAIL')
+sys.exit(0 if Passed else 1)
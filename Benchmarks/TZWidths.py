@@ -0,0 +1,198 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Benchmark and parity check for the TZ widths of Transects.TZIntersect
+(Transects.TZWidthsFromRaster, which samples each TZ raster along all
+transects at once) against the polygonise-then-loop version it replaced, on
+seeded synthetic TZ rasters around a wavy veg edge. Three kinds of raster
+are used:
+    - bands: one TZ band containing the veg edge, well inside the ref line
+      buffer; widths must match to within the sample step (1 m), as the
+      samples see the same pixel edges the polygons were cut along
+    - cut: a TZ band running out past max_dist_ref on the seaward side; the
+      old version clipped the TZ polygons to a buffer around the whole veg
+      edge, the new one stops sampling max_dist_ref along the transect from
+      the intersection, so where the transect is not square to the veg edge
+      the old widths run a few metres further out to sea; the new widths
+      must never be longer than the old ones
+    - patches: a second TZ band further seaward and holes in the TZ; the old
+      version measured across the outline of the polygon whose first crossing
+      was closest to the veg edge (so across any holes), the new one takes
+      the run of TZ pixels containing (or closest to) the veg edge, so stops
+      at holes; again the new widths must never be longer
+These are the intended differences. The checks are made on transects that
+cross the TZ outline twice; the odd transect clipping a pixel corner crosses
+it 4 or more times, where the old version took the distance between the
+first two crossings (often a metre or two across the corner) rather than the
+width of the TZ, so these are only counted. The share of widths that differ
+and the runtime of both are reported.
+
+Run from anywhere with:
+    python Benchmarks/TZWidths.py
+"""
+
+import os
+import sys
+import time
+import shutil
+import tempfile
+import warnings
+warnings.filterwarnings("ignore")
+import numpy as np
+import geopandas as gpd
+import rasterio as rio
+from rasterio.features import shapes
+from shapely.geometry import LineString
+
+RepoDir = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, RepoDir)
+from Toolshed import Transects, Image_Processing, Toolbox
+
+#%% Settings
+
+NoTransects = 300
+NoImages = 5 # per kind of raster
+MaxDistRef = 150 # settings['max_dist_ref']
+PixelSize = 10
+Shape = (120, 400) # rows, cols
+Angle = 7 # degrees off perpendicular, so transects don't run along pixel edges
+EPSG = 32630
+Seed = 0
+
+
+#%% Reference implementation (TZ polygonised, clipped to the veg edge buffer, then each transect intersected)
+
+def OldTZWidths(TZpath, Vegline, TransectGeoms, InterPnts, max_dist_ref):
+    with rio.Env():
+        with rio.open(TZpath) as src:
+            img = src.read(1).astype("float32") # first band
+            results = (
+            {'properties': {'raster_val': v}, 'geometry': s}
+            for i, (s, v)
+            in enumerate(
+                shapes(img, mask=None, transform=src.transform)))
+    # TZ to polygon
+    geoms = list(results)
+    TZpoly = gpd.GeoDataFrame.from_features(geoms, src.crs)
+    TZpoly = TZpoly[TZpoly['raster_val'] == 1] # get rid of nan polygons
+    # Get matching veg line and buffer by ref line buffer amount
+    VeglineBuff = gpd.GeoSeries([Vegline], crs=src.crs).buffer(max_dist_ref)
+    # Clip TZ polys to matching image's vegline buffer
+    TZpolyClip = gpd.clip(TZpoly,VeglineBuff)
+    TZpolyClip = TZpolyClip.explode(index_parts=False)
+
+    TZwidths, Crossings = [], []
+    for TransectGeom, InterPnt in zip(TransectGeoms, InterPnts):
+        # Intersect Tr with TZ polygon
+        TrIntersect = TZpolyClip.exterior.intersection(TransectGeom)
+        # Remove empty geoms from TZ dataframe
+        TZpolyClipInter = TrIntersect[(TrIntersect.is_empty == False) & (TrIntersect.isna() == False)]
+        # if Transect ends inside TZ polygon, extend length until multipoint is achieved
+        while (TZpolyClipInter.geom_type == 'Point').sum() > 0:
+            TransectGeom = Toolbox.ExtendLine(TransectGeom, 10)
+            TrIntersect = TZpolyClip.exterior.intersection(TransectGeom)
+            TZpolyClipInter = TrIntersect[(TrIntersect.is_empty == False) & (TrIntersect.isna() == False)]
+        # if Transect doesn't intersect with any TZ polygons
+        if len(TZpolyClipInter) == 0:
+            TZwidths.append(np.nan)
+            Crossings.append(0)
+            continue
+        # distance between first TZ intersection point and VE-Tr intersection
+        pntdist = np.array([list(Pnts.geoms)[0].distance(InterPnt) for Pnts in TZpolyClipInter])
+        TZpolyClose = TZpolyClipInter[pntdist == pntdist.min()]
+        # TZ width (Distance between intersect points)
+        Pnts = TZpolyClose.explode(index_parts=True)
+        TZwidths.append(Pnts.iloc[0].distance(Pnts.iloc[1]))
+        Crossings.append(len(Pnts))
+    return np.array(TZwidths), np.array(Crossings)
+
+
+#%% Inputs
+
+rng = np.random.default_rng(Seed)
+X0, Y0 = 500000.0, 6250000.0
+transform = rio.transform.from_origin(X0, Y0, PixelSize, PixelSize)
+Cols, Rows = np.meshgrid(np.arange(Shape[1]) + 0.5, np.arange(Shape[0]) + 0.5)
+PixX, PixY = transform * (Cols, Rows)
+
+def VegEdgeY(x, phase, amp):
+    # wavy veg edge running along the x axis, land to the north
+    return Y0 - Shape[0]*PixelSize/2 + amp*np.sin((x - X0)/300 + phase)
+
+def SyntheticTZ(kind):
+    phase, amp = rng.uniform(0, 2*np.pi), rng.uniform(20, 80) if kind == 'cut' else rng.uniform(10, 40)
+    # offset of each pixel from the veg edge (positive to sea), widths varying along the coast
+    Offset = VegEdgeY(PixX, phase, amp) - PixY
+    Landward = 20 + 15*np.sin((PixX - X0)/500 + rng.uniform(0, 2*np.pi))
+    Seaward = 30 + 20*np.sin((PixX - X0)/400 + rng.uniform(0, 2*np.pi))
+    if kind == 'cut':
+        Seaward = Seaward + 200 # past max_dist_ref
+    TZ = (Offset > -Landward) & (Offset < Seaward)
+    if kind == 'patches':
+        TZ |= (Offset > Seaward + 40) & (Offset < Seaward + 80)
+        Holes = rng.random(Shape) < 0.03
+        TZ &= ~(Holes & (Offset > -Landward + PixelSize) & (Offset < Seaward - PixelSize))
+    Vegline = LineString(np.c_[np.linspace(X0, X0 + Shape[1]*PixelSize, 2000),
+                               VegEdgeY(np.linspace(X0, X0 + Shape[1]*PixelSize, 2000), phase, amp)])
+    return np.where(TZ, 1.0, np.nan).astype(np.float32), Vegline
+
+# transects from land to sea, slightly skewed, clear of the raster edges
+TrX = np.linspace(X0 + 400, X0 + Shape[1]*PixelSize - 400, NoTransects)
+TrUnitVec = np.array([np.sin(np.radians(Angle)), -np.cos(np.radians(Angle))])
+TrStart = np.c_[TrX, np.full(NoTransects, Y0 - 100)]
+TransectGeoms = [LineString([tuple(S), tuple(S + 900*TrUnitVec)]) for S in TrStart]
+TrUnitVecs = np.tile(TrUnitVec, (NoTransects, 1))
+
+WorkDir = tempfile.mkdtemp()
+Rasters = []
+for kind in ['bands', 'cut', 'patches']:
+    for i in range(NoImages):
+        im_TZ, Vegline = SyntheticTZ(kind)
+        path = os.path.join(WorkDir, '%s_%d_TZ.tif' % (kind, i))
+        Image_Processing.write_TZ(path, im_TZ, transform, EPSG)
+        # veg edge intersection on each transect
+        InterPnts = [TrGeom.intersection(Vegline) for TrGeom in TransectGeoms]
+        Rasters.append((kind, path, Vegline, InterPnts))
+
+
+#%% Run both and compare
+
+Passed = True
+Results = dict([(kind, ([], [], [])) for kind in ['bands', 'cut', 'patches']])
+OldTime, NewTime = 0, 0
+for kind, path, Vegline, InterPnts in Rasters:
+    Start = time.perf_counter()
+    Old, Crossings = OldTZWidths(path, Vegline, TransectGeoms, InterPnts, MaxDistRef)
+    OldTime += time.perf_counter() - Start
+    Start = time.perf_counter()
+    New = Transects.TZWidthsFromRaster(path, 'EPSG:%d' % EPSG, np.array([P.coords[0] for P in InterPnts]),
+                                       TrUnitVecs, MaxDistRef)
+    NewTime += time.perf_counter() - Start
+    for result, value in zip(Results[kind], [Old, New, Crossings]):
+        result.append(value)
+
+for kind, (Old, New, Crossings) in Results.items():
+    Old, New, Crossings = np.concatenate(Old), np.concatenate(New), np.concatenate(Crossings)
+    # transects crossing the TZ outline just twice (else the old width was between the first two crossings)
+    Two = Crossings == 2
+    Diff = Old[Two] - New[Two]
+    if kind == 'bands':
+        # same width to within the sample step
+        Same = np.all(np.abs(Diff) <= 1)
+    else:
+        # the new width never goes beyond the old one (the cut along the transect is inside the
+        # buffer, and holes can only shorten the run)
+        Same = np.all(Diff >= -1)
+    Passed &= Same
+    print('%s: %d widths, mean %.1f m before, %.1f m now; on the %d crossing the TZ once, %.1f%% differ by over 1 m '
+          '(up to %.1f m longer before, %.1f m shorter): %s' %
+          (kind, len(Old), np.nanmean(Old), np.nanmean(New), Two.sum(), 100*np.mean(np.abs(Diff) > 1),
+           Diff.max(), -Diff.min(), 'match' if Same else 'MISMATCH'))
+    print('  %d crossing the outline 4+ times (e.g. at a pixel corner), measured across the first 2 before: '
+          '%d differ by over 1 m' % ((~Two).sum(), np.sum(np.abs(Old[~Two] - New[~Two]) > 1)))
+print('%d TZ rasters x %d transects: %.2f s before, %.3f s now (%.0fx)' %
+      (len(Rasters), NoTransects, OldTime, NewTime, OldTime/NewTime))
+
+shutil.rmtree(WorkDir)
+print('PASS' if Passed else 'FAIL')
+sys.exit(0 if Passed else 1)
@@ -0,0 +1,206 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Benchmark and parity check for Transects.ValidateIntersects and
+Transects.ValidateSatIntersects on the St Andrews validation lines, against
+the pairwise transect-line intersection and per-transect NearDate matching
+they replaced.
+
+Shore-normal transects are cast along the longest St Andrews survey line,
+and each transect is given a seeded set of sat dates and distances (including
+one date with no validation survey within 5 months).
+
+Run from anywhere with:
+    python Benchmarks/ValidationMatching.py
+"""
+
+import os
+import sys
+import time
+import shutil
+import tempfile
+import warnings
+warnings.filterwarnings("ignore")
+from datetime import datetime
+import numpy as np
+import geopandas as gpd
+from shapely.geometry import LineString, Point
+
+RepoDir = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, RepoDir)
+from Toolshed import Transects, Toolbox
+
+#%% Settings
+
+ValidationShp = os.path.join(RepoDir, 'Validation', 'StAndrews_Veg_Edge_combined_singlepart.shp')
+DatesCol = 'Date'
+sitename = 'StAndrews'
+TrSpacing = 10 # metres between transects
+TrLength = 200 # metres, centred on the reference line
+# sat dates near the St Andrews surveys, plus one with no survey within 5 months
+SatDates = ['2007-04-17', '2011-09-26', '2014-01-01', '2016-08-10',
+            '2017-07-17', '2018-06-27', '2018-07-04', '2018-12-20']
+
+
+#%% Reference implementation (pairwise intersects and NearDate matching)
+
+def OldNearDate(target, items):
+    nearestDate = min(items, key=lambda x: abs(x - target))
+    if abs((target - nearestDate).days) > 153:
+        return False
+    else:
+        return nearestDate
+
+
+def OldIntersects(ValidGDF, TransectGDF, TransectDict):
+    # every transect against every validation line
+    ColumnData, Geoms = [], []
+    for ID, TrGeom in zip(TransectGDF['TransectID'], TransectGDF.geometry):
+        for dates, SGeom in zip(ValidGDF[DatesCol], ValidGDF.geometry):
+            ColumnData.append((ID, dates))
+            Geoms.append(TrGeom.intersection(SGeom))
+    AllIntersects = gpd.GeoDataFrame(ColumnData, geometry=Geoms, columns=['TransectID','Vdates'])
+    AllIntersects = AllIntersects[~AllIntersects.is_empty].reset_index(drop=True)
+    AllIntersects['Vinterpnt'] = [Inter.geoms[0] if Inter.geom_type == 'MultiPoint' else Inter
+                                  for Inter in AllIntersects.geometry]
+    AllIntersects = AllIntersects.drop('geometry', axis=1)
+    AllIntersects = AllIntersects.merge(TransectGDF[['TransectID','geometry']], on='TransectID')
+    AllIntersects['Vdists'] = [Toolbox.CalcDistance(AllIntersects['Vinterpnt'][i], AllIntersects['geometry'][i])
+                               for i in range(len(AllIntersects))]
+    # per-transect lists, filtering the whole table for every value
+    ValidDict = TransectDict.copy()
+    for Key in ['Vdates', 'Vdists', 'Vinterpnt']:
+        ValidDict[Key] = []
+        for Tr in range(len(TransectGDF['TransectID'])):
+            TrKey = []
+            for j in range(len(AllIntersects.loc[AllIntersects['TransectID']==Tr])):
+                TrKey.append(AllIntersects[Key].loc[AllIntersects['TransectID']==Tr].iloc[j])
+            ValidDict[Key].append(TrKey)
+    return ValidDict
+
+
+def OldValidateIntersects(ValidGDF, TransectGDF, TransectDict):
+    ValidDict = OldIntersects(ValidGDF, TransectGDF, TransectDict)
+    ValidDict['valsatdist'] = []
+    for Tr in range(len(TransectGDF)):
+        VDateList = [datetime.strptime(date, '%Y-%m-%d') for date in ValidDict['Vdates'][Tr]]
+        DateList = [datetime.strptime(date, '%Y-%m-%d') for date in ValidDict['dates'][Tr]]
+        ValSatDists = []
+        for D, VDate in enumerate(VDateList):
+            if DateList == []:
+                continue
+            NearestDate = OldNearDate(VDate, DateList)
+            if NearestDate is False:
+                # DateList.index(False) raised here; new version gives nan
+                ValSatDists.append(np.nan)
+                continue
+            DateIndex = DateList.index(NearestDate)
+            ValSatDists.append(ValidDict['distances'][Tr][DateIndex] - ValidDict['Vdists'][Tr][D])
+        ValidDict['valsatdist'].append(ValSatDists)
+    return ValidDict
+
+
+def OldValidateSatIntersects(ValidGDF, TransectGDF, TransectDict):
+    ValidDict = OldIntersects(ValidGDF, TransectGDF, TransectDict)
+    ValidDict['valsatdist'], ValidDict['valsatdate'] = [], []
+    for Tr in range(len(TransectGDF)):
+        VDateList = [datetime.strptime(date, '%Y-%m-%d') for date in ValidDict['Vdates'][Tr]]
+        DateList = [datetime.strptime(date, '%Y-%m-%d') for date in ValidDict['dates'][Tr]]
+        ValSatDists = list(np.empty(len(DateList))*np.nan)
+        ValSatDates = list(np.empty(len(DateList))*np.nan)
+        for D, Date in enumerate(DateList):
+            if VDateList == []:
+                continue
+            NearestDate = OldNearDate(Date, VDateList)
+            if NearestDate is False:
+                continue
+            VDateIndex = VDateList.index(NearestDate)
+            ValSatDists[D] = ValidDict['distances'][Tr][D] - ValidDict['Vdists'][Tr][VDateIndex]
+            ValSatDates[D] = ValidDict['Vdates'][Tr][VDateIndex]
+        ValidDict['valsatdist'].append(ValSatDists)
+        ValidDict['valsatdate'].append(ValSatDates)
+    return ValidDict
+
+
+#%% Inputs
+
+def ShoreNormalTransects(RefLine, Spacing, Length):
+    Geoms = []
+    for Dist in np.arange(0, RefLine.length, Spacing):
+        Pnt = RefLine.interpolate(Dist)
+        Ahead = RefLine.interpolate(min(Dist + 1, RefLine.length))
+        Behind = RefLine.interpolate(max(Dist - 1, 0))
+        dx, dy = Ahead.x - Behind.x, Ahead.y - Behind.y
+        Norm = np.hypot(dx, dy)
+        nx, ny = -dy/Norm*Length/2, dx/Norm*Length/2
+        Geoms.append(LineString([(Pnt.x - nx, Pnt.y - ny), (Pnt.x + nx, Pnt.y + ny)]))
+    return gpd.GeoDataFrame({'TransectID':np.arange(len(Geoms))}, geometry=Geoms)
+
+
+def SameList(ListA, ListB):
+    if len(ListA) != len(ListB):
+        return False
+    for A, B in zip(ListA, ListB):
+        if isinstance(A, Point) or isinstance(B, Point):
+            if not A.equals(B):
+                return False
+        elif isinstance(A, str) or isinstance(B, str):
+            if A != B:
+                return False
+        elif not np.isclose(float(A), float(B), equal_nan=True):
+            return False
+    return True
+
+
+WorkDir = tempfile.mkdtemp()
+os.makedirs(os.path.join(WorkDir, 'Data', sitename))
+os.chdir(WorkDir)
+
+ValidGDF = gpd.read_file(ValidationShp)[[DatesCol, 'geometry']]
+ValidGDF[DatesCol] = [str(Date)[:10] for Date in ValidGDF[DatesCol]]
+# dates written as text so both readers hand back '%Y-%m-%d' strings
+ValidPath = os.path.join(WorkDir, 'validation.shp')
+ValidGDF.to_file(ValidPath)
+
+RefLine = ValidGDF.geometry[ValidGDF.length.idxmax()]
+TransectGDF = ShoreNormalTransects(RefLine, TrSpacing, TrLength).set_crs(ValidGDF.crs)
+
+rng = np.random.default_rng(0)
+TransectDict = {'TransectID':list(TransectGDF['TransectID']), 'dates':[], 'distances':[]}
+for Tr in range(len(TransectGDF)):
+    TrDates = [Date for Date in SatDates if rng.random() > 0.3] if Tr % 11 else []
+    TransectDict['dates'].append(TrDates)
+    TransectDict['distances'].append(list(rng.uniform(0, TrLength, len(TrDates))))
+
+print('%i transects, %i validation lines' % (len(TransectGDF), len(ValidGDF)))
+
+
+#%% Run both and compare
+
+Passed = True
+for Name, OldFn, NewFn, Keys in [
+        ('ValidateIntersects', OldValidateIntersects,
+         lambda: Transects.ValidateIntersects(ValidPath, DatesCol, TransectGDF, dict(TransectDict)),
+         ['Vdates', 'Vdists', 'Vinterpnt', 'valsatdist']),
+        ('ValidateSatIntersects', OldValidateSatIntersects,
+         lambda: Transects.ValidateSatIntersects(sitename, ValidPath, DatesCol, TransectGDF, dict(TransectDict)),
+         ['Vdates', 'Vdists', 'Vinterpnt', 'valsatdist', 'valsatdate'])]:
+
+    Start = time.perf_counter()
+    OldDict = OldFn(ValidGDF, TransectGDF, dict(TransectDict))
+    OldTime = time.perf_counter() - Start
+    Start = time.perf_counter()
+    NewDict = NewFn()
+    NewTime = time.perf_counter() - Start
+
+    for Key in Keys:
+        Same = (len(OldDict[Key]) == len(NewDict[Key]) and
+                all(SameList(OldTr, NewTr) for OldTr, NewTr in zip(OldDict[Key], NewDict[Key])))
+        Passed &= Same
+        print('%s %s: %s' % (Name, Key, 'match' if Same else 'MISMATCH'))
+    print('%s: pairwise %.2f s, indexed %.2f s (%.1fx)\n' % (Name, OldTime, NewTime, OldTime/NewTime))
+
+os.chdir(RepoDir)
+shutil.rmtree(WorkDir)
+print('PASS' if Passed else 'FAIL')
+sys.exit(0 if Passed else 1)
@@ -0,0 +1,201 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Benchmark and check of the year composite scheduler and composite store used
+by VegetationLine.extract_veglines_year, with Earth Engine replaced by a
+local stub.
+
+The stub stands in for Image_Processing.preprocess_cloudfreeyearcomposite,
+returning a seeded synthetic composite for each year after a delay (shorter
+for later years, so they arrive out of order; one year is fully clouded, so
+is skipped). Classification is replaced by a stub with a fixed cost, which
+takes its threshold from the composite's NDVI, so outputs can be compared.
+The script checks:
+    - outputs match a one-year-at-a-time loop, in year order
+    - with settings['check_detection'] on, years are shown in year order
+      (show_detection is replaced by a stub that records the dates)
+    - an error while classifying a year is raised without waiting for the
+      remaining years, and leaves no worker threads behind
+    - with settings['composite_cache'] off (the default) nothing is stored
+    - with it on, a rerun only requests the current (unfinished) year, and
+      adding a year to settings['year_list'] only requests that year
+
+Run from anywhere with:
+    python Benchmarks/YearComposites.py
+"""
+
+import os
+import sys
+import time
+import shutil
+import tempfile
+import threading
+import warnings
+warnings.filterwarnings("ignore")
+from datetime import datetime
+import numpy as np
+
+RepoDir = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, RepoDir)
+from Toolshed import VegetationLine, Image_Processing, Toolbox
+
+#%% Settings
+
+sitename = 'StAndrews'
+satname = 'L8'
+ThisYear = datetime.utcnow().year
+Years = list(range(ThisYear-7, ThisYear+1)) # last year in list is not over yet
+# years not stored (the month after a year ends is allowed for late images)
+Unfinished = [year for year in Years if datetime.utcnow() < datetime(year+1, 2, 1)]
+CloudyYear = ThisYear-4
+CompositeDelay = 0.3 # seconds per composite request (for the first year, less for later years)
+ClassifyTime = 0.1 # seconds per composite classification
+ImShape = (120, 150)
+
+
+#%% Stubs
+
+Requests = []
+RequestLock = threading.Lock()
+
+def StubComposite(fn, satname, settings, polygon):
+    year = settings['year_list'][fn]
+    with RequestLock:
+        Requests.append(year)
+    time.sleep(CompositeDelay*(1 - (year - Years[0])/(2*len(Years))))
+    rng = np.random.default_rng(year)
+    im_ms = rng.uniform(0.02, 0.4, ImShape + (5,))
+    cloud_mask = np.zeros(ImShape, bool)
+    if year == CloudyYear:
+        cloud_mask[:] = True
+    georef = [float(year), 15.0, 0, 720000.0, 0, -15.0] # year as origin, to tell composites apart
+    return im_ms, georef, cloud_mask, [], None, np.zeros(ImShape, bool)
+
+
+def StubClassify(composite, image_epsg, settings, clf, pixel_size, min_beach_area_pixels, keep_images=False):
+    im_ms, georef, cloud_mask = composite[:3]
+    if cloud_mask.all():
+        return None
+    if settings.get('fail_year') == int(georef[0]):
+        raise Exception('classification failed')
+    time.sleep(ClassifyTime)
+    im_ndvi = Toolbox.nd_index(im_ms[:,:,3], im_ms[:,:,2], cloud_mask)
+    t_ndvi = float(np.nanmedian(im_ndvi))
+    shoreline = np.argwhere(im_ndvi > t_ndvi)[:10].astype(float)
+    result = {'cloud_cover':0.0, 'shoreline':shoreline, 'shoreline_latlon':shoreline,
+              'shoreline_proj':shoreline, 't_ndvi':t_ndvi, 'contours_ndvi':[]}
+    if keep_images:
+        result.update(im_ms=im_ms, cloud_mask=cloud_mask, im_labels=None, im_ref_buffer=None, georef=georef)
+    return result
+
+
+Shown = []
+def StubShowDetection(im_ms, cloud_mask, im_labels, im_ref_buffer, shoreline, image_epsg, georef,
+                      settings, date, satname, contours, t_ndvi):
+    Shown.append(date)
+    return False
+
+
+Image_Processing.preprocess_cloudfreeyearcomposite = StubComposite
+VegetationLine.classify_year_composite = StubClassify
+VegetationLine.show_detection = StubShowDetection
+VegetationLine.joblib = type('joblib', (), {'load':staticmethod(lambda path: None)})
+
+
+#%% Inputs
+
+WorkDir = tempfile.mkdtemp()
+os.makedirs(os.path.join(WorkDir, sitename))
+polygon = [[[-2.84869, 56.34007], [-2.79878, 56.34007], [-2.79878, 56.32641],
+            [-2.84869, 56.32641], [-2.84869, 56.34007]]]
+
+def Settings(years, cache, **kwargs):
+    settings = {'inputs':{'sitename':sitename, 'filepath':WorkDir},
+            'reference_shoreline':np.zeros((3,3)), 'year_list':list(years),
+            'cloud_thresh':0.5, 'cloud_mask_issue':False, 'output_epsg':27700,
+            'adjust_detection':False, 'check_detection':False, 'save_figure':False,
+            'buffer_size':250, 'min_beach_area':200, 'year_workers':4,
+            'composite_cache':cache}
+    settings.update(kwargs)
+    return settings
+
+def Metadata(years):
+    return {satname:{'filenames':['%s_composite_%d' % (satname, year) for year in years],
+                     'epsg':[32630]*len(years), 'dates':['%d-07-01' % year for year in years],
+                     'acc_georef':[10.0]*len(years)}}
+
+def SerialOutput(years):
+    # one year at a time: wait for each composite, then classify it
+    settings = Settings(years, False)
+    dates, thresholds = [], []
+    for fn, year in enumerate(years):
+        result = StubClassify(StubComposite(fn, satname, settings, polygon), 32630, settings, None, 15, 1)
+        if result is not None:
+            dates.append('%d-07-01' % year)
+            thresholds.append(result['t_ndvi'])
+    return dates, thresholds
+
+def Run(years, cache, **kwargs):
+    del Requests[:]
+    Start = time.perf_counter()
+    output = VegetationLine.extract_veglines_year(Settings(years, cache, **kwargs), Metadata(years),
+                                                  [satname], polygon)[0]
+    return output, time.perf_counter() - Start, sorted(Requests)
+
+def Check(name, output, Expected):
+    Same = output['dates'] == Expected[0] and np.allclose(output['threshold'], Expected[1])
+    print('%s: outputs %s' % (name, 'match' if Same else 'MISMATCH'))
+    return Same
+
+
+#%% Run and compare
+
+Passed = True
+Start = time.perf_counter()
+Expected = SerialOutput(Years)
+SerialTime = time.perf_counter() - Start
+print('%d years, one at a time: %.2f s' % (len(Years), SerialTime))
+
+output, RunTime, Requested = Run(Years, False)
+Passed &= Check('concurrent, no store (%.2f s, %.1fx)' % (RunTime, SerialTime/RunTime), output, Expected)
+
+del Shown[:]
+output, RunTime, Requested = Run(Years, False, check_detection=True)
+Passed &= Check('check_detection (%.2f s)' % RunTime, output, Expected)
+Same = Shown == Expected[0]
+Passed &= Same
+print('  years shown in year order: %s' % ('ok' if Same else 'MISMATCH %s' % Shown))
+
+Threads = threading.active_count()
+Start = time.perf_counter()
+try:
+    Run(Years, False, fail_year=Years[1])
+    Error = None
+except Exception as e:
+    Error = e
+Elapsed = time.perf_counter() - Start
+time.sleep(CompositeDelay)
+Same = Error is not None and threading.active_count() == Threads and Elapsed < SerialTime
+Passed &= Same
+print('error in %d: raised after %.2f s, %d worker threads left: %s' %
+      (Years[1], Elapsed, threading.active_count() - Threads, 'ok' if Same else 'MISMATCH'))
+
+Stored = os.path.isdir(os.path.join(WorkDir, sitename, 'preprocessed'))
+Passed &= not Stored
+print('composites stored with composite_cache off: %s' % Stored)
+
+output, RunTime, Requested = Run(Years, True)
+Passed &= Check('concurrent, first run with store (%.2f s)' % RunTime, output, Expected)
+output, RunTime, Requested = Run(Years, True)
+Passed &= Check('rerun with store (%.2f s)' % RunTime, output, Expected) and Requested == Unfinished
+print('  years requested: %s (expected only %s, not over yet)' % (Requested, Unfinished))
+
+NewYears = [Years[0]-1] + Years
+output, RunTime, Requested = Run(NewYears, True)
+Passed &= Check('year added (%.2f s)' % RunTime, output, SerialOutput(NewYears))
+Passed &= Requested == [Years[0]-1] + Unfinished
+print('  years requested: %s' % Requested)
+
+shutil.rmtree(WorkDir)
+print('PASS' if Passed else 'FAIL')
+sys.exit(0 if Passed else 1)
@@ -15,7 +15,9 @@ import pdb
 import ee
 
 # modules to download, unzip and stack the images
-from urllib.request import urlretrieve
+from urllib.request import urlopen
+import io
+import uuid
 import zipfile
 import copy
 import shutil
@@ -23,13 +25,16 @@ from osgeo import gdal
 
 # additional modules
 from datetime import datetime, timedelta
+from concurrent.futures import ThreadPoolExecutor, as_completed
+import time
 import pytz
 import pickle
 from skimage import morphology, transform
+from shapely.strtree import STRtree
 from scipy import ndimage
 
 # CoastSat modules
-from Toolshed import Image_Processing, Toolbox, gdal_merge
+from Toolshed import Image_Processing, Toolbox
 
 np.seterr(all='ignore') # raise/ignore divisions by 0 and nans
 
@@ -69,6 +74,8 @@ def retrieve_images(inputs):
             ```
         'filepath_data': str
             filepath to the directory where the images are downloaded
+        'download_workers': int (optional)
+            number of images downloaded at the same time (default 4)
 
     Returns:
     -----------
@@ -100,6 +107,13 @@ def retrieve_images(inputs):
     im_folder = os.path.join(inputs['filepath'],inputs['sitename'])
     if not os.path.exists(im_folder): os.makedirs(im_folder)
 
+    # several images are downloaded at once
+    if 'download_workers' in inputs.keys():
+        n_workers = inputs['download_workers']
+    else:
+        n_workers = 4
+    executor = ThreadPoolExecutor(max_workers=n_workers)
+
     print('\nDownloading images:')
     suffix = '.tif'
     for satname in im_dict_T1.keys():
@@ -108,6 +122,7 @@ def retrieve_images(inputs):
         filepaths = create_folder_structure(im_folder, satname)
         # initialise variables and loop through images
         georef_accs = []; filenames = []; all_names = []; im_epsg = []
+        testdata[satname] = []; jobs = dict([])
         for i in range(len(im_dict_T1[satname])):
 
             im_meta = im_dict_T1[satname][i]
@@ -156,21 +171,7 @@ def retrieve_images(inputs):
                     im_fn[''] = im_date + '_' + satname + '_' + inputs['sitename'] + '_dup' + suffix
                 all_names.append(im_fn[''])
                 filenames.append(im_fn[''])
-                # download .tif from EE
-                while True:
-                    try:
-                        im_ee = ee.Image(im_meta['id'])
-                        testdata[satname].append(im_ee)
-                        local_data = download_tif(im_ee, inputs['polygon'], bands[''], filepaths[1])
-                        break
-                    except:
-                        continue
-                # rename the file as the image is downloaded as 'data.tif'
-                try:
-                    os.rename(local_data, os.path.join(filepaths[1], im_fn['']))
-                except: # overwrite if already exists
-                    os.remove(os.path.join(filepaths[1], im_fn['']))
-                    os.rename(local_data, os.path.join(filepaths[1], im_fn['']))
+                downloads = [(bands[''], filepaths[1], im_fn[''])]
                 # metadata for .txt file
                 filename_txt = im_fn[''].replace('.tif','')
                 metadict = {'filename':im_fn[''],'acc_georef':georef_accs[i],
@@ -194,27 +195,8 @@ def retrieve_images(inputs):
                         im_fn[key] = im_date + '_' + satname + '_' + inputs['sitename'] + '_' + key + '_dup' + suffix
                 all_names.append(im_fn['pan'])
                 filenames.append(im_fn['pan'])
-                # download .tif from EE (panchromatic band and multispectral bands)
-                while True:
-                    try:
-                        im_ee = ee.Image(im_meta['id'])
-                        testdata[satname].append(im_ee)
-                        local_data_pan = download_tif(im_ee, inputs['polygon'], bands['pan'], filepaths[1])
-                        local_data_ms = download_tif(im_ee, inputs['polygon'], bands['ms'], filepaths[2])
-                        break
-                    except:
-                        continue
-                # rename the files as the image is downloaded as 'data.tif'
-                try: # panchromatic
-                    os.rename(local_data_pan, os.path.join(filepaths[1], im_fn['pan']))
-                except: # overwrite if already exists
-                    os.remove(os.path.join(filepaths[1], im_fn['pan']))
-                    os.rename(local_data_pan, os.path.join(filepaths[1], im_fn['pan']))
-                try: # multispectral
-                    os.rename(local_data_ms, os.path.join(filepaths[2], im_fn['ms']))
-                except: # overwrite if already exists
-                    os.remove(os.path.join(filepaths[2], im_fn['ms']))
-                    os.rename(local_data_ms, os.path.join(filepaths[2], im_fn['ms']))
+                downloads = [(bands['pan'], filepaths[1], im_fn['pan']),
+                             (bands['ms'], filepaths[2], im_fn['ms'])]
                 # metadata for .txt file
                 filename_txt = im_fn['pan'].replace('_pan','').replace('.tif','')
                 metadict = {'filename':im_fn['pan'],'acc_georef':georef_accs[i],
@@ -241,46 +223,36 @@ def retrieve_images(inputs):
                                 im_fn[key] = im_date + '_' + satname + '_' + inputs['sitename'] + '_' + key + '_dup4' + suffix
                 all_names.append(im_fn['10m'])
                 filenames.append(im_fn['10m'])
-                # download .tif from EE (multispectral bands at 3 different resolutions)
-                while True:
-                    try:
-                        im_ee = ee.Image(im_meta['id'])
-                        testdata[satname].append(im_ee)
-                        local_data_10m = download_tif(im_ee, inputs['polygon'], bands['10m'], filepaths[1])
-                        local_data_20m = download_tif(im_ee, inputs['polygon'], bands['20m'], filepaths[2])
-                        local_data_60m = download_tif(im_ee, inputs['polygon'], bands['60m'], filepaths[3])
-                        break
-                    except:
-                        continue
-                # rename the files as the image is downloaded as 'data.tif'
-                try: # 10m
-                    os.rename(local_data_10m, os.path.join(filepaths[1], im_fn['10m']))
-                except: # overwrite if already exists
-                    os.remove(os.path.join(filepaths[1], im_fn['10m']))
-                    os.rename(local_data_10m, os.path.join(filepaths[1], im_fn['10m']))
-                try: # 20m
-                    os.rename(local_data_20m, os.path.join(filepaths[2], im_fn['20m']))
-                except: # overwrite if already exists
-                    os.remove(os.path.join(filepaths[2], im_fn['20m']))
-                    os.rename(local_data_20m, os.path.join(filepaths[2], im_fn['20m']))
-                try: # 60m
-                    os.rename(local_data_60m, os.path.join(filepaths[3], im_fn['60m']))
-                except: # overwrite if already exists
-                    os.remove(os.path.join(filepaths[3], im_fn['60m']))
-                    os.rename(local_data_60m, os.path.join(filepaths[3], im_fn['60m']))
+                downloads = [(bands['10m'], filepaths[1], im_fn['10m']),
+                             (bands['20m'], filepaths[2], im_fn['20m']),
+                             (bands['60m'], filepaths[3], im_fn['60m'])]
                 # metadata for .txt file
                 filename_txt = im_fn['10m'].replace('_10m','').replace('.tif','')
                 metadict = {'filename':im_fn['10m'],'acc_georef':georef_accs[i],
                             'epsg':im_epsg[i]}
 
-            # write metadata
+            # download .tif files from EE (written straight to their final filenames)
+            im_ee = ee.Image(im_meta['id'])
+            testdata[satname].append(im_ee)
+            future = executor.submit(download_image, im_ee, inputs['polygon'], downloads)
+            jobs[future] = (filename_txt, metadict)
+
+        for n, future in enumerate(as_completed(jobs)):
+            filename_txt, metadict = jobs[future]
+            try:
+                future.result()
+            except Exception as e:
+                print('\nWARNING: %s could not be downloaded (%s)' % (metadict['filename'], e))
+                continue
+            # write metadata (only for images that downloaded successfully)
             with open(os.path.join(filepaths[0],filename_txt + '.txt'), 'w') as f:
                 for key in metadict.keys():
                     f.write('%s\t%s\n'%(key,metadict[key]))
             # print percentage completion for user
-            print('\r%d%%' %int((i+1)/len(im_dict_T1[satname])*100), end='')
+            print('\r%d%%' %int((n+1)/len(jobs)*100), end='')
 
         print('')
+    executor.shutdown()
 
     # once all images have been downloaded, load metadata from .txt files
     metadata = get_metadata(inputs)
@@ -367,7 +339,7 @@ def get_metadata(inputs):
 # AUXILIARY FUNCTIONS
 ###################################################################################################
 
-def check_images_available(inputs):
+def check_images_available(inputs, return_images=True):
     """
     Create the structure of subfolders for each satellite mission
 
@@ -378,13 +350,16 @@ def check_images_available(inputs):
     -----------
     inputs: dict
         inputs dictionnary
+    return_images: bool
+        if False, only the number of images is requested from the server
+        (for a quick check before downloading)
 
     Returns:
     -----------
     im_dict_T1: list of dict
-        list of images in Tier 1 and Level-1C
+        list of images in Tier 1 and Level-1C (counts if return_images is False)
     im_dict_T2: list of dict
-        list of images in Tier 2 (Landsat only)
+        list of images in Tier 2 (Landsat only; counts if return_images is False)
     """
     
     point = ee.Geometry.Point(inputs['polygon'][0][0])
@@ -408,77 +383,73 @@ def check_images_available(inputs):
                  'L9':'LANDSAT/LC09/C02/T1_TOA',
                  'S2':'COPERNICUS/S2'}
 
-    print('- In Landsat Tier 1 & Sentinel-2 Level-1C:')
-    im_dict_T1 = dict([])
-    sum_img = 0
-    for satname in inputs['sat_list']:
-
-        # get list of images in EE collection
-        while True:
-            try:
-                ee_col = ee.ImageCollection(col_names_T1[satname])
-                if inputs['daterange'] == 'no': #FM: list of unique dates instead
-                #NEED TO FIX THIS due to date props having specific format
-                    ee_col_2 = ee_col.map(ee_col.set('simpleTime',ee.Date(ee_col.get('system:time_start')).format('YYYY-MM-dd')))
-                    col = ee_col_2.filterBounds(point).filter(ee.Filter.inList("simpleTime", inputs['dates']))
-                else:
-                    col = ee_col.filterBounds(point)\
-                                .filterDate(inputs['dates'][0], inputs['dates'][-1])
-                                #.filter(ee.Filter.eq('CLOUD_COVER',inputs['cloud_thresh']))
-                    
-                im_list = col.getInfo().get('features')
-                break
-            except:
-                continue
-        # remove very cloudy images (>95% cloud cover)
-        im_list_upt = remove_cloudy_images(im_list, satname)
-        sum_img = sum_img + len(im_list_upt)
-        print('  %s: %d images'%(satname,len(im_list_upt)))
-        im_dict_T1[satname] = im_list_upt
-
-    print('  Total: %d images'%sum_img)
-
-    # in only S2 is in sat_list, stop here
-    if len(inputs['sat_list']) == 1 and inputs['sat_list'][0] == 'S2':
-        return #im_dict_T1, []
-
-    # otherwise check how many images are available in Landsat Tier 2
     col_names_T2 = {'L5':'LANDSAT/LT05/C01/T2_TOA',
                  'L7':'LANDSAT/LE07/C01/T2_TOA',
                  'L8':'LANDSAT/LC08/C01/T2_TOA',
                  'L9':'LANDSAT/LC09/C02/T2_TOA'}
-    print('- In Landsat Tier 2:', end='\n')
-    im_dict_T2 = dict([])
-    sum_img = 0
+    
+    # build queries for each satellite in Tier 1/Level-1C, then Landsat Tier 2
+    queries = []
     for satname in inputs['sat_list']:
-        if satname == 'S2': continue
-        # get list of images in EE collection
-        while True:
-            try:
-                ee_col = ee.ImageCollection(col_names_T2[satname])
-                col = ee_col.filterBounds(ee.Geometry.Polygon(inputs['polygon']))\
-                            .filterDate(inputs['dates'][0],inputs['dates'][-1])
-                            #.filter(ee.Filter.eq('CLOUD_COVER',inputs['cloud_thresh']))
-                im_list = col.getInfo().get('features')
-                break
-            except:
-                continue
-        # remove very cloudy images (>95% cloud cover)
-        im_list_upt = remove_cloudy_images(im_list, satname)
-        sum_img = sum_img + len(im_list_upt)
-        print('  %s: %d images'%(satname,len(im_list_upt)))
-        im_dict_T2[satname] = im_list_upt
+        ee_col = ee.ImageCollection(col_names_T1[satname])
+        if inputs['daterange'] == 'no': #FM: list of unique dates instead
+        #NEED TO FIX THIS due to date props having specific format
+            ee_col_2 = ee_col.map(ee_col.set('simpleTime',ee.Date(ee_col.get('system:time_start')).format('YYYY-MM-dd')))
+            col = ee_col_2.filterBounds(point).filter(ee.Filter.inList("simpleTime", inputs['dates']))
+        else:
+            col = ee_col.filterBounds(point)\
+                        .filterDate(inputs['dates'][0], inputs['dates'][-1])
+                        #.filter(ee.Filter.eq('CLOUD_COVER',inputs['cloud_thresh']))
+        # remove very cloudy images (>95% cloud cover) on the server
+        queries.append(('T1', satname, col.filter(ee.Filter.lte(CLOUD_PROPERTIES[satname], 95))))
+    # in only S2 is in sat_list, no need to check Landsat Tier 2
+    if not (len(inputs['sat_list']) == 1 and inputs['sat_list'][0] == 'S2'):
+        for satname in inputs['sat_list']:
+            if satname == 'S2': continue
+            ee_col = ee.ImageCollection(col_names_T2[satname])
+            col = ee_col.filterBounds(ee.Geometry.Polygon(inputs['polygon']))\
+                        .filterDate(inputs['dates'][0],inputs['dates'][-1])
+                        #.filter(ee.Filter.eq('CLOUD_COVER',inputs['cloud_thresh']))
+            queries.append(('T2', satname, col.filter(ee.Filter.lte(CLOUD_PROPERTIES[satname], 95))))
+    
+    im_dict = {'T1':dict([]), 'T2':dict([])}
+    if return_images:
+        # get list of images in each EE collection, sending the requests concurrently
+        with ThreadPoolExecutor(max_workers=4) as executor:
+            im_lists = list(executor.map(lambda query: Toolbox.GetInfoRetry(query[2]).get('features'), queries))
+        for (tier, satname, col), im_list in zip(queries, im_lists):
+            im_dict[tier][satname] = im_list
+        counts = dict([(tier, dict([(satname, len(im_list)) for satname, im_list in im_dict[tier].items()])) for tier in im_dict])
+    else:
+        # only the number of images in each collection (all in one request)
+        sizes = Toolbox.GetInfoRetry(ee.List([col.size() for tier, satname, col in queries]))
+        for (tier, satname, col), size in zip(queries, sizes):
+            im_dict[tier][satname] = size
+        counts = im_dict
+    
+    print('- In Landsat Tier 1 & Sentinel-2 Level-1C:')
+    for satname in counts['T1']:
+        print('  %s: %d images'%(satname,counts['T1'][satname]))
+    print('  Total: %d images'%sum(counts['T1'].values()))
 
-    print('  Total: %d images'%sum_img)
+    # in only S2 is in sat_list, stop here
+    if len(inputs['sat_list']) == 1 and inputs['sat_list'][0] == 'S2':
+        return im_dict['T1'], []
+
+    print('- In Landsat Tier 2:', end='\n')
+    for satname in counts['T2']:
+        print('  %s: %d images'%(satname,counts['T2'][satname]))
+    print('  Total: %d images'%sum(counts['T2'].values()))
 
-    return
+    return im_dict['T1'], im_dict['T2']
 
 
-def download_tif(image, polygon, bandsId, filepath):
+def download_tif(image, polygon, bandsId, filepath, filename='data.tif', timeout=300):
     """
     Downloads a .TIF image from the ee server. The image is downloaded as a
-    zip file then moved to the working directory, unzipped and stacked into a
-    single .TIF file.
+    zip file into memory, unzipped and stacked into a single .TIF file. A 
+    stalled download or a failed GDAL step raises an exception, so the 
+    download can be retried (see download_image()).
 
     Two different codes based on which version of the earth-engine-api is being
     used.
@@ -494,11 +465,14 @@ def download_tif(image, polygon, bandsId, filepath):
         longitudes in the first column and latitudes in the second column
     bandsId: list of dict
         list of bands to be downloaded
-    filepath: location where the temporary file should be saved
+    filepath: location where the file should be saved
+    filename: name of the stacked file
+    timeout: float
+        seconds to wait on the server before the download is abandoned
 
     Returns:
     -----------
-    Downloads an image in a file named data.tif
+    Downloads an image in a file named data.tif (or filename)
 
     """
 
@@ -511,9 +485,17 @@ def download_tif(image, polygon, bandsId, filepath):
             'filePerBand': 'false',
             'name': 'data',
             }))
-        local_zip, headers = urlretrieve(url)
-        with zipfile.ZipFile(local_zip) as local_zipfile:
-            return local_zipfile.extract('data.tif', filepath)
+        buffer = io.BytesIO()
+        with urlopen(url, timeout=timeout) as response:
+            shutil.copyfileobj(response, buffer)
+        # extract under a unique name (so concurrent downloads into the same 
+        # folder don't clash), then move into place as filename
+        tmpname = os.path.join(filepath, filename + '.' + uuid.uuid4().hex + '.part')
+        with zipfile.ZipFile(buffer) as local_zipfile:
+            with local_zipfile.open('data.tif') as src, open(tmpname, 'wb') as dst:
+                shutil.copyfileobj(src, dst)
+        os.replace(tmpname, os.path.join(filepath, filename))
+        return os.path.join(filepath, filename)
     # for the newer versions of ee
     else:
         # crop image on the server and create url to download
@@ -524,31 +506,73 @@ def download_tif(image, polygon, bandsId, filepath):
             'filePerBand': 'false',
             'name': 'data',
             }))
-        # download zipfile with the cropped bands
-        local_zip, headers = urlretrieve(url)
-        # move zipfile from temp folder to data folder
-        dest_file = os.path.join(filepath, 'imagezip')
-        shutil.move(local_zip,dest_file)
-        # unzip file
-        with zipfile.ZipFile(dest_file) as local_zipfile:
+        # download zipfile with the cropped bands straight into memory
+        buffer = io.BytesIO()
+        with urlopen(url, timeout=timeout) as response:
+            shutil.copyfileobj(response, buffer)
+        # unzip single bands into GDAL's in-memory filesystem
+        memdir = '/vsimem/%s' % uuid.uuid4().hex
+        with zipfile.ZipFile(buffer) as local_zipfile:
+            fn_tifs = []
             for fn in local_zipfile.namelist():
-                local_zipfile.extract(fn, filepath)
-            # filepath + filename to single bands
-            fn_tifs = [os.path.join(filepath,_) for _ in local_zipfile.namelist()]
-        # stack bands into single .tif
-        outds = gdal.BuildVRT(os.path.join(filepath,'stacked.vrt'), fn_tifs, separate=True)
-        outds = gdal.Translate(os.path.join(filepath,'data.tif'), outds)
-        # delete single-band files
-        for fn in fn_tifs: os.remove(fn)
-        # delete .vrt file
-        os.remove(os.path.join(filepath,'stacked.vrt'))
-        # delete zipfile
-        os.remove(dest_file)
-        # delete data.tif.aux (not sure why this is created)
-        if os.path.exists(os.path.join(filepath,'data.tif.aux')):
-            os.remove(os.path.join(filepath,'data.tif.aux'))
-        # return filepath to stacked file called data.tif
-        return os.path.join(filepath,'data.tif')
+                fn_tifs.append(memdir + '/' + fn)
+                gdal.FileFromMemBuffer(fn_tifs[-1], local_zipfile.read(fn))
+        try:
+            # stack bands into single .tif (GDAL returns None rather than raising on failure)
+            vrt = gdal.BuildVRT(memdir + '/stacked.vrt', fn_tifs, separate=True)
+            if vrt is None:
+                raise Exception('Could not stack the bands of %s: %s' % (filename, gdal.GetLastErrorMsg()))
+            outds = gdal.Translate(os.path.join(filepath, filename), vrt)
+            vrt = None
+            if outds is None:
+                if os.path.exists(os.path.join(filepath, filename)):
+                    os.remove(os.path.join(filepath, filename))
+                raise Exception('Could not write %s: %s' % (filename, gdal.GetLastErrorMsg()))
+            outds = None # flush to disk
+        finally:
+            # free in-memory files
+            for fn in fn_tifs + [memdir + '/stacked.vrt']: gdal.Unlink(fn)
+        # delete .aux file (not sure why this is created)
+        if os.path.exists(os.path.join(filepath, filename + '.aux')):
+            os.remove(os.path.join(filepath, filename + '.aux'))
+        # return filepath to stacked file
+        return os.path.join(filepath, filename)
+
+
+def download_image(image, polygon, downloads, retries=5, backoff=2, timeout=300):
+    """
+    Downloads all the band groups of one image, retrying with an increasing
+    wait between attempts if the download fails.
+
+    Arguments:
+    -----------
+    image: ee.Image
+        Image object to be downloaded
+    polygon: list
+        polygon containing the lon/lat coordinates to be extracted
+    downloads: list of tuples
+        (bandsId, filepath, filename) for each .tif to download
+    retries: int
+        number of attempts before giving up
+    backoff: float
+        wait (in seconds) after the first failure, doubled after each failure
+    timeout: float
+        seconds to wait on a stalled download before it counts as failed
+
+    Returns:
+    -----------
+    filepaths of the downloaded .tif files
+
+    """
+    for attempt in range(retries):
+        try:
+            return [download_tif(image, polygon, bandsId, filepath, filename, timeout) 
+                    for bandsId, filepath, filename in downloads]
+        except Exception as e:
+            error = e
+            if attempt < retries-1:
+                time.sleep(min(backoff * 2**attempt, 60))
+    raise error
 
 
 def create_folder_structure(im_folder, satname):
@@ -589,6 +613,14 @@ def create_folder_structure(im_folder, satname):
     return filepaths
 
 
+# name of the cloud cover property (in %) of each satellite's EE collection
+CLOUD_PROPERTIES = {'L5':'CLOUD_COVER',
+                    'L7':'CLOUD_COVER',
+                    'L8':'CLOUD_COVER',
+                    'L9':'CLOUD_COVER',
+                    'S2':'CLOUDY_PIXEL_PERCENTAGE'}
+
+
 def remove_cloudy_images(im_list, satname, prc_cloud_cover=95):
     """
     Removes from the EE collection very cloudy images (>95% cloud cover)
@@ -611,10 +643,7 @@ def remove_cloudy_images(im_list, satname, prc_cloud_cover=95):
     """
 
     # remove very cloudy images from the collection (>95% cloud)
-    if satname in ['L5','L7','L8']:
-        cloud_property = 'CLOUD_COVER'
-    elif satname in ['S2']:
-        cloud_property = 'CLOUDY_PIXEL_PERCENTAGE'
+    cloud_property = CLOUD_PROPERTIES[satname]
     cloud_cover = [_['properties'][cloud_property] for _ in im_list]
     if np.any([_ > prc_cloud_cover for _ in cloud_cover]):
         idx_delete = np.where([_ > prc_cloud_cover for _ in cloud_cover])[0]
@@ -643,37 +672,39 @@ def filter_S2_collection(im_list):
         filtered list of images
     """
 
-    # get datetimes
-    timestamps = [datetime.fromtimestamp(_['properties']['system:time_start']/1000,
-                                         tz=pytz.utc) for _ in im_list]
+    # get acquisition times (in milliseconds)
+    timestamps = np.array([_['properties']['system:time_start'] for _ in im_list], dtype=np.int64)
     # get utm zone projections
     utm_zones = np.array([int(_['bands'][0]['crs'][5:]) for _ in im_list])
     if len(np.unique(utm_zones)) == 1:
         return im_list
     else:
         utm_zone_selected =  np.max(np.unique(utm_zones))
+        same_utm = utm_zones == utm_zone_selected
+        # sort the acquisition times once, so the images acquired within 24h of
+        # each image can be found by binary search instead of comparing all pairs
+        time_window = 1000*60*60*24
+        order = np.argsort(timestamps, kind='stable')
+        timestamps_sorted = timestamps[order]
         # find the images that were acquired at the same time but have different utm zones
-        idx_all = np.arange(0,len(im_list),1)
-        idx_covered = np.ones(len(im_list)).astype(bool)
-        idx_delete = []
+        idx_covered = np.zeros(len(im_list)).astype(bool)
+        idx_delete = set()
         i = 0
-        while 1:
-            same_time = np.abs([(timestamps[i]-_).total_seconds() for _ in timestamps]) < 60*60*24
-            idx_same_time = np.where(same_time)[0]
-            same_utm = utm_zones == utm_zone_selected
-            # get indices that have the same time (less than 24h apart) but not the same utm zone
-            idx_temp = np.where([same_time[j] == True and same_utm[j] == False for j in idx_all])[0]
-            idx_keep = idx_same_time[[_ not in idx_temp for _ in idx_same_time]]
+        while i < len(im_list):
+            lo = np.searchsorted(timestamps_sorted, timestamps[i] - time_window, side='right')
+            hi = np.searchsorted(timestamps_sorted, timestamps[i] + time_window, side='left')
+            idx_same_time = np.sort(order[lo:hi])
+            # indices that have the same time (less than 24h apart) but not the same utm zone
+            idx_temp = idx_same_time[~same_utm[idx_same_time]]
+            idx_keep = idx_same_time[same_utm[idx_same_time]]
             # if more than 2 images with same date and same utm, drop the last ones
             if len(idx_keep) > 2:
-               idx_temp = np.append(idx_temp,idx_keep[-(len(idx_keep)-2):])
-            for j in idx_temp:
-                idx_delete.append(j)
-            idx_covered[idx_same_time] = False
-            if np.any(idx_covered):
-                i = np.where(idx_covered)[0][0]
-            else:
-                break
+                idx_temp = np.append(idx_temp, idx_keep[2:])
+            idx_delete.update(idx_temp.tolist())
+            idx_covered[idx_same_time] = True
+            # move on to the next image not yet covered
+            while i < len(im_list) and idx_covered[i]:
+                i += 1
         # update the collection by deleting all those images that have same timestamp
         # and different utm projection
         im_list_flt = [x for k,x in enumerate(im_list) if k not in idx_delete]
@@ -732,15 +763,8 @@ def merge_overlapping_images(metadata,inputs):
     filepath = os.path.join(inputs['filepath'], inputs['sitename'])
     filenames = metadata[sat]['filenames']
     total_images = len(filenames)
-    # nested function
-    def duplicates_dict(lst):
-        "return duplicates and indices"
-        def duplicates(lst, item):
-                return [i for i, x in enumerate(lst) if x == item]
-        return dict((x, duplicates(lst, x)) for x in set(lst) if lst.count(x) > 1)    
-      
     # first pass on images that have the exact same timestamp
-    duplicates = duplicates_dict([_.split('_')[0] for _ in filenames])
+    duplicates = group_duplicates([_.split('_')[0] for _ in filenames])
     total_removed_step1 = 0
     if len(duplicates) > 0:
         # loop through each pair of duplicates and merge them
@@ -762,23 +786,10 @@ def merge_overlapping_images(metadata,inputs):
                 print('WARNING: there was an error as two S2 images do not have the same epsg,'+
                       ' please open an issue on Github at https://github.com/kvos/CoastSat/issues'+
                       ' and include your script so I can find out what happened.')
-            # find which images contain other images
-            contain_bools_list = []
-            for i,poly1 in enumerate(polygons):
-                contain_bools = []
-                for k,poly2 in enumerate(polygons):
-                    if k == i: 
-                        contain_bools.append(True)
-                        # print('%d*: '%k+str(poly1.contains(poly2)))
-                    else:
-                        # print('%d: '%k+str(poly1.contains(poly2)))
-                        contain_bools.append(poly1.contains(poly2))
-                contain_bools_list.append(contain_bools)
-            # look if one image contains all the others
-            contain_all = [np.all(_) for _ in contain_bools_list]
+            # find if one image contains all the others
+            idx_keep = find_containing_polygon(polygons)
             # if one image contains all the others, keep that one and delete the rest
-            if np.any(contain_all):
-                idx_keep = np.where(contain_all)[0][0]
+            if idx_keep is not None:
                 for i in [_ for _ in range(len(idx_dup)) if not _ == idx_keep]:
                     # print('removed %s'%(fn_im[i][-1]))
                     # remove the 3 .tif files + the .txt file
@@ -792,20 +803,7 @@ def merge_overlapping_images(metadata,inputs):
     
     # find the pairs of images that are within 5 minutes of each other and merge them
     time_delta = 5*60 # 5 minutes in seconds
-    dates = metadata[sat]['dates'].copy()
-    pairs = []
-    for i,date in enumerate(metadata[sat]['dates']):
-        # dummy value so it does not match it again
-        dates[i] = pytz.utc.localize(datetime(1,1,1) + timedelta(days=i+1))
-        # calculate time difference
-        time_diff = np.array([np.abs((date - _).total_seconds()) for _ in dates])
-        # find the matching times and add to pairs list
-        boolvec = time_diff <= time_delta
-        if np.sum(boolvec) == 0:
-            continue
-        else:
-            idx_dup = np.where(boolvec)[0][0]
-            pairs.append([i,idx_dup])
+    pairs = pair_simultaneous_images(metadata[sat]['dates'], time_delta)
     total_merged_step2 = len(pairs)        
     # because they could be triplicates in S2 images, adjust the pairs for consecutive merges
     for i in range(1,len(pairs)):
@@ -931,20 +929,16 @@ def merge_overlapping_images(metadata,inputs):
                 else:
                     continue
     
-            # once all the pairs of .tif files have been masked with no_data, merge the using gdal_merge
-            fn_merged = os.path.join(filepath, 'merged.tif')
+            # once all the pairs of .tif files have been masked with no_data, merge them
+            # through a virtual mosaic (0 is treated as no_data, as with gdal_merge -n 0)
             for k in range(3):  
-                # merge masked bands
-                gdal_merge.main(['', '-o', fn_merged, '-n', '0', fn_im[0][k], fn_im[1][k]])
+                fn_new = fn_im[0][k].split('.')[0] + '_merged.tif'
+                merge_vrt([fn_im[0][k], fn_im[1][k]], fn_new, nodata=0)
                 # remove old files
                 os.chmod(fn_im[0][k], 0o777)
                 os.remove(fn_im[0][k])
                 os.chmod(fn_im[1][k], 0o777)
                 os.remove(fn_im[1][k])
-                # rename new file
-                fn_new = fn_im[0][k].split('.')[0] + '_merged.tif'
-                os.chmod(fn_merged, 0o777)
-                os.rename(fn_merged, fn_new)
     
             # open both metadata files
             metadict0 = dict([])
@@ -982,4 +976,131 @@ def merge_overlapping_images(metadata,inputs):
     # update the metadata dict
     metadata_updated = get_metadata(inputs)
 
-    return metadata_updated
\ No newline at end of file
+    return metadata_updated
+
+
+def group_duplicates(lst):
+    """
+    Find the items that appear more than once in a list, in a single pass.
+
+    Arguments:
+    -----------
+    lst: list
+        list of hashable items (e.g. timestamps)
+
+    Returns:
+    -----------
+    duplicates: dict
+        indices in lst of each item that appears more than once
+
+    """
+    groups = dict([])
+    for i, item in enumerate(lst):
+        groups.setdefault(item, []).append(i)
+    return dict((item, idx) for item, idx in groups.items() if len(idx) > 1)
+
+
+def find_containing_polygon(polygons):
+    """
+    Find the first polygon that contains all the others. Candidates are 
+    screened with an STRtree: a polygon can only contain all the others if 
+    all of their bounding boxes intersect its own.
+
+    Arguments:
+    -----------
+    polygons: list of shapely.geometry.Polygon
+        image footprints
+
+    Returns:
+    -----------
+    idx_keep: int or None
+        index of the polygon containing all the others (None if there isn't one)
+
+    """
+    tree = STRtree(polygons)
+    for i, poly in enumerate(polygons):
+        # shapely >= 2.0 returns indices, older versions return the geometries
+        if len(tree.query(poly)) < len(polygons):
+            continue
+        if all(poly.contains(other) for k, other in enumerate(polygons) if k != i):
+            return i
+    return None
+
+
+def pair_simultaneous_images(dates, time_delta):
+    """
+    Pair each image with the next image (in list order) acquired within 
+    time_delta seconds of it. Dates are sorted once and each image's matches
+    are found by binary search, rather than comparing every pair of dates.
+
+    Arguments:
+    -----------
+    dates: list of datetime
+        acquisition dates of the images
+    time_delta: float
+        maximum time difference (in seconds) between paired images
+
+    Returns:
+    -----------
+    pairs: list of lists
+        [i, j] for each image i with a match j (j > i)
+
+    """
+    t = np.array([_.timestamp() for _ in dates])
+    order = np.argsort(t, kind='stable')
+    t_sorted = t[order]
+    pairs = []
+    for i in range(len(t)):
+        lo = np.searchsorted(t_sorted, t[i] - time_delta, side='left')
+        hi = np.searchsorted(t_sorted, t[i] + time_delta, side='right')
+        later = order[lo:hi][order[lo:hi] > i]
+        if len(later) > 0:
+            pairs.append([i, int(later.min())])
+    return pairs
+
+
+def merge_vrt(fn_in, fn_out, nodata=0):
+    """
+    Merge overlapping rasters into a single GeoTIFF through a virtual (VRT) 
+    mosaic, held in memory, so only the output file is written. As with 
+    gdal_merge, the output has the pixel size of the first file and covers 
+    all the files, and where they overlap pixels from later files are used 
+    unless they are nodata.
+
+    Arguments:
+    -----------
+    fn_in: list of str
+        paths to the rasters to merge
+    fn_out: str
+        path to the merged .tif file
+    nodata: float
+        pixel value in the input rasters to ignore
+
+    Returns:
+    -----------
+    fn_out: str
+        path to the merged .tif file
+
+    """
+    # pixel size of the first file (gdal_merge's default)
+    src = gdal.Open(fn_in[0])
+    if src is None:
+        raise Exception('Could not open %s: %s' % (fn_in[0], gdal.GetLastErrorMsg()))
+    georef = src.GetGeoTransform()
+    src = None
+    memvrt = '/vsimem/%s.vrt' % uuid.uuid4().hex
+    vrt = gdal.BuildVRT(memvrt, fn_in, srcNodata=nodata, hideNodata=True, 
+                        resolution='user', xRes=abs(georef[1]), yRes=abs(georef[5]))
+    if vrt is None:
+        raise Exception('Could not build a mosaic of %s: %s' % (', '.join(fn_in), gdal.GetLastErrorMsg()))
+    try:
+        outds = gdal.Translate(fn_out, vrt)
+        if outds is None:
+            if os.path.exists(fn_out):
+                os.remove(fn_out)
+            raise Exception('Could not write %s: %s' % (fn_out, gdal.GetLastErrorMsg()))
+        outds = None # flush to disk
+    finally:
+        vrt = None
+        gdal.Unlink(memvrt)
+    return fn_out
\ No newline at end of file
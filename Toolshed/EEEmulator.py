@@ -0,0 +1,775 @@
+"""
+This module contains an offline stand-in for the parts of the Earth Engine API
+(and geemap.ee_to_numpy) used to find, describe and download satellite images,
+backed by a folder of local GeoTIFFs. Requests can be slowed down and made to
+fail at a set rate, and the number of requests and bytes returned are counted
+per request type, so image ingestion can be timed and tested without network.
+
+Images are stored under the root folder at their Earth Engine ID, with an
+optional JSON file of band names and image properties alongside:
+    root/LANDSAT/LC08/C01/T1_TOA/LC08_204020_20200417.tif
+    root/LANDSAT/LC08/C01/T1_TOA/LC08_204020_20200417.json
+        {"bands": ["B1", "B2", ...], "properties": {"CLOUD_COVER": 12.5, ...}}
+All bands of an image share the grid of the GeoTIFF. Every image should have
+a 'system:time_start' (ms) or 'DATE_ACQUIRED' (YYYY-MM-DD) property.
+
+Usage:
+    emulator = EEEmulator.Emulator('./Data/emulator', latency=0.2, failure_rate=0.05)
+    with emulator:  # ee and geemap in Toolshed modules now point to the emulator
+        metadata = Toolbox.metadata_collection(inputs, Toolbox.image_retrieval(inputs))
+    print(emulator.Stats())
+"""
+
+# load modules
+import os
+import sys
+import glob
+import json
+import time
+import types
+import random
+import zipfile
+import tempfile
+import threading
+from collections import Counter
+from datetime import datetime, timezone
+from urllib.request import pathname2url
+
+import numpy as np
+import rasterio
+from rasterio.vrt import WarpedVRT
+from rasterio.warp import transform_bounds
+from rasterio.transform import Affine
+from shapely import geometry
+
+
+class EEException(Exception):
+    """
+    Error raised by emulated requests (as ee.EEException is by real ones).
+    """
+
+
+class Emulator:
+    """
+    Offline Earth Engine emulator over a folder of local GeoTIFFs. The emulated
+    modules are Emulator.ee and Emulator.geemap; Install() (or using the
+    emulator as a context manager) swaps them in for the real ones.
+
+    Arguments:
+    -----------
+    root: str
+        folder of images stored at their Earth Engine IDs (see module docstring)
+    latency: float or tuple
+        wait (in seconds) added to each request, or (min, max) of a uniform
+        random wait
+    failure_rate: float
+        fraction of requests that raise EEException (as a transient 'Service
+        Unavailable' error, which is worth retrying)
+    max_pixels: int
+        largest ee_to_numpy() request (in pixels) before it fails, as on the
+        server (262144); None for no limit
+    seed: int
+        seed of the random waits and failures
+    version: str
+        version string reported as ee.__version__
+    """
+    def __init__(self, root, latency=0, failure_rate=0, max_pixels=262144, seed=0, version='0.1.300'):
+        self.root = root
+        self.latency = latency
+        self.failure_rate = failure_rate
+        self.max_pixels = max_pixels
+        self.random = random.Random(seed)
+        self.lock = threading.Lock()
+        self.headers = {}
+        self.saved = {}
+        self.tmpdir = None
+        self.Reset()
+
+        # emulated ee module (classes are bound to this emulator)
+        bound = lambda cls: type(cls.__name__, (cls,), {'emu':self})
+        self.ee = types.ModuleType('ee')
+        self.ee.__version__ = version
+        self.ee.EEException = EEException
+        self.ee.ee_exception = types.SimpleNamespace(EEException=EEException)
+        self.ee.Initialize = lambda *args, **kwargs: None
+        self.ee.Authenticate = lambda *args, **kwargs: None
+        self.ee.ComputedObject = ComputedObject
+        for cls in [Image, ImageCollection, Number, Date, List, Dictionary]:
+            setattr(self.ee, cls.__name__, bound(cls))
+        self.ee.Geometry = Geometry
+        self.ee.Filter = Filter
+        self.ee.Algorithms = types.SimpleNamespace(
+            Describe=lambda image: self.ee.Dictionary(image._Info()),
+            Landsat=types.SimpleNamespace(simpleCloudScore=SimpleCloudScore,
+                                          simpleComposite=lambda collection, *args, **kwargs: collection.median()))
+        self.ee.data = types.SimpleNamespace(getDownloadId=self.GetDownloadId,
+                                             makeDownloadUrl=self.MakeDownloadUrl)
+
+        # emulated geemap module
+        self.geemap = types.ModuleType('geemap')
+        self.geemap.ee_to_numpy = self.EEToNumpy
+
+    def Reset(self):
+        """
+        Clear the request counts.
+        """
+        with self.lock:
+            self.calls = Counter()
+            self.bytes = Counter()
+            self.failures = Counter()
+
+    def Stats(self):
+        """
+        Number of requests, bytes returned and injected failures per request
+        type (getInfo, ee_to_numpy, getDownloadId).
+        """
+        with self.lock:
+            return {'calls':dict(self.calls), 'bytes':dict(self.bytes),
+                    'failures':dict(self.failures)}
+
+    def Request(self, name):
+        """
+        Count a request, wait for the emulated latency and raise EEException
+        if the request is picked to fail.
+        """
+        with self.lock:
+            self.calls[name] += 1
+            if isinstance(self.latency, (tuple, list)):
+                wait = self.random.uniform(*self.latency)
+            else:
+                wait = self.latency
+            fail = self.random.random() < self.failure_rate
+            if fail:
+                self.failures[name] += 1
+        if wait > 0:
+            time.sleep(wait)
+        if fail:
+            raise EEException('Emulated failure of %s request: Service Unavailable' % name)
+
+    def Record(self, name, nbytes):
+        with self.lock:
+            self.bytes[name] += nbytes
+
+    def Install(self):
+        """
+        Swap the emulated ee and geemap modules in for the real ones, both for
+        future imports and in any Toolshed modules already imported.
+        """
+        for name in ['ee', 'geemap']:
+            self.saved[('sys.modules', name)] = sys.modules.get(name)
+            sys.modules[name] = getattr(self, name)
+        for modname, module in list(sys.modules.items()):
+            if not modname.startswith('Toolshed.') or module is None:
+                continue
+            for name in ['ee', 'geemap']:
+                if hasattr(module, name):
+                    self.saved[(modname, name)] = getattr(module, name)
+                    setattr(module, name, getattr(self, name))
+        return self
+
+    def Uninstall(self):
+        """
+        Put back the modules replaced by Install().
+        """
+        for (modname, name), original in self.saved.items():
+            if modname == 'sys.modules':
+                if original is None:
+                    sys.modules.pop(name, None)
+                else:
+                    sys.modules[name] = original
+            elif modname in sys.modules:
+                setattr(sys.modules[modname], name, original)
+        self.saved = {}
+
+    def __enter__(self):
+        return self.Install()
+
+    def __exit__(self, *exc):
+        self.Uninstall()
+        return False
+
+    def Header(self, imageID):
+        """
+        Bands, properties and footprint of a local image (read once and kept).
+        """
+        with self.lock:
+            if imageID in self.headers:
+                return self.headers[imageID]
+
+        path = os.path.join(self.root, *imageID.split('/')) + '.tif'
+        if not os.path.isfile(path):
+            raise EEException('Image.load: Image asset \'%s\' not found.' % imageID)
+        sidecar = {}
+        if os.path.isfile(path[:-4] + '.json'):
+            with open(path[:-4] + '.json') as f:
+                sidecar = json.load(f)
+
+        with rasterio.open(path) as src:
+            if 'bands' in sidecar.keys():
+                names = sidecar['bands']
+            elif all(src.descriptions):
+                names = list(src.descriptions)
+            else:
+                names = ['B%d' % (k+1) for k in range(src.count)]
+            crs = src.crs.to_string()
+            bands = [{'id':names[k],
+                      'data_type':{'type':'PixelType',
+                                   'precision':'float' if np.dtype(src.dtypes[k]).kind == 'f' else 'int'},
+                      'dimensions':[src.width, src.height],
+                      'crs':crs,
+                      'crs_transform':list(src.transform)[:6]} for k in range(src.count)]
+            footprint = geometry.box(*transform_bounds(src.crs, 'EPSG:4326', *src.bounds))
+            dtype = np.result_type(*src.dtypes)
+
+        props = dict(sidecar['properties']) if 'properties' in sidecar.keys() else {}
+        if 'system:time_start' not in props.keys() and 'DATE_ACQUIRED' in props.keys():
+            props['system:time_start'] = Millis(props['DATE_ACQUIRED'])
+        props['system:index'] = os.path.basename(path)[:-4]
+        props['system:footprint'] = {'type':'LinearRing',
+                                     'coordinates':[list(xy) for xy in footprint.exterior.coords]}
+
+        header = {'path':path, 'bands':bands, 'properties':props,
+                  'footprint':footprint, 'dtype':dtype}
+        with self.lock:
+            self.headers[imageID] = header
+        return header
+
+    def CollectionIDs(self, collectionID):
+        """
+        IDs of all the local images in a collection.
+        """
+        folder = os.path.join(self.root, *collectionID.split('/'))
+        if not os.path.isdir(folder):
+            raise EEException('ImageCollection.load: ImageCollection asset \'%s\' not found.' % collectionID)
+        return [collectionID + '/' + os.path.basename(fn)[:-4] for fn in sorted(glob.glob(os.path.join(folder, '*.tif')))]
+
+    def EEToNumpy(self, ee_object, bands=None, region=None, properties=None, default_value=None):
+        """
+        Emulated geemap.ee_to_numpy(): pixels of an image within a region as a
+        (rows, cols, bands) array. As in geemap, errors are printed and None
+        is returned.
+        """
+        try:
+            self.Request('ee_to_numpy')
+            if bands is not None:
+                ee_object = ee_object.select(bands)
+            grid = ee_object._Grid(region)
+            if self.max_pixels is not None and grid['width']*grid['height'] > self.max_pixels:
+                raise EEException('Image.sampleRectangle: Too many pixels in sample; must be <= %d. Got %d.'
+                                  % (self.max_pixels, grid['width']*grid['height']))
+            im = ee_object._Read(grid)
+            nodata = 0 if default_value is None else default_value
+            im = np.moveaxis(np.where(np.isnan(im), nodata, im), 0, -1).astype(ee_object._DType())
+            self.Record('ee_to_numpy', im.nbytes)
+            return im
+        except Exception as e:
+            print(e)
+            return None
+
+    def GetDownloadId(self, params):
+        """
+        Emulated ee.data.getDownloadId(): writes the requested bands (one
+        GeoTIFF each, clipped to the region) to a zip file in a temporary
+        folder and returns its path as the download ID.
+        """
+        self.Request('getDownloadId')
+        image = params['image']
+        bandIDs = [band['id'] if isinstance(band, dict) else band for band in params['bands']]
+        name = params['name'] if 'name' in params.keys() else 'download'
+
+        with self.lock:
+            if self.tmpdir is None:
+                self.tmpdir = tempfile.mkdtemp(prefix='eeemulator_')
+        zippath = os.path.join(self.tmpdir, '%s_%d.zip' % (name, id(params)))
+        with zipfile.ZipFile(zippath, 'w') as zf:
+            for bandID in bandIDs:
+                band = image.select([bandID])
+                grid = band._Grid(params['region'])
+                im = band._Read(grid)[0]
+                dtype = band._DType()
+                with rasterio.MemoryFile() as memfile:
+                    with memfile.open(driver='GTiff', width=grid['width'], height=grid['height'], count=1,
+                                      dtype=dtype, crs=grid['crs'], transform=grid['transform']) as dst:
+                        dst.write(np.where(np.isnan(im), 0, im).astype(dtype), 1)
+                    zf.writestr('%s.%s.tif' % (name, bandID), memfile.read())
+        self.Record('getDownloadId', os.path.getsize(zippath))
+        return {'docid':zippath, 'token':''}
+
+    def MakeDownloadUrl(self, downloadId):
+        """
+        Emulated ee.data.makeDownloadUrl(): file:// URL of the zip file.
+        """
+        return 'file:' + pathname2url(os.path.abspath(downloadId['docid']))
+
+
+def Millis(date):
+    """
+    Milliseconds since 1970 (UTC) of an Earth Engine date argument: a number
+    of milliseconds, a datetime, an ee.Date or an ISO date string.
+    """
+    if isinstance(date, Date):
+        return date.value
+    if isinstance(date, ComputedObject):
+        date = Resolve(date)
+    if isinstance(date, (int, float, np.integer, np.floating)):
+        return int(date)
+    if isinstance(date, str):
+        date = datetime.fromisoformat(date.replace('Z', '+00:00'))
+    if date.tzinfo is None:
+        date = date.replace(tzinfo=timezone.utc)
+    return int(round(date.timestamp()*1000))
+
+
+def Resolve(value):
+    """
+    Client-side value of an emulated object (recursing into lists and dicts),
+    i.e. what getInfo() returns.
+    """
+    if isinstance(value, ComputedObject):
+        return Resolve(value._Value())
+    if isinstance(value, (list, tuple)):
+        return [Resolve(v) for v in value]
+    if isinstance(value, dict):
+        return dict([(k, Resolve(v)) for k, v in value.items()])
+    if isinstance(value, np.generic):
+        return value.item()
+    return value
+
+
+class ComputedObject:
+    """
+    Base of the emulated ee objects. Everything is computed straight away on
+    the client; only getInfo() counts as (and costs) a request.
+    """
+    emu = None
+
+    def _Value(self):
+        raise NotImplementedError
+
+    def getInfo(self):
+        self.emu.Request('getInfo')
+        info = Resolve(self)
+        self.emu.Record('getInfo', len(json.dumps(info)))
+        return info
+
+
+class Number(ComputedObject):
+    def __init__(self, value):
+        self.value = value
+
+    def _Value(self):
+        return self.value
+
+
+class Date(ComputedObject):
+    def __init__(self, date):
+        self.value = Millis(date)
+
+    def millis(self):
+        return self.emu.ee.Number(self.value)
+
+    def _Value(self):
+        return {'type':'Date', 'value':self.value}
+
+
+class List(ComputedObject):
+    def __init__(self, values):
+        if isinstance(values, List):
+            values = values.values
+        self.values = list(values)
+
+    def get(self, index):
+        return self.values[Resolve(index)]
+
+    def size(self):
+        return self.emu.ee.Number(len(self.values))
+
+    def _Value(self):
+        return self.values
+
+
+class Dictionary(ComputedObject):
+    def __init__(self, values=None):
+        if isinstance(values, Dictionary):
+            values = values.values
+        self.values = dict(Resolve(values)) if values is not None else {}
+
+    def get(self, key, defaultValue=None):
+        key = Resolve(key)
+        if key not in self.values.keys():
+            if defaultValue is None:
+                raise EEException('Dictionary.get: Dictionary does not contain key: %s.' % key)
+            return defaultValue
+        return self.values[key]
+
+    def keys(self):
+        return self.emu.ee.List(list(self.values.keys()))
+
+    def _Value(self):
+        return self.values
+
+
+class Geometry(ComputedObject):
+    """
+    Lon/lat geometry (only Point and Polygon are emulated).
+    """
+    def __init__(self, geom):
+        self.geom = geom
+
+    @staticmethod
+    def Point(coords, *args):
+        if not isinstance(coords, (list, tuple)):
+            coords = [coords, args[0]]
+        return Geometry(geometry.Point(coords))
+
+    @staticmethod
+    def Polygon(coords, *args):
+        # single ring (list of [x,y]) or list of rings
+        if np.ndim(coords) == 2:
+            coords = [coords]
+        return Geometry(geometry.Polygon(coords[0], coords[1:]))
+
+    def _Value(self):
+        return geometry.mapping(self.geom)
+
+    def getInfo(self):
+        # geometries are described on the client, without a request
+        return Resolve(self)
+
+
+def Footprint(image):
+    """
+    Lon/lat polygon of an image's footprint.
+    """
+    return geometry.Polygon(image.props['system:footprint']['coordinates'])
+
+
+def ToGeometry(region):
+    """
+    Shapely geometry of a region given as an ee.Geometry, a GeoJSON dict or
+    a list of polygon coordinates.
+    """
+    if isinstance(region, Geometry):
+        return region.geom
+    if isinstance(region, dict):
+        return geometry.shape(region)
+    return Geometry.Polygon(region).geom
+
+
+class Filter:
+    """
+    Filters on image properties (and dates, as 'system:time_start').
+    """
+    def __init__(self, test):
+        self.test = test
+
+    @staticmethod
+    def _Compare(name, value, op):
+        value = Resolve(value)
+        return Filter(lambda props: name in props.keys() and op(props[name], value))
+
+    @staticmethod
+    def lt(name, value):
+        return Filter._Compare(name, value, lambda a, b: a < b)
+
+    @staticmethod
+    def lte(name, value):
+        return Filter._Compare(name, value, lambda a, b: a <= b)
+
+    @staticmethod
+    def gt(name, value):
+        return Filter._Compare(name, value, lambda a, b: a > b)
+
+    @staticmethod
+    def gte(name, value):
+        return Filter._Compare(name, value, lambda a, b: a >= b)
+
+    @staticmethod
+    def eq(name, value):
+        return Filter._Compare(name, value, lambda a, b: a == b)
+
+    @staticmethod
+    def neq(name, value):
+        return Filter._Compare(name, value, lambda a, b: a != b)
+
+    @staticmethod
+    def inList(name, values):
+        return Filter._Compare(name, values, lambda a, b: a in b)
+
+    @staticmethod
+    def date(start, end=None):
+        # as in Earth Engine, no end date means a 1 millisecond range
+        start = Millis(start)
+        end = start + 1 if end is None else Millis(end)
+        return Filter(lambda props: 'system:time_start' in props.keys() and
+                      start <= props['system:time_start'] < end)
+
+    @staticmethod
+    def And(*filters):
+        return Filter(lambda props: all(f.test(props) for f in filters))
+
+    @staticmethod
+    def Or(*filters):
+        return Filter(lambda props: any(f.test(props) for f in filters))
+
+
+class Image(ComputedObject):
+    """
+    Emulated ee.Image: a local image (by ID), or one derived from others.
+    Pixels are only read by ee_to_numpy() and downloads, on the grid of the
+    first band, as a (bands, rows, cols) float array with NaN where masked.
+    """
+    def __init__(self, arg=None):
+        if isinstance(arg, Image):
+            self.__dict__.update(arg.__dict__)
+            return
+        header = self.emu.Header(arg)
+        self.id = arg
+        self.bands = header['bands']
+        self.props = dict(header['properties'])
+        self.region = None
+        self.dtype = header['dtype']
+        names = [band['id'] for band in self.bands]
+        path = header['path']
+        def read(grid, bandIDs):
+            with rasterio.open(path) as src:
+                with WarpedVRT(src, crs=grid['crs'], transform=grid['transform'],
+                               width=grid['width'], height=grid['height']) as vrt:
+                    im = vrt.read([names.index(b)+1 for b in bandIDs], masked=True)
+            return im.astype(float).filled(np.nan)
+        self.reader = read
+
+    @classmethod
+    def _Derived(cls, parent, bands, reader, props=None, dtype=None):
+        image = cls.__new__(cls)
+        image.id = None
+        image.bands = bands
+        image.props = dict(parent.props) if props is None else props
+        image.region = parent.region if parent is not None else None
+        image.dtype = parent.dtype if dtype is None else dtype
+        image.reader = reader
+        return image
+
+    def _Copy(self):
+        image = type(self).__new__(type(self))
+        image.__dict__.update(self.__dict__)
+        image.props = dict(self.props)
+        return image
+
+    def _DType(self):
+        return self.dtype
+
+    def _Grid(self, region=None):
+        """
+        Pixel grid of the first band covering a lon/lat region (by default
+        the clip region or footprint of the image).
+        """
+        if len(self.bands) == 0:
+            raise EEException('Image has no bands.')
+        if region is None:
+            region = self.region
+        if region is None:
+            geom = Footprint(self)
+        else:
+            geom = ToGeometry(region)
+        crs = self.bands[0]['crs']
+        a, b, c, d, e, f = self.bands[0]['crs_transform']
+        left, bottom, right, top = transform_bounds('EPSG:4326', crs, *geom.bounds)
+        col0, col1 = int(np.floor((left-c)/a)), int(np.ceil((right-c)/a))
+        row0, row1 = int(np.floor((top-f)/e)), int(np.ceil((bottom-f)/e))
+        return {'crs':crs, 'transform':Affine(a, b, c+col0*a, d, e, f+row0*e),
+                'width':max(col1-col0, 1), 'height':max(row1-row0, 1)}
+
+    def _Read(self, grid):
+        return self.reader(grid, [band['id'] for band in self.bands])
+
+    def _Info(self):
+        info = {'type':'Image', 'bands':[dict(band) for band in self.bands], 'properties':dict(self.props)}
+        if self.id is not None:
+            info['id'] = self.id
+        return info
+
+    def _Value(self):
+        return self._Info()
+
+    def get(self, name):
+        name = Resolve(name)
+        if name == 'system:id':
+            return self.id
+        return self.props.get(name)
+
+    def set(self, *args):
+        image = self._Copy()
+        if isinstance(args[0], (dict, Dictionary)):
+            image.props.update(Resolve(args[0]))
+        else:
+            image.props[Resolve(args[0])] = Resolve(args[1])
+        return image
+
+    def toDictionary(self):
+        props = dict([(k, v) for k, v in self.props.items() if not k.startswith('system:')])
+        return self.emu.ee.Dictionary(props)
+
+    def propertyNames(self):
+        return self.emu.ee.List(list(self.props.keys()))
+
+    def bandNames(self):
+        return self.emu.ee.List([band['id'] for band in self.bands])
+
+    def select(self, *args):
+        if len(args) > 0 and isinstance(args[0], (list, tuple)):
+            selectors = list(args[0])
+            names = list(args[1]) if len(args) > 1 else selectors
+        else:
+            selectors = names = list(args)
+        bandinfo = dict([(band['id'], band) for band in self.bands])
+        for b in selectors:
+            if b not in bandinfo.keys():
+                raise EEException('Image.select: Pattern \'%s\' did not match any bands.' % b)
+        bands = [dict(bandinfo[old], id=new) for old, new in zip(selectors, names)]
+        rename = dict(zip(names, selectors))
+        parent = self.reader
+        image = type(self)._Derived(self, bands, lambda grid, bandIDs: parent(grid, [rename[b] for b in bandIDs]))
+        image.id = self.id
+        return image
+
+    def addBands(self, other):
+        other = type(self)(other)
+        ids = [band['id'] for band in self.bands]
+        reader, otherreader = self.reader, other.reader
+        def read(grid, bandIDs):
+            return np.concatenate([reader(grid, [b]) if b in ids else otherreader(grid, [b])
+                                   for b in bandIDs]) if len(bandIDs) else np.zeros((0, grid['height'], grid['width']))
+        image = type(self)._Derived(self, self.bands + [b for b in other.bands if b['id'] not in ids], read,
+                                    dtype=np.result_type(self.dtype, other.dtype))
+        image.id = self.id
+        return image
+
+    def clip(self, geom):
+        image = self._Copy()
+        image.region = geom
+        return image
+
+    def updateMask(self, mask):
+        reader, maskreader = self.reader, mask.reader
+        maskband = [mask.bands[0]['id']]
+        def read(grid, bandIDs):
+            im = reader(grid, bandIDs)
+            im[:, ~(maskreader(grid, maskband)[0] > 0)] = np.nan
+            return im
+        image = type(self)._Derived(self, self.bands, read)
+        image.id = self.id
+        return image
+
+    def _Compare(self, value, op):
+        reader = self.reader
+        def read(grid, bandIDs):
+            im = reader(grid, bandIDs)
+            return np.where(np.isnan(im), np.nan, op(im, value).astype(float))
+        return type(self)._Derived(self, self.bands, read, dtype=np.uint8)
+
+    def lt(self, value):
+        return self._Compare(Resolve(value), np.less)
+
+    def lte(self, value):
+        return self._Compare(Resolve(value), np.less_equal)
+
+    def gt(self, value):
+        return self._Compare(Resolve(value), np.greater)
+
+    def gte(self, value):
+        return self._Compare(Resolve(value), np.greater_equal)
+
+
+def SimpleCloudScore(image):
+    """
+    Emulated ee.Algorithms.Landsat.simpleCloudScore(). There is no cloud score
+    offline, so the added 'cloud' band is 0 everywhere.
+    """
+    def read(grid, bandIDs):
+        return np.zeros((len(bandIDs), grid['height'], grid['width']))
+    cloud = type(image)._Derived(image, [dict(image.bands[0], id='cloud')], read, dtype=np.uint8)
+    return image.addBands(cloud)
+
+
+class ImageCollection(ComputedObject):
+    """
+    Emulated ee.ImageCollection: a collection ID of local images, or a list of
+    images.
+    """
+    def __init__(self, arg):
+        if isinstance(arg, ImageCollection):
+            self.id, self.images = arg.id, list(arg.images)
+        elif isinstance(arg, str):
+            self.id = arg
+            self.images = [self.emu.ee.Image(imageID) for imageID in self.emu.CollectionIDs(arg)]
+        else:
+            self.id = None
+            self.images = [image if isinstance(image, Image) else self.emu.ee.Image(image) for image in arg]
+
+    @classmethod
+    def fromImages(cls, images):
+        return cls(list(images))
+
+    def _New(self, images):
+        collection = type(self)(list(images))
+        collection.id = self.id
+        return collection
+
+    def filter(self, f):
+        return self._New([image for image in self.images if f.test(image.props)])
+
+    def filterDate(self, start, end=None):
+        return self.filter(Filter.date(start, end))
+
+    def filterBounds(self, geom):
+        geom = ToGeometry(geom)
+        return self._New([image for image in self.images if Footprint(image).intersects(geom)])
+
+    def select(self, *args):
+        return self._New([image.select(*args) for image in self.images])
+
+    def map(self, function):
+        return self._New([function(image) for image in self.images])
+
+    def sort(self, name, ascending=True):
+        return self._New(sorted(self.images, key=lambda image: image.props.get(name), reverse=not ascending))
+
+    def limit(self, n, name=None, ascending=True):
+        images = self.sort(name, ascending).images if name is not None else self.images
+        return self._New(images[:n])
+
+    def first(self):
+        return self.images[0] if len(self.images) > 0 else None
+
+    def size(self):
+        return self.emu.ee.Number(len(self.images))
+
+    def aggregate_array(self, name):
+        return self.emu.ee.List([image.get(name) for image in self.images if image.get(name) is not None])
+
+    def _Composite(self, reduce):
+        if len(self.images) == 0:
+            # no bands, so reading pixels fails as on the server
+            return self.emu.ee.Image._Derived(None, [], None, props={}, dtype=np.float64)
+        first = self.images[0]
+        readers = [image.reader for image in self.images]
+        def read(grid, bandIDs):
+            return reduce(np.stack([reader(grid, bandIDs) for reader in readers]))
+        return self.emu.ee.Image._Derived(first, first.bands, read, props={}, dtype=first.dtype)
+
+    def mosaic(self):
+        # later images on top, earlier ones fill in where they are masked
+        def reduce(stack):
+            im = stack[0]
+            for layer in stack[1:]:
+                im = np.where(np.isnan(layer), im, layer)
+            return im
+        return self._Composite(reduce)
+
+    def median(self):
+        return self._Composite(lambda stack: np.nanmedian(stack, axis=0))
+
+    def _Value(self):
+        return {'type':'ImageCollection', 'bands':[], 'id':self.id, 'properties':{},
+                'features':[image._Info() for image in self.images]}
@@ -16,6 +16,7 @@ import skimage.morphology as morphology
 import sklearn.decomposition as decomposition
 import skimage.exposure as exposure
 import rasterio
+from PIL import Image, ImageDraw
 
 # other modules
 from osgeo import gdal
@@ -26,7 +27,13 @@ from shapely import geometry
 import ee
 import geemap
 import glob
+import shutil
+import tempfile
 from datetime import datetime
+import threading
+from concurrent.futures import ThreadPoolExecutor
+import json
+import hashlib
 
 # CoastSat modules
 from Toolshed import Toolbox
@@ -37,7 +44,7 @@ from pyproj import transform as Transf
 np.seterr(all='ignore') # raise/ignore divisions by 0 and nans
 
 # Main function to preprocess a satellite image (L5,L7,L8 or S2)
-def preprocess_single(fn, filenames, satname, settings, polygon, dates, savetifs):
+def preprocess_single(fn, filenames, satname, settings, polygon, dates, savetifs, writer=None):
     
     cloud_mask_issue = settings['cloud_mask_issue']
     
@@ -617,18 +624,127 @@ def preprocess_single(fn, filenames, satname, settings, polygon, dates, savetifs
         im_extra = []
         
     if savetifs == True:
-        save_RGB_NDVI(im_ms, cloud_mask, georef, filenames[fn], settings)
+        save_RGB_NDVI(im_ms, cloud_mask, georef, filenames[fn], settings, writer)
     
     return im_ms, georef, cloud_mask, im_extra, im_QA, im_nodata, acqtime
 
 
+def preprocess_single_cached(fn, filenames, satname, settings, polygon, dates, savetifs, writer=None):
+    """
+    Wrapper around preprocess_single() which stores each preprocessed image
+    (NPZ of arrays, plus JSON sidecar of georef and other info) 
+    under <filepath>/<sitename>/preprocessed, keyed by image ID and a hash of
+    the settings used in preprocessing. On reruns (e.g. with new classifier or
+    threshold settings), images are loaded from the store rather than being
+    downloaded, pansharpened and resampled again. Images skipped during 
+    preprocessing (empty or too cloudy) are remembered too.
+    
+    Only used if settings['preprocess_cache'] is True; otherwise this just 
+    calls preprocess_single(). Quicklook GeoTIFFs are only saved when an image
+    is first preprocessed.
+
+    Parameters
+    ----------
+    Same as preprocess_single().
+
+    Returns
+    -------
+    Same as preprocess_single().
+
+    """
+    if not ('preprocess_cache' in settings.keys() and settings['preprocess_cache']):
+        return preprocess_single(fn, filenames, satname, settings, polygon, dates, savetifs, writer)
+    
+    cachepath = preprocess_cache_path(filenames[fn], satname, settings, polygon)
+    if os.path.isfile(cachepath+'.json'):
+        try:
+            return load_preprocessed(cachepath)
+        except (OSError, ValueError, KeyError):
+            print(' - cached preprocessed image unreadable, preprocessing again')
+    
+    preprocessed = preprocess_single(fn, filenames, satname, settings, polygon, dates, savetifs, writer)
+    save_preprocessed(cachepath, preprocessed)
+    
+    return preprocessed
+
+
+def preprocess_cache_path(filename, satname, settings, polygon):
+    """
+    Filepath (without extension) of an image in the preprocessed image store.
+    The key combines the image ID with a hash of everything preprocessing 
+    depends on, so changing any of these settings makes a new entry.
+    """
+    key = {'image':filename,
+           'satname':satname,
+           'polygon':polygon,
+           'cloud_mask_issue':settings['cloud_mask_issue'],
+           'cloud_thresh':settings['cloud_thresh'],
+           'ref_epsg':settings['ref_epsg'] if 'ref_epsg' in settings.keys() else None,
+           'sitename':settings['inputs']['sitename']}
+    # local images can be changed in place, so also key on file size and modified time
+    if os.path.isfile(filename):
+        key['size'] = os.path.getsize(filename)
+        key['mtime'] = os.path.getmtime(filename)
+    keyhash = hashlib.sha1(json.dumps(key, sort_keys=True, default=str).encode()).hexdigest()[:12]
+    
+    imageID = ''.join(c if c.isalnum() or c in '-_.' else '_' for c in os.path.splitext(os.path.basename(filename))[0])
+    cachedir = os.path.join(settings['inputs']['filepath'], settings['inputs']['sitename'], 'preprocessed', satname)
+    if os.path.isdir(cachedir) is False:
+        os.makedirs(cachedir)
+    
+    return os.path.join(cachedir, imageID+'_'+keyhash)
+
+
+def save_preprocessed(cachepath, preprocessed):
+    """
+    Save the outputs of preprocess_single() to the preprocessed image store.
+    Arrays go into an uncompressed NPZ (compressing them took longer than 
+    preprocessing, and slowed down reruns); the georef, acquisition time and 
+    any non-array outputs (e.g. empty lists) go into a JSON sidecar, which is 
+    written last so only complete entries are ever loaded.
+    """
+    names = ['im_ms', 'georef', 'cloud_mask', 'im_extra', 'im_QA', 'im_nodata', 'acqtime']
+    # empty S2 images come back without acqtime, so the number of outputs is kept too
+    arrays, sidecar = {}, {'skipped': preprocessed[0] is None, 'length': len(preprocessed), 'values': {}}
+    if not sidecar['skipped']:
+        for name, value in zip(names, preprocessed):
+            if isinstance(value, np.ndarray) and name != 'georef':
+                arrays[name] = value
+            elif name == 'georef':
+                # element by element, so ints stay ints and floats stay floats
+                sidecar['values'][name] = [v.item() if isinstance(v, np.generic) else v for v in value]
+            else:
+                sidecar['values'][name] = value
+        np.savez(cachepath+'.npz', **arrays)
+    with open(cachepath+'.json', 'w') as f:
+        json.dump(sidecar, f)
+
+
+def load_preprocessed(cachepath):
+    """
+    Load the outputs of preprocess_single() from the preprocessed image store.
+    """
+    with open(cachepath+'.json', 'r') as f:
+        sidecar = json.load(f)
+    if sidecar['skipped']:
+        return None, None, None, None, None, None, None
+    
+    names = ['im_ms', 'georef', 'cloud_mask', 'im_extra', 'im_QA', 'im_nodata', 'acqtime']
+    with np.load(cachepath+'.npz') as npz:
+        arrays = {name:npz[name] for name in npz.files}
+    arrays.update(sidecar['values'])
+    
+    return tuple(arrays[name] for name in names[:sidecar.get('length', len(names))])
+
+
 ###################################################################################################
 # AUXILIARY FUNCTIONS
 ###################################################################################################
 
-def save_RGB_NDVI(im_ms, cloud_mask, georef, filenames, settings):
+def save_RGB_NDVI(im_ms, cloud_mask, georef, filenames, settings, writer=None):
     '''
     Saves local georeferenced versions of the RGB and NDVI images to be investigated in a GIS.
+    How (and if) they are written is set by settings['quicklook_tifs'] (see QuicklookMode()).
     FM March 2022
     Arguments:
     --------
@@ -636,8 +752,16 @@ def save_RGB_NDVI(im_ms, cloud_mask, georef, filenames, settings):
         multispectral image array
     cloud_mask:
         cloud mask created from defined nodata pixels
+    writer: TifWriter (optional)
+        background writer to queue the GeoTIFFs on, rather than writing them here
     
     '''
+    if QuicklookMode(settings) == 'skip':
+        return
+    if writer is not None:
+        # make the quicklooks in the background too (from copies, as the main loop carries on)
+        writer.Submit(save_RGB_NDVI, np.array(im_ms), np.array(cloud_mask), georef, filenames, settings)
+        return
     print(' \nsaving '+filenames)
     im_NDVI = Toolbox.nd_index(im_ms[:,:,3], im_ms[:,:,2], cloud_mask) # NIR and red bands
     try: # some sentinel images with 0 axis don't get caught before this
@@ -651,38 +775,14 @@ def save_RGB_NDVI(im_ms, cloud_mask, georef, filenames, settings):
     transform = rasterio.transform.from_origin(georef[0], georef[3], georef[1], georef[1]) # use georef to get affine
     
     # 3-band RGB array and 1-band NDVI
-    for imarray, imtype, bandno in zip([im_RGB, im_NDVI],['RGB.tif', 'NDVI.tif'],[3,1]):
-        if bandno > 1:
-            imarray_brc = np.moveaxis(imarray,2,0) # rasterio expects shape of (bands, rows, cols)
-            savename = os.path.join(settings['inputs']['filepath'],settings['inputs']['sitename'],'jpg_files',tifname+'_'+imtype)
-            with rasterio.open(savename,'w',
-                driver='GTiff',
-                height=imarray_brc.shape[1],
-                width=imarray_brc.shape[2],
-                count=bandno,
-                dtype=imarray_brc.dtype,
-                crs='EPSG:'+str(settings['output_epsg']),
-                transform=transform,
-            ) as tif:
-                tif.write(imarray_brc)
-        else:
-            imarray_brc = imarray
-            savename = os.path.join(settings['inputs']['filepath'],settings['inputs']['sitename'],'jpg_files',tifname+'_'+imtype)
-            with rasterio.open(
-                savename,'w',
-                driver='GTiff',
-                height=imarray_brc.shape[0],
-                width=imarray_brc.shape[1],
-                count=bandno,
-                dtype=imarray_brc.dtype,
-                crs='EPSG:'+str(settings['output_epsg']),
-                transform=transform,
-            ) as tif:
-                tif.write(imarray_brc,1) # single band raster requires an index param
+    for imarray, imtype in zip([im_RGB, im_NDVI],['RGB.tif', 'NDVI.tif']):
+        savename = os.path.join(settings['inputs']['filepath'],settings['inputs']['sitename'],'jpg_files',tifname+'_'+imtype)
+        save_quicklook(savename, imarray, transform, settings)
   
-def save_ClassIm(im_classif, im_labels, cloud_mask, georef, filenames, settings):
+def save_ClassIm(im_classif, im_labels, cloud_mask, georef, filenames, settings, writer=None):
     '''
     Saves local georeferenced version of the classified image to be investigated in a GIS.
+    How (and if) it is written is set by settings['quicklook_tifs'] (see QuicklookMode()).
     FM Sept 2022
     Arguments:
     --------
@@ -690,8 +790,12 @@ def save_ClassIm(im_classif, im_labels, cloud_mask, georef, filenames, settings)
         multispectral image array
     cloud_mask:
         cloud mask created from defined nodata pixels
+    writer: TifWriter (optional)
+        background writer to queue the GeoTIFF on, rather than writing it here
     
     '''
+    if QuicklookMode(settings) == 'skip':
+        return
     print(' \nsaving classified '+filenames)
 
     # coastsat georef: [Xtr, Xscale, Xshear, Ytr, Yshear, Yscale]
@@ -701,22 +805,127 @@ def save_ClassIm(im_classif, im_labels, cloud_mask, georef, filenames, settings)
     transform = rasterio.transform.from_origin(georef[0], georef[3], georef[1], georef[1]) # use georef to get affine
     
     # Binary classified image
-    with rasterio.open(
-        os.path.join(settings['inputs']['filepath'],settings['inputs']['sitename'],'jpg_files',tifname+'_'+'CLASS.tif'),
-        'w',
+    savename = os.path.join(settings['inputs']['filepath'],settings['inputs']['sitename'],'jpg_files',tifname+'_'+'CLASS.tif')
+    save_quicklook(savename, im_classif, transform, settings, writer)
+
+
+def QuicklookMode(settings):
+    '''
+    How quicklook GeoTIFFs (RGB, NDVI and classified images) are saved, from
+    settings['quicklook_tifs']:
+        'save': written straight away at full resolution (default)
+        'defer': queued on a background writer at full resolution
+        'downsample': queued on a background writer, downsampled by 
+                      settings['quicklook_factor'] (default 4)
+        'skip': not saved
+    '''
+    if 'quicklook_tifs' in settings.keys():
+        mode = settings['quicklook_tifs']
+    else:
+        mode = 'save'
+    if mode not in ['save','defer','downsample','skip']:
+        raise Exception('quicklook_tifs %s is not an option, choose between save, defer, downsample or skip' % mode)
+    return mode
+
+
+def save_quicklook(savename, imarray, transform, settings, writer=None):
+    '''
+    Write (or queue on a background writer) a quicklook GeoTIFF, downsampling
+    it first if settings['quicklook_tifs'] is 'downsample'.
+    
+    Arguments:
+    --------
+    savename: str
+        filepath of GeoTIFF
+    imarray: np.array
+        2D (rows, cols) or 3D (rows, cols, bands) image array
+    transform: affine.Affine
+        geotransform of image array
+    settings: dict
+        veg edge extraction settings
+    writer: TifWriter (optional)
+        background writer to queue the GeoTIFF on
+    
+    '''
+    if QuicklookMode(settings) == 'downsample':
+        if 'quicklook_factor' in settings.keys():
+            factor = int(settings['quicklook_factor'])
+        else:
+            factor = 4
+        # take every nth pixel and scale the pixel size to match
+        imarray = imarray[::factor, ::factor]
+        transform = transform * rasterio.Affine.scale(factor)
+    if writer is None:
+        write_tif(savename, imarray, transform, settings['output_epsg'])
+    else:
+        # copy so later changes to the array in the main loop don't end up in the file
+        writer.Submit(write_tif, savename, np.array(imarray), transform, settings['output_epsg'])
+
+
+def write_tif(savename, imarray, transform, epsg):
+    '''
+    Write a 2D (rows, cols) or 3D (rows, cols, bands) image array to GeoTIFF.
+    '''
+    if imarray.ndim == 3:
+        imarray = np.moveaxis(imarray,2,0) # rasterio expects shape of (bands, rows, cols)
+    else:
+        imarray = imarray[np.newaxis,:,:]
+    with rasterio.open(savename,'w',
         driver='GTiff',
-        height=im_classif.shape[0],
-        width=im_classif.shape[1],
-        count=1,
-        dtype=im_classif.dtype,
-        crs='EPSG:'+str(settings['output_epsg']),
+        height=imarray.shape[1],
+        width=imarray.shape[2],
+        count=imarray.shape[0],
+        dtype=imarray.dtype,
+        crs='EPSG:'+str(epsg),
         transform=transform,
     ) as tif:
-        tif.write(im_classif,1)
+        tif.write(imarray)
+
+
+class TifWriter:
+    '''
+    Writes GeoTIFFs (or any other output, e.g. .jpg quicklooks) on a small pool 
+    of background threads, so disk I/O overlaps with image processing in the main loop. The number of queued writes is 
+    bounded (Submit() blocks when the queue is full) to cap memory use.
+    Use as a context manager, or call Close() to wait for all writes to finish.
+    '''
+    def __init__(self, n_workers=2, max_queued=8):
+        self.Executor = ThreadPoolExecutor(max_workers=n_workers)
+        self.Slots = threading.BoundedSemaphore(n_workers + max_queued)
+        self.Futures = []
+    
+    def Submit(self, func, *args, **kwargs):
+        self.Slots.acquire()
+        try:
+            Future = self.Executor.submit(func, *args, **kwargs)
+        except:
+            self.Slots.release()
+            raise
+        Future.add_done_callback(lambda _: self.Slots.release())
+        self.Futures.append(Future)
+        return Future
+    
+    def Close(self):
+        '''
+        Wait for all queued writes, raising the first error that occurred.
+        '''
+        self.Executor.shutdown(wait=True)
+        Futures, self.Futures = self.Futures, []
+        for Future in Futures:
+            Future.result()
+    
+    def __enter__(self):
+        return self
+    
+    def __exit__(self, *exc):
+        self.Close()
+        return False
        
-def save_TZone(im_ms, im_labels, cloud_mask, georef, filenames, settings):
+def save_TZone(im_ms, im_labels, cloud_mask, georef, filenames, settings, TZstack=None):
     '''
     Saves local georeferenced version of the transition zone to be investigated in a GIS.
+    Written as a tiled, compressed GeoTIFF, unless a TZStack is given, in
+    which case the raster is added to the satellite's stack (batch mode).
     FM Sept 2022
     Arguments:
     --------
@@ -724,6 +933,8 @@ def save_TZone(im_ms, im_labels, cloud_mask, georef, filenames, settings):
         multispectral image array
     cloud_mask:
         cloud mask created from defined nodata pixels
+    TZstack: TZStack (optional)
+        stack to add the TZ raster to (batch mode)
     
     '''
     print(' \nsaving transition zone of '+filenames)
@@ -737,30 +948,99 @@ def save_TZone(im_ms, im_labels, cloud_mask, georef, filenames, settings):
     int_veg = im_ndvi[im_labels[:,:,0]]
     int_nonveg = im_ndvi[im_labels[:,:,1]] 
 
-    im_TZ = im_ndvi.copy()
     TZbuffer = Toolbox.TZValues(int_veg, int_nonveg)
+    # pixels with NDVI between the TZ bounds are 1, everything else nan
+    im_TZ = np.where((im_ndvi > TZbuffer[0]) & (im_ndvi < TZbuffer[1]), 1.0, np.nan).astype(im_ndvi.dtype)
     
-    for i in range(len(im_ndvi[:,0])):
-        for j in range(len(im_ndvi[0,:])):
-            if im_ndvi[i,j] > TZbuffer[0] and im_ndvi[i,j] < TZbuffer[1]:
-                im_TZ[i,j] = 1.0
-            else:
-                im_TZ[i,j] = np.nan
+    if TZstack is not None:
+        TZstack.Add(tifname, im_TZ, transform)
+        return
     
     # Binary classified image
+    write_TZ(os.path.join(settings['inputs']['filepath'],settings['inputs']['sitename'],'jpg_files',tifname+'_'+'TZ.tif'),
+             im_TZ, transform, settings['output_epsg'])
+
+
+def write_TZ(savename, im_TZ, transform, epsg):
+    '''
+    Write a transition zone array to a tiled, compressed single-band GeoTIFF.
+    '''
     with rasterio.open(
-        os.path.join(settings['inputs']['filepath'],settings['inputs']['sitename'],'jpg_files',tifname+'_'+'TZ.tif'),
+        savename,
         'w',
         driver='GTiff',
         height=im_TZ.shape[0],
         width=im_TZ.shape[1],
         count=1,
         dtype=im_TZ.dtype,
-        crs='EPSG:'+str(settings['output_epsg']),
+        crs='EPSG:'+str(epsg),
         transform=transform,
+        tiled=True, blockxsize=256, blockysize=256,
+        compress='deflate',
     ) as tif:
         tif.write(im_TZ,1)
 
+
+class TZStack:
+    '''
+    Collects the transition zones of a satellite (batch mode) into multi-band 
+    GeoTIFF time-cubes, one band per image (band descriptions hold the image 
+    names), with images on different grids in separate stacks.
+    Each TZ is written to a part file in a temporary folder as soon as it is 
+    added, so only one band is in memory at a time. Close() copies the parts 
+    band by band into the stacks, replacing the satellite's stacks and any 
+    single-image *_TZ.tif files of the same images left by earlier runs.
+    '''
+    def __init__(self, satname, settings):
+        self.Dir = os.path.join(settings['inputs']['filepath'],settings['inputs']['sitename'],'jpg_files')
+        self.Name = settings['inputs']['sitename']+'_'+satname+'_TZstack'
+        self.EPSG = settings['output_epsg']
+        self.PartsDir = tempfile.mkdtemp(prefix=self.Name+'_parts_', dir=self.Dir)
+        self.Grids = {} # image names and part files for each (shape, transform)
+    
+    def Add(self, tifname, im_TZ, transform):
+        partname = os.path.join(self.PartsDir, tifname+'_TZ.tif')
+        # TZ is only 1 or nan so can be stored at single precision
+        write_TZ(partname, im_TZ.astype(np.float32), transform, self.EPSG)
+        self.Grids.setdefault((im_TZ.shape, transform), []).append((tifname, partname))
+    
+    def Close(self):
+        '''
+        Write out the stacks and remove the part files.
+        '''
+        if len(self.Grids) > 0:
+            # earlier runs may have had a different number of grids
+            for oldstack in glob.glob(os.path.join(self.Dir, self.Name+'[0-9]*.tif')):
+                os.remove(oldstack)
+        for g, ((shape, transform), bands) in enumerate(self.Grids.items()):
+            savename = os.path.join(self.Dir, self.Name+str(g)+'.tif')
+            print(' \nsaving %d transition zones to %s' % (len(bands), savename))
+            with rasterio.open(
+                savename,
+                'w',
+                driver='GTiff',
+                height=shape[0],
+                width=shape[1],
+                count=len(bands),
+                dtype=np.float32,
+                crs='EPSG:'+str(self.EPSG),
+                transform=transform,
+                tiled=True, blockxsize=256, blockysize=256,
+                compress='deflate',
+                interleave='band',
+            ) as tif:
+                for b, (tifname, partname) in enumerate(bands):
+                    with rasterio.open(partname) as part:
+                        tif.write(part.read(1), b+1)
+                    tif.set_band_description(b+1, tifname)
+                    # stop stale single-image TZ being read alongside this band
+                    oldTZ = os.path.join(self.Dir, tifname+'_TZ.tif')
+                    if os.path.isfile(oldTZ):
+                        os.remove(oldTZ)
+        shutil.rmtree(self.PartsDir, ignore_errors=True)
+        self.Grids = {}
+
+
 def create_cloud_mask(im_QA, satname, cloud_mask_issue):
     """
     Creates a cloud mask using the information contained in the QA band.
@@ -772,7 +1052,7 @@ def create_cloud_mask(im_QA, satname, cloud_mask_issue):
     im_QA: np.array
         Image containing the QA band
     satname: string
-        short name for the satellite: ```'L5', 'L7', 'L8' or 'S2'```
+        short name for the satellite: ```'L5', 'L7', 'L8', 'L9' or 'S2'```
     cloud_mask_issue: boolean
         True if there is an issue with the cloud mask and sand pixels are being
         erroneously masked on the images
@@ -784,30 +1064,95 @@ def create_cloud_mask(im_QA, satname, cloud_mask_issue):
         
     """
 
-    # convert QA bits (the bits allocated to cloud cover vary depending on the satellite mission)
-    if satname == 'L8':
-        cloud_values = [2800, 2804, 2808, 2812, 6896, 6900, 6904, 6908]
-    elif satname == 'L7' or satname == 'L5' or satname == 'L4':
-        cloud_values = [752, 756, 760, 764]
-    elif satname == 'S2':
-        cloud_values = [1024, 2048] # 1024 = dense cloud, 2048 = cirrus clouds
-
     # find which pixels have bits corresponding to cloud values
-    cloud_mask = np.isin(im_QA, cloud_values)
+    cloud_mask = decode_cloud_QA(im_QA, satname)
 
     # remove cloud pixels that form very thin features. These are beach or swash pixels that are
     # erroneously identified as clouds by the CFMASK algorithm applied to the images by the USGS.
-    if sum(sum(cloud_mask)) > 0 and sum(sum(~cloud_mask)) > 0:
-        morphology.remove_small_objects(cloud_mask, min_size=10, connectivity=1, in_place=True)
+    # (done at the native resolution of the QA band, before any upsampling of the mask)
+    if cloud_mask.any() and not cloud_mask.all():
+        cloud_mask = morphology.remove_small_objects(cloud_mask, min_size=10, connectivity=1)
 
         if cloud_mask_issue:
             elem = morphology.square(3) # use a square of width 3 pixels
             cloud_mask = morphology.binary_opening(cloud_mask,elem) # perform image opening
             # remove objects with less than 25 connected pixels
-            morphology.remove_small_objects(cloud_mask, min_size=25, connectivity=1, in_place=True)
+            cloud_mask = morphology.remove_small_objects(cloud_mask, min_size=25, connectivity=1)
 
     return cloud_mask
 
+
+# QA values flagged as cloud (the bits allocated to cloud cover vary depending on the satellite mission)
+CLOUD_QA_VALUES = {'L4': [752, 756, 760, 764],
+                   'L5': [752, 756, 760, 764],
+                   'L7': [752, 756, 760, 764],
+                   'L8': [2800, 2804, 2808, 2812, 6896, 6900, 6904, 6908],
+                   'L9': [2800, 2804, 2808, 2812, 6896, 6900, 6904, 6908],
+                   'S2': [1024, 2048]} # 1024 = dense cloud, 2048 = cirrus clouds
+
+_CLOUD_QA_LUTS = {}
+
+
+def cloud_QA_LUT(satname):
+    """
+    Boolean lookup table over every 16-bit QA value, True where the value
+    is flagged as cloud for that satellite. Built once per satellite.
+
+    Arguments:
+    -----------
+    satname: string
+        short name for the satellite: ```'L5', 'L7', 'L8', 'L9' or 'S2'```
+
+    Returns:
+    -----------
+    lut: np.array
+        boolean array of length 65536
+        
+    """
+    if satname not in _CLOUD_QA_LUTS:
+        if satname not in CLOUD_QA_VALUES:
+            raise ValueError("No cloud QA values defined for satellite '%s'" % satname)
+        lut = np.zeros(2**16, dtype=bool)
+        lut[CLOUD_QA_VALUES[satname]] = True
+        _CLOUD_QA_LUTS[satname] = lut
+    return _CLOUD_QA_LUTS[satname]
+
+
+def decode_cloud_QA(im_QA, satname):
+    """
+    Flag cloudy pixels in a QA band in a single pass, by indexing integer QA
+    values into the satellite's 16-bit cloud lookup table. QA bands that 
+    arrive as floats (when stacked with reflectance bands) are compared 
+    directly against the satellite's cloud values.
+
+    Arguments:
+    -----------
+    im_QA: np.array
+        Image containing the QA band
+    satname: string
+        short name for the satellite: ```'L5', 'L7', 'L8', 'L9' or 'S2'```
+
+    Returns:
+    -----------
+    cloud_mask : np.array
+        boolean array with True if a pixel is cloudy and False otherwise
+        
+    """
+    lut = cloud_QA_LUT(satname)
+    im_QA = np.asarray(im_QA)
+    if im_QA.dtype.kind not in 'ui':
+        # float QA (stacked with reflectance bands) only needs a few equality
+        # checks, which is quicker than casting to use the LUT
+        return np.isin(im_QA, CLOUD_QA_VALUES[satname])
+    if im_QA.dtype == np.int16:
+        # negative values read as 32768-65535 (never cloud flags), without a copy
+        im_QA = im_QA.view(np.uint16)
+    if im_QA.dtype != np.uint16 and im_QA.dtype != np.uint8:
+        # wider integer types: anything outside 0-65535 is never a cloud flag
+        valid = (im_QA >= 0) & (im_QA < 2**16)
+        return np.take(lut, np.where(valid, im_QA, 0)) & valid
+    return np.take(lut, im_QA)
+
 def hist_match(source, template):
     """
     Adjust the pixel values of a grayscale image such that its histogram matches
@@ -852,13 +1197,68 @@ def hist_match(source, template):
 
     return interp_t_values[bin_idx].reshape(oldshape)
 
-def pansharpen(im_ms, im_pan, cloud_mask):
+def hist_match_lut(source, template, n_quantiles=1024, n_sample=200000):
+    """
+    Faster approximation of hist_match() for large images. Rather than 
+    sorting every pixel of both images, the quantiles of each are estimated 
+    from a regular subsample of pixels, and source values are mapped to the 
+    template through a lookup table of matching quantiles.
+
+    Arguments:
+    -----------
+    source: np.array
+        Image to transform; the histogram is computed over the flattened
+        array
+    template: np.array
+        Template image; can have different dimensions to source
+    n_quantiles: int
+        Number of quantiles in the lookup table
+    n_sample: int
+        Maximum number of pixels used to estimate the quantiles of each image
+        
+    Returns:
+    -----------
+    matched: np.array
+        The transformed output image
+        
+    """
+    oldshape = source.shape
+    source = source.ravel()
+    template = template.ravel()
+    # regularly spaced subsample of pixels
+    s_sample = source[::int(np.ceil(len(source)/n_sample))]
+    t_sample = template[::int(np.ceil(len(template)/n_sample))]
+    
+    # quantiles from sorted samples (quicker than np.quantile for many quantiles)
+    s_sorted, t_sorted = np.sort(s_sample), np.sort(t_sample)
+    s_values = np.interp(np.linspace(0, len(s_sorted)-1, n_quantiles), np.arange(len(s_sorted)), s_sorted)
+    t_values = np.interp(np.linspace(0, len(t_sorted)-1, n_quantiles), np.arange(len(t_sorted)), t_sorted)
+    # repeated source values (e.g. integer pixel values) map to the top of their quantile range
+    last = len(s_values) - 1 - np.unique(s_values[::-1], return_index=True)[1]
+    s_values, t_values = s_values[last], t_values[last]
+    
+    # integer-valued sources (e.g. raw pan band) can be matched by indexing a table of every value
+    s_min, s_max = np.min(source), np.max(source)
+    if s_max - s_min < 2**16 and np.all(np.mod(s_sample, 1) == 0):
+        s_int = (source - s_min).astype(np.intp)
+        if np.array_equal(s_int, source - s_min):
+            table = np.interp(np.arange(s_min, s_max+1), s_values, t_values)
+            return table[s_int].reshape(oldshape)
+    
+    return np.interp(source, s_values, t_values).reshape(oldshape)
+
+def pansharpen(im_ms, im_pan, cloud_mask, n_sample=200000):
     """
     Pansharpens a multispectral image, using the panchromatic band and a cloud mask.
     A PCA is applied to the image, then the 1st PC is replaced, after histogram 
     matching with the panchromatic band. Note that it is essential to match the
     histrograms of the 1st PC and the panchromatic band before replacing and 
     inverting the PCA.
+    
+    The PCA is fitted on a regular (strided) subsample of non-cloud pixels and 
+    applied to all pixels at once, and histograms are matched through a quantile 
+    lookup table (see hist_match_lut()). The 1st PC is oriented so its band 
+    loadings sum positive, i.e. it increases with brightness like the pan band.
 
     KV WRL 2018
 
@@ -870,6 +1270,8 @@ def pansharpen(im_ms, im_pan, cloud_mask):
         Panchromatic band (2D)
     cloud_mask: np.array
         2D cloud mask with True where cloud pixels are
+    n_sample: int
+        Maximum number of pixels used to fit the PCA
 
     Returns:
     -----------
@@ -878,23 +1280,30 @@ def pansharpen(im_ms, im_pan, cloud_mask):
         
     """
 
-    # reshape image into vector and apply cloud mask
+    # reshape image into vector and find non-cloud pixels
     vec = im_ms.reshape(im_ms.shape[0] * im_ms.shape[1], im_ms.shape[2])
     vec_mask = cloud_mask.reshape(im_ms.shape[0] * im_ms.shape[1])
-    vec = vec[~vec_mask, :]
-    # apply PCA to multispectral bands
-    pca = decomposition.PCA()
-    vec_pcs = pca.fit_transform(vec)
+    clear = np.flatnonzero(~vec_mask)
+    vec_clear = vec[clear]
+    # fit PCA to multispectral bands on a regular subsample of non-cloud pixels
+    vec_sample = vec_clear[::int(np.ceil(len(vec_clear)/n_sample))]
+    vec_mean = vec_sample.mean(axis=0)
+    vec_centred = vec_sample - vec_mean
+    _, components = np.linalg.eigh(vec_centred.T @ vec_centred / (len(vec_sample) - 1))
+    pc1_axis = components[:,-1] # component with most variance
+    # eigenvector sign is arbitrary; point 1st PC towards brighter pixels so 
+    # matching it to the pan band doesn't invert contrast
+    if pc1_axis.sum() < 0:
+        pc1_axis = -pc1_axis
+    # 1st PC of non-cloud pixels
+    pc1 = vec_clear @ pc1_axis - vec_mean @ pc1_axis
 
     # replace 1st PC with pan band (after matching histograms)
     vec_pan = im_pan.reshape(im_pan.shape[0] * im_pan.shape[1])
-    vec_pan = vec_pan[~vec_mask]
-    vec_pcs[:,0] = hist_match(vec_pan, vec_pcs[:,0])
-    vec_ms_ps = pca.inverse_transform(vec_pcs)
-
-    # reshape vector into image
-    vec_ms_ps_full = np.ones((len(vec_mask), im_ms.shape[2])) * np.nan
-    vec_ms_ps_full[~vec_mask,:] = vec_ms_ps
+    pc1_pan = hist_match_lut(vec_pan[clear], pc1)
+    # other PCs are unchanged, so inverting the PCA just shifts pixels along the 1st PC
+    vec_ms_ps_full = np.full((len(vec_mask), im_ms.shape[2]), np.nan)
+    vec_ms_ps_full[clear,:] = vec_clear + (pc1_pan - pc1)[:,np.newaxis] * pc1_axis
     im_ms_ps = vec_ms_ps_full.reshape(im_ms.shape[0], im_ms.shape[1], im_ms.shape[2])
 
     return im_ms_ps
@@ -957,12 +1366,94 @@ def rescale_image_intensity(im, cloud_mask, prob_high):
 
     return im_adj
 
-def create_jpg(im_ms, cloud_mask, date, satname, filepath):
+def quicklook_RGB(im, cloud_mask, prob_high=99.9):
+    """
+    8-bit contrast-stretched copy of an image (multispectral or single band)
+    for quicklooks. Same stretch as rescale_image_intensity() (0 to the 
+    prob_high percentile of the clear pixels in each band), done with one 
+    percentile call over all bands. Cloudy pixels are white.
+
+    Arguments:
+    -----------
+    im: np.array
+        Image to rescale, can be 3D (multispectral) or 2D (single band)
+    cloud_mask: np.array
+        2D cloud mask with True where cloud pixels are
+    prob_high: float
+        probability of exceedence used to calculate the upper percentile
+
+    Returns:
+    -----------
+    im_8bit: np.array
+        rescaled image (uint8), same shape as im
+    """
+    im_3d = im.reshape(im.shape[0], im.shape[1], -1)
+    prc_high = np.percentile(im_3d[~cloud_mask], prob_high, axis=0)
+    prc_high[~(prc_high > 0)] = 1 # flat or empty bands stay black
+    im_adj = np.clip(np.nan_to_num(im_3d / prc_high), 0, 1)
+    im_8bit = (im_adj * 255 + 0.5).astype(np.uint8)
+    im_8bit[cloud_mask] = 255
+    
+    return im_8bit.reshape(im.shape)
+
+
+def render_jpg(im_8bit, title, filename, shorelines=[], georef=None, scale=1, quality=95):
+    """
+    Writes an 8-bit RGB (or grayscale) image straight to a .jpg with Pillow,
+    with the title on a white strip above the image and shoreline points 
+    drawn on top in pixel coordinates. Much faster than going through a 
+    matplotlib figure.
+
+    Arguments:
+    -----------
+    im_8bit: np.array
+        uint8 image (see quicklook_RGB())
+    title: str
+        text written above the image
+    filename: str
+        path of the .jpg to write
+    shorelines: list of np.array
+        shorelines (X,Y world coordinates) to draw on the image
+    georef: np.array
+        vector of 6 elements [Xtr, Xscale, Xshear, Ytr, Yshear, Yscale],
+        needed if shorelines are given
+    scale: int
+        factor to enlarge the image by (nearest neighbour)
+    quality: int
+        JPEG quality (1-95)
+
+    Returns:
+    -----------
+        Saves the .jpg
+    """
+    im = Image.fromarray(im_8bit)
+    if scale != 1:
+        im = im.resize((im.width*scale, im.height*scale), Image.NEAREST)
+    
+    draw = ImageDraw.Draw(im)
+    for shoreline in shorelines:
+        if len(shoreline) == 0:
+            continue
+        sl_pix = Toolbox.convert_world2pix(shoreline[:,:2], georef) * scale
+        draw.point([tuple(xy) for xy in sl_pix], fill='#EAC435')
+    
+    # white title strip above the image
+    strip = 20
+    out = Image.new(im.mode, (im.width, im.height + strip), 'white')
+    out.paste(im, (0, strip))
+    ImageDraw.Draw(out).text((4, 4), title, fill='black')
+    out.save(filename, quality=quality)
+
+
+def create_jpg(im_ms, cloud_mask, date, satname, filepath, shorelines=[], georef=None, renderer='pillow', imagename=None):
     """
     Saves a .jpg file with the RGB image as well as the NIR and SWIR1 grayscale images.
     This functions can be modified to obtain different visualisations of the 
     multispectral images.
 
+    RGB quicklooks are written directly with Pillow by default 
+    (renderer='matplotlib' for the old figure), with optional shoreline overlay.
+
     KV WRL 2018
 
     Arguments:
@@ -975,12 +1466,33 @@ def create_jpg(im_ms, cloud_mask, date, satname, filepath):
         string containing the date at which the image was acquired
     satname: str
         name of the satellite mission (e.g., 'L5')
+    filepath: str
+        folder to save the .jpg in
+    shorelines: list of np.array
+        shorelines (X,Y world coordinates) to draw on the image (Pillow only)
+    georef: np.array
+        georeferencing vector of the image, needed if shorelines are given
+    renderer: str
+        'pillow' or 'matplotlib'
+    imagename: str
+        image ID added to the .jpg name, so images from the same date don't
+        overwrite each other (optional)
 
     Returns:
     -----------
         Saves a .jpg image corresponding to the preprocessed satellite image
 
     """
+    
+    if imagename is None:
+        jpgname = os.path.join(filepath, date + '_' + satname + '.jpg')
+    else:
+        jpgname = os.path.join(filepath, date + '_' + satname + '_' + imagename + '.jpg')
+    
+    if renderer == 'pillow':
+        im_RGB = quicklook_RGB(im_ms[:,:,[2,1,0]], cloud_mask, 99.9)
+        render_jpg(im_RGB, date + '   ' + satname, jpgname, shorelines, georef)
+        return
 
     # rescale image intensity for display purposes
     im_RGB = rescale_image_intensity(im_ms[:,:,[2,1,0]], cloud_mask, 99.9)
@@ -1017,10 +1529,8 @@ def create_jpg(im_ms, cloud_mask, date, satname, filepath):
 #    ax3.imshow(im_SWIR, cmap='seismic')
 #    ax3.set_title('Short-wave Infrared', fontsize=16)
 
-    # save figure
-    plt.rcParams['savefig.jpeg_quality'] = 100
-    fig.savefig(os.path.join(filepath,
-                             date + '_' + satname + '.jpg'), dpi=150)
+    # save figure (the savefig.jpeg_quality rcParam no longer exists in matplotlib >= 3.5)
+    fig.savefig(jpgname, dpi=150, pil_kwargs={'quality':95})
     plt.close()
 
 
@@ -1059,37 +1569,47 @@ def save_jpg(metadata, settings, polygon, dates, **kwargs):
     if not os.path.exists(filepath_jpg):
             os.makedirs(filepath_jpg)
 
-    # loop through satellite list
-    for satname in metadata.keys():
-
-        filepath = Toolbox.get_filepath(settings['inputs'],satname)
-        filenames = metadata[satname]['filenames']
-
-        # loop through images
-        for i in range(len(filenames)):
-            # image filename
-            fn = Toolbox.get_filenames(filenames[i],filepath, satname)
-            # read and preprocess image
-            im_ms, georef, cloud_mask, im_extra, im_QA, im_nodata = preprocess_single(fn, satname, settings, polygon, dates, savetifs=False)
+    # .jpg files are rendered and written in the background while the next image is preprocessed
+    writer = TifWriter()
+    
+    try:
+        # loop through satellite list
+        for satname in metadata.keys():
 
-            # compute cloud_cover percentage (with no data pixels)
-            cloud_cover_combined = np.divide(sum(sum(cloud_mask.astype(int))),
-                                    (cloud_mask.shape[0]*cloud_mask.shape[1]))
-            if cloud_cover_combined > 0.99: # if 99% of cloudy pixels in image skip
-                continue
+            filenames = metadata[satname]['filenames']
 
-            # remove no data pixels from the cloud mask (for example L7 bands of no data should not be accounted for)
-            cloud_mask_adv = np.logical_xor(cloud_mask, im_nodata)
-            # compute updated cloud cover percentage (without no data pixels)
-            cloud_cover = np.divide(sum(sum(cloud_mask_adv.astype(int))),
-                                    (sum(sum((~im_nodata).astype(int)))))
-            # skip image if cloud cover is above threshold
-            if cloud_cover > cloud_thresh or cloud_cover == 1:
-                continue
-            # save .jpg with date and satellite in the title
-            date = filenames[i][:19]
-            plt.ioff()  # turning interactive plotting off
-            create_jpg(im_ms, cloud_mask, date, satname, filepath_jpg)
+            # loop through images
+            for i in range(len(filenames)):
+                # read and preprocess image
+                im_ms, georef, cloud_mask, im_extra, im_QA, im_nodata = preprocess_single(i, filenames, satname, settings, polygon, dates, savetifs=False)[:6]
+            
+                if im_ms is None:
+                    continue
+
+                # compute cloud_cover percentage (with no data pixels)
+                cloud_cover_combined = np.divide(sum(sum(cloud_mask.astype(int))),
+                                        (cloud_mask.shape[0]*cloud_mask.shape[1]))
+                if cloud_cover_combined > 0.99: # if 99% of cloudy pixels in image skip
+                    continue
+
+                # remove no data pixels from the cloud mask (for example L7 bands of no data should not be accounted for)
+                cloud_mask_adv = np.logical_xor(cloud_mask, im_nodata)
+                # compute updated cloud cover percentage (without no data pixels)
+                cloud_cover = np.divide(sum(sum(cloud_mask_adv.astype(int))),
+                                        (sum(sum((~im_nodata).astype(int)))))
+                # skip image if cloud cover is above threshold
+                if cloud_cover > cloud_thresh or cloud_cover == 1:
+                    continue
+                # save .jpg with date and satellite in the title, named with the image ID
+                # as well since several images can be acquired on the same date
+                date = metadata[satname]['dates'][i]
+                imagename = filenames[i].rsplit('/',1)[-1] # get characters after last /
+                if imagename.endswith('.tif'): # local image has extension in filename; remove it
+                    imagename = imagename[:-4]
+                writer.Submit(create_jpg, im_ms, cloud_mask, date, satname, filepath_jpg, imagename=imagename)
+    finally:
+        # wait for the .jpg files still being written (also if an image fails)
+        writer.Close()
 
     # print the location where the images have been saved
     print('Satellite images saved as .jpg in ' + os.path.join(filepath_data, sitename,
@@ -1332,6 +1852,47 @@ def get_reference_sl(metadata, settings, polygon, dates):
 
     return pts_coords
 
+def preprocess_cloudfreeyearcomposite_cached(fn, satname, settings, polygon):
+    """
+    Wrapper around preprocess_cloudfreeyearcomposite() which keeps each year's
+    composite in the preprocessed image store (see preprocess_single_cached()),
+    keyed by site, year, satellite and a hash of the preprocessing settings.
+    Adding a year to settings['year_list'] then only fetches that year.
+    
+    Only used if settings['composite_cache'] is True; otherwise this just 
+    calls preprocess_cloudfreeyearcomposite(). Years that are not yet over 
+    (allowing a month for late images to be ingested) are never stored, as 
+    their composites would change as new images arrive.
+
+    Parameters
+    ----------
+    Same as preprocess_cloudfreeyearcomposite().
+
+    Returns
+    -------
+    Same as preprocess_cloudfreeyearcomposite().
+
+    """
+    year = int(settings['year_list'][fn])
+    if not ('composite_cache' in settings.keys() and settings['composite_cache']):
+        return preprocess_cloudfreeyearcomposite(fn, satname, settings, polygon)
+    if datetime.utcnow() < datetime(year+1, 2, 1):
+        return preprocess_cloudfreeyearcomposite(fn, satname, settings, polygon)
+    
+    cachepath = preprocess_cache_path(satname+'_composite_'+str(year), satname, settings, polygon)
+    if os.path.isfile(cachepath+'.json'):
+        try:
+            return load_preprocessed(cachepath)[:6]
+        except (OSError, ValueError, KeyError):
+            print(' - cached composite unreadable, preprocessing again')
+    
+    composite = preprocess_cloudfreeyearcomposite(fn, satname, settings, polygon)
+    # stored with an empty acquisition time, to match preprocess_single() outputs
+    save_preprocessed(cachepath, tuple(composite) + (None,))
+    
+    return composite
+
+
 def preprocess_cloudfreeyearcomposite(fn, satname, settings, polygon):
     """
     In development
@@ -555,7 +555,9 @@ def find_wl_contours2(im_ms, im_labels, cloud_mask, buffer_size, im_ref_buffer):
 def create_shoreline_buffer(im_shape, georef, image_epsg, pixel_size, settings, epsg):
     """
     Creates a buffer around the reference shoreline. The size of the buffer is 
-    given by settings['max_dist_ref'].
+    given by settings['max_dist_ref']. The buffer is made with a distance 
+    transform and kept for reuse by all images on the same grid (see 
+    Toolbox.BufferMaskGet()).
 
     KV WRL 2018
 
@@ -588,28 +590,32 @@ def create_shoreline_buffer(im_shape, georef, image_epsg, pixel_size, settings,
 
     if 'reference_shoreline' in settings.keys():
 
-        # convert reference shoreline to pixel coordinates
         ref_sl = settings['reference_shoreline']
-        ref_sl_conv = Toolbox.convert_epsg(ref_sl, epsg, image_epsg)[:,:-1]
-        ref_sl_pix = Toolbox.convert_world2pix(ref_sl_conv, georef)
-        ref_sl_pix_rounded = np.round(ref_sl_pix).astype(int)
-
-        # make sure that the pixel coordinates of the reference shoreline are inside the image
-        idx_row = np.logical_and(ref_sl_pix_rounded[:,0] > 0, ref_sl_pix_rounded[:,0] < im_shape[1])
-        idx_col = np.logical_and(ref_sl_pix_rounded[:,1] > 0, ref_sl_pix_rounded[:,1] < im_shape[0])
-        idx_inside = np.logical_and(idx_row, idx_col)
-        ref_sl_pix_rounded = ref_sl_pix_rounded[idx_inside,:]
-
-        # create binary image of the reference shoreline (1 where the shoreline is 0 otherwise)
-        im_binary = np.zeros(im_shape)
-        for j in range(len(ref_sl_pix_rounded)):
-            im_binary[ref_sl_pix_rounded[j,1], ref_sl_pix_rounded[j,0]] = 1
-        im_binary = im_binary.astype(bool)
-
-        # dilate the binary image to create a buffer around the reference shoreline
         max_dist_ref_pixels = np.ceil(settings['max_dist_ref']/pixel_size)
-        se = morphology.disk(max_dist_ref_pixels)
-        im_buffer = morphology.binary_dilation(im_binary, se)
+        
+        def compute():
+            # convert reference shoreline to pixel coordinates
+            ref_sl_conv = Toolbox.convert_epsg(ref_sl, epsg, image_epsg)[:,:-1]
+            ref_sl_pix = Toolbox.convert_world2pix(ref_sl_conv, georef)
+            ref_sl_pix_rounded = np.round(ref_sl_pix).astype(int)
+    
+            # make sure that the pixel coordinates of the reference shoreline are inside the image
+            idx_row = np.logical_and(ref_sl_pix_rounded[:,0] > 0, ref_sl_pix_rounded[:,0] < im_shape[1])
+            idx_col = np.logical_and(ref_sl_pix_rounded[:,1] > 0, ref_sl_pix_rounded[:,1] < im_shape[0])
+            idx_inside = np.logical_and(idx_row, idx_col)
+            ref_sl_pix_rounded = ref_sl_pix_rounded[idx_inside,:]
+    
+            # create binary image of the reference shoreline (True where the shoreline is)
+            im_binary = np.zeros(im_shape, dtype=bool)
+            im_binary[ref_sl_pix_rounded[:,1], ref_sl_pix_rounded[:,0]] = True
+    
+            # buffer the reference shoreline (same as dilating with a disk)
+            return Toolbox.BufferBinary(im_binary, max_dist_ref_pixels)
+        
+        # the buffer is the same for every image on the same grid, so it is only made once
+        key = ('points', tuple(map(float, georef)), tuple(im_shape), float(max_dist_ref_pixels), 
+               epsg, image_epsg, Toolbox.ArrayHash(ref_sl))
+        im_buffer = Toolbox.BufferMaskGet(key, compute, settings)
 
     return im_buffer
 
@@ -12,6 +12,7 @@ import numpy as np
 import matplotlib.pyplot as plt
 import pdb
 import glob
+import tempfile
 
 # other modules
 from osgeo import gdal, osr
@@ -19,9 +20,14 @@ import pandas as pd
 import geopandas as gpd
 from shapely import geometry
 from shapely.geometry import Point, Polygon, LineString, MultiLineString, MultiPoint
+try: # vectorised geometry creation (shapely >= 2.0)
+    from shapely import linestrings, multipoints
+except ImportError:
+    linestrings, multipoints = None, None
 import folium
 
 import skimage.transform as transform
+from scipy import ndimage
 from astropy.convolution import convolve
 from datetime import datetime, timedelta
 from IPython.display import clear_output
@@ -29,6 +35,13 @@ import ee
 
 import pickle
 import math
+import sqlite3
+import json
+import hashlib
+import threading
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from concurrent.futures import TimeoutError as FuturesTimeoutError
 import requests
 from requests.auth import HTTPBasicAuth
 
@@ -591,6 +604,101 @@ def remove_duplicates(output):
         print('0 duplicates')
         return output
 
+class DateIndex:
+    """
+    Sorted index of dates, for answering batches of nearest, before/after and
+    within-tolerance date queries with binary searches instead of scanning
+    the full list of dates for each query.
+    
+    Query results are positions in the original (unsorted) list of dates, 
+    with -1 where no date matches. Where a date is repeated, the position of 
+    its first occurrence is returned.
+    """
+    
+    def __init__(self, Dates):
+        """
+        Parameters
+        ----------
+        Dates : list
+            Dates to index (datetimes, np.datetime64s or '%Y-%m-%d' strings).
+        """
+        self.Dates = DateIndex.ToDatetime64(Dates)
+        self.Order = np.argsort(self.Dates, kind='stable')
+        self.Sorted = self.Dates[self.Order]
+        # position in sorted array of first occurrence of each date
+        self.First = np.searchsorted(self.Sorted, self.Sorted, side='left')
+    
+    def __len__(self):
+        return len(self.Dates)
+    
+    @staticmethod
+    def ToDatetime64(Dates):
+        """
+        Convert dates (timezone aware dates are converted to UTC) to a 
+        datetime64[ns] array.
+        """
+        Dates = np.atleast_1d(np.asarray(Dates, dtype=object) if not isinstance(Dates, np.ndarray) else Dates)
+        if len(Dates) == 0:
+            return np.array([], dtype='datetime64[ns]')
+        return pd.to_datetime(Dates.ravel(), utc=True).tz_localize(None).values
+    
+    def Before(self, Targets, Inclusive=True):
+        """
+        Position of latest date before (or on, if Inclusive) each target date.
+        """
+        Targets = DateIndex.ToDatetime64(Targets)
+        Pos = np.searchsorted(self.Sorted, Targets, side='right' if Inclusive else 'left') - 1
+        return self._ToOriginal(Pos, Pos >= 0)
+    
+    def After(self, Targets, Inclusive=True):
+        """
+        Position of earliest date after (or on, if Inclusive) each target date.
+        """
+        Targets = DateIndex.ToDatetime64(Targets)
+        Pos = np.searchsorted(self.Sorted, Targets, side='left' if Inclusive else 'right')
+        return self._ToOriginal(Pos, Pos < len(self.Sorted))
+    
+    def Nearest(self, Targets, Tolerance=None):
+        """
+        Position of nearest date to each target date (earlier date used on 
+        ties). If Tolerance (timedelta) is given, dates further than this 
+        from the target are not matched.
+        """
+        Targets = DateIndex.ToDatetime64(Targets)
+        Pos = np.searchsorted(self.Sorted, Targets, side='left')
+        Prev = np.clip(Pos - 1, 0, None)
+        Next = np.clip(Pos, None, len(self.Sorted) - 1)
+        Valid = np.full(len(Targets), len(self.Sorted) > 0)
+        if not Valid.any():
+            return np.full(len(Targets), -1)
+        PrevDiff = np.where(Pos > 0, Targets - self.Sorted[Prev], np.timedelta64(2**62,'ns'))
+        NextDiff = np.where(Pos < len(self.Sorted), self.Sorted[Next] - Targets, np.timedelta64(2**62,'ns'))
+        UsePrev = PrevDiff <= NextDiff
+        Pos = np.where(UsePrev, Prev, Next)
+        if Tolerance is not None:
+            Valid &= np.where(UsePrev, PrevDiff, NextDiff) <= np.timedelta64(pd.Timedelta(Tolerance))
+        return self._ToOriginal(Pos, Valid)
+    
+    def Within(self, Targets, Tolerance):
+        """
+        Positions of all dates within Tolerance (timedelta) of each target
+        date, as one array per target.
+        """
+        Targets = DateIndex.ToDatetime64(Targets)
+        Tolerance = np.timedelta64(pd.Timedelta(Tolerance))
+        Lo = np.searchsorted(self.Sorted, Targets - Tolerance, side='left')
+        Hi = np.searchsorted(self.Sorted, Targets + Tolerance, side='right')
+        return [np.sort(self.Order[L:H]) for L, H in zip(Lo, Hi)]
+    
+    def _ToOriginal(self, Pos, Valid):
+        """
+        Convert positions in sorted array to positions in original dates.
+        """
+        Pos = np.where(Valid, Pos, 0)
+        if len(self.Sorted) == 0:
+            return np.full(len(Pos), -1)
+        return np.where(Valid, self.Order[self.First[Pos]], -1)
+
 def get_closest_datapoint(dates, dates_ts, values_ts):
     """
     Extremely efficient script to get closest data point to a set of dates from a very
@@ -620,16 +728,11 @@ def get_closest_datapoint(dates, dates_ts, values_ts):
     if dates[0] < dates_ts[0] or dates[-1] > dates_ts[-1]: 
         raise Exception('Time-series do not cover the range of your input dates')
     
-    # get closest point to each date (no interpolation)
-    temp = []
-    def find(item, lst):
-        start = 0
-        start = lst.index(item, start)
-        return start
-    for i,date in enumerate(dates):
-        print('\rExtracting closest points: %d%%' % int((i+1)*100/len(dates)), end='')
-        temp.append(values_ts[find(min(item for item in dates_ts if item > date), dates_ts)])
-    values = np.array(temp)
+    # get first point after each date (no interpolation)
+    idx = DateIndex(dates_ts).After(dates, Inclusive=False)
+    if np.any(idx == -1):
+        raise Exception('Time-series do not cover the range of your input dates')
+    values = np.asarray(values_ts)[idx]
     
     return values
 
@@ -715,38 +818,24 @@ def output_to_gdf(output, geomtype):
   
     """    
      
-    # loop through the mapped shorelines
-    counter = 0
-    for i in range(len(output['shorelines'])):
-        # skip if there shoreline is empty 
-        if len(output['shorelines'][i]) == 0:
-            continue
-        else:
-            # save the geometry depending on the linestyle
-            if geomtype == 'lines':
-                for j in range (len(output['shorelines'][i])):
-                    abbba = []
-                    abbba.append(output['shorelines'][i][j][1])
-                    abbba.append(output['shorelines'][i][j][0])
-                    output['shorelines'][i][j] = abbba
-                geom = geometry.LineString(output['shorelines'][i])
-            elif geomtype == 'points':
-                coords = output['shorelines'][i]
-                geom = geometry.MultiPoint([(coords[_,1], coords[_,0]) for _ in range(coords.shape[0])])
-            else:
-                raise Exception('geomtype %s is not an option, choose between lines or points'%geomtype)
-            # save into geodataframe with attributes
-            gdf = gpd.GeoDataFrame(geometry=gpd.GeoSeries(geom))
-            gdf.index = [i]
-            gdf.loc[i,'date'] = datetime.strftime(datetime.strptime(output['dates'][0],'%Y-%m-%d'),'%Y-%m-%d %H:%M:%S')
-            gdf.loc[i,'satname'] = output['satname'][i]
-            gdf.loc[i,'cloud_cover'] = output['cloud_cover'][i]
-            # store into geodataframe
-            if counter == 0:
-                gdf_all = gdf
-            else:
-                gdf_all = gdf_all.append(gdf)
-            counter = counter + 1
+    if geomtype not in ['lines','points']:
+        raise Exception('geomtype %s is not an option, choose between lines or points'%geomtype)
+    
+    # skip empty shorelines, keeping index of each mapped shoreline
+    idx = [i for i in range(len(output['shorelines'])) if len(output['shorelines'][i]) != 0]
+    # swap coordinate order of each shoreline (row, col to x, y)
+    coords = [np.asarray(output['shorelines'][i])[:,[1,0]] for i in idx]
+    # save the geometry depending on the linestyle
+    if geomtype == 'lines':
+        geoms = CoordsToGeoms(coords, linestrings, geometry.LineString)
+    else:
+        geoms = CoordsToGeoms(coords, multipoints, geometry.MultiPoint)
+    
+    # save into geodataframe with attributes
+    gdf_all = gpd.GeoDataFrame(geometry=gpd.GeoSeries(geoms, index=idx))
+    gdf_all['date'] = datetime.strftime(datetime.strptime(output['dates'][0],'%Y-%m-%d'),'%Y-%m-%d %H:%M:%S')
+    gdf_all['satname'] = [output['satname'][i] for i in idx]
+    gdf_all['cloud_cover'] = np.array([output['cloud_cover'][i] for i in idx], dtype=float)
             
     return gdf_all
 
@@ -768,21 +857,46 @@ def transects_to_gdf(transects):
         
     """  
        
-    # loop through the mapped shorelines
-    for i,key in enumerate(list(transects.keys())):
-        # save the geometry + attributes
-        geom = geometry.LineString(transects[key])
-        gdf = gpd.GeoDataFrame(geometry=gpd.GeoSeries(geom))
-        gdf.index = [i]
-        gdf.loc[i,'name'] = key
-        # store into geodataframe
-        if i == 0:
-            gdf_all = gdf
-        else:
-            gdf_all = gdf_all.append(gdf)
+    keys = list(transects.keys())
+    # save the geometry + attributes
+    geoms = CoordsToGeoms([np.asarray(transects[key]) for key in keys], linestrings, geometry.LineString)
+    gdf_all = gpd.GeoDataFrame(geometry=gpd.GeoSeries(geoms, index=range(len(keys))))
+    gdf_all['name'] = keys
             
     return gdf_all
 
+def CoordsToGeoms(coords, vectorfunc, geomclass):
+    """
+    Create a list of geometries from a list of coordinate arrays. With 
+    shapely >= 2.0, all geometries are created in one call from a single 
+    buffer of coordinates; otherwise they are created one by one.
+
+    Parameters
+    ----------
+    coords : list
+        Arrays of x,y coordinates, one per geometry.
+    vectorfunc : function or None
+        Vectorised shapely constructor (e.g. shapely.linestrings).
+    geomclass : class
+        Shapely geometry class to fall back on (e.g. LineString).
+
+    Returns
+    -------
+    geoms : list
+        Shapely geometries.
+
+    """
+    if len(coords) == 0:
+        return []
+    if vectorfunc is None:
+        return [geomclass(coord) for coord in coords]
+    # ragged buffer of all coordinates, with index of geometry each belongs to
+    allcoords = np.concatenate([np.asarray(coord, dtype=float) for coord in coords])
+    indices = np.repeat(np.arange(len(coords)), [len(coord) for coord in coords])
+    
+    return list(vectorfunc(allcoords, indices=indices))
+
+
 def get_image_bounds(fn):
     """
     Returns a polygon with the bounds of the image in the .tif file
@@ -872,6 +986,29 @@ def CreateFileStructure(sitename, sat_list):
 
 
 def metadata_collection(inputs, Sat):
+    """
+    Collect filenames, dates, epsg codes, georeferencing accuracy and cloud 
+    cover for every image in each satellite collection, and cache them in 
+    <sitename>_metadata.pkl. The properties of all collections are reduced
+    server-side and fetched in a single request. If inputs['update_metadata']
+    is True and a cached file exists, only images acquired on or after the 
+    last cached date of each satellite are requested (filtered on 
+    system:time_start), and those not already cached are appended.
+    
+    Arguments:
+    -----------
+    inputs: dict
+        inputs dictionnary (sat_list, filepath, sitename and optionally
+        update_metadata)
+    Sat: list
+        list of ee.ImageCollection, one per satellite in sat_list
+        
+    Returns:
+    -----------
+    metadata: dict
+        dict of filenames, acc_georef, epsg, dates and cloud_cover per satellite
+        
+    """
     
     sat_list = inputs['sat_list']
     filepath_data = inputs['filepath']
@@ -885,36 +1022,53 @@ def metadata_collection(inputs, Sat):
     else: 
         filename = sitename + '_metadata.pkl'
         filepath = os.path.join(filepath_data, sitename)
+        update = 'update_metadata' in inputs.keys() and inputs['update_metadata']
         
         if filename in os.listdir(filepath):
-            print('Metadata already exists and was loaded')
             with open(os.path.join(filepath, filename), 'rb') as f:
                 metadata = pickle.load(f)
-            return metadata
+            if not update:
+                print('Metadata already exists and was loaded')
+                return metadata
+            print('Metadata already exists, updating with new images')
+        else:
+            metadata = dict([])
         
-        metadata = dict([])
-    
+        Collections = []
         for i in range(len(sat_list)):
-            metadata[sat_list[i]] = {'filenames':[], 'acc_georef':[], 'epsg':[], 'dates':[]}
-    
-        for i in range(len(Sat)):
-            Features = Sat[i].getInfo().get('features')
-            for j in range(len(Features)):
-                Feature = Features[j]
-                if sat_list[i] != 'S2':
-                    metadata[sat_list[i]]['filenames'].append(Feature['id'])
-                    metadata[sat_list[i]]['acc_georef'].append(Feature['properties']['GEOMETRIC_RMSE_MODEL'])
-                    metadata[sat_list[i]]['epsg'].append(int(Feature['bands'][0]['crs'].lstrip('EPSG:')))
-                    metadata[sat_list[i]]['dates'].append(Feature['properties']['DATE_ACQUIRED'])
-                else:
-                    metadata[sat_list[i]]['filenames'].append(Feature['id'])
-                    metadata[sat_list[i]]['acc_georef'].append(Feature['bands'][1]['crs_transform'])
-                    metadata[sat_list[i]]['epsg'].append(int(Feature['bands'][1]['crs'].lstrip('EPSG:')))
-                    d = datetime.strptime(Feature['properties']['DATATAKE_IDENTIFIER'][5:13],'%Y%m%d')
-                    metadata[sat_list[i]]['dates'].append(str(d.strftime('%Y-%m-%d')))
-                
-                print('\r'+sat_list[i],": ",round(100*(j+1)/len(Features)),'%   ', end='')
-            print("Done")
+            if sat_list[i] not in metadata.keys():
+                metadata[sat_list[i]] = {'filenames':[], 'acc_georef':[], 'epsg':[], 'dates':[], 'cloud_cover':[]}
+            elif 'cloud_cover' not in metadata[sat_list[i]].keys():
+                # caches from before cloud cover was collected
+                metadata[sat_list[i]]['cloud_cover'] = [np.nan]*len(metadata[sat_list[i]]['filenames'])
+            Collection = Sat[i]
+            if len(metadata[sat_list[i]]['dates']) > 0:
+                # only request images from the start of the last cached date onwards
+                # (filterDate() with no end date would only cover 1ms)
+                lastdate = ee.Date(max(metadata[sat_list[i]]['dates'])).millis()
+                Collection = Collection.filter(ee.Filter.gte('system:time_start', lastdate))
+            Collections.append(CollectionMetadata(Collection, sat_list[i]))
+        
+        # one request for the properties of every collection
+        print('Requesting image metadata...')
+        SatRows = GetInfoRetry(ee.List(Collections))
+        
+        for i in range(len(sat_list)):
+            satmeta = metadata[sat_list[i]]
+            known = set(satmeta['filenames'])
+            newcount = 0
+            for ID, acc, crs, date, cloud in SatRows[i]:
+                if ID in known:
+                    continue
+                if sat_list[i] == 'S2':
+                    date = datetime.strptime(date[5:13],'%Y%m%d').strftime('%Y-%m-%d')
+                satmeta['filenames'].append(ID)
+                satmeta['acc_georef'].append(acc)
+                satmeta['epsg'].append(int(crs.lstrip('EPSG:')))
+                satmeta['dates'].append(date)
+                satmeta['cloud_cover'].append(cloud if cloud >= 0 else np.nan)
+                newcount += 1
+            print(sat_list[i]+': '+str(newcount)+' new images')
         
         with open(os.path.join(filepath, sitename + '_metadata.pkl'), 'wb') as f:
             pickle.dump(metadata, f)
@@ -922,7 +1076,114 @@ def metadata_collection(inputs, Sat):
     return metadata
 
 
+def CollectionMetadata(Collection, satname):
+    """
+    Server-side reduction of an image collection to one row per image of
+    [ID, georef accuracy, crs, date, cloud cover]. Nothing is requested until
+    .getInfo() is called on the result (or on a list containing it).
+    Landsat rows hold the GEOMETRIC_RMSE_MODEL (12m if missing) and the crs of
+    the first band; S2 rows hold the crs transform and crs of the 20m band and 
+    the raw DATATAKE_IDENTIFIER in place of the date. Missing cloud cover is -1.
+    
+    Arguments:
+    -----------
+    Collection: ee.ImageCollection
+        collection of satellite images
+    satname: str
+        name of satellite platform (e.g. 'L8', 'S2')
+        
+    Returns:
+    -----------
+    ee.List
+        list of per-image rows
+        
+    """
+    if satname == 'S2':
+        bandnum, datekey, cloudkey = 1, 'DATATAKE_IDENTIFIER', 'CLOUDY_PIXEL_PERCENTAGE'
+    else:
+        bandnum, datekey, cloudkey = 0, 'DATE_ACQUIRED', 'CLOUD_COVER'
+    
+    def ImageRow(image):
+        # same band description as returned by getInfo() on the image
+        band = ee.Dictionary(ee.List(ee.Dictionary(ee.Algorithms.Describe(image)).get('bands')).get(bandnum))
+        props = image.toDictionary()
+        if satname == 'S2':
+            acc = band.get('crs_transform')
+        else:
+            acc = props.get('GEOMETRIC_RMSE_MODEL', 12)
+        row = ee.List([image.get('system:id'), acc, band.get('crs'), 
+                       props.get(datekey), props.get(cloudkey, -1)])
+        return image.set('metadata_row', row)
+    
+    return Collection.map(ImageRow).aggregate_array('metadata_row')
+
+
         
+# parts of the messages of Earth Engine errors that are worth retrying (server busy
+# or unavailable, rate limits); other errors (missing assets, bad arguments,
+# authentication) won't go away by waiting, so are raised straight away
+EE_TRANSIENT_ERRORS = ['too many concurrent', 'too many requests', 'rate limit', 'quota exceeded',
+                       'computation timed out', 'deadline exceeded', 'service unavailable',
+                       'temporarily unavailable', 'bad gateway', 'gateway timeout',
+                       'internal server error', 'internal error', 'backend error']
+
+
+def TransientError(error):
+    """
+    True if a failed Earth Engine request is worth retrying: network errors 
+    and timeouts, or an error whose message is in EE_TRANSIENT_ERRORS.
+    """
+    if isinstance(error, OSError): # includes TimeoutError and ConnectionError
+        return True
+    message = str(error).lower()
+    return any(key in message for key in EE_TRANSIENT_ERRORS)
+
+
+def GetInfoRetry(eeobject, retries=6, backoff=1, max_backoff=32, timeout=300):
+    """
+    Call getInfo() on an Earth Engine object, retrying failed or timed out 
+    requests after an exponentially increasing wait (capped at max_backoff).
+    Only transient errors are retried (see TransientError()); others, and 
+    the last error once all attempts are used up, are raised.
+    
+    Arguments:
+    -----------
+    eeobject: ee.ComputedObject
+        Earth Engine object to evaluate (collection, list, dictionary...)
+    retries: int
+        number of attempts before giving up
+    backoff: float
+        wait (in seconds) after the first failure, doubled after each failure
+    max_backoff: float
+        longest wait between attempts (in seconds)
+    timeout: float
+        time (in seconds) to wait for each attempt to return
+        
+    Returns:
+    -----------
+    info: dict or list
+        result of eeobject.getInfo()
+        
+    """
+    for attempt in range(retries):
+        # run on a separate thread so a hung request can be abandoned
+        executor = ThreadPoolExecutor(max_workers=1)
+        try:
+            return executor.submit(eeobject.getInfo).result(timeout=timeout)
+        except Exception as e:
+            if isinstance(e, FuturesTimeoutError):
+                error = TimeoutError('getInfo() took longer than %ss' % timeout)
+            else:
+                error = e
+        finally:
+            executor.shutdown(wait=False)
+        if not TransientError(error):
+            raise error
+        if attempt < retries-1:
+            time.sleep(min(backoff * 2**attempt, max_backoff))
+    raise error
+
+
 def image_retrieval(inputs):
     
     point = ee.Geometry.Point(inputs['polygon'][0][0])
@@ -935,7 +1196,7 @@ def image_retrieval(inputs):
         cloud_thresh = 90
         
     if 'L5' in inputs['sat_list']:
-        Landsat5 = ee.ImageCollection("LANDSAT/LT05/C01/T1_TOA").filterBounds(point).filterDate(inputs['dates'][0], inputs['dates'][1])
+        Landsat5 = ee.ImageCollection("LANDSAT/LT05/C01/T1_TOA").filterBounds(point).filterDate(inputs['dates'][0], inputs['dates'][1]).filter(ee.Filter.lt('CLOUD_COVER', cloud_thresh))
         Sat.append(Landsat5)
     if 'L7' in inputs['sat_list']:
         Landsat7 = ee.ImageCollection('LANDSAT/LE07/C02/T1_TOA').filterBounds(point).filterDate(inputs['dates'][0], inputs['dates'][1]).filter(ee.Filter.lt('CLOUD_COVER', cloud_thresh))
@@ -943,6 +1204,9 @@ def image_retrieval(inputs):
     if 'L8' in inputs['sat_list']:
         Landsat8 = ee.ImageCollection('LANDSAT/LC08/C01/T1_TOA').filterBounds(point).filterDate(inputs['dates'][0], inputs['dates'][1]).filter(ee.Filter.lt('CLOUD_COVER', cloud_thresh))
         Sat.append(Landsat8)
+    if 'L9' in inputs['sat_list']:
+        Landsat9 = ee.ImageCollection('LANDSAT/LC09/C02/T1_TOA').filterBounds(point).filterDate(inputs['dates'][0], inputs['dates'][1]).filter(ee.Filter.lt('CLOUD_COVER', cloud_thresh))
+        Sat.append(Landsat9)
     if 'S2' in inputs['sat_list']:
         Sentinel2 = ee.ImageCollection("COPERNICUS/S2").filterBounds(point).filterDate(inputs['dates'][0], inputs['dates'][1]).filter(ee.Filter.lte('CLOUDY_PIXEL_PERCENTAGE', cloud_thresh))
         Sat.append(Sentinel2)
@@ -989,29 +1253,110 @@ def LocalImageMetadata(inputs, Sat):
     for i in range(len(inputs['sat_list'])):
         metadata[inputs['sat_list'][i]] = {'filenames':[], 'acc_georef':[], 'epsg':[], 'dates':[]}
 
+    # image headers are read in parallel, and reused from the index for unchanged files
+    indexpath = os.path.join(filepath, inputs['sitename'] + '_localheaders.sqlite')
+    
     # for i in range(len(Sat[0])):
-    for i in range(1):    
+    for i in range(1):
+        headers = ScanLocalHeaders(Sat[i], indexpath)
         for j in range(len(Sat[i])):
             
-            imdata = rasterio.open(Sat[i][j])
+            transform, crs = headers[Sat[i][j]]
             
             metadata[inputs['sat_list'][i]]['filenames'].append(Sat[i][j])
             
-            metadata[inputs['sat_list'][i]]['acc_georef'].append(list(imdata.transform)[0:6])
+            metadata[inputs['sat_list'][i]]['acc_georef'].append(transform)
             
-            metadata[inputs['sat_list'][i]]['epsg'].append(str(imdata.crs).lstrip('EPSG:'))
+            metadata[inputs['sat_list'][i]]['epsg'].append(crs.lstrip('EPSG:'))
             
             date = datetime.strptime(os.path.basename(Sat[i][j])[0:8],'%Y%m%d') #relies on date being YYYYMMDD first in filename
             metadata[inputs['sat_list'][i]]['dates'].append(str(date.strftime('%Y-%m-%d')))
             
-            
-            print(inputs['sat_list'][i],": ",(100*(j+1)/len(Sat[i])),'%', end='')
+        print(inputs['sat_list'][i],": ",len(Sat[i]),' images')
     
     with open(os.path.join(filepath, inputs['sitename'] + '_metadata.pkl'), 'wb') as f:
         pickle.dump(metadata, f)
         
     return metadata
 
+
+def ReadLocalHeader(impath):
+    """
+    Read the georeferencing of a local image from its header only (no pixel
+    data is read).
+    
+    Arguments:
+    -----------
+    impath: str
+        path to image file
+        
+    Returns:
+    -----------
+    transform: list
+        first 6 elements of the image's affine transform
+    crs: str
+        image CRS as a string (e.g. 'EPSG:32630')
+        
+    """
+    # stop GDAL listing the (potentially very large) image folder on every open
+    with rasterio.Env(GDAL_DISABLE_READDIR_ON_OPEN='EMPTY_DIR'):
+        with rasterio.open(impath) as imdata:
+            return list(imdata.transform)[0:6], str(imdata.crs)
+
+
+def ScanLocalHeaders(impaths, indexpath, n_workers=8):
+    """
+    Get the georeferencing of many local images, backed by a persistent SQLite
+    index keyed by path, modification time and size. Only new or changed files
+    are opened, and those are read in parallel across a pool of threads.
+    
+    Arguments:
+    -----------
+    impaths: list
+        paths to image files
+    indexpath: str
+        path to SQLite index file (created if it doesn't exist)
+    n_workers: int
+        number of threads used to read image headers
+        
+    Returns:
+    -----------
+    headers: dict
+        (transform, crs) for each path, as returned by ReadLocalHeader()
+        
+    """
+    con = sqlite3.connect(indexpath)
+    try:
+        con.execute("CREATE TABLE IF NOT EXISTS headers "
+                    "(path TEXT PRIMARY KEY, mtime REAL, size INTEGER, transform TEXT, crs TEXT)")
+        indexed = {row[0]:row[1:] for row in con.execute("SELECT path, mtime, size, transform, crs FROM headers")}
+        
+        headers = dict([])
+        stale = []
+        stats = dict([])
+        for impath in impaths:
+            stat = os.stat(impath)
+            stats[impath] = (stat.st_mtime, stat.st_size)
+            row = indexed.get(impath)
+            if row is not None and (row[0], row[1]) == stats[impath]:
+                headers[impath] = (json.loads(row[2]), row[3])
+            else:
+                stale.append(impath)
+        
+        if len(stale) > 0:
+            print('Reading headers of %d new or changed images...' % len(stale))
+            with ThreadPoolExecutor(max_workers=n_workers) as executor:
+                for impath, header in zip(stale, executor.map(ReadLocalHeader, stale)):
+                    headers[impath] = header
+            con.executemany("INSERT OR REPLACE INTO headers VALUES (?, ?, ?, ?, ?)",
+                            [(impath, stats[impath][0], stats[impath][1], 
+                              json.dumps(headers[impath][0]), headers[impath][1]) for impath in stale])
+            con.commit()
+    finally:
+        con.close()
+    
+    return headers
+
 def PlanetImageRetrieval(inputs):
     '''
     Finds Planet imagery using a valid API key and parameters to constrain the dataset.
@@ -1095,49 +1440,222 @@ def PlanetImageRetrieval(inputs):
     
     return Sat
     
-def PlanetDownload(Sat):
-    
-    idURLs = []
-    for ID in Sat[0]:
-        idURL = 'https://api.planet.com/data/v1/item-types/{}/items/{}/assets'.format('PSScene4Band', ID)
-
-        # Returns JSON metadata for assets in this ID. Learn more: planet.com/docs/reference/data-api/items-assets/#asset
-        result = \
-            requests.get(
-                idURL,
-                auth=HTTPBasicAuth(os.environ['PL_API_KEY'], '')
-                )
-        
-        # List of asset types available for this particular satellite image
-        #print(result.json().keys())
-        idURLs.append(idURL)
-        # Parse out useful links
-        links = result.json()[u'analytic']['_links']
-        selflink = links['_self']
-        activationlink = links['activate']        
-        # Activate analytic dataset
-        activateResult = \
-            requests.get(
-                activationlink,
-                auth=HTTPBasicAuth(os.environ['PL_API_KEY'], '')
-                )
-        activationStatResult = \
-            requests.get(
-                selflink,
-                auth=HTTPBasicAuth(os.environ['PL_API_KEY'], '')
-                )
-        print(activationStatResult.json()['status'])
-        while activationStatResult.json()['status'] != 'active':
-            print(ID+' is still '+activationStatResult.json()['status'])
-            time.sleep(10)
-        else:
-            break
-        # Download imagery
-        downloadlink = activationStatResult.json()["location"]
-        print(downloadlink)
+def PlanetDownload(Sat, filepath='./Data', sitename=None, asset_type='analytic', n_workers=4, max_wait=3600):
+    """
+    Activate and download Planet assets for a list of image IDs. All assets are
+    activated up front and their status is polled with exponential backoff 
+    (rather than a tight loop on each image in turn); active assets are then 
+    downloaded concurrently across a bounded pool of threads. Progress is 
+    recorded in a JSON manifest, so an interrupted run can be restarted: 
+    finished files are skipped and partial files are resumed with HTTP range
+    requests.
+    
+    Arguments:
+    -----------
+    Sat: list
+        list containing a list of Planet image IDs (from PlanetImageRetrieval)
+    filepath: str
+        path to Data folder
+    sitename: str
+        name of site; images are saved to <filepath>/<sitename>/local_images/PlanetScope.
+        If None, only activation is run and nothing is downloaded
+    asset_type: str
+        Planet asset to activate and download
+    n_workers: int
+        maximum number of simultaneous downloads
+    max_wait: float
+        maximum time (in seconds) to wait for assets to activate
+        
+    Returns:
+    -----------
+    idURLs: list
+        asset URLs for each image ID
+        
+    """
+    auth = HTTPBasicAuth(os.environ['PL_API_KEY'], '')
+    idURLs = ['https://api.planet.com/data/v1/item-types/{}/items/{}/assets'.format('PSScene4Band', ID) for ID in Sat[0]]
+    
+    if sitename is not None:
+        imdir = os.path.join(filepath, sitename, 'local_images', 'PlanetScope')
+        os.makedirs(imdir, exist_ok=True)
+        manifestpath = os.path.join(imdir, 'planet_manifest.json')
+    else:
+        imdir, manifestpath = None, None
+    manifest = PlanetManifest(manifestpath)
+    
+    # request activation of every asset not already downloaded
+    selflinks = {}
+    for ID, idURL in zip(Sat[0], idURLs):
+        if manifest.Get(ID, 'status') == 'done':
+            continue
+        try:
+            # Returns JSON metadata for assets in this ID. Learn more: planet.com/docs/reference/data-api/items-assets/#asset
+            asset = PlanetRequest('get', idURL, auth=auth).json()[asset_type]
+            selflinks[ID] = asset['_links']['_self']
+            if asset['status'] == 'active':
+                manifest.Update(ID, status='active', location=asset['location'])
+            else:
+                PlanetRequest('get', asset['_links']['activate'], auth=auth)
+                manifest.Update(ID, status='activating')
+        except requests.RequestException as e:
+            # skipped for this run only, so one bad item doesn't stop the rest
+            print('\nActivation of %s failed: %s' % (ID, e))
+    
+    # poll activation status, backing off between rounds
+    delay, waited = 5, 0
+    pending = [ID for ID in selflinks if manifest.Get(ID, 'status') == 'activating']
+    while len(pending) > 0 and waited < max_wait:
+        print('\rWaiting for %d of %d assets to activate...' % (len(pending), len(selflinks)), end='')
+        time.sleep(delay)
+        waited += delay
+        delay = min(delay*2, 120)
+        for ID in pending:
+            try:
+                asset = PlanetRequest('get', selflinks[ID], auth=auth).json()
+            except requests.RequestException:
+                continue # polled again next round
+            if asset['status'] == 'active':
+                manifest.Update(ID, status='active', location=asset['location'])
+        pending = [ID for ID in pending if manifest.Get(ID, 'status') == 'activating']
+    if len(pending) > 0:
+        print('\n%d assets were not activated within %ds; rerun to resume' % (len(pending), max_wait))
+    
+    if imdir is None:
+        return idURLs
+    
+    # download active assets concurrently
+    active = [ID for ID in Sat[0] if manifest.Get(ID, 'status') == 'active']
+    def Fetch(ID):
+        impath = os.path.join(imdir, ID + '.tif')
+        try:
+            size = PlanetFetchAsset(manifest.Get(ID, 'location'), impath, auth)
+            manifest.Update(ID, status='done', path=impath, size=size)
+        except Exception as e:
+            # left as active so the next run resumes the partial file
+            print('\nDownload of %s failed: %s' % (ID, e))
+    with ThreadPoolExecutor(max_workers=n_workers) as executor:
+        for i, _ in enumerate(executor.map(Fetch, active)):
+            print('\rDownloading: %d/%d' % (i+1, len(active)), end='')
+    print('\n%d of %d images downloaded' % (len([ID for ID in Sat[0] if manifest.Get(ID, 'status') == 'done']), len(Sat[0])))
         
     return idURLs
 
+
+class PlanetManifest:
+    """
+    Thread-safe record of Planet asset states (activating/active/done),
+    rewritten to a JSON file on every update so progress survives interruption.
+    """
+    def __init__(self, path=None):
+        self.path = path
+        self.lock = threading.Lock()
+        self.entries = {}
+        if path is not None and os.path.exists(path):
+            with open(path) as f:
+                self.entries = json.load(f)
+    
+    def Get(self, ID, key):
+        with self.lock:
+            return self.entries.get(ID, {}).get(key)
+    
+    def Update(self, ID, **kwargs):
+        with self.lock:
+            self.entries.setdefault(ID, {}).update(kwargs)
+            if self.path is not None:
+                # write to temp file first so a crash never leaves a truncated manifest
+                with open(self.path + '.tmp', 'w') as f:
+                    json.dump(self.entries, f, indent=1)
+                os.replace(self.path + '.tmp', self.path)
+
+
+def PlanetRequest(method, url, retries=5, backoff=2, **kwargs):
+    """
+    HTTP request to the Planet API, retried with exponential backoff on 
+    connection errors, rate limiting (429) and server errors (5xx).
+    
+    Arguments:
+    -----------
+    method: str
+        HTTP method ('get', 'post')
+    url: str
+        request URL
+    retries: int
+        number of attempts before giving up
+    backoff: float
+        initial wait between attempts (in seconds), doubled after each failure
+    **kwargs:
+        passed on to requests.request (auth, json, headers, stream...)
+        
+    Returns:
+    -----------
+    response: requests.Response
+        
+    """
+    kwargs.setdefault('timeout', 60)
+    for attempt in range(retries):
+        try:
+            response = requests.request(method, url, **kwargs)
+            if response.status_code != 429 and response.status_code < 500:
+                response.raise_for_status()
+                return response
+            error = requests.HTTPError('%d response from %s' % (response.status_code, url))
+        except (requests.ConnectionError, requests.Timeout) as e:
+            error = e
+        if attempt < retries-1:
+            time.sleep(backoff * 2**attempt)
+    raise error
+
+
+def PlanetFetchAsset(url, impath, auth, chunksize=2**16):
+    """
+    Stream a Planet asset to file, resuming from a previous partial download 
+    (<impath>.part) with an HTTP range request where possible. The file is only
+    moved to impath once complete.
+    
+    Arguments:
+    -----------
+    url: str
+        asset download location
+    impath: str
+        path to save file to
+    auth: requests.auth.HTTPBasicAuth
+        Planet API authentication
+    chunksize: int
+        number of bytes written at a time
+        
+    Returns:
+    -----------
+    size: int
+        size of the downloaded file in bytes
+        
+    """
+    partpath = impath + '.part'
+    start = os.path.getsize(partpath) if os.path.exists(partpath) else 0
+    headers = {'Range': 'bytes=%d-' % start} if start > 0 else {}
+    try:
+        response = PlanetRequest('get', url, auth=auth, headers=headers, stream=True)
+    except requests.HTTPError as e:
+        # range starts at the end of the file, so the partial file is already complete
+        if start > 0 and e.response is not None and e.response.status_code == 416:
+            os.replace(partpath, impath)
+            return os.path.getsize(impath)
+        raise
+    with response:
+        # servers that ignore the range send the whole file again
+        if response.status_code == 206:
+            mode = 'ab'
+            total = response.headers.get('Content-Range', '*').split('/')[-1]
+        else:
+            mode = 'wb'
+            total = response.headers.get('Content-Length', '*')
+        with open(partpath, mode) as f:
+            for chunk in response.iter_content(chunk_size=chunksize):
+                f.write(chunk)
+    if total.isdigit() and os.path.getsize(partpath) != int(total):
+        raise IOError('incomplete download (%d of %s bytes)' % (os.path.getsize(partpath), total))
+    os.replace(partpath, impath)
+    return os.path.getsize(impath)
+
 def PlanetMetadata(sat_list, Sat, filepath_data, sitename):
     
     filename = sitename + '_metadata.pkl'
@@ -1415,21 +1933,21 @@ def NearestDates(surveys,metadata,sat_list):
 
     for sat in sat_list:
         print(sat,'SATELLITE')
-        satdates=[]
+        # index sat dates once and find nearest to all verification dates together
+        satdates = DateIndex([datetime.strptime(satdate,'%Y-%m-%d') for satdate in metadata[sat]['dates']])
+        nearestidx = satdates.Nearest([datetime.strptime(veridate,'%Y-%m-%d') for veridate in veridates], 
+                                      Tolerance=timedelta(days=153))
         nearestdate = []
         nearestID = []
-        for veridate in veridates:
+        for veridate, idx in zip(veridates, nearestidx):
             print('verification:\t',veridate)
-            veridate = datetime.strptime(veridate,'%Y-%m-%d')
-            for satdate in metadata[sat]['dates']:
-                satdates.append(datetime.strptime(satdate,'%Y-%m-%d'))
-            
-            print('nearest:\t\t',NearDate(veridate,satdates))
-            if NearDate(veridate,satdates) == False:
+            if idx == -1:
+                print('nearest:\t\t',False)
                 print('no image near in time.')
             else:
-                nearestdate.append(datetime.strftime(NearDate(veridate,satdates),'%Y-%m-%d'))
-                nearestID.append(metadata[sat]['dates'].index(datetime.strftime(NearDate(veridate,satdates),'%Y-%m-%d')))
+                print('nearest:\t\t',datetime.strptime(metadata[sat]['dates'][idx],'%Y-%m-%d'))
+                nearestdate.append(metadata[sat]['dates'][idx])
+                nearestID.append(int(idx))
 
         nearestdates[sat] = nearestdate
         nearestIDs[sat] = nearestID     
@@ -1552,6 +2070,133 @@ def GStoArr(shoreline):
     shorelineArr = np.array(shorelineArrList)
     return shorelineArr
 
+class BufferMasks:
+    """
+    Memoised reference-line buffer masks. The buffer around the reference line
+    is the same for every image on the same grid (nearly all images of a 
+    satellite), so masks are kept by key in an in-memory LRU and, if a folder
+    is given, on disk as .npy files. Masks are returned read-only, as the same 
+    array is shared between images.
+    """
+    def __init__(self, maxsize=32):
+        self.maxsize = maxsize
+        self.lock = threading.Lock()
+        self.masks = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+    
+    def Get(self, key, compute, cachedir=None):
+        """
+        Mask for key (a tuple of the grid, buffer and reference line hash), 
+        calling compute() only if it is neither in memory nor in cachedir.
+        """
+        keyhash = hashlib.sha1(repr(key).encode()).hexdigest()[:16]
+        with self.lock:
+            if keyhash in self.masks:
+                self.masks.move_to_end(keyhash)
+                self.hits += 1
+                return self.masks[keyhash]
+        
+        mask = None
+        if cachedir is not None:
+            path = os.path.join(cachedir, keyhash + '.npy')
+            if os.path.isfile(path):
+                try:
+                    mask = np.load(path)
+                except (OSError, ValueError):
+                    mask = None
+        if mask is None:
+            mask = compute()
+            if cachedir is not None:
+                # other threads may be making the folder at the same time
+                os.makedirs(cachedir, exist_ok=True)
+                # write to a temp file of its own first, so a crash never leaves a truncated
+                # mask and threads computing the same mask don't write over each other
+                fd, tmppath = tempfile.mkstemp(prefix=keyhash + '.', suffix='.tmp', dir=cachedir)
+                try:
+                    with os.fdopen(fd, 'wb') as f:
+                        np.save(f, mask)
+                    os.replace(tmppath, path)
+                except BaseException:
+                    if os.path.isfile(tmppath):
+                        os.remove(tmppath)
+                    raise
+        mask.setflags(write=False)
+        
+        with self.lock:
+            self.misses += 1
+            self.masks[keyhash] = mask
+            self.masks.move_to_end(keyhash)
+            while len(self.masks) > self.maxsize:
+                self.masks.popitem(last=False)
+        return mask
+
+
+# buffer masks shared by all images in a session (see BufferMaskGet())
+BUFFER_MASKS = BufferMasks()
+
+
+def BufferMaskGet(key, compute, settings):
+    """
+    Reference-line buffer mask from the shared cache, computed with compute() 
+    if missing. Masks are also stored on disk (under the site folder) if 
+    settings['buffer_cache'] is True.
+    
+    Arguments:
+    -----------
+    key: tuple
+        everything the mask depends on (georef, image shape, buffer distance, 
+        hash of the reference line; see ArrayHash())
+    compute: function
+        returns the boolean mask
+    settings: dict
+        settings dictionnary (with 'inputs', optionally 'buffer_cache')
+        
+    Returns:
+    -----------
+    mask: np.array
+        read-only boolean mask
+        
+    """
+    if 'buffer_cache' in settings.keys() and settings['buffer_cache']:
+        cachedir = os.path.join(settings['inputs']['filepath'], settings['inputs']['sitename'], 'buffer_masks')
+    else:
+        cachedir = None
+    return BUFFER_MASKS.Get(key, compute, cachedir)
+
+
+def BufferBinary(im_binary, radius):
+    """
+    Buffer of radius pixels around the True pixels of a binary image. Gives the
+    same result as a binary dilation with morphology.disk(radius), but from a
+    Euclidean distance transform, whose cost does not grow with the radius.
+
+    Arguments:
+    -----------
+    im_binary: np.array
+        boolean image, True on the pixels to buffer
+    radius: float
+        buffer distance in pixels
+
+    Returns:    
+    -----------
+    im_buffer: np.array
+        boolean image, True within radius of a True pixel of im_binary
+
+    """
+    if not im_binary.any():
+        return np.zeros(im_binary.shape, dtype=bool)
+    return ndimage.distance_transform_edt(~im_binary) <= radius
+
+
+def ArrayHash(arr):
+    """
+    Short hash of an array's values, shape and dtype (for cache keys).
+    """
+    arr = np.ascontiguousarray(arr)
+    return hashlib.sha1(arr.tobytes() + str((arr.shape, arr.dtype.str)).encode()).hexdigest()[:16]
+
+
 def ArrtoGS(refline,georef):
     """
     
@@ -1588,13 +2233,13 @@ def NearDate(target,items):
         List of datetimes.
 
     """
-    nearestDate = min(items, key=lambda x: abs(x - target))
-    
-    # # if difference is longer than 5 months, no match exists  
-    if abs((target - nearestDate).days) > 153: 
+    idx = DateIndex(items).Nearest(target)[0]
+    # if difference is longer than 5 months, no match exists  
+    # (whole days compared, so gaps up to 153 days 23 hours are still matched)
+    if idx == -1 or abs((target - items[idx]).days) > 153: 
         return False
     else:
-        return nearestDate
+        return items[idx]
 
 
 
@@ -1711,107 +2356,244 @@ def TZValues(int_veg, int_nonveg):
     
     return [minval,maxval]
 
-def QuantifyErrors(sitename, SatGDF, DatesCol,ValidDict,TransectIDs):
+def QuantifyErrors(sitename, SatGDF, DatesCol, ValidDict, TransectIDs, Breakdowns=None, Clusters=None):
+    """
+    Calculate error stats (count, MAE, RMSE, bias, R squared, counts within
+    10m and 15m) between satellite and validation lines, for each sat date
+    and in total, for a chosen range of transects. Stats are saved to CSV.
     
+    Extra breakdowns of the same errors by satellite, season or cluster of 
+    transects can be saved to their own CSVs, calculated in the same pass.
+
+    Parameters
+    ----------
+    sitename : str
+        Name of site.
+    SatGDF : GeoDataFrame
+        Sat-derived lines (only dates present in this are used).
+    DatesCol : str
+        Name of dates column in SatGDF.
+    ValidDict : dict
+        Validation dictionary created from ValidateSatIntersects().
+    TransectIDs : list
+        First and last (exclusive) transect IDs to calculate errors over.
+    Breakdowns : list, optional
+        Extra fields to group errors by, any of 'satname', 'season' or 
+        'cluster'. The default is None (per-date and total stats only).
+    Clusters : dict or array-like, optional
+        Cluster label for each transect ID, required for 'cluster' breakdown.
+
+    Returns
+    -------
+    errordf : DataFrame
+        Error stats for each sat date, plus a 'Total' row.
+
+    """
     
     filepath = os.path.join(os.getcwd(), 'Data', sitename, 'validation')
     if os.path.isdir(filepath) is False:
         os.mkdir(filepath)
-        
-    errordata = []
-    errordates = []
-    Sdates = SatGDF[DatesCol].unique()
-    
-    for Sdate in Sdates:
-        valsatdist = []
-        # for each transect in given range
-        for Tr in range(TransectIDs[0],TransectIDs[1]): 
-            if Tr > len(ValidDict['dates']): # for when transect values extend beyond what transects exist
-                print("check your chosen transect values!")
-                return
-            if Sdate in ValidDict['dates'][Tr]:
-                DateIndex = (ValidDict['dates'][Tr].index(Sdate))
-                # rare occasion where transect intersects valid line but NOT sat line (i.e. no distance between them)
-                if ValidDict['valsatdist'][Tr] != []:
-                    valsatdist.append(ValidDict['valsatdist'][Tr][DateIndex])
-                else:
-                    continue
-            else:
-                continue
-        # due to way dates are used, some transects might be missing validation dates so collection will be empty
-        if valsatdist != []: 
-            errordata.append(valsatdist)
-            errordates.append(Sdate)
-    # sort both dates and list of values by date
-    if len(errordates) > 1:
-        errordatesrt, errorsrt = [list(d) for d in zip(*sorted(zip(errordates, errordata), key=lambda x: x[0]))]
-    else:
-        errordatesrt = errordates
-        errorsrt = errordata
-    df = pd.DataFrame(errorsrt)
-    df = df.transpose()
-    df.columns = errordatesrt
     
-    errordict = {'Date':[],'Count':[],'MAE':[],'RMSE':[],'CountSub10m':[],'CountSub15m':[]}
+    if TransectIDs[1] > len(ValidDict['dates']): # for when transect values extend beyond what transects exist
+        print("check your chosen transect values!")
+        return
+    
+    ErrorDF = ValidErrorsDF(SatGDF, DatesCol, ValidDict, TransectIDs, Clusters)
+    
+    # per-date stats plus total over all dates
+    errordf = ErrorStats(ErrorSums(ErrorDF, 'dates'))
+    totaldf = ErrorStats(ErrorSums(ErrorDF.assign(dates='Total'), 'dates'))
+    errordf = pd.concat([errordf, totaldf]).rename_axis('Date').reset_index()
     
     print('Transects %s to %s:' % (TransectIDs[0],TransectIDs[1]))
-    totald = []
-    for date in df.columns:
-        d = df[date]
-        for i,datum in enumerate(d):
-            totald.append(datum)
-        mse_f = np.mean(d**2)
-        mae_f = np.mean(abs(d))
-        rmse_f = np.sqrt(mse_f)
-        sub3  = d.between(-3,3).sum()
-        sub10 = d.between(-10,10).sum()
-        sub15 = d.between(-15,15).sum()
-        # r2_f = 1-(sum(d**2)/sum((y-np.mean(y))**2))
-        print('For sat date %s:' % date)
-        print('Count: %s' % d.count())
-        print("MAE:",mae_f)
-        # print("MSE:", mse_f)
-        print("RMSE:", rmse_f)
-        # print("R-Squared:", r2)
-        print('Sub 3m-pixel Tr percent:',round(sub3/d.count()*100,1), '%')
-        print('Sub 10m-pixel Tr percent:',round(sub10/d.count()*100,1), '%')
-        print('Sub 15m-pixel Tr percent:',round(sub15/d.count()*100,1), '%')
-        if d.count() != 0:
-            errordict['Date'].append(date)
-            errordict['Count'].append(d.count())
-            errordict['MAE'].append(mae_f)
-            errordict['RMSE'].append(rmse_f)
-            errordict['CountSub10m'].append(sub10)
-            errordict['CountSub15m'].append(sub15)
-
-            
-    totald = np.array(totald)
-    mse = np.mean(np.power(totald[~np.isnan(totald)], 2))
-    mae = np.mean(abs(totald[~np.isnan(totald)]))
-    rmse = np.sqrt(mse)
-    sub3  = np.logical_and(totald>=-3,totald<=3).sum()
-    sub10 = np.logical_and(totald>=-10,totald<=10).sum()
-    sub15 = np.logical_and(totald>=-15,totald<=15).sum()
-    print('TOTAL')
-    print('Count: %s' % len(totald[~np.isnan(totald)]))
-    print("MAE:",mae)
-    # print("MSE:", mse)
-    print("RMSE:", rmse)
-    print('Sub 3m-pixel Tr percent:',round(sub3/len(totald[~np.isnan(totald)])*100,1),'%')
-    print('Sub 10m-pixel Tr percent:',round(sub10/len(totald[~np.isnan(totald)])*100,1),'%')
-    print('Sub 15m-pixel Tr percent:',round(sub15/len(totald[~np.isnan(totald)])*100,1),'%')
-    errordict['Date'].append('Total')
-    errordict['Count'].append(len(totald[~np.isnan(totald)]))
-    errordict['MAE'].append(mae)
-    errordict['RMSE'].append(rmse)
-    errordict['CountSub10m'].append(sub10)
-    errordict['CountSub15m'].append(sub15)
-    
-    errordf = pd.DataFrame(errordict)
+    for _, row in errordf.iterrows():
+        if row['Date'] == 'Total':
+            print('TOTAL')
+        else:
+            print('For sat date %s:' % row['Date'])
+        print('Count: %s' % row['Count'])
+        print("MAE:", row['MAE'])
+        print("RMSE:", row['RMSE'])
+        print('Sub 3m-pixel Tr percent:',round(row['CountSub3m']/row['Count']*100,1), '%')
+        print('Sub 10m-pixel Tr percent:',round(row['CountSub10m']/row['Count']*100,1), '%')
+        print('Sub 15m-pixel Tr percent:',round(row['CountSub15m']/row['Count']*100,1), '%')
+    
+    errordf = errordf[['Date','Count','MAE','RMSE','CountSub10m','CountSub15m','Bias','R2']]
     savepath = os.path.join(filepath, sitename+'_Errors_Transects'+str(TransectIDs[0])+'to'+str(TransectIDs[1])+'.csv')
     print("Error stats saved to "+savepath)
     errordf.to_csv(savepath, index=False)
     
+    if Breakdowns is not None:
+        for By in Breakdowns:
+            bydf = ErrorStats(ErrorSums(ErrorDF, By)).reset_index()
+            bypath = os.path.join(filepath, sitename+'_Errors_'+By+'_Transects'+str(TransectIDs[0])+'to'+str(TransectIDs[1])+'.csv')
+            print("Error stats by "+By+" saved to "+bypath)
+            bydf.to_csv(bypath, index=False)
+    
+    return errordf
+
+
+def QuantifyErrorsSites(Sites, By='dates', savepath=None):
+    """
+    Calculate error stats over multiple sites. Sites are read one at a time 
+    and only running sums of errors are kept, so each site's validation 
+    dictionary can be loaded and discarded in turn (e.g. from a generator).
+
+    Parameters
+    ----------
+    Sites : iterable
+        Tuples of (SatGDF, DatesCol, ValidDict, TransectIDs) for each site,
+        with optional fifth item Clusters (see QuantifyErrors()).
+    By : str, optional
+        Field to group errors by; 'dates', 'satname', 'season', 'cluster', or
+        'sitename' (position of site in Sites). The default is 'dates'.
+    savepath : str, optional
+        Path to CSV to save stats to. The default is None (not saved).
+
+    Returns
+    -------
+    errordf : DataFrame
+        Error stats for each group, plus a 'Total' row.
+
+    """
+    Sums, TotalSums = None, None
+    for SiteNo, Site in enumerate(Sites):
+        ErrorDF = ValidErrorsDF(*Site).assign(sitename=SiteNo)
+        SiteSums = ErrorSums(ErrorDF, By)
+        SiteTotal = ErrorSums(ErrorDF.assign(total='Total'), 'total')
+        if Sums is None:
+            Sums, TotalSums = SiteSums, SiteTotal
+        else:
+            Sums = Sums.add(SiteSums, fill_value=0)
+            TotalSums = TotalSums.add(SiteTotal, fill_value=0)
+        
+    errordf = pd.concat([ErrorStats(Sums), ErrorStats(TotalSums)]).rename_axis(By).reset_index()
+    if savepath is not None:
+        print("Error stats saved to "+savepath)
+        errordf.to_csv(savepath, index=False)
+    
+    return errordf
+
+
+def ValidErrorsDF(SatGDF, DatesCol, ValidDict, TransectIDs, Clusters=None):
+    """
+    Flatten distances between sat and validation lines in a range of 
+    transects into one table, with the first intersection on each transect
+    used for each sat date.
+
+    Parameters
+    ----------
+    SatGDF : GeoDataFrame
+        Sat-derived lines (only dates present in this are used).
+    DatesCol : str
+        Name of dates column in SatGDF.
+    ValidDict : dict
+        Validation dictionary created from ValidateSatIntersects().
+    TransectIDs : list
+        First and last (exclusive) transect IDs to use.
+    Clusters : dict or array-like, optional
+        Cluster label for each transect ID. The default is None.
+
+    Returns
+    -------
+    ErrorDF : DataFrame
+        One row per valid sat-validation distance, with fields TransectID,
+        dates, satname, season, cluster, valsatdist and Vdists.
+
+    """
+    TrRange = [Tr for Tr in range(TransectIDs[0],TransectIDs[1]) if len(ValidDict['valsatdist'][Tr]) > 0]
+    TrLens = [len(ValidDict['dates'][Tr]) for Tr in TrRange]
+    
+    ErrorDF = pd.DataFrame({'TransectID':np.repeat(TrRange, TrLens).astype(int),
+                            'dates':[Date for Tr in TrRange for Date in ValidDict['dates'][Tr]],
+                            'distances':np.array([Dist for Tr in TrRange for Dist in ValidDict['distances'][Tr]], dtype=float),
+                            'valsatdist':np.array([Dist for Tr in TrRange for Dist in ValidDict['valsatdist'][Tr]], dtype=float)})
+    if 'satname' in ValidDict:
+        ErrorDF['satname'] = [Sat for Tr in TrRange for Sat in ValidDict['satname'][Tr]]
+    else:
+        ErrorDF['satname'] = None
+    
+    ErrorDF = ErrorDF.drop_duplicates(['TransectID','dates'])
+    ErrorDF = ErrorDF[ErrorDF['dates'].isin(SatGDF[DatesCol].unique()) & ErrorDF['valsatdist'].notna()]
+    
+    # validation distance along transect (for R squared)
+    ErrorDF['Vdists'] = ErrorDF['distances'] - ErrorDF['valsatdist']
+    Months = pd.to_datetime(ErrorDF['dates'], format='%Y-%m-%d').dt.month.values
+    ErrorDF['season'] = np.array(['DJF','MAM','JJA','SON'])[(Months % 12) // 3]
+    if Clusters is not None:
+        ErrorDF['cluster'] = pd.Series(Clusters).reindex(ErrorDF['TransectID']).values
+    else:
+        ErrorDF['cluster'] = None
+    
+    return ErrorDF.reset_index(drop=True)
+
+
+def ErrorSums(ErrorDF, By):
+    """
+    Running sums of sat-validation distances per group, from which error
+    stats can be calculated. Sums from different tables can be added together.
+
+    Parameters
+    ----------
+    ErrorDF : DataFrame
+        Table of distances created with ValidErrorsDF().
+    By : str
+        Field to group distances by.
+
+    Returns
+    -------
+    Sums : DataFrame
+        Sums per group.
+
+    """
+    d = ErrorDF['valsatdist']
+    SumDF = pd.DataFrame({By:ErrorDF[By],
+                          'n':1,
+                          'd':d,
+                          'absd':d.abs(),
+                          'd2':d**2,
+                          'sub3':d.between(-3,3).astype(int),
+                          'sub10':d.between(-10,10).astype(int),
+                          'sub15':d.between(-15,15).astype(int),
+                          'y':ErrorDF['Vdists'],
+                          'y2':ErrorDF['Vdists']**2})
+    
+    return SumDF.groupby(By, sort=True).sum()
+
+
+def ErrorStats(Sums):
+    """
+    Error stats from sums of sat-validation distances (see ErrorSums()).
+
+    Parameters
+    ----------
+    Sums : DataFrame
+        Sums per group.
+
+    Returns
+    -------
+    Stats : DataFrame
+        Count, MAE, RMSE, counts within 3, 10 and 15m, bias (mean of sat minus
+        validation distances) and R squared for each group.
+
+    """
+    n = Sums['n']
+    # residuals are sat - validation; total variance is of validation distances
+    SSres = Sums['d2']
+    SStot = Sums['y2'] - Sums['y']**2 / n
+    Stats = pd.DataFrame({'Count':n.astype(int),
+                          'MAE':Sums['absd'] / n,
+                          'RMSE':np.sqrt(SSres / n),
+                          'CountSub3m':Sums['sub3'].astype(int),
+                          'CountSub10m':Sums['sub10'].astype(int),
+                          'CountSub15m':Sums['sub15'].astype(int),
+                          'Bias':Sums['d'] / n,
+                          'R2':(1 - SSres / SStot).where(SStot > 0)},
+                         index=Sums.index)
+    Stats = Stats[Stats['Count'] > 0]
+    
+    return Stats
+
 def CalcDistance(Geom1,Geom2):
     """
     Calculate distance between two shapely geoms, either using a point and line
@@ -1923,35 +2705,25 @@ def GetWaterElevs(settings, dates_sat):
     tides_ts = np.array(tide_data['tide'])
 
     
-    tides_sat = []
-    def find(item, lst):
-        start = 0
-        start = lst.index(item, start)
-        return start
-    
     # Previously found first following tide time, but incorrect when time is e.g. only 1min past the hour
-    # for i,date in enumerate(dates_sat):
-    #     tides_sat.append(tides_ts[find(min(item for item in dates_ts if item > date), dates_ts)])
-    
     # Interpolate tide using number of minutes through the hour the satellite image was captured
-    for i,date in enumerate(dates_sat):
-        # find preceding and following hourly tide levels and times
-        time_1 = dates_ts[find(min(item for item in dates_ts if item > date-timedelta(hours=1)), dates_ts)]
-        tide_1 = tides_ts[find(min(item for item in dates_ts if item > date-timedelta(hours=1)), dates_ts)]
-        time_2 = dates_ts[find(min(item for item in dates_ts if item > date), dates_ts)]
-        tide_2 = tides_ts[find(min(item for item in dates_ts if item > date), dates_ts)]
-        
-        # Find time difference of actual satellite timestamp (next hour minus sat timestamp)
-        timediff = time_2 - date
-        # Get proportion of time through the hour (e.g. 59mins past = 0.01)
-        timeprop = timediff / timedelta(hours=1)
-        
-        # Get difference between the two tidal stages
-        tidediff = (tide_2 - tide_1) / 2
-        tide_sat = tide_2 - (tidediff * timeprop)
-        
-        tides_sat.append(tide_sat)
-        print(tide_sat)
+    TideIndex = DateIndex(dates_ts)
+    # find preceding and following hourly tide levels and times
+    idx_1 = TideIndex.After([date-timedelta(hours=1) for date in dates_sat], Inclusive=False)
+    idx_2 = TideIndex.After(dates_sat, Inclusive=False)
+    if np.any(idx_1 == -1) or np.any(idx_2 == -1):
+        raise Exception('Tide data do not cover the range of your satellite dates')
+    tide_1 = tides_ts[idx_1]
+    tide_2 = tides_ts[idx_2]
+    
+    # Find time difference of actual satellite timestamp (next hour minus sat timestamp)
+    timediff = TideIndex.Dates[idx_2] - DateIndex.ToDatetime64(dates_sat)
+    # Get proportion of time through the hour (e.g. 59mins past = 0.01)
+    timeprop = timediff / np.timedelta64(1,'h')
+    
+    # Get difference between the two tidal stages
+    tidediff = (tide_2 - tide_1) / 2
+    tides_sat = list(tide_2 - (tidediff * timeprop))
     
     return tides_sat
 
@@ -24,7 +24,7 @@ import skimage.transform as transform
 from sklearn.linear_model import LinearRegression
 from pylab import ginput
 import rasterio as rio
-from rasterio.features import shapes
+from concurrent.futures import ThreadPoolExecutor
 
 from Toolshed import Toolbox
 from Toolshed.Coast import *
@@ -267,6 +267,8 @@ def GetBeachWidth(BasePath, TransectGDF, TransectDict, WaterlineGDF, settings, o
     '''
     Intersection between veglines and shorelines, based on geopandas GDFs/shapefiles.
     Shorelines are tidally corrected using either a DEM of slopes or a single slope value for all transects.
+    Waterline intersections are found in bulk using a spatial index, and are matched
+    to the nearest-dated veg edge intersection on the same transect with a merge.
     
     FM Sept 2022
 
@@ -276,8 +278,16 @@ def GetBeachWidth(BasePath, TransectGDF, TransectDict, WaterlineGDF, settings, o
         Path to shapefiles of transects.
     TransectGDF : GeoDataFrame
         GDF of shore-normal transects created.
-    ShorelineGDF : GeoDataFrame
-        GDF of lines extracted from sat images.
+    TransectDict : dict
+        Transects with veg edge intersection info (from GetIntersections()).
+    WaterlineGDF : GeoDataFrame
+        GDF of waterlines extracted from sat images.
+    settings : dict
+        Veg edge extraction settings.
+    output : dict
+        Output of extracted lines (used for tidal correction).
+    AvBeachSlope : float
+        Average beach slope to use for tidal correction.
 
     Returns
     -------
@@ -287,44 +297,10 @@ def GetBeachWidth(BasePath, TransectGDF, TransectDict, WaterlineGDF, settings, o
     '''
      
     print("performing intersections between transects and waterlines")
-    # initialise where each intersection between lines and transects will be saved
-    ColumnData = []
-    Geoms = []
-    # for each row/feature in transect
-    for _, _, ID, TrGeom in TransectGDF.itertuples():
-        # Extend transect line out to sea and inland
-        TrGeom = Toolbox.ExtendLine(TrGeom, 300)
-        # for each row/feature shoreline
-        for _,dates,_,_,_,_,_,_,_,_,SGeom in WaterlineGDF.itertuples():
-            # calculate intersections between each transect and shoreline
-            Intersects = TrGeom.intersection(SGeom)
-            ColumnData.append((ID,dates))
-            Geoms.append(Intersects)
-            
-    # create GDF from appended lists of intersections        
-    AllIntersects = gpd.GeoDataFrame(ColumnData,geometry=Geoms,columns=['TransectID', 'wldates'])
-    # remove any rows with no intersections
-    AllIntersects = AllIntersects[~AllIntersects.is_empty].reset_index().drop('index',axis=1)
-    # duplicate geom column to save point intersections
-    AllIntersects['wlinterpnt'] = AllIntersects['geometry']
-    # take only first point on any transects which intersected a single shoreline more than once
-    for inter in range(len(AllIntersects)):
-        if AllIntersects['wlinterpnt'][inter].geom_type == 'MultiPoint':
-            AllIntersects['wlinterpnt'][inter] = list(AllIntersects['wlinterpnt'][inter])[0] # list() accesses individual points in MultiPoint
-    AllIntersects = AllIntersects.drop('geometry',axis=1)
-    # attribute join on transect ID to get transect geometry back
-    AllIntersects = AllIntersects.merge(TransectGDF[['TransectID','geometry']], on='TransectID')
-    
-    print("formatting back into dict...")
-    # initialise distances of intersections 
-    distances = []
-    # for each intersection
-    for i in range(len(AllIntersects)):
-        # calculate distance of intersection along transect
-        distances.append(np.sqrt( 
-            (AllIntersects['wlinterpnt'][i].x - AllIntersects['geometry'][i].coords[0][0])**2 + 
-            (AllIntersects['wlinterpnt'][i].y - AllIntersects['geometry'][i].coords[0][1])**2 ))
-    AllIntersects['wldists'] = distances
+    # Extend transect line out to sea and inland, then intersect with each waterline
+    AllIntersects = TransectIntersects(TransectGDF, WaterlineGDF, ExtendDist=300)
+    AllIntersects['wldates'] = WaterlineGDF['dates'].values[AllIntersects['LineID']]
+    AllIntersects = AllIntersects.rename(columns={'interpnt':'wlinterpnt', 'distances':'wldists'})
 
     # Tidal correction to get corrected distances along transects
     CorrectedDists, TidalStages = TidalCorrection(settings, output, AllIntersects, AvBeachSlope)
@@ -333,91 +309,149 @@ def GetBeachWidth(BasePath, TransectGDF, TransectDict, WaterlineGDF, settings, o
     
     # Field representing beach zone dependent on tidal height range split into 3 (upper, middle or lower)
     TideSteps = BeachTideLoc(settings)
-    ShoreLevels = []
-    for i in range(len(AllIntersects)):
-        if AllIntersects['waterelev'][i] > TideSteps[0] and AllIntersects['waterelev'][i] < TideSteps[1]:
-            ShoreLevels.append('lower')
-        elif AllIntersects['waterelev'][i] > TideSteps[1] and AllIntersects['waterelev'][i] < TideSteps[2]:
-            ShoreLevels.append('middle')
-        elif AllIntersects['waterelev'][i] > TideSteps[2] and AllIntersects['waterelev'][i] < TideSteps[3]:
-            ShoreLevels.append('upper')
-    AllIntersects['tidezone'] = ShoreLevels
+    WaterElev = AllIntersects['waterelev']
+    AllIntersects['tidezone'] = np.select([(WaterElev > TideSteps[0]) & (WaterElev < TideSteps[1]),
+                                           (WaterElev > TideSteps[1]) & (WaterElev < TideSteps[2]),
+                                           (WaterElev > TideSteps[2]) & (WaterElev < TideSteps[3])],
+                                          ['lower', 'middle', 'upper'], default=None)
     
-    #initialise lists used for storing each transect's intersection values
-    dates, distances, corrdists, welev, tzone, interpnt = ([] for i in range(6)) # per-transect lists of values
-
-    Key = [dates, distances, corrdists, welev, tzone, interpnt]
-    KeyName = ['wldates','wldists', 'wlcorrdist','waterelev','tidezone','wlinterpnt']
-       
-    # for each column name
-    for i in range(len(Key)):
-        # for each transect
-        for Tr in range(len(TransectGDF['TransectID'])):
-            # refresh per-transect list
-            TrKey = []
-            # for each matching intersection on a single transect
-            for j in range(len(AllIntersects.loc[AllIntersects['TransectID']==Tr])):
-                # append each intersection value to a list for each transect
-                # iloc used so index doesn't restart at 0 each loop
-                TrKey.append(AllIntersects[KeyName[i]].loc[AllIntersects['TransectID']==Tr].iloc[j]) 
-            Key[i].append(TrKey)
-    
-        TransectDict[KeyName[i]] = Key[i]
-          
     # Create beach width attribute
     print('calculating distances between veg and water lines...')
-    TransectDict['beachwidth'] = TransectDict['TransectID'].copy()
-    # for each transect
-    for Tr in range(len(TransectGDF['TransectID'])):
-        # dates into transect-specific list
-        WLDateList = [datetime.strptime(date, '%Y-%m-%d') for date in TransectDict['wldates'][Tr]]
-        VLDateList = [datetime.strptime(date, '%Y-%m-%d') for date in TransectDict['dates'][Tr]]
-        # find index of closest waterline date to each vegline date
-        VLSLDists = []
-        for D, WLDate in enumerate(WLDateList):
-            # index of matching nearest date
-            if VLDateList != []:
-                DateLoc = Toolbox.NearDate(WLDate,VLDateList)
-                if DateLoc == False:
-                    VLSLDists.append(np.nan)
-                    continue
-                else:
-                    DateIndex = VLDateList.index(DateLoc)
-            else:
-                continue
-            # use date index to identify matching distance along transect
-            # and calculate distance between two intersections (veg - water means +ve is veg measured seaward towards water)
-            VLSLDists.append(TransectDict['wlcorrdist'][Tr][D] - TransectDict['distances'][Tr][DateIndex])
-            
-        TransectDict['beachwidth'][Tr] = VLSLDists
+    VegDF = TransectDictToDF(TransectDict, ['dates','distances']).rename(columns={'dates':'vldates','distances':'vldists'})
+    # match each waterline to closest veg edge date (within 5 months) on same transect
+    WaterDF = AllIntersects[['TransectID','wldates','wlcorrdist']]
+    # transects with no veg edges at all get no beach widths
+    WaterDF = WaterDF[WaterDF['TransectID'].isin(VegDF['TransectID'])]
+    WidthDF = MatchNearestDates(WaterDF, VegDF, 'wldates', 'vldates')
+    # distance between two intersections (veg - water means +ve is veg measured seaward towards water)
+    WidthDF['beachwidth'] = WidthDF['wlcorrdist'] - WidthDF['vldists']
+    
+    # regroup values into per-transect lists
+    KeyName = ['wldates','wldists', 'wlcorrdist','waterelev','tidezone','wlinterpnt']
+    TransectDict.update(GroupByTransect(AllIntersects, KeyName, len(TransectGDF)))
+    TransectDict.update(GroupByTransect(WidthDF, ['beachwidth'], len(TransectGDF)))
     
     print("TransectDict with beach width and waterline intersections created.")
         
     return TransectDict
+
+
+def TransectIntersects(TransectGDF, LinesGDF, ExtendDist=None):
+    """
+    Intersect every transect with every line in bulk, using a spatial index to
+    find the transect-line pairs which cross, rather than testing all pairs.
+    Where a transect crosses a single line more than once, only the first 
+    point is kept.
+
+    Parameters
+    ----------
+    TransectGDF : GeoDataFrame
+        GDF of shore-normal transects (with TransectID field).
+    LinesGDF : GeoDataFrame
+        GDF of lines to intersect with (sat, water or validation lines).
+    ExtendDist : float, optional
+        Distance to extend transects by in both directions before 
+        intersecting. The default is None (no extension).
+
+    Returns
+    -------
+    IntersectDF : DataFrame
+        One row per transect-line intersection, sorted by transect then line,
+        with fields TransectID, LineID (positional index of line in LinesGDF),
+        interpnt (intersection Point) and distances (distance of 
+        intersection from start of unextended transect).
+
+    """
+    TrGeoms = list(TransectGDF.geometry)
+    if ExtendDist is not None:
+        TrGeoms = [Toolbox.ExtendLine(TrGeom, ExtendDist) for TrGeom in TrGeoms]
+    # lines and transects should share a CRS for the spatial index
+    TrGDF = gpd.GeoDataFrame({'TransectID':TransectGDF['TransectID'].values}, geometry=TrGeoms, crs=LinesGDF.crs)
+    LineGDF = gpd.GeoDataFrame(geometry=list(LinesGDF.geometry), crs=LinesGDF.crs)
+    
+    # candidate pairs from spatial index
+    Pairs = gpd.sjoin(TrGDF, LineGDF, how='inner', predicate='intersects')
+    Pairs = Pairs.rename(columns={'index_right':'LineID'}).sort_values(['TransectID','LineID'], kind='stable')
+    
+    # intersect each transect with its paired lines
+    PairTrs = gpd.GeoSeries(list(Pairs.geometry))
+    PairLines = gpd.GeoSeries(list(LineGDF.geometry.values[Pairs['LineID'].values]))
+    Inters = PairTrs.intersection(PairLines)
+    IntersectDF = pd.DataFrame({'TransectID':Pairs['TransectID'].values, 'LineID':Pairs['LineID'].values})
+    # remove any rows with no point intersections
+    Keep = (~Inters.is_empty & Inters.geom_type.isin(['Point','MultiPoint'])).values
+    IntersectDF, Inters = IntersectDF[Keep].reset_index(drop=True), list(Inters[Keep])
+    # take only first point on any transects which intersected a single line more than once
+    IntersectDF['interpnt'] = [Inter.geoms[0] if Inter.geom_type == 'MultiPoint' else Inter for Inter in Inters]
+    
+    # distance of intersection along (unextended) transect
+    TrStarts = dict(zip(TransectGDF['TransectID'], [np.array(Geom.coords[0]) for Geom in TransectGDF.geometry]))
+    StartXY = np.array([TrStarts[TrID] for TrID in IntersectDF['TransectID']]).reshape(-1,2)
+    InterXY = np.array([(Pnt.x, Pnt.y) for Pnt in IntersectDF['interpnt']]).reshape(-1,2)
+    IntersectDF['distances'] = np.sqrt(np.sum((InterXY - StartXY)**2, axis=1))
+    
+    return IntersectDF
+
+
+def GroupByTransect(IntersectDF, KeyName, NoTransects):
+    """
+    Regroup rows of a table of intersections into per-transect lists of 
+    values for each field, as stored in TransectDict.
+
+    Parameters
+    ----------
+    IntersectDF : DataFrame
+        Table of intersections with TransectID field.
+    KeyName : list
+        Names of fields to regroup.
+    NoTransects : int
+        Number of transects (transects with no intersections get empty lists).
+
+    Returns
+    -------
+    TrValues : dict
+        Lists of values per transect for each field in KeyName.
+
+    """
+    Grouped = IntersectDF.groupby('TransectID', sort=True)[KeyName].agg(list).reindex(range(NoTransects))
+    TrValues = {}
+    for Key in KeyName:
+        TrValues[Key] = [Vals if isinstance(Vals, list) else [] for Vals in Grouped[Key]]
+    
+    return TrValues
     
 
 def TidalCorrection(settings, output, IntersectDF, AvBeachSlope):
+    """
+    Tidally correct waterline intersection distances along transects, using
+    the water elevation at the time each image was captured and a beach slope.
+    The correction is applied to all intersections at once.
+
+    Parameters
+    ----------
+    settings : dict
+        Veg edge extraction settings.
+    output : dict
+        Output of extracted lines (dates and times of each image).
+    IntersectDF : DataFrame
+        Waterline intersections with dates (wldates) and distances (wldists).
+    AvBeachSlope : float
+        Average beach slope to use if no DEM is available.
+
+    Returns
+    -------
+    CorrIntDistances : array
+        Tidally corrected distances along transects.
+    TidalStages : array
+        Water elevations (relative to reference elevation) at each intersection.
 
-    # # load tidal data
-    # tidefilepath = os.path.join(settings['inputs']['filepath'],'tides',settings['inputs']['sitename']+'_tides.csv')
-    # tide_data = pd.read_csv(tidefilepath, parse_dates=['date'])
-    # dates_ts = [_.to_pydatetime() for _ in tide_data['date']]
-    # tides_ts = np.array(tide_data['tide'])
+    """
     
     # # get the tide level corresponding to the time of sat image acquisition
     dates_sat = []
     for i in range(len(output['dates'])):
         dates_sat_str = output['dates'][i] +' '+output['times'][i]
         dates_sat.append(datetime.strptime(dates_sat_str, '%Y-%m-%d %H:%M:%S.%f'))
-    
-    # tide_sat = []
-    # def find(item, lst):
-    #     start = 0
-    #     start = lst.index(item, start)
-    #     return start
-    # for i,date in enumerate(dates_sat):
-    #     tide_sat.append(tides_ts[find(min(item for item in dates_ts if item > date), dates_ts)])
-    # tides_sat = np.array(tide_sat)
          
     tide_sat = Toolbox.GetWaterElevs(settings,dates_sat)
     tides_sat = np.array(tide_sat)
@@ -438,21 +472,15 @@ def TidalCorrection(settings, output, IntersectDF, AvBeachSlope):
         # TO DO: incorporate CoastSat.slopes into this part?
         BeachSlope = AvBeachSlope
     
-    CorrIntDistances = []
-    TidalStages = []
+    # lookup of tide level for each image date (first image on each date is used)
+    TideLookup = pd.Series(tides_sat, index=pd.to_datetime([dt.date() for dt in dates_sat]))
+    TideLookup = TideLookup[~TideLookup.index.duplicated(keep='first')]
     
-    dates_sat_d = []
-    for dt in dates_sat:
-        dates_sat_d.append(dt.date())
-    
-    for D, Dist in enumerate(IntersectDF['wldists']):
-        DateIndex = dates_sat_d.index(datetime.strptime(IntersectDF['wldates'][D], '%Y-%m-%d').date())
-        # calculate and apply cross-shore correction 
-        TidalElev = tides_sat[DateIndex] - RefElev
-        Correction = TidalElev / BeachSlope
-        # correction is minus because transect dists are defined land to seaward
-        CorrIntDistances.append(Dist - Correction)
-        TidalStages.append(TidalElev)
+    # calculate and apply cross-shore correction to all intersections
+    TidalStages = TideLookup.reindex(pd.to_datetime(IntersectDF['wldates'], format='%Y-%m-%d')).values - RefElev
+    Correction = TidalStages / BeachSlope
+    # correction is minus because transect dists are defined land to seaward
+    CorrIntDistances = np.asarray(IntersectDF['wldists'], dtype=float) - Correction
     
     return CorrIntDistances, TidalStages
 
@@ -760,8 +788,37 @@ def CalculateChanges(TransectDict,TransectInterGDF):
     return TransectDict
 
 
-def TZIntersect(settings,TransectDict,TransectInterGDF, VeglinesGDF, BasePath):
-    
+def TZIntersect(settings,TransectDict,TransectInterGDF, VeglinesGDF, BasePath, n_workers=None):
+    """
+    Measure the cross-shore width of the transition zone (TZ) on each transect,
+    for every image a veg edge was extracted from. Each TZ raster is sampled 
+    along all transects at once (points spaced every metre either side of the 
+    veg edge intersection, out to the ref line buffer distance), and the width 
+    is taken from the length of the run of TZ pixels closest to the veg edge.
+    Rasters for different image dates are processed in parallel.
+
+    Parameters
+    ----------
+    settings : dict
+        Veg edge extraction settings (uses 'inputs' and 'max_dist_ref').
+    TransectDict : dict
+        Transects with intersection info.
+    TransectInterGDF : GeoDataFrame
+        GDF of transects with veg edge intersections.
+    VeglinesGDF : GeoDataFrame
+        GDF of veg edges extracted from sat images.
+    BasePath : str
+        Path to save intersected transect shapefile to.
+    n_workers : int, optional
+        Number of TZ rasters to process at once. The default is None 
+        (chosen by ThreadPoolExecutor from the number of CPUs).
+
+    Returns
+    -------
+    TransectInterGDF : GeoDataFrame
+        GDF of transects with TZ widths (TZwidth) and mean widths (TZwidthMn) added.
+
+    """
     
     print('Intersecting transects with transition zones... ')
     # Initialise empty field that matches dimensions of each intersection
@@ -770,79 +827,51 @@ def TZIntersect(settings,TransectDict,TransectInterGDF, VeglinesGDF, BasePath):
         WidthFields.append([np.nan]*len(TransectInterGDF['filename'].iloc[Tr]))
         
     fpath = os.path.join(settings['inputs']['filepath'], settings['inputs']['sitename'])
-    # read in Transition Zone tifs
-    fnames = [os.path.basename(x) for x in glob.glob(os.path.join(fpath,'jpg_files', '*_TZ.tif'))]
-
-    for fnum, fname in enumerate(fnames): # for each TZ raster (and therefore image date)
-        with rio.Env():
-            with rio.open(os.path.join(fpath, 'jpg_files', fname)) as src:
-                img = src.read(1).astype("float32") # first band
-                results = (
-                {'properties': {'raster_val': v}, 'geometry': s}
-                for i, (s, v) 
-                in enumerate(
-                    shapes(img, mask=None, transform=src.transform)))
-        # TZ to polygon
-        geoms = list(results)
-        TZpoly = gpd.GeoDataFrame.from_features(geoms, src.crs)
-        TZpoly = TZpoly[TZpoly['raster_val'] == 1] # get rid of nan polygons
-        
-        f = fname[:-7] # get rid of '_TZ' and extension
-        # Calculate area of polygons
-        TZpoly['area'] = TZpoly.area        
-        # Get matching veg line and buffer by ref line buffer amount
-        VeglinesGDF['imagename'] = [os.path.basename(x) for x in VeglinesGDF['filename']]
-        Vegline = VeglinesGDF[VeglinesGDF['imagename'].isin([f])]
-        VeglineBuff = Vegline.buffer(settings['max_dist_ref'])
-        # convert to matching CRS for clipping (also ensures same CRS for Tr intersect)
-        TZpoly = TZpoly.to_crs(VeglineBuff.crs) 
-        # Clip TZ polys to matching image's vegline buffer
-        TZpolyClip = gpd.clip(TZpoly,VeglineBuff)
-        TZpolyClip = TZpolyClip.explode()
-                    
-        # Intersection between polygon edges and Tr
-        for Tr in range(len(TransectInterGDF)):
-            print('\r %0.3f %% images processed : %0.3f %% transects processed' % ( ((fnum)/len(fnames))*100, (Tr/len(TransectInterGDF))*100 ), end='')
-            # list of filenames on each transect from intersections with VEs
-            TrFiles = [os.path.basename(x) for x in TransectInterGDF['filename'].iloc[Tr]]
-            # get matching image index in list of transect's VE filenames 
-            try:
-                ImInd = TrFiles.index(f)
-            except: # if filename doesn't exist in list of files on transect, skip
-                TZwidth = np.nan
-                continue # step out of current Tr loop and start on next Tr
-            
-            TransectGeom = TransectInterGDF['geometry'].iloc[Tr]
-            # Distances of each intersection pair from VE
-            TZpolyClip['pntdist'] = [np.nan]*len(TZpolyClip)
-            # Intersect Tr with TZ polygon
-            TZpolyClip['TrIntersect'] = TZpolyClip.exterior.intersection(TransectGeom)
-            # Remove empty geoms from TZ dataframe
-            TZpolyClipInter = TZpolyClip[TZpolyClip['TrIntersect'].is_empty == False][TZpolyClip['TrIntersect'].isna() == False]
-            
-            # if Transect ends inside TZ polygon, extend length until multipoint is achieved
-            while (TZpolyClipInter['TrIntersect'].geom_type == 'Point').sum() > 0:
-                TransectGeom = Toolbox.ExtendLine(TransectGeom, 10)
-                TZpolyClip['TrIntersect'] = TZpolyClip.exterior.intersection(TransectGeom)
-                # Remove empty geoms from TZ dataframe
-                TZpolyClipInter = TZpolyClip[TZpolyClip['TrIntersect'].is_empty == False][TZpolyClip['TrIntersect'].isna() == False]
-            
-            # fill in distance between first TZ intersection point and VE-Tr intersection
-            for i in range(len(TZpolyClipInter)):
-                TZpolyClipInter['pntdist'].iloc[i] = list(TZpolyClipInter['TrIntersect'].iloc[i])[0].distance(TransectInterGDF['interpnt'][Tr][ImInd])
-            # TZpolyClip['pntdist'] = TZpolyClip.centroid.distance(TransectInterGDF['interpnt'][Tr][ImInd])
-            
-            # if Transect doesn't intersect with any TZ polygons
-            if len(TZpolyClipInter) == 0:
-                TZwidth = np.nan
-            else:                
-                TZpolyClose = TZpolyClipInter['TrIntersect'][TZpolyClipInter['pntdist'] == TZpolyClipInter['pntdist'].min()]
-                # TZ width (Distance between intersect points)
-                TZwidth = TZpolyClose.explode(index_parts=True).iloc[0].distance(TZpolyClose.explode(index_parts=True).iloc[1])
+    # read in Transition Zone tifs (image name, filepath and band of each TZ)
+    TZrasters = [(os.path.basename(x)[:-7], x, 1) for x in glob.glob(os.path.join(fpath,'jpg_files', '*_TZ.tif'))] # get rid of '_TZ' and extension
+    # and any TZ stacks (one band per image, named in band descriptions)
+    for x in glob.glob(os.path.join(fpath,'jpg_files', '*_TZstack*.tif')):
+        with rio.open(x) as src:
+            TZrasters.extend([(f, x, b+1) for b, f in enumerate(src.descriptions)])
+    # where an image's TZ is in more than one file (left from an earlier run 
+    # in the other mode), only the most recently written one is used
+    TZlatest = {}
+    for TZraster in TZrasters:
+        f, x, _ = TZraster
+        if f not in TZlatest or os.path.getmtime(x) > os.path.getmtime(TZlatest[f][1]):
+            TZlatest[f] = TZraster
+    TZrasters = list(TZlatest.values())
+    
+    # start coords and unit vectors of each transect (land to sea)
+    TrCoords = np.array([[Geom.coords[0], Geom.coords[-1]] for Geom in TransectInterGDF.geometry])
+    TrVecs = TrCoords[:,1,:] - TrCoords[:,0,:]
+    TrUnitVecs = TrVecs / np.linalg.norm(TrVecs, axis=1)[:,None]
+    
+    # lookup of image name to VE intersection index, for each transect
+    ImIndLookup = []
+    for Tr in range(len(TransectInterGDF)):
+        TrFiles = [os.path.basename(x) for x in TransectInterGDF['filename'].iloc[Tr]]
+        ImIndLookup.append({TrFile:ImInd for ImInd, TrFile in reversed(list(enumerate(TrFiles)))})
+    
+    def ProcessTZ(TZraster):
+        f, TZpath, band = TZraster
+        # transects which have a VE intersection from the same image
+        TrIDs = [Tr for Tr in range(len(TransectInterGDF)) if f in ImIndLookup[Tr]]
+        if TrIDs == []:
+            return f, TrIDs, []
+        InterPnts = np.array([TransectInterGDF['interpnt'].iloc[Tr][ImIndLookup[Tr][f]].coords[0] for Tr in TrIDs])
+        TZwidths = TZWidthsFromRaster(TZpath, TransectInterGDF.crs,
+                                      InterPnts, TrUnitVecs[TrIDs], settings['max_dist_ref'], band=band)
+        return f, TrIDs, TZwidths
+    
+    with ThreadPoolExecutor(max_workers=n_workers) as executor:
+        for fnum, (f, TrIDs, TZwidths) in enumerate(executor.map(ProcessTZ, TZrasters)):
+            print('\r %0.3f %% images processed' % ( ((fnum+1)/len(TZrasters))*100 ), end='')
             # Info stored back onto the matching Tr ID
-            WidthFields[Tr][ImInd] = TZwidth
+            for Tr, TZwidth in zip(TrIDs, TZwidths):
+                WidthFields[Tr][ImIndLookup[Tr][f]] = TZwidth
     
-    print('Adding TZ widths to transect shapefile... ')
+    print('\nAdding TZ widths to transect shapefile... ')
     TransectInterGDF['TZwidth'] = WidthFields
     
     # initialise and fill field with median TZ widths across each Tr's timeseries
@@ -863,7 +892,110 @@ def TZIntersect(settings,TransectDict,TransectInterGDF, VeglinesGDF, BasePath):
     return TransectInterGDF
 
 
+def TZWidthsFromRaster(TZpath, TrCRS, InterPnts, TrUnitVecs, MaxDist, SampleStep=1.0, band=1):
+    """
+    Sample a transition zone raster along many transects at once and measure
+    the width of the TZ closest to each veg edge intersection. Samples run 
+    along each transect line (beyond its ends if need be) out to MaxDist 
+    either side of the intersection point. Runs of consecutive TZ samples are 
+    found for all transects together, and the run closest to (or containing)
+    the intersection point gives the TZ width.
+
+    Parameters
+    ----------
+    TZpath : str
+        Filepath to TZ raster (1 = transition zone, NaN elsewhere).
+    TrCRS : pyproj.CRS or str
+        CRS of the transects and intersection points.
+    InterPnts : array
+        N x 2 array of veg edge intersection coordinates (one per transect).
+    TrUnitVecs : array
+        N x 2 array of unit vectors pointing along each transect.
+    MaxDist : float
+        Distance (in metres) either side of the intersection to sample over
+        (usually the ref line buffer distance settings['max_dist_ref']).
+    SampleStep : float, optional
+        Spacing of samples along each transect (in metres). The default is 1.0.
+    band : int, optional
+        Band of raster to read (for multi-band TZ stacks). The default is 1.
+
+    Returns
+    -------
+    TZwidths : array
+        TZ width (in metres) for each transect, NaN where no TZ is crossed.
+
+    """
+    # distances of samples along transect relative to intersection point
+    SampleDists = np.arange(-MaxDist, MaxDist+SampleStep, SampleStep)
+    CentreInd = int(np.argmin(np.abs(SampleDists)))
+    # N transects x M samples coordinate grids
+    SampleX = InterPnts[:,0][:,None] + SampleDists[None,:]*TrUnitVecs[:,0][:,None]
+    SampleY = InterPnts[:,1][:,None] + SampleDists[None,:]*TrUnitVecs[:,1][:,None]
+    
+    with rio.open(TZpath) as src:
+        img = src.read(band)
+        # reproject sample points to raster CRS if needed
+        if src.crs is not None and TrCRS is not None and pyproj.CRS(src.crs) != pyproj.CRS(TrCRS):
+            Transformer = pyproj.Transformer.from_crs(TrCRS, src.crs, always_xy=True)
+            SampleX, SampleY = Transformer.transform(SampleX, SampleY)
+        # world coords to pixel row/col
+        Cols, Rows = ~src.transform * (SampleX, SampleY)
+    Rows = np.floor(Rows).astype(int)
+    Cols = np.floor(Cols).astype(int)
+    InBounds = (Rows >= 0) & (Rows < img.shape[0]) & (Cols >= 0) & (Cols < img.shape[1])
+    TZmask = np.zeros(SampleX.shape, dtype=bool)
+    TZmask[InBounds] = img[Rows[InBounds], Cols[InBounds]] == 1
+    
+    # start (+1) and end (-1) of each run of TZ samples along each transect
+    Edges = np.diff(np.pad(TZmask, ((0,0),(1,1))).astype(np.int8), axis=1)
+    RunTr, RunStart = np.nonzero(Edges == 1)
+    _, RunEnd = np.nonzero(Edges == -1) # ends are exclusive and pair up with starts in order
+    
+    TZwidths = np.full(len(InterPnts), np.nan)
+    if len(RunTr) == 0:
+        return TZwidths
+    # sample distance of each run from intersection (0 if run contains it)
+    RunDist = np.maximum(np.maximum(RunStart - CentreInd, CentreInd - (RunEnd-1)), 0)
+    # pick closest run on each transect
+    Order = np.lexsort((RunDist, RunTr))
+    ClosestTr, FirstInd = np.unique(RunTr[Order], return_index=True)
+    ClosestRuns = Order[FirstInd]
+    TZwidths[ClosestTr] = (RunEnd[ClosestRuns] - RunStart[ClosestRuns]) * SampleStep
+    
+    return TZwidths
+
+
 def SlopeIntersect(settings,TransectDict,TransectInterGDF, VeglinesGDF, BasePath, DTMfile=None):
+    """
+    Extract max and mean slope along each transect from a slope raster, over
+    a swath either side of each transect's average veg edge position (the 
+    width of the swath is the mean TZ width plus 5 m). Sample points for all 
+    transects are built at once and pulled from a single read of the raster 
+    window covering them.
+
+    Parameters
+    ----------
+    settings : dict
+        Veg edge extraction settings.
+    TransectDict : dict
+        Transects with intersection info.
+    TransectInterGDF : GeoDataFrame
+        GDF of transects with veg edge intersections and TZ widths (TZwidthMn).
+    VeglinesGDF : GeoDataFrame
+        GDF of veg edges extracted from sat images.
+    BasePath : str
+        Path to save intersected transect shapefile to.
+    DTMfile : str or rasterio dataset, optional
+        Filepath to slope raster (in same CRS as transects), or an already 
+        open rasterio dataset so repeated runs can share one file handle. 
+        The default is None.
+
+    Returns
+    -------
+    TransectInterGDF : GeoDataFrame
+        GDF of transects with max and mean slope added (SlopeMax, SlopeMean).
+
+    """
     
     if DTMfile is None:
         print('No DTM file provided.')
@@ -872,56 +1004,50 @@ def SlopeIntersect(settings,TransectDict,TransectInterGDF, VeglinesGDF, BasePath
     else:
         print('Intersecting transects with slope ... ')
         
-        # DTM should be in same CRS as Transects    
-        src = rio.open(DTMfile)
-
-        MaxSlope = []
-        MeanSlope = []
+        MaxSlope = np.full(len(TransectInterGDF), np.nan)
+        MeanSlope = np.full(len(TransectInterGDF), np.nan)
         
+        # Take average vegline intersection point of each transect to swath points along
+        # (transects with no line intersections or no TZ width are left as nan)
+        TrIDs, InterPnts, TrStarts, Dists = [], [], [], []
         for Tr in range(len(TransectInterGDF)):
-            print('\r %0.3f %% transects processed' % ( (Tr/len(TransectInterGDF))*100 ), end='')
-
-            # Only want 20 m either side of veg intersect
-            InterPnts = TransectInterGDF['interpnt'].iloc[Tr]
-            # If there are no line intersections on that transect
-            if InterPnts == []:
-                MaxSlope.append(np.nan)
-                MeanSlope.append(np.nan)
+            Pnts = TransectInterGDF['interpnt'].iloc[Tr]
+            if Pnts == [] or np.isnan(TransectInterGDF['TZwidthMn'].iloc[Tr]):
+                continue
+            TrIDs.append(Tr)
+            InterPnts.append([np.mean([Pnt.x for Pnt in Pnts]), np.mean([Pnt.y for Pnt in Pnts])])
+            TrStarts.append(TransectInterGDF.geometry.iloc[Tr].coords[0])
+            # Distance decided by cross-shore width of TZ plus extra 5m buffer
+            Dists.append(round(TransectInterGDF['TZwidthMn'].iloc[Tr]) + 5)
+        
+        if TrIDs != []:
+            InterPnts, TrStarts, Dists = np.array(InterPnts), np.array(TrStarts), np.array(Dists)
+            # normalised vector pointing from intersection back to transect start
+            v = TrStarts - InterPnts
+            vnorm = v / np.linalg.norm(v, axis=1)[:,None]
+            # regularly spaced points (1m apart) from -dist to +dist of intersection along each transect
+            distance_delta = 1
+            Offsets = np.arange(0, 2*Dists.max(), distance_delta)[None,:] - Dists[:,None]
+            Valid = Offsets < Dists[:,None]
+            PntsX = InterPnts[:,0][:,None] + Offsets*vnorm[:,0][:,None]
+            PntsY = InterPnts[:,1][:,None] + Offsets*vnorm[:,1][:,None]
+            
+            # DTM should be in same CRS as Transects
+            if isinstance(DTMfile, str):
+                with rio.open(DTMfile) as src:
+                    Slopes = SampleRasterWindow(src, PntsX, PntsY)
             else:
-                # Take average vegline intersection point of each transect to swath points along
-                InterPnt = Point(np.mean([Pnt.x for Pnt in InterPnts]), np.mean([Pnt.y for Pnt in InterPnts]))
-                
-                # Extend Tr in either direction along transect from intersection point
-                intx, Trx, inty, Try = InterPnt.coords.xy[0][0], TransectInterGDF.iloc[Tr].geometry.coords.xy[0][0], InterPnt.coords.xy[1][0],TransectInterGDF.iloc[Tr].geometry.coords.xy[1][0]
-                # Distance decided by cross-shore width of TZ plus extra 5m buffer
-                # dist = 20
-                dist = round(TransectInterGDF['TZwidthMn'].iloc[Tr]) + 5
-                # calculate vector
-                v = (Trx-intx, Try-inty)
-                v_ = np.sqrt((Trx-intx)**2 + (Try-inty)**2)
-                # calculate normalised vector
-                vnorm = v / v_
-                # use norm vector to extend 
-                x_1, y_1 = (intx, inty) - (dist*vnorm)
-                x_2, y_2 = (intx, inty) + (dist*vnorm)
-                
-                # New linestring from extended points
-                NewTr = gpd.GeoDataFrame(index=[0], crs=TransectInterGDF.crs, geometry=[LineString([(x_1,y_1),(x_2,y_2)])])
-                NewTrGeom = NewTr.geometry
-                # Generate regularly spaced points along each transect
-                distance_delta = 1
-                distances = np.arange(0, float(NewTrGeom.length), distance_delta)
-                points = [NewTrGeom.interpolate(distance) for distance in distances]
-                points = [(float(point.x), float(point.y)) for point in points]
-                
-                # Extract slope values at each point along Tr
-                MaxSlopeTr = np.max([val[0] for val in src.sample(points)])
-                MeanSlopeTr = np.mean([val[0] for val in src.sample(points)])
-                if MaxSlopeTr == -9999: # nodata value
-                    MaxSlopeTr = np.nan
-                    MeanSlopeTr = np.nan
-                MaxSlope.append(MaxSlopeTr)
-                MeanSlope.append(MeanSlopeTr)
+                Slopes = SampleRasterWindow(DTMfile, PntsX, PntsY)
+            
+            # Extract slope values at each point along Tr
+            Slopes = np.where(Valid, Slopes, np.nan)
+            MaxSlopeTr = np.nanmax(Slopes, axis=1)
+            MeanSlopeTr = np.nanmean(Slopes, axis=1)
+            NoData = MaxSlopeTr == -9999 # nodata value
+            MaxSlopeTr[NoData] = np.nan
+            MeanSlopeTr[NoData] = np.nan
+            MaxSlope[TrIDs] = MaxSlopeTr
+            MeanSlope[TrIDs] = MeanSlopeTr
         
         TransectInterGDF['SlopeMax'] = MaxSlope
         TransectInterGDF['SlopeMean'] = MeanSlope
@@ -937,9 +1063,50 @@ def SlopeIntersect(settings,TransectDict,TransectInterGDF, VeglinesGDF, BasePath
         TransectInterShp.to_file(os.path.join(BasePath,settings['inputs']['sitename']+'_Transects_Intersected.shp'))
             
         return TransectInterGDF    
+
+
+def SampleRasterWindow(src, X, Y, band=1):
+    """
+    Sample a raster at many points with a single read of the window covering
+    all of them, rather than many small reads (as with src.sample()). Points
+    falling outside the raster get the nodata value (or 0 if none is set), 
+    as they would from src.sample().
+
+    Parameters
+    ----------
+    src : rasterio dataset
+        Open raster to sample.
+    X : array
+        x coordinates of sample points (any shape, in raster CRS).
+    Y : array
+        y coordinates of sample points (same shape as X).
+    band : int, optional
+        Raster band to sample. The default is 1.
+
+    Returns
+    -------
+    Values : array
+        Raster values at each point (same shape as X).
+
+    """
+    nodata = src.nodata if src.nodata is not None else 0
+    Cols, Rows = ~src.transform * (np.asarray(X), np.asarray(Y))
+    Rows = np.floor(Rows).astype(int)
+    Cols = np.floor(Cols).astype(int)
+    InBounds = (Rows >= 0) & (Rows < src.height) & (Cols >= 0) & (Cols < src.width)
+    Values = np.full(Rows.shape, nodata, dtype=float)
+    if InBounds.any():
+        # single read of window covering all points
+        RowMin, RowMax = Rows[InBounds].min(), Rows[InBounds].max()
+        ColMin, ColMax = Cols[InBounds].min(), Cols[InBounds].max()
+        Win = rio.windows.Window(ColMin, RowMin, ColMax-ColMin+1, RowMax-RowMin+1)
+        WinArr = src.read(band, window=Win)
+        Values[InBounds] = WinArr[Rows[InBounds]-RowMin, Cols[InBounds]-ColMin]
+    
+    return Values
             
 
-def ValidateIntersects(ValidationShp, DatesCol, TransectGDF, TransectDict):
+def ValidateIntersects(ValidationShp, DatesCol, TransectGDF, TransectDict, DateTol=153):
     """
     Intersects transects with validation lines from shapefile, matches date of
     each validation line to nearest sat line, and calculates distance along 
@@ -956,11 +1123,15 @@ def ValidateIntersects(ValidationShp, DatesCol, TransectGDF, TransectDict):
         Transect GDF with no attributes, just geometries.
     TransectDict : dict
         Transect dictionary with attributes.
+    DateTol : int, optional
+        Maximum number of days between matched validation and sat dates.
+        The default is 153 (5 months).
 
     Returns
     -------
-    TYPE
-        DESCRIPTION.
+    ValidDict : dict
+        Transect dictionary with validation intersections (Vdates, Vdists,
+        Vinterpnt) and distances between validation and sat lines (valsatdist).
         
     """
     
@@ -971,89 +1142,28 @@ def ValidateIntersects(ValidationShp, DatesCol, TransectGDF, TransectDict):
     else:
         print('No date column found - check your spelling')
         return
-    # initialise where each intersection between lines and transects will be saved
-    ColumnData = []
-    Geoms = []
-     # for each row/feature in transect
-    for _, _, ID, TrGeom in TransectGDF.itertuples():
-         # for each row/feature shoreline
-        for _,dates,SGeom in ValidGDF.itertuples():
-             # calculate intersections between each transect and shoreline
-            Intersects = TrGeom.intersection(SGeom)
-            ColumnData.append((ID,dates))
-            Geoms.append(Intersects)
-            
-    # create GDF from appended lists of intersections        
-    AllIntersects = gpd.GeoDataFrame(ColumnData,geometry=Geoms,columns=['TransectID','Vdates'])
-    # remove any rows with no intersections
-    AllIntersects = AllIntersects[~AllIntersects.is_empty].reset_index().drop('index',axis=1)
-    # duplicate geom column to save point intersections
-    AllIntersects['Vinterpnt'] = AllIntersects['geometry']
-    # take only first point on any transects which intersected a single shoreline more than once
-    for inter in range(len(AllIntersects)):
-        if AllIntersects['Vinterpnt'][inter].geom_type == 'MultiPoint':
-            AllIntersects['Vinterpnt'][inter] = list(AllIntersects['Vinterpnt'][inter])[0] # list() accesses individual points in MultiPoint
-    AllIntersects = AllIntersects.drop('geometry',axis=1)
-    # attribute join on transect ID to get transect geometry back
-    AllIntersects = AllIntersects.merge(TransectGDF[['TransectID','geometry']], on='TransectID')
+    AllIntersects = ValidationIntersects(ValidGDF, DatesCol, TransectGDF)
     
     print("formatting back into dict...")
-    # initialise distances of intersections 
-    distances = []
-    # for each intersection
-    for i in range(len(AllIntersects)):
-        # calculate distance of intersection along transect
-        distances.append(Toolbox.CalcDistance(AllIntersects['Vinterpnt'][i], AllIntersects['geometry'][i]))
-    AllIntersects['Vdists'] = distances
-    
-    #initialise lists used for storing each transect's intersection values
-    Vdates,Vdists, Vinterpnt = ([] for i in range(3)) # per-transect lists of values
-
-    Key = [Vdates, Vdists, Vinterpnt]
-    KeyName = ['Vdates', 'Vdists', 'Vinterpnt']
     ValidDict = TransectDict.copy()
-    
-    # for each column name
-    for i in range(len(Key)):
-        # for each transect
-        for Tr in range(len(TransectGDF['TransectID'])):
-            # refresh per-transect list
-            TrKey = []
-            # for each matching intersection on a single transect
-            for j in range(len(AllIntersects.loc[AllIntersects['TransectID']==Tr])):
-                # append each intersection value to a list for each transect
-                # iloc used so index doesn't restart at 0 each loop
-                TrKey.append(AllIntersects[KeyName[i]].loc[AllIntersects['TransectID']==Tr].iloc[j]) 
-            Key[i].append(TrKey)
-    
-        ValidDict[KeyName[i]] = Key[i]
+    ValidDict.update(GroupByTransect(AllIntersects, ['Vdates', 'Vdists', 'Vinterpnt'], len(TransectGDF)))
     
     print('calculating distances between validation and sat lines...')
-    ValidDict['valsatdist'] = ValidDict['TransectID'].copy()
-    # for each transect
-    for Tr in range(len(TransectGDF['TransectID'])):
-        # dates into transect-specific list
-        VDateList = [datetime.strptime(date, '%Y-%m-%d') for date in ValidDict['Vdates'][Tr]]
-        DateList = [datetime.strptime(date, '%Y-%m-%d') for date in ValidDict['dates'][Tr]]
-        # find index of closest sat date to each validation date
-        ValSatDists = []
-        for D, VDate in enumerate(VDateList):
-            # index of matching nearest date
-            if DateList != []:
-                DateIndex = DateList.index(Toolbox.NearDate(VDate,DateList))
-            else:
-                continue
-            # use date index to identify matching distance along transect
-            # and calculate distance between two intersections (sat - validation means +ve is seaward/-ve is landward)
-            ValSatDists.append(ValidDict['distances'][Tr][DateIndex] - ValidDict['Vdists'][Tr][D])
-            
-        ValidDict['valsatdist'][Tr] = ValSatDists
+    SatDF = TransectDictToDF(TransectDict, ['dates','distances'])
+    # find closest sat date to each validation date
+    ValSatDF = MatchNearestDates(AllIntersects[['TransectID','Vdates','Vdists']], SatDF, 'Vdates', 'dates', DateTol)
+    # distance between two intersections (sat - validation means +ve is seaward/-ve is landward)
+    ValSatDF['valsatdist'] = ValSatDF['distances'] - ValSatDF['Vdists']
+    ValidDict.update(GroupByTransect(ValSatDF, ['valsatdist'], len(TransectGDF)))
+    # transects with no sat intersections have no distances to compare
+    ValidDict['valsatdist'] = [ValSatDists if TrDates != [] else [] 
+                               for ValSatDists, TrDates in zip(ValidDict['valsatdist'], TransectDict['dates'])]
         
     print("TransectDict with intersections created.")
     
     return ValidDict
 
-def ValidateSatIntersects(sitename, ValidationShp, DatesCol, TransectGDF, TransectDict):
+def ValidateSatIntersects(sitename, ValidationShp, DatesCol, TransectGDF, TransectDict, DateTol=153):
     """
     Intersects transects with validation lines from shapefile, matches date of
     each sat line to nearest valid. line, and calculates distance along 
@@ -1071,11 +1181,16 @@ def ValidateSatIntersects(sitename, ValidationShp, DatesCol, TransectGDF, Transe
         Transect GDF with no attributes, just geometries.
     TransectDict : dict
         Transect dictionary with attributes.
+    DateTol : int, optional
+        Maximum number of days between matched sat and validation dates.
+        The default is 153 (5 months).
 
     Returns
     -------
     ValidDict : dict
-        DESCRIPTION.
+        Transect dictionary with validation intersections (Vdates, Vdists,
+        Vinterpnt), and distances to and dates of matching validation lines
+        for each sat line (valsatdist, valsatdate; nan where no match exists).
         
     """
     
@@ -1090,102 +1205,122 @@ def ValidateSatIntersects(sitename, ValidationShp, DatesCol, TransectGDF, Transe
     else:
         print('No date column found - check your spelling')
         return
-    # initialise where each intersection between lines and transects will be saved
-    ColumnData = []
-    Geoms = []
-     # for each row/feature in transect
-    for _, _, ID, TrGeom in TransectGDF.itertuples():
-         # for each row/feature shoreline
-        for _,dates,SGeom in ValidGDF.itertuples():
-             # calculate intersections between each transect and shoreline
-            Intersects = TrGeom.intersection(SGeom)
-            ColumnData.append((ID,dates))
-            Geoms.append(Intersects)
-            
-    # create GDF from appended lists of intersections        
-    AllIntersects = gpd.GeoDataFrame(ColumnData,geometry=Geoms,columns=['TransectID','Vdates'])
-    # remove any rows with no intersections
-    AllIntersects = AllIntersects[~AllIntersects.is_empty].reset_index().drop('index',axis=1)
-    # duplicate geom column to save point intersections
-    AllIntersects['Vinterpnt'] = AllIntersects['geometry']
-    # take only first point on any transects which intersected a single shoreline more than once
-    for inter in range(len(AllIntersects)):
-        if AllIntersects['Vinterpnt'][inter].geom_type == 'MultiPoint':
-            AllIntersects['Vinterpnt'][inter] = list(AllIntersects['Vinterpnt'][inter])[0] # list() accesses individual points in MultiPoint
-    AllIntersects = AllIntersects.drop('geometry',axis=1)
-    # attribute join on transect ID to get transect geometry back
-    AllIntersects = AllIntersects.merge(TransectGDF[['TransectID','geometry']], on='TransectID')
+    AllIntersects = ValidationIntersects(ValidGDF, DatesCol, TransectGDF)
     
     print("formatting back into dict...")
-    # initialise distances of intersections 
-    distances = []
-    # for each intersection
-    for i in range(len(AllIntersects)):
-        # calculate distance of intersection along transect
-        distances.append(Toolbox.CalcDistance(AllIntersects['Vinterpnt'][i], AllIntersects['geometry'][i]))
-    AllIntersects['Vdists'] = distances
-    
-    #initialise lists used for storing each transect's intersection values
-    Vdates,Vdists, Vinterpnt = ([] for i in range(3)) # per-transect lists of values
-
-    Key = [Vdates, Vdists, Vinterpnt]
-    KeyName = ['Vdates', 'Vdists', 'Vinterpnt']
     ValidDict = TransectDict.copy()
-    
-    # for each column name
-    for i in range(len(Key)):
-        # for each transect
-        for Tr in range(len(TransectGDF['TransectID'])):
-            # refresh per-transect list
-            TrKey = []
-            # for each matching intersection on a single transect
-            for j in range(len(AllIntersects.loc[AllIntersects['TransectID']==Tr])):
-                # append each intersection value to a list for each transect
-                # iloc used so index doesn't restart at 0 each loop
-                TrKey.append(AllIntersects[KeyName[i]].loc[AllIntersects['TransectID']==Tr].iloc[j]) 
-            Key[i].append(TrKey)
-    
-        ValidDict[KeyName[i]] = Key[i]
+    ValidDict.update(GroupByTransect(AllIntersects, ['Vdates', 'Vdists', 'Vinterpnt'], len(TransectGDF)))
     
     print('calculating distances between validation and sat lines...')
-    ValidDict['valsatdist'] = ValidDict['TransectID'].copy()
-    ValidDict['valsatdate'] = ValidDict['TransectID'].copy()
-    # for each transect
-    for Tr in range(len(TransectGDF['TransectID'])):
-        # dates into transect-specific list
-        VDateList = [datetime.strptime(date, '%Y-%m-%d') for date in ValidDict['Vdates'][Tr]]
-        DateList = [datetime.strptime(date, '%Y-%m-%d') for date in ValidDict['dates'][Tr]]
-        # find index of closest validation date to each sat date
-        # previously was empty list with nans or distances appended
-        # now should start with list of nans with n=n(dates)
-        ValSatDists = list(np.empty(len(ValidDict['dates'][Tr]))*np.nan)
-        ValSatDates = list(np.empty(len(ValidDict['dates'][Tr]))*np.nan)
-        for D, Date in enumerate(DateList):
-            # index of matching nearest date
-            if VDateList != []:
-                NearestDate = Toolbox.NearDate(Date,VDateList)
-                if NearestDate == False: # if no matching validation date exists, add nan to the list
-                    continue
-                else:
-                    # use date index to identify matching distance along transect
-                    # and calculate distance between two intersections (sat - validation means +ve is seaward/-ve is landward)
-                    DateStr = datetime.strftime(Date,'%Y-%m-%d')
-                    SDateIndex = ValidDict['dates'][Tr].index(DateStr)
-                    VDateIndex = VDateList.index(NearestDate)
-                    ValSatDists[SDateIndex] = ValidDict['distances'][Tr][D] - ValidDict['Vdists'][Tr][VDateIndex]
-                    ValSatDates[SDateIndex] = ValidDict['Vdates'][Tr][VDateIndex]
-            else:
-                continue
-       
-
-        ValidDict['valsatdist'][Tr] = ValSatDists
-        ValidDict['valsatdate'][Tr] = ValSatDates
+    # each sat line keeps its own slot; unmatched lines stay as nan
+    SatDF = TransectDictToDF(TransectDict, ['dates','distances'])
+    ValSatDF = MatchNearestDates(SatDF, AllIntersects[['TransectID','Vdates','Vdists']], 'dates', 'Vdates', DateTol)
+    # distance between two intersections (sat - validation means +ve is seaward/-ve is landward)
+    ValSatDF['valsatdist'] = ValSatDF['distances'] - ValSatDF['Vdists']
+    ValSatDF['valsatdate'] = ValSatDF['Vdates']
+    ValidDict.update(GroupByTransect(ValSatDF, ['valsatdist','valsatdate'], len(TransectGDF)))
         
     print("ValidDict with intersections created.")
     
     return ValidDict
 
 
+def ValidationIntersects(ValidGDF, DatesCol, TransectGDF):
+    """
+    Intersect transects with validation lines using a spatial index, and
+    measure distance of each intersection along its transect.
+
+    Parameters
+    ----------
+    ValidGDF : GeoDataFrame
+        Validation lines with dates field.
+    DatesCol : str
+        Name of attribute field where dates are stored.
+    TransectGDF : GeoDataFrame
+        Transect GDF with no attributes, just geometries.
+
+    Returns
+    -------
+    AllIntersects : DataFrame
+        One row per transect-validation line intersection, with fields
+        TransectID, Vdates, Vinterpnt and Vdists.
+
+    """
+    AllIntersects = TransectIntersects(TransectGDF, ValidGDF)
+    AllIntersects['Vdates'] = ValidGDF[DatesCol].values[AllIntersects['LineID']]
+    AllIntersects = AllIntersects.rename(columns={'interpnt':'Vinterpnt', 'distances':'Vdists'})
+    
+    return AllIntersects
+
+
+def TransectDictToDF(TransectDict, KeyName):
+    """
+    Flatten per-transect lists of values in TransectDict into one table, 
+    with one row per value and a TransectID field.
+
+    Parameters
+    ----------
+    TransectDict : dict
+        Transect dictionary with attributes.
+    KeyName : list
+        Names of per-transect list fields to flatten (must be same lengths).
+
+    Returns
+    -------
+    TransectDF : DataFrame
+        Flattened values with TransectID field.
+
+    """
+    TrLens = [len(TrVals) for TrVals in TransectDict[KeyName[0]]]
+    TransectDF = pd.DataFrame({'TransectID':np.repeat(np.arange(len(TrLens)), TrLens)})
+    for Key in KeyName:
+        TransectDF[Key] = [Val for TrVals in TransectDict[Key] for Val in TrVals]
+    
+    return TransectDF
+
+
+def MatchNearestDates(LeftDF, RightDF, LeftDates, RightDates, DateTol=153):
+    """
+    Match each row of one table of per-transect values to the row of another 
+    table with the nearest date on the same transect. Where a transect has
+    several rows on the same date in RightDF, the first is used.
+
+    Parameters
+    ----------
+    LeftDF : DataFrame
+        Rows to find matches for (with TransectID field).
+    RightDF : DataFrame
+        Rows to match to (with TransectID field).
+    LeftDates : str
+        Name of dates field ('%Y-%m-%d' strings) in LeftDF.
+    RightDates : str
+        Name of dates field ('%Y-%m-%d' strings) in RightDF.
+    DateTol : int, optional
+        Maximum number of days between matched dates. The default is 153.
+
+    Returns
+    -------
+    MatchDF : DataFrame
+        LeftDF in its original order, with fields of the matched RightDF rows
+        appended (nan where no match within DateTol exists).
+
+    """
+    Left = LeftDF.reset_index(drop=True).copy()
+    Left['order'] = np.arange(len(Left))
+    Left['leftdatetime'] = pd.to_datetime(Left[LeftDates], format='%Y-%m-%d')
+    Left['TransectID'] = Left['TransectID'].astype(int)
+    Right = RightDF.drop_duplicates(['TransectID',RightDates]).copy()
+    Right['rightdatetime'] = pd.to_datetime(Right[RightDates], format='%Y-%m-%d')
+    Right['TransectID'] = Right['TransectID'].astype(int)
+    
+    MatchDF = pd.merge_asof(Left.sort_values('leftdatetime'), Right.sort_values('rightdatetime'),
+                            left_on='leftdatetime', right_on='rightdatetime', by='TransectID',
+                            direction='nearest', tolerance=pd.Timedelta(days=DateTol))
+    MatchDF = MatchDF.sort_values('order').drop(columns=['order','leftdatetime','rightdatetime']).reset_index(drop=True)
+    
+    return MatchDF
+
+
 def compute_intersection(output, transects, settings, linetype):
     """
     Computes the intersection between the 2D shorelines and the shore-normal.
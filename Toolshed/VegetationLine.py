@@ -32,8 +32,10 @@ import matplotlib.cm as cm
 from matplotlib import colors
 from matplotlib import gridspec
 import pickle
+import hashlib
 from datetime import datetime
 from pylab import ginput
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor, as_completed
 
 # CoastSat modules
 from Toolshed import Toolbox, Image_Processing
@@ -89,229 +91,250 @@ def extract_veglines(metadata, settings, polygon, dates, clf_model):
     plt.close('all')
 
     print('Mapping veglines:')
-
-    # loop through satellite list
-    for satname in metadata.keys():
-
-        # get images
-        #filepath = Toolbox.get_filepath(settings['inputs'],satname)
-        filenames = metadata[satname]['filenames']
-
-        # initialise the output variables
-        output_timestamp = []       # datetime at which the image was acquired (YYYY-MM-DD)
-        output_time = []            # UTC timestamp
-        output_vegline = []         # vector of vegline points
-        output_vegline_latlon = []
-        output_vegline_proj = []
-        output_shoreline = []       # vector of waterline points
-        output_shoreline_latlon = []
-        output_shoreline_proj = []
-        output_filename = []        # filename of the images from which the veglines are derived
-        output_cloudcover = []      # cloud cover of the images
-        output_geoaccuracy = []     # georeferencing accuracy of the images
-        output_idxkeep = []         # index that were kept during the analysis (cloudy images are skipped)
-        output_t_ndvi = []          # NDVI threshold used to map the vegline
-        output_t_ndwi = []          # NDWI threshold used to map the vegline
+    
+    # quicklook GeoTIFFs can be written in the background while images are processed
+    if Image_Processing.QuicklookMode(settings) in ['defer','downsample']:
+        writer = Image_Processing.TifWriter()
+    else:
+        writer = None
+
+    try:
+        # loop through satellite list
+        for satname in metadata.keys():
+
+            # get images
+            #filepath = Toolbox.get_filepath(settings['inputs'],satname)
+            filenames = metadata[satname]['filenames']
+
+            # initialise the output variables
+            output_timestamp = []       # datetime at which the image was acquired (YYYY-MM-DD)
+            output_time = []            # UTC timestamp
+            output_vegline = []         # vector of vegline points
+            output_vegline_latlon = []
+            output_vegline_proj = []
+            output_shoreline = []       # vector of waterline points
+            output_shoreline_latlon = []
+            output_shoreline_proj = []
+            output_filename = []        # filename of the images from which the veglines are derived
+            output_cloudcover = []      # cloud cover of the images
+            output_geoaccuracy = []     # georeferencing accuracy of the images
+            output_idxkeep = []         # index that were kept during the analysis (cloudy images are skipped)
+            output_t_ndvi = []          # NDVI threshold used to map the vegline
+            output_t_ndwi = []          # NDWI threshold used to map the vegline
         
-        # get pixel size from dimensions in first image
-        if satname in ['L5','L7','L8','L9']:
-            pixel_size = 15
-            # ee.Image(metadata[satname]['filenames'][0]).getInfo()['bands'][1]['crs_transform'][0] / 2 # after downsampling
-        elif satname == 'S2':
-            pixel_size = 10
-            # ee.Image(metadata[satname]['filenames'][0]).getInfo()['bands'][1]['crs_transform'][0]
-        else:
-            pixel_size = metadata[settings['inputs']['sat_list'][0]]['acc_georef'][0][0] #pull first image's pixel size from transform matrix
+            # get pixel size from dimensions in first image
+            if satname in ['L5','L7','L8','L9']:
+                pixel_size = 15
+                # ee.Image(metadata[satname]['filenames'][0]).getInfo()['bands'][1]['crs_transform'][0] / 2 # after downsampling
+            elif satname == 'S2':
+                pixel_size = 10
+                # ee.Image(metadata[satname]['filenames'][0]).getInfo()['bands'][1]['crs_transform'][0]
+            else:
+                pixel_size = metadata[settings['inputs']['sat_list'][0]]['acc_georef'][0][0] #pull first image's pixel size from transform matrix
         
-        # load in trained classifier pkl file
-        clf = joblib.load(os.path.join(filepath_models, clf_model))
+            # load in trained classifier pkl file
+            clf = joblib.load(os.path.join(filepath_models, clf_model))
+        
+            # if batch writing TZ rasters, add them to one stack per satellite
+            if 'TZ_stack' in settings.keys() and settings['TZ_stack']:
+                TZstack = Image_Processing.TZStack(satname, settings)
+            else:
+                TZstack = None
             
-        # convert settings['min_beach_area'] and settings['buffer_size'] from metres to pixels
-        # TO DO: figure out why these exist
-        buffer_size_pixels = np.ceil(settings['buffer_size']/pixel_size)
-        min_beach_area_pixels = np.ceil(settings['min_beach_area']/pixel_size**2)
+            # convert settings['min_beach_area'] and settings['buffer_size'] from metres to pixels
+            # TO DO: figure out why these exist
+            buffer_size_pixels = np.ceil(settings['buffer_size']/pixel_size)
+            min_beach_area_pixels = np.ceil(settings['min_beach_area']/pixel_size**2)
 
-        # loop through the images
-        for i in range(len(filenames)):
+            # loop through the images
+            for i in range(len(filenames)):
 
-            print('\r%s:   %0.3f %% ' % (satname,((i+1)/len(filenames))*100), end='')
+                print('\r%s:   %0.3f %% ' % (satname,((i+1)/len(filenames))*100), end='')
 
-            # preprocess image (cloud mask + pansharpening/downsampling)
-            fn = int(i)
-            im_ms, georef, cloud_mask, im_extra, im_QA, im_nodata, acqtime = Image_Processing.preprocess_single(fn, filenames, satname, settings, polygon, dates, savetifs=True)
+                # preprocess image (cloud mask + pansharpening/downsampling)
+                fn = int(i)
+                im_ms, georef, cloud_mask, im_extra, im_QA, im_nodata, acqtime = Image_Processing.preprocess_single_cached(fn, filenames, satname, settings, polygon, dates, savetifs=True, writer=writer)
 
-            if im_ms is None:
-                print(" - Skipped: empty raster")
-                continue
+                if im_ms is None:
+                    print(" - Skipped: empty raster")
+                    continue
             
-            if cloud_mask == []:
-                print(" - Skipped: no cloud mask available")
-                continue
+                if isinstance(cloud_mask, list) and len(cloud_mask) == 0:
+                    print(" - Skipped: no cloud mask available")
+                    continue
             
-            # get image spatial reference system (epsg code) from metadata dict
-            image_epsg = int(metadata[satname]['epsg'][i])
-            # compute cloud_cover percentage (with no data pixels)
-            cloud_cover_combined = np.divide(sum(sum(cloud_mask.astype(int))),
-                                    (cloud_mask.shape[0]*cloud_mask.shape[1]))
-            if cloud_cover_combined > 0.95: # if 99% of cloudy pixels in image skip
-                print(" - Skipped: cloud cover over 95%")
-                continue
-            # remove no data pixels from the cloud mask 
-            # (for example L7 bands of no data should not be accounted for)
-            cloud_mask_adv = np.logical_xor(cloud_mask, im_nodata) 
-            # compute updated cloud cover percentage (without no data pixels)
-            cloud_cover = np.divide(sum(sum(cloud_mask_adv.astype(int))),
-                                    (sum(sum((~im_nodata).astype(int)))))
-            # skip image if cloud cover is above user-defined threshold
-            if cloud_cover > settings['cloud_thresh']:
-                print(" - Skipped: cloud cover over user threshold")
-                continue
+                # get image spatial reference system (epsg code) from metadata dict
+                image_epsg = int(metadata[satname]['epsg'][i])
+                # compute cloud_cover percentage (with no data pixels)
+                cloud_cover_combined = np.divide(sum(sum(cloud_mask.astype(int))),
+                                        (cloud_mask.shape[0]*cloud_mask.shape[1]))
+                if cloud_cover_combined > 0.95: # if 99% of cloudy pixels in image skip
+                    print(" - Skipped: cloud cover over 95%")
+                    continue
+                # remove no data pixels from the cloud mask 
+                # (for example L7 bands of no data should not be accounted for)
+                cloud_mask_adv = np.logical_xor(cloud_mask, im_nodata) 
+                # compute updated cloud cover percentage (without no data pixels)
+                cloud_cover = np.divide(sum(sum(cloud_mask_adv.astype(int))),
+                                        (sum(sum((~im_nodata).astype(int)))))
+                # skip image if cloud cover is above user-defined threshold
+                if cloud_cover > settings['cloud_thresh']:
+                    print(" - Skipped: cloud cover over user threshold")
+                    continue
 
-            # calculate a buffer around the reference shoreline
-            im_ref_buffer_og = BufferShoreline(settings,settings['reference_shoreline'],georef,cloud_mask)
-            if i == 0: # if the first image in a sat set, use the ref shoreline
-                im_ref_buffer = im_ref_buffer_og
-            else:
-                im_ref_buffer = im_ref_buffer_og
-            # otherwise use the most recent shoreline found, so buffer updates through time
-            # TO DO: figure out way to update refline ONLY if no gaps in previous line exist (length-based? based on number of coords?)
-            # elif output_shoreline[-1].length < im_ref_buffer_og: 
-            #     output_shorelineArr = Toolbox.GStoArr(output_shoreline[-1])
-            #     im_ref_buffer = BufferShoreline(settings,output_shorelineArr,georef,pixel_size,cloud_mask)
-            # # im_ref_buffer = BufferShoreline(settings,georef,pixel_size,cloud_mask)
+                # calculate a buffer around the reference shoreline
+                im_ref_buffer_og = BufferShoreline(settings,settings['reference_shoreline'],georef,cloud_mask)
+                if i == 0: # if the first image in a sat set, use the ref shoreline
+                    im_ref_buffer = im_ref_buffer_og
+                else:
+                    im_ref_buffer = im_ref_buffer_og
+                # otherwise use the most recent shoreline found, so buffer updates through time
+                # TO DO: figure out way to update refline ONLY if no gaps in previous line exist (length-based? based on number of coords?)
+                # elif output_shoreline[-1].length < im_ref_buffer_og: 
+                #     output_shorelineArr = Toolbox.GStoArr(output_shoreline[-1])
+                #     im_ref_buffer = BufferShoreline(settings,output_shorelineArr,georef,pixel_size,cloud_mask)
+                # # im_ref_buffer = BufferShoreline(settings,georef,pixel_size,cloud_mask)
             
-            # classify image with NN classifier
-            im_classif, im_labels = classify_image_NN(im_ms, im_extra, cloud_mask, min_beach_area_pixels, clf)
-            # if extracting shorelines alongside (using original CoastSat NN)
-            if settings['wetdry'] == True:
-                sh_clf = joblib.load(os.path.join(filepath_models, 'NN_4classes_S2_new.pkl'))
-                sh_classif, sh_labels = classify_image_NN_shore(im_ms, im_extra, cloud_mask, min_beach_area_pixels, sh_clf)
+                # classify image with NN classifier
+                im_classif, im_labels = classify_image_NN(im_ms, im_extra, cloud_mask, min_beach_area_pixels, clf)
+                # if extracting shorelines alongside (using original CoastSat NN)
+                if settings['wetdry'] == True:
+                    sh_clf = joblib.load(os.path.join(filepath_models, 'NN_4classes_S2_new.pkl'))
+                    sh_classif, sh_labels = classify_image_NN_shore(im_ms, im_extra, cloud_mask, min_beach_area_pixels, sh_clf)
             
-            # if classified image comes back with almost no pixels in either class (<5%), skip
-            if (np.count_nonzero(im_labels[:,:,0])/(len(im_labels) * len(im_labels[0]))) < 0.05 or (np.count_nonzero(im_labels[:,:,1])/(len(im_labels) * len(im_labels[0]))) < 0.05:
-                print(' - Skipped: classifier cannot find enough variety of classes')
-                continue
+                # if classified image comes back with almost no pixels in either class (<5%), skip
+                if (np.count_nonzero(im_labels[:,:,0])/(len(im_labels) * len(im_labels[0]))) < 0.05 or (np.count_nonzero(im_labels[:,:,1])/(len(im_labels) * len(im_labels[0]))) < 0.05:
+                    print(' - Skipped: classifier cannot find enough variety of classes')
+                    continue
             
-            # save classified image and transition zone mask after classification takes place
-            Image_Processing.save_ClassIm(im_classif, im_labels, cloud_mask, georef, filenames[fn], settings)
-            Image_Processing.save_TZone(im_ms, im_labels, cloud_mask, georef, filenames[fn], settings)
+                # save classified image and transition zone mask after classification takes place
+                Image_Processing.save_ClassIm(im_classif, im_labels, cloud_mask, georef, filenames[fn], settings, writer)
+                Image_Processing.save_TZone(im_ms, im_labels, cloud_mask, georef, filenames[fn], settings, TZstack)
             
-            # if adjust_detection is True, let the user adjust the detected shoreline
-            if settings['adjust_detection']:
-                date = metadata[satname]['dates'][i]
-                skip_image, vegline, vegline_latlon, vegline_proj, t_ndvi = adjust_detection(im_ms, cloud_mask, im_labels,
-                                                                  im_ref_buffer, image_epsg, georef,
-                                                                  settings, date, satname, buffer_size_pixels, image_epsg)
-                # if the user decides to skip the image, continue and do not save the mapped vegline
-                if skip_image:
-                    continue
+                # if adjust_detection is True, let the user adjust the detected shoreline
+                if settings['adjust_detection']:
+                    date = metadata[satname]['dates'][i]
+                    skip_image, vegline, vegline_latlon, vegline_proj, t_ndvi = adjust_detection(im_ms, cloud_mask, im_labels,
+                                                                      im_ref_buffer, image_epsg, georef,
+                                                                      settings, date, satname, buffer_size_pixels, image_epsg)
+                    # if the user decides to skip the image, continue and do not save the mapped vegline
+                    if skip_image:
+                        continue
                 
-            else:
-                # compute NDVI image (NIR-R)
-                im_ndvi = Toolbox.nd_index(im_ms[:,:,3], im_ms[:,:,2], cloud_mask)
-
-                if settings['inputs']['sitename'] == 'StAndrewsWest' or settings['inputs']['sitename'] == 'StAndrewsEast':
-                    print('(using weighted peaks for contouring)')
-                    contours_ndvi, t_ndvi = FindShoreContours_WP(im_ndvi, im_labels, cloud_mask, im_ref_buffer)
-                    # contours_ndvi, t_ndvi = FindShoreContours_Enhc(im_ndvi, im_labels, cloud_mask, im_ref_buffer)
                 else:
-                    # contours_ndvi, t_ndvi = FindShoreContours_Enhc(im_ndvi, im_labels, cloud_mask, im_ref_buffer)
-                    contours_ndvi, t_ndvi = FindShoreContours_WP(im_ndvi, im_labels, cloud_mask, im_ref_buffer)
-                    
-                if settings['wetdry'] == True:
-                    im_ndwi = Toolbox.nd_index(im_ms[:,:,3], im_ms[:,:,1], cloud_mask)
-                    contours_ndwi, t_ndwi = FindShoreContours_Water(im_ndwi, sh_labels, cloud_mask, im_ref_buffer)
+                    # compute NDVI image (NIR-R)
+                    im_ndvi = Toolbox.nd_index(im_ms[:,:,3], im_ms[:,:,2], cloud_mask)
 
-                # process the contours into a vegline
-                vegline, vegline_latlon, vegline_proj = ProcessShoreline(contours_ndvi, cloud_mask, georef, image_epsg, settings)
-                if settings['wetdry'] == True:
-                    shoreline, shoreline_latlon, shoreline_proj = ProcessShoreline(contours_ndwi, cloud_mask, georef, image_epsg, settings)
+                    if settings['inputs']['sitename'] == 'StAndrewsWest' or settings['inputs']['sitename'] == 'StAndrewsEast':
+                        print('(using weighted peaks for contouring)')
+                        contours_ndvi, t_ndvi = FindShoreContours_WP(im_ndvi, im_labels, cloud_mask, im_ref_buffer)
+                        # contours_ndvi, t_ndvi = FindShoreContours_Enhc(im_ndvi, im_labels, cloud_mask, im_ref_buffer)
+                    else:
+                        # contours_ndvi, t_ndvi = FindShoreContours_Enhc(im_ndvi, im_labels, cloud_mask, im_ref_buffer)
+                        contours_ndvi, t_ndvi = FindShoreContours_WP(im_ndvi, im_labels, cloud_mask, im_ref_buffer)
+                    
+                    if settings['wetdry'] == True:
+                        im_ndwi = Toolbox.nd_index(im_ms[:,:,3], im_ms[:,:,1], cloud_mask)
+                        contours_ndwi, t_ndwi = FindShoreContours_Water(im_ndwi, sh_labels, cloud_mask, im_ref_buffer)
 
-                if settings['check_detection'] or settings['save_figure']:
-                    date = metadata[satname]['dates'][i]
-                    if not settings['check_detection']:
-                        plt.ioff() # turning interactive plotting off
+                    # process the contours into a vegline
+                    vegline, vegline_latlon, vegline_proj = ProcessShoreline(contours_ndvi, cloud_mask, georef, image_epsg, settings)
                     if settings['wetdry'] == True:
-                        skip_image = show_detection(im_ms, cloud_mask, im_labels, im_ref_buffer, vegline,
-                                                    image_epsg, georef, settings, date, satname, contours_ndvi, t_ndvi,
-                                                    sh_classif, sh_labels, contours_ndwi, t_ndwi)
-                    else:
-                        skip_image = show_detection(im_ms, cloud_mask, im_labels, im_ref_buffer, vegline,
-                                                    image_epsg, georef, settings, date, satname, contours_ndvi, t_ndvi)
+                        shoreline, shoreline_latlon, shoreline_proj = ProcessShoreline(contours_ndwi, cloud_mask, georef, image_epsg, settings)
+
+                    if settings['check_detection'] or settings['save_figure']:
+                        date = metadata[satname]['dates'][i]
+                        if not settings['check_detection']:
+                            plt.ioff() # turning interactive plotting off
+                        if settings['wetdry'] == True:
+                            skip_image = show_detection(im_ms, cloud_mask, im_labels, im_ref_buffer, vegline,
+                                                        image_epsg, georef, settings, date, satname, contours_ndvi, t_ndvi,
+                                                        sh_classif, sh_labels, contours_ndwi, t_ndwi)
+                        else:
+                            skip_image = show_detection(im_ms, cloud_mask, im_labels, im_ref_buffer, vegline,
+                                                        image_epsg, georef, settings, date, satname, contours_ndvi, t_ndvi)
                         
                         
-                        # if the user decides to skip the image, continue and do not save the mapped vegline
-                    if skip_image:
-                        continue
+                            # if the user decides to skip the image, continue and do not save the mapped vegline
+                        if skip_image:
+                            continue
             
 
-            # append to output variables
-            output_timestamp.append(metadata[satname]['dates'][i])
-            output_time.append(acqtime)
-            output_vegline.append(vegline)
-            output_vegline_latlon.append(vegline_latlon)
-            output_vegline_proj.append(vegline_proj)
-            if settings['wetdry'] == True:
-                output_shoreline.append(shoreline)
-                output_shoreline_latlon.append(shoreline_latlon)
-                output_shoreline_proj.append(shoreline_proj)
-                output_t_ndwi.append(t_ndwi)
-            output_filename.append(filenames[i])
-            output_cloudcover.append(cloud_cover)
-            output_geoaccuracy.append(metadata[satname]['acc_georef'][i])
-            output_idxkeep.append(i)
-            output_t_ndvi.append(t_ndvi)
+                # append to output variables
+                output_timestamp.append(metadata[satname]['dates'][i])
+                output_time.append(acqtime)
+                output_vegline.append(vegline)
+                output_vegline_latlon.append(vegline_latlon)
+                output_vegline_proj.append(vegline_proj)
+                if settings['wetdry'] == True:
+                    output_shoreline.append(shoreline)
+                    output_shoreline_latlon.append(shoreline_latlon)
+                    output_shoreline_proj.append(shoreline_proj)
+                    output_t_ndwi.append(t_ndwi)
+                output_filename.append(filenames[i])
+                output_cloudcover.append(cloud_cover)
+                output_geoaccuracy.append(metadata[satname]['acc_georef'][i])
+                output_idxkeep.append(i)
+                output_t_ndvi.append(t_ndvi)
 
         
-        # create dictionary of output
-        output[satname] = {
-                'dates': output_timestamp,
-                'times':output_time,
-                'shorelines': output_vegline,
-                'waterlines':output_shoreline,
-                'filename': output_filename,
-                'cloud_cover': output_cloudcover,
-                'idx': output_idxkeep,
-                'vthreshold': output_t_ndvi,
-                'wthreshold': output_t_ndwi
-                }
-        print('')
-    
-        output_latlon[satname] = {
-                'dates': output_timestamp,
-                'times':output_time,
-                'shorelines': output_vegline_latlon,
-                'waterlines':output_shoreline_latlon,
-                'filename': output_filename,
-                'cloud_cover': output_cloudcover,
-                'idx': output_idxkeep,
-                'vthreshold': output_t_ndvi,
-                'wthreshold': output_t_ndwi
-                }
+            if TZstack is not None:
+                TZstack.Close()
         
-        output_proj[satname] = {
-                'dates': output_timestamp,
-                'times':output_time,
-                'shorelines': output_vegline_proj,
-                'waterlines':output_shoreline_proj,
-                'filename': output_filename,
-                'cloud_cover': output_cloudcover,
-                'idx': output_idxkeep,
-                'vthreshold': output_t_ndvi,
-                'wthreshold': output_t_ndwi
-                }
+            # create dictionary of output
+            output[satname] = {
+                    'dates': output_timestamp,
+                    'times':output_time,
+                    'shorelines': output_vegline,
+                    'waterlines':output_shoreline,
+                    'filename': output_filename,
+                    'cloud_cover': output_cloudcover,
+                    'idx': output_idxkeep,
+                    'vthreshold': output_t_ndvi,
+                    'wthreshold': output_t_ndwi
+                    }
+            print('')
+    
+            output_latlon[satname] = {
+                    'dates': output_timestamp,
+                    'times':output_time,
+                    'shorelines': output_vegline_latlon,
+                    'waterlines':output_shoreline_latlon,
+                    'filename': output_filename,
+                    'cloud_cover': output_cloudcover,
+                    'idx': output_idxkeep,
+                    'vthreshold': output_t_ndvi,
+                    'wthreshold': output_t_ndwi
+                    }
         
-
-        dates_sat = []
-        for i in range(len(output_timestamp)):
-            dates_sat_str = output_timestamp[i] +' '+output_time[i]
-            dates_sat.append(datetime.strptime(dates_sat_str, '%Y-%m-%d %H:%M:%S.%f'))
+            output_proj[satname] = {
+                    'dates': output_timestamp,
+                    'times':output_time,
+                    'shorelines': output_vegline_proj,
+                    'waterlines':output_shoreline_proj,
+                    'filename': output_filename,
+                    'cloud_cover': output_cloudcover,
+                    'idx': output_idxkeep,
+                    'vthreshold': output_t_ndvi,
+                    'wthreshold': output_t_ndwi
+                    }
         
-        output_waterelev = Toolbox.GetWaterElevs(settings, dates_sat)
-        output[satname]['tideelev'] = output_waterelev
-        output_latlon[satname]['tideelev'] = output_waterelev
-        output_proj[satname]['tideelev'] = output_waterelev
+
+            dates_sat = []
+            for i in range(len(output_timestamp)):
+                dates_sat_str = output_timestamp[i] +' '+output_time[i]
+                dates_sat.append(datetime.strptime(dates_sat_str, '%Y-%m-%d %H:%M:%S.%f'))
         
+            output_waterelev = Toolbox.GetWaterElevs(settings, dates_sat)
+            output[satname]['tideelev'] = output_waterelev
+            output_latlon[satname]['tideelev'] = output_waterelev
+            output_proj[satname]['tideelev'] = output_waterelev
+    finally:
+        # wait for any quicklook GeoTIFFs still being written (also if an image fails,
+        # so the files already queued aren't left half written)
+        if writer is not None:
+            writer.Close()
+    
     # change the format to have one list sorted by date with all the veglines (easier to use)
     output = Toolbox.merge_output(output)
     output_latlon = Toolbox.merge_output(output_latlon)
@@ -1141,7 +1164,9 @@ def find_wl_contours2_old(im_ms, im_labels, cloud_mask, buffer_size, im_ref_buff
 def create_shoreline_buffer(im_shape, georef, image_epsg, pixel_size, settings, epsg):
     """
     Creates a buffer around the reference shoreline. The size of the buffer is 
-    given by settings['max_dist_ref'].
+    given by settings['max_dist_ref']. The buffer is made with a distance 
+    transform and kept for reuse by all images on the same grid (see 
+    Toolbox.BufferMaskGet()).
 
     KV WRL 2018
 
@@ -1169,33 +1194,31 @@ def create_shoreline_buffer(im_shape, georef, image_epsg, pixel_size, settings,
         binary image, True where the buffer is, False otherwise
 
     """
-    #initialise the image buffer
-    im_buffer = np.ones(im_shape).astype(bool)
-
     # convert reference shoreline to pixel coordinates
     ref_sl = settings['reference_shoreline'][:,:-1]
-
-    #ref_sl_conv = Toolbox.convert_epsg(ref_sl, epsg, image_epsg)
-    ref_sl_pix = Toolbox.convert_world2pix(ref_sl, georef)
-
-    ref_sl_pix_rounded = np.round(ref_sl_pix).astype(int)
-    # make sure that the pixel coordinates of the reference shoreline are inside the image
-    idx_row = np.logical_and(ref_sl_pix_rounded[:,0] > 0, ref_sl_pix_rounded[:,0] < im_shape[1])
-    idx_col = np.logical_and(ref_sl_pix_rounded[:,1] > 0, ref_sl_pix_rounded[:,1] < im_shape[0])
-    idx_inside = np.logical_and(idx_row, idx_col)
-
-    ref_sl_pix_rounded = ref_sl_pix_rounded[idx_inside,:]
-
-    # create binary image of the reference shoreline (1 where the shoreline is 0 otherwise)
-    im_binary = np.zeros(im_shape)
-    for j in range(len(ref_sl_pix_rounded)):
-        im_binary[ref_sl_pix_rounded[j,1], ref_sl_pix_rounded[j,0]] = 1
-    im_binary = im_binary.astype(bool)
-
-    # dilate the binary image to create a buffer around the reference shoreline
     max_dist_ref_pixels = np.ceil(settings['max_dist_ref']/pixel_size)
-    se = morphology.disk(max_dist_ref_pixels)
-    im_buffer = morphology.binary_dilation(im_binary, se)
+    
+    def compute():
+        #ref_sl_conv = Toolbox.convert_epsg(ref_sl, epsg, image_epsg)
+        ref_sl_pix = Toolbox.convert_world2pix(ref_sl, georef)
+    
+        ref_sl_pix_rounded = np.round(ref_sl_pix).astype(int)
+        # make sure that the pixel coordinates of the reference shoreline are inside the image
+        idx_row = np.logical_and(ref_sl_pix_rounded[:,0] > 0, ref_sl_pix_rounded[:,0] < im_shape[1])
+        idx_col = np.logical_and(ref_sl_pix_rounded[:,1] > 0, ref_sl_pix_rounded[:,1] < im_shape[0])
+        idx_inside = np.logical_and(idx_row, idx_col)
+    
+        ref_sl_pix_rounded = ref_sl_pix_rounded[idx_inside,:]
+    
+        # create binary image of the reference shoreline (True where the shoreline is)
+        im_binary = np.zeros(im_shape, dtype=bool)
+        im_binary[ref_sl_pix_rounded[:,1], ref_sl_pix_rounded[:,0]] = True
+        
+        return Toolbox.BufferBinary(im_binary, max_dist_ref_pixels)
+    
+    # the buffer is the same for every image on the same grid, so it is only made once
+    key = ('points', tuple(map(float, georef)), tuple(im_shape), float(max_dist_ref_pixels), Toolbox.ArrayHash(ref_sl))
+    im_buffer = Toolbox.BufferMaskGet(key, compute, settings)
     
     return im_buffer
 
@@ -1203,6 +1226,7 @@ def create_shoreline_buffer(im_shape, georef, image_epsg, pixel_size, settings,
 def BufferShoreline(settings,refline,georef,cloud_mask):
     """
     Buffer reference line and utilise geopandas to generate boolean mask of where shoreline swath is.
+    The mask is made once per image grid and reused (see Toolbox.BufferMaskGet()).
     FM 2022
 
     Parameters
@@ -1220,17 +1244,27 @@ def BufferShoreline(settings,refline,georef,cloud_mask):
         Array with same dimensions as sat image, with True where buffered reference shoreline exists.
 
     """
-    if type(refline) == np.ndarray:
-        refGS = Toolbox.ArrtoGS(refline, georef)
-    else: # if refline is read in as shapefile
-        refGS = gpd.GeoSeries(refline['geometry'])
-    
     buffDist = settings['max_dist_ref']/georef[1] # convert from metres to pixels using georef cell size
-    refLSBuffer = refGS.buffer(buffDist)
-    refShapes = ((geom,value) for geom, value in zip(refLSBuffer.geometry, np.ones(len(refLSBuffer))))
-    im_buffer_float = features.rasterize(refShapes,out_shape=cloud_mask.shape)
-    # convert to bool
-    im_buffer = im_buffer_float > 0 
+    
+    def compute():
+        if type(refline) == np.ndarray:
+            refGS = Toolbox.ArrtoGS(refline, georef)
+        else: # if refline is read in as shapefile
+            refGS = gpd.GeoSeries(refline['geometry'])
+        
+        refLSBuffer = refGS.buffer(buffDist)
+        refShapes = ((geom,value) for geom, value in zip(refLSBuffer.geometry, np.ones(len(refLSBuffer))))
+        im_buffer_float = features.rasterize(refShapes,out_shape=cloud_mask.shape)
+        # convert to bool
+        return im_buffer_float > 0 
+    
+    # the buffer is the same for every image on the same grid, so it is only made once
+    if type(refline) == np.ndarray:
+        refhash = Toolbox.ArrayHash(refline[:,:2])
+    else:
+        refhash = hashlib.sha1(b''.join(geom.wkb for geom in refline['geometry'])).hexdigest()[:16]
+    key = ('line', tuple(map(float, georef)), cloud_mask.shape, float(buffDist), refhash)
+    im_buffer = Toolbox.BufferMaskGet(key, compute, settings)
     
     return im_buffer
 
@@ -2148,98 +2182,96 @@ def extract_veglines_year(settings, metadata, sat_list, polygon):#(metadata, set
         buffer_size_pixels = np.ceil(settings['buffer_size']/pixel_size)
         min_beach_area_pixels = np.ceil(settings['min_beach_area']/pixel_size**2)
 
-        # loop through the images
-        for i in range(len(years)):
-
-            print('\r%s:   %d%%' % (satname,int(((i+1)/len(filenames))*100)), end='')
-
-            # preprocess image (cloud mask + pansharpening/downsampling)
-            fn = int(i)
-            im_ms, georef, cloud_mask, im_extra, im_QA, im_nodata = Image_Processing.preprocess_cloudfreeyearcomposite(fn, satname, settings, polygon)
-
-            if im_ms is None:
-                continue
-            
-            if cloud_mask == []:
-                continue
+        # interactive detection has to run one year at a time in this process;
+        # otherwise each year's composite is classified in a worker pool
+        # (processes only if asked for, as spawned workers re-run unguarded driver scripts)
+        interactive = settings['adjust_detection'] or settings['check_detection'] or settings['save_figure']
+        if 'year_workers' in settings.keys():
+            n_workers = settings['year_workers']
+        else:
+            n_workers = 4
+        
+        year_results = dict([])
+        futures = dict([])
+        if interactive:
+            pool = None
+        elif 'year_processes' in settings.keys() and settings['year_processes']:
+            pool = ProcessPoolExecutor(max_workers=n_workers)
+        else:
+            pool = ThreadPoolExecutor(max_workers=n_workers)
+        # composites are requested concurrently and handled as they arrive 
+        # (in year order when interactive, so years are shown in order)
+        composites = year_composites(satname, settings, polygon, n_workers, ordered=interactive)
+        try:
+            for n, (i, composite) in enumerate(composites):
+
+                print('\r%s:   %d%%' % (satname,int(((n+1)/len(years))*100)), end='')
+
+                # get image spatial reference system (epsg code) from metadata dict
+                image_epsg = settings['output_epsg']
+                image_epsg = metadata[satname]['epsg'][i]
             
-            # get image spatial reference system (epsg code) from metadata dict
-            image_epsg = settings['output_epsg']
-            image_epsg = metadata[satname]['epsg'][i]
-            # compute cloud_cover percentage (with no data pixels)
-            cloud_cover_combined = np.divide(sum(sum(cloud_mask.astype(int))),
-                                    (cloud_mask.shape[0]*cloud_mask.shape[1]))
-            if cloud_cover_combined > 0.95: # if 99% of cloudy pixels in image skip
-                continue
-            # remove no data pixels from the cloud mask 
-            # (for example L7 bands of no data should not be accounted for)
-            cloud_mask_adv = np.logical_xor(cloud_mask, im_nodata) 
-            # compute updated cloud cover percentage (without no data pixels)
-            cloud_cover = np.divide(sum(sum(cloud_mask_adv.astype(int))),
-                                    (sum(sum((~im_nodata).astype(int)))))
-            # skip image if cloud cover is above user-defined threshold
-            if cloud_cover > settings['cloud_thresh']:
-                continue
-
-            # calculate a buffer around the reference shoreline (if any has been digitised)
-            im_ref_buffer = create_shoreline_buffer(cloud_mask.shape, georef, image_epsg,
-                                                    pixel_size, settings, image_epsg)
-
-            # classify image in 4 classes (sand, whitewater, water, other) with NN classifier
-            im_classif, im_labels = classify_image_NN(im_ms, im_extra, cloud_mask,
-                                    min_beach_area_pixels, clf)
+                if not interactive:
+                    futures[i] = pool.submit(classify_year_composite, composite, image_epsg, settings, 
+                                             clf, pixel_size, min_beach_area_pixels)
+                    continue
             
-            # if adjust_detection is True, let the user adjust the detected shoreline
-            if settings['adjust_detection']:
-                date = metadata[satname]['dates'][i]
-                skip_image, shoreline, shoreline_latlon, shoreline_proj, t_ndvi = adjust_detection(im_ms, cloud_mask, im_labels,
-                                                                  im_ref_buffer, image_epsg, georef,
-                                                                  settings, date, satname, buffer_size_pixels, image_epsg)
-                # if the user decides to skip the image, continue and do not save the mapped shoreline
-                if skip_image:
+                result = classify_year_composite(composite, image_epsg, settings, clf, pixel_size, 
+                                                 min_beach_area_pixels, keep_images=True)
+                if result is None:
                     continue
+                im_ms, cloud_mask, im_labels, im_ref_buffer, georef = [result[key] for key in 
+                                                                       ['im_ms','cloud_mask','im_labels','im_ref_buffer','georef']]
+                date = metadata[satname]['dates'][i]
+            
+                # if adjust_detection is True, let the user adjust the detected shoreline
+                if settings['adjust_detection']:
+                    skip_image, shoreline, shoreline_latlon, shoreline_proj, t_ndvi = adjust_detection(im_ms, cloud_mask, im_labels,
+                                                                      im_ref_buffer, image_epsg, georef,
+                                                                      settings, date, satname, buffer_size_pixels, image_epsg)
+                    # if the user decides to skip the image, continue and do not save the mapped shoreline
+                    if skip_image:
+                        continue
+                    result.update({'shoreline':shoreline, 'shoreline_latlon':shoreline_latlon,
+                                   'shoreline_proj':shoreline_proj, 't_ndvi':t_ndvi})
                 
-            # otherwise map the contours automatically with one of the two following functions:
-            # if there are pixels in the 'sand' class --> use find_wl_contours2 (enhanced)
-            # otherwise use find_wl_contours2 (traditional)
-            else:
-                im_ndvi = Toolbox.nd_index(im_ms[:,:,3], im_ms[:,:,2], cloud_mask)
-                
-                if settings['inputs']['sitename'] == 'StAndrewsWest' or settings['inputs']['sitename'] == 'StAndrewsEast':
-                    print('(using weighted peaks for contouring)')
-                    contours_ndvi, t_ndvi = FindShoreContours_WP(im_ndvi, im_labels, cloud_mask, im_ref_buffer)
-                    # contours_ndvi, t_ndvi = FindShoreContours_Enhc(im_ndvi, im_labels, cloud_mask, im_ref_buffer)
                 else:
-                    # contours_ndvi, t_ndvi = FindShoreContours_Enhc(im_ndvi, im_labels, cloud_mask, im_ref_buffer)
-                    contours_ndvi, t_ndvi = FindShoreContours_WP(im_ndvi, im_labels, cloud_mask, im_ref_buffer)
-
-                # process the water contours into a shoreline
-                shoreline, shoreline_latlon, shoreline_proj = ProcessShoreline(contours_ndvi, cloud_mask, georef, image_epsg, settings)
-                
-
-                if settings['check_detection'] or settings['save_figure']:
-                    date = metadata[satname]['dates'][i]
                     if not settings['check_detection']:
                         plt.ioff() # turning interactive plotting off
-                    skip_image = show_detection(im_ms, cloud_mask, im_labels, im_ref_buffer, shoreline,
-                                                image_epsg, georef, settings, date, satname,contours_ndvi, t_ndvi)
+                    skip_image = show_detection(im_ms, cloud_mask, im_labels, im_ref_buffer, result['shoreline'],
+                                                image_epsg, georef, settings, date, satname, result['contours_ndvi'], result['t_ndvi'])
                     # if the user decides to skip the image, continue and do not save the mapped shoreline
                     if skip_image:
                         continue
-            
-            # if max(scipy.spatial.distance.directed_hausdorff(ref_line, shoreline, seed=0))>settings['hausdorff_threshold']:
-            #     continue
-         
-            # append to output variables
+                year_results[i] = result
+        
+            for i, future in futures.items():
+                year_results[i] = future.result()
+        finally:
+            # on an error, don't wait for the years that haven't started
+            composites.close()
+            if pool is not None:
+                for future in futures.values():
+                    future.cancel()
+                pool.shutdown()
+        
+        # if max(scipy.spatial.distance.directed_hausdorff(ref_line, shoreline, seed=0))>settings['hausdorff_threshold']:
+        #     continue
+        
+        # append to output variables (in year order)
+        for i in sorted(year_results.keys()):
+            result = year_results[i]
+            if result is None:
+                continue
             output_timestamp.append(metadata[satname]['dates'][i])
-            output_shoreline.append(shoreline)
-            output_shoreline_latlon.append(shoreline_latlon)
-            output_shoreline_proj.append(shoreline_proj)
+            output_shoreline.append(result['shoreline'])
+            output_shoreline_latlon.append(result['shoreline_latlon'])
+            output_shoreline_proj.append(result['shoreline_proj'])
             output_filename.append(filenames[i])
-            output_cloudcover.append(cloud_cover)
+            output_cloudcover.append(result['cloud_cover'])
             output_geoaccuracy.append(metadata[satname]['acc_georef'][i])
             output_idxkeep.append(i)
-            output_t_ndvi.append(t_ndvi)
+            output_t_ndvi.append(result['t_ndvi'])
 
         # create dictionnary of output
         output[satname] = {
@@ -2290,4 +2322,139 @@ def extract_veglines_year(settings, metadata, sat_list, polygon):#(metadata, set
     with open(os.path.join(filepath, sitename + '_output_proj.pkl'), 'wb') as f:
         pickle.dump(output_proj, f)
         
-    return output, output_latlon, output_proj
\ No newline at end of file
+    return output, output_latlon, output_proj
+
+
+def year_composites(satname, settings, polygon, n_workers=4, ordered=False):
+    """
+    Request the cloud-free composite for each year in settings['year_list']
+    concurrently, yielding each one as soon as it is ready (so classification
+    can start without waiting for every year), or in year order if ordered 
+    is True. Composites come from the composite store where possible (see 
+    Image_Processing.preprocess_cloudfreeyearcomposite_cached()).
+
+    Parameters
+    ----------
+    satname : str
+        Name of satellite platform (e.g. 'L8').
+    settings : dict
+        Veg edge extraction settings.
+    polygon : list
+        Coordinates of the site's bounding polygon.
+    n_workers : int, optional
+        Number of composites requested at once. The default is 4.
+    ordered : bool, optional
+        If True, yield the composites in the order of settings['year_list'] 
+        (still requested concurrently). The default is False.
+
+    Yields
+    ------
+    i : int
+        Index of the year in settings['year_list'].
+    composite : tuple
+        Outputs of preprocess_cloudfreeyearcomposite().
+
+    """
+    with ThreadPoolExecutor(max_workers=n_workers) as executor:
+        futures = dict([(executor.submit(Image_Processing.preprocess_cloudfreeyearcomposite_cached, 
+                                         i, satname, settings, polygon), i) 
+                        for i in range(len(settings['year_list']))])
+        try:
+            for future in (futures if ordered else as_completed(futures)):
+                yield futures[future], future.result()
+        finally:
+            # if stopped early, don't request the years that haven't started
+            for future in futures:
+                future.cancel()
+
+
+def classify_year_composite(composite, image_epsg, settings, clf, pixel_size, min_beach_area_pixels, keep_images=False):
+    """
+    Classify a year's composite and extract the veg edge from it. Kept at 
+    module level (and free of plotting) so it can run in a worker pool.
+
+    Parameters
+    ----------
+    composite : tuple
+        Outputs of preprocess_cloudfreeyearcomposite().
+    image_epsg : int
+        EPSG code of the composite.
+    settings : dict
+        Veg edge extraction settings.
+    clf : classifier
+        Trained sklearn classifier.
+    pixel_size : float
+        Pixel size of the composite (in metres).
+    min_beach_area_pixels : float
+        Minimum area (in pixels) of objects kept in the classification.
+    keep_images : bool, optional
+        If True, also return the arrays needed to display or adjust the 
+        detection. The default is False.
+
+    Returns
+    -------
+    result : dict or None
+        Veg edge (image, latlon and projected coords), NDVI threshold and 
+        cloud cover; None if the composite is missing or too cloudy.
+
+    """
+    im_ms, georef, cloud_mask, im_extra, im_QA, im_nodata = composite
+    
+    if im_ms is None:
+        return None
+    
+    if isinstance(cloud_mask, list) and len(cloud_mask) == 0:
+        return None
+    
+    # compute cloud_cover percentage (with no data pixels)
+    cloud_cover_combined = np.divide(sum(sum(cloud_mask.astype(int))),
+                            (cloud_mask.shape[0]*cloud_mask.shape[1]))
+    if cloud_cover_combined > 0.95: # if 99% of cloudy pixels in image skip
+        return None
+    # remove no data pixels from the cloud mask 
+    # (for example L7 bands of no data should not be accounted for)
+    cloud_mask_adv = np.logical_xor(cloud_mask, im_nodata) 
+    # compute updated cloud cover percentage (without no data pixels)
+    cloud_cover = np.divide(sum(sum(cloud_mask_adv.astype(int))),
+                            (sum(sum((~im_nodata).astype(int)))))
+    # skip image if cloud cover is above user-defined threshold
+    if cloud_cover > settings['cloud_thresh']:
+        return None
+
+    # calculate a buffer around the reference shoreline (if any has been digitised)
+    im_ref_buffer = create_shoreline_buffer(cloud_mask.shape, georef, image_epsg,
+                                            pixel_size, settings, image_epsg)
+
+    # classify image in 4 classes (sand, whitewater, water, other) with NN classifier
+    im_classif, im_labels = classify_image_NN(im_ms, im_extra, cloud_mask,
+                            min_beach_area_pixels, clf)
+    
+    result = {'cloud_cover':cloud_cover}
+    if keep_images:
+        result.update({'im_ms':im_ms, 'cloud_mask':cloud_mask, 'im_labels':im_labels, 
+                       'im_ref_buffer':im_ref_buffer, 'georef':georef})
+    
+    # veg edge is drawn by the user instead if adjust_detection is True
+    if settings['adjust_detection']:
+        return result
+    
+    # otherwise map the contours automatically
+    im_ndvi = Toolbox.nd_index(im_ms[:,:,3], im_ms[:,:,2], cloud_mask)
+    
+    if settings['inputs']['sitename'] == 'StAndrewsWest' or settings['inputs']['sitename'] == 'StAndrewsEast':
+        print('(using weighted peaks for contouring)')
+        contours_ndvi, t_ndvi = FindShoreContours_WP(im_ndvi, im_labels, cloud_mask, im_ref_buffer)
+        # contours_ndvi, t_ndvi = FindShoreContours_Enhc(im_ndvi, im_labels, cloud_mask, im_ref_buffer)
+    else:
+        # contours_ndvi, t_ndvi = FindShoreContours_Enhc(im_ndvi, im_labels, cloud_mask, im_ref_buffer)
+        contours_ndvi, t_ndvi = FindShoreContours_WP(im_ndvi, im_labels, cloud_mask, im_ref_buffer)
+
+    # process the water contours into a shoreline
+    shoreline, shoreline_latlon, shoreline_proj = ProcessShoreline(contours_ndvi, cloud_mask, georef, image_epsg, settings)
+    
+    result.update({'shoreline':shoreline, 'shoreline_latlon':shoreline_latlon, 
+                   'shoreline_proj':shoreline_proj, 't_ndvi':t_ndvi})
+    if keep_images:
+        result['contours_ndvi'] = contours_ndvi
+    
+    return result
\ No newline at end of file
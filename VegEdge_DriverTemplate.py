@@ -78,7 +78,7 @@ if os.path.isdir(direc) is False:
 #%% Image Retrieval
 
 # before downloading the images, check how many images are available for your inputs
-Download.check_images_available(inputs)
+Download.check_images_available(inputs, return_images=False)
 
 
 #%% Image Download
@@ -103,6 +103,12 @@ settings = {
     'check_detection': True,    # if True, shows each shoreline detection to the user for validation
     'adjust_detection': False,  # if True, allows user to adjust the postion of each shoreline by changing the threhold
     'save_figure': True,        # if True, saves a figure showing the mapped shoreline for each image
+    'TZ_stack': False,          # if True, saves transition zone rasters as one multi-band stack per satellite
+    'quicklook_tifs': 'save',   # RGB/NDVI/classified GeoTIFFs: 'save', 'defer' (background writer), 'downsample' or 'skip'
+    'preprocess_cache': False,  # if True, stores preprocessed images so reruns skip downloading/pansharpening
+    'composite_cache': False,   # if True, stores each year's cloud-free composite so reruns skip rebuilding it
+    'year_workers': 4,          # number of yearly composites requested/classified at once
+    'buffer_cache': False,      # if True, also stores reference shoreline buffer masks on disk for later runs
     # [ONLY FOR ADVANCED USERS] shoreline detection parameters:
     'min_beach_area': 200,     # minimum area (in metres^2) for an object to be labelled as a beach
     'buffer_size': 250,         # radius (in metres) for buffer around sandy pixels considered in the shoreline detection